@@ -64,6 +64,7 @@ from .dao.library import Song
 from .dao.transcode import find_ffmpeg
 from .dao.filesys.filesys import FileSystem
 from .dao.filesys.s3fs import BotoFileSystemImpl
+from .dao.filesys.transfer import set_chunk_size
 from .dao.db import db_connect, db_init_main
 
 from .framework.application import FlaskApp
@@ -101,10 +102,15 @@ class YueApp(FlaskApp):
             logging.warning("database contains %d tables. expected %d." % (
                 nbTablesActual, nbTablesExpected))
 
+        set_chunk_size(config.filesystem.chunk_size)
+
         if config.aws.endpoint is not None:
             aws = config.aws
             s3fs = BotoFileSystemImpl(aws.endpoint, aws.region,
-                aws.access_key, aws.secret_key)
+                aws.access_key, aws.secret_key,
+                part_size=aws.part_size,
+                multipart_threshold=aws.multipart_threshold,
+                max_concurrency=aws.max_concurrency)
             FileSystem.register(BotoFileSystemImpl.scheme, s3fs)
 
         self.user_service = UserService(config, self.db, self.db.tables)
@@ -406,6 +412,7 @@ def getApp(config_dir, profile, debugLogging=True):
     logging.error("root logger support: ERROR")
 
     app = YueApp(cfg)
+    app.filesys_service.startPreviewWorkers()
 
     if not debugLogging:
         routes = app.list_routes()
@@ -97,7 +97,9 @@ from yueserver.framework2.server_core import readline, Namespace, \
     SocketFile, CaseInsensitiveDict, UploadChunkedFile, UploadMultiPartFile, \
     Response, Router
 
-from yueserver.framework2.server import Site
+from yueserver.framework2.server import Site, Protocol
+from yueserver.framework2.server_async import AsyncSite
+from yueserver.framework2.compression import ResponseCompressor
 from yueserver.framework2.openapi import Resource, \
     get, put, post, delete, \
     header, param, body, timed, returns, \
@@ -111,6 +113,7 @@ from .config import Config
 from .dao.db import db_connect, db_init_main
 from .dao.filesys.filesys import FileSystem
 from .dao.filesys.s3fs import BotoFileSystemImpl
+from .dao.filesys.transfer import set_chunk_size
 
 
 from .framework2.client import ApplicationClient, AuthenticatedRestClient
@@ -276,6 +279,8 @@ class Application(object):
             logging.warning("database contains %d tables. expected %d." % (
                 nbTablesActual, nbTablesExpected))
 
+        set_chunk_size(cfg.filesystem.chunk_size)
+
         if cfg.aws.endpoint is not None:
 
             logging.getLogger("botocore").setLevel(logging.WARNING)
@@ -289,11 +294,15 @@ class Application(object):
                 aws.endpoint,
                 aws.region,
                 aws.access_key,
-                aws.secret_key)
+                aws.secret_key,
+                part_size=aws.part_size,
+                multipart_threshold=aws.multipart_threshold,
+                max_concurrency=aws.max_concurrency)
             FileSystem.register(BotoFileSystemImpl.scheme, s3fs)
 
         user_service = UserService(self.cfg, self.db, self.db.tables)
         filesys_service = FileSysService(self.cfg, self.db, self.db.tables)
+        filesys_service.startPreviewWorkers()
         transcode_service = TranscodeService(self.cfg, self.db, self.db.tables)
         audio_service = AudioService(self.cfg, self.db, self.db.tables)
 
@@ -315,7 +324,20 @@ class Application(object):
 
     def run(self):
 
-        self.site = Site("0.0.0.0")
+        compressor = ResponseCompressor(
+            levels=self.cfg.compression.levels,
+            min_size=self.cfg.compression.min_size,
+            cache_size=self.cfg.compression.cache_size)
+        if self.cfg.http.backend == "asyncio":
+            self.site = AsyncSite("0.0.0.0", Protocol(compressor),
+                workers=self.cfg.http.workers or 16,
+                idle_timeout=self.cfg.http.idle_timeout)
+        else:
+            self.site = Site("0.0.0.0", Protocol(compressor),
+                workers=self.cfg.http.workers,
+                max_per_ip=self.cfg.http.max_connections_per_ip,
+                idle_timeout=self.cfg.http.idle_timeout)
+        self.app_resource.site = self.site
 
         use_ssl = True
         if not os.path.exists(self.cfg.ssl.private_key):
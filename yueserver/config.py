@@ -58,6 +58,10 @@ class AwsConfig(BaseConfig):
     Amazon Web Services Credentials
 
     used for s3 bucket access
+
+    part_size: the size of each part of a multipart upload or download
+    multipart_threshold: files larger than this are uploaded in parts
+    max_concurrency: the number of parts transferred in parallel
     """
     def __init__(self, base):
 
@@ -68,6 +72,81 @@ class AwsConfig(BaseConfig):
         self.secret_key = self.get_key(creds, 'secret_key', default=None)
         self.region = self.get_key(creds, 'region', default=None)
 
+        transfer = self.get_key(base, 'aws', 'transfer', default={})
+
+        self.part_size = self.parse_bytes(self.get_key(transfer, 'part_size', default="8m"))
+        self.multipart_threshold = self.parse_bytes(self.get_key(transfer, 'multipart_threshold', default="8m"))
+        self.max_concurrency = int(self.get_key(transfer, 'max_concurrency', default=4))
+
+class FileSystemConfig(BaseConfig):
+    """
+    File system settings
+
+    chunk_size: the size of the buffer used when copying files
+    dedup: store files with identical contents once per user
+    preview_workers: the number of threads generating previews in the
+        background. when 0, previews are generated while handling a request
+    preview_video_workers: the maximum number of ffmpeg processes used to
+        generate previews of videos
+    preview_scales: the previews generated when a file is uploaded
+    preview_cache_size: the number of bytes used to keep small previews
+        in memory. when 0, previews are always read from storage
+    """
+    def __init__(self, base):
+        self.chunk_size = self.parse_bytes(self.get_key(base, 'filesystem', 'chunk_size', default="256k"))
+        self.dedup = bool(self.get_key(base, 'filesystem', 'dedup', default=False))
+        self.preview_workers = int(self.get_key(base, 'filesystem', 'preview', 'workers', default=2))
+        self.preview_video_workers = int(self.get_key(base, 'filesystem', 'preview', 'video_workers', default=1))
+        self.preview_scales = self.get_key(base, 'filesystem', 'preview', 'scales', default=["thumb"])
+        self.preview_cache_size = self.parse_bytes(self.get_key(base, 'filesystem', 'preview', 'cache_size', default="0"))
+
+class LibraryConfig(BaseConfig):
+    """
+    Music library settings
+
+    index: serve library searches from an in-memory index of each domain
+    summary: serve the domain info from an in-memory summary of each domain
+    queue_cache: keep the song queue for each user in memory
+    """
+    def __init__(self, base):
+        self.index = bool(self.get_key(base, 'library', 'index', default=False))
+        self.summary = bool(self.get_key(base, 'library', 'summary', default=False))
+        self.queue_cache = bool(self.get_key(base, 'library', 'queue_cache', default=False))
+
+class CompressionConfig(BaseConfig):
+    """
+    Response compression settings
+
+    levels: the compression level for each encoding (gzip, br, zstd)
+    min_size: responses smaller than this are not compressed
+    cache_size: the number of bytes used to keep compressed copies
+        of responses which are sent with an ETag or Cache-Control header
+    """
+    def __init__(self, base):
+        self.levels = dict(self.get_key(base, 'compression', 'levels', default={}))
+        self.min_size = self.parse_bytes(self.get_key(base, 'compression', 'min_size', default="1k"))
+        self.cache_size = self.parse_bytes(self.get_key(base, 'compression', 'cache_size', default="16m"))
+
+class HttpConfig(BaseConfig):
+    """
+    HTTP server settings
+
+    backend: "thread" or "asyncio"
+    workers: the number of threads handling requests. when 0, a new
+        thread is started for each connection. the asyncio backend
+        uses 16 threads by default
+    max_connections_per_ip: the maximum number of open connections from
+        a single address, 0 for no limit. only used when workers > 0
+    idle_timeout: the number of seconds before an idle keep-alive
+        connection is closed, and the time allowed to receive the
+        headers of a request
+    """
+    def __init__(self, base):
+        self.backend = self.get_key(base, 'http', 'backend', default="thread")
+        self.workers = int(self.get_key(base, 'http', 'workers', default=0))
+        self.max_connections_per_ip = int(self.get_key(base, 'http', 'max_connections_per_ip', default=32))
+        self.idle_timeout = float(self.get_key(base, 'http', 'idle_timeout', default=30))
+
 class Config(ApplicationBaseConfig):
     """base class for application configurations"""
 
@@ -82,6 +161,10 @@ class Config(ApplicationBaseConfig):
         self.database = DatabaseConfig(base)
         self.transcode = TranscodeConfig(base)
         self.aws = AwsConfig(base)
+        self.filesystem = FileSystemConfig(base)
+        self.library = LibraryConfig(base)
+        self.compression = CompressionConfig(base)
+        self.http = HttpConfig(base)
 
     @staticmethod
     def null():
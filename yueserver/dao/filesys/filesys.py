@@ -24,6 +24,7 @@ from ..util import epoch_time
 from stat import S_ISDIR, S_ISREG, S_IRGRP, S_ISLNK
 
 from .util import sh_escape, AbstractFileSystem, FileRecord
+from .transfer import copyfileobj
 
 class FileSystemError(Exception):
     pass
@@ -46,24 +47,19 @@ class LocalFileSystemImpl(AbstractFileSystem):
         return open(path, mode)
 
     def upload(self, reader, path):
-        xfer_bytes = 0
         with self.open(path, "wb") as writer:
-            buf = reader.read(2048)
-            while buf:
-                writer.write(buf)
-                xfer_bytes += len(buf)
-                buf = reader.read(2048)
-        return xfer_bytes
-
-    def download(self, path, writer):
-        xfer_bytes = 0
+            return copyfileobj(reader, writer)
+
+    def download(self, path, writer, offset=0, length=None):
+        """ write the contents of a file to writer
+
+        offset: the first byte to write
+        length: if given, write at most length bytes
+        """
         with self.open(path, "rb") as reader:
-            buf = reader.read(2048)
-            while buf:
-                writer.write(buf)
-                xfer_bytes += len(buf)
-                buf = reader.read(2048)
-        return xfer_bytes
+            if offset:
+                reader.seek(offset)
+            return copyfileobj(reader, writer, length)
 
     def listdir(self, path):
         return os.listdir(path)
@@ -196,24 +192,19 @@ class MemoryFileSystemImpl(AbstractFileSystem):
         raise ValueError("Invalid mode: %s" % mode)
 
     def upload(self, reader, path):
-        xfer_bytes = 0
         with self.open(path, "wb") as writer:
-            buf = reader.read(2048)
-            while buf:
-                writer.write(buf)
-                xfer_bytes += len(buf)
-                buf = reader.read(2048)
-        return xfer_bytes
-
-    def download(self, path, writer):
-        xfer_bytes = 0
+            return copyfileobj(reader, writer)
+
+    def download(self, path, writer, offset=0, length=None):
+        """ write the contents of a file to writer
+
+        offset: the first byte to write
+        length: if given, write at most length bytes
+        """
         with self.open(path, "rb") as reader:
-            buf = reader.read(2048)
-            while buf:
-                writer.write(buf)
-                xfer_bytes += len(buf)
-                buf = reader.read(2048)
-        return xfer_bytes
+            if offset:
+                reader.seek(offset)
+            return copyfileobj(reader, writer, length)
 
     def _scandir_impl(self, path):
         visited = set()
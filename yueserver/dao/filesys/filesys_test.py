@@ -1,9 +1,11 @@
 
+import os
 import unittest
 import json
 import io
+import tempfile
 
-from .util import sh_escape
+from .util import sh_escape, RangeWriter, RangeComplete
 from .filesys import FileSystem, sh_escape
 from .s3fs import S3FileSystemImpl
 
@@ -109,6 +111,47 @@ class FileSystemTestCase(unittest.TestCase):
         for rec in fs.scandir(parent):
             self.assertEqual(rec.size, len(msg))
 
+    def test_download_range(self):
+
+        fs = FileSystem()
+
+        msg = bytes(range(256)) * 1024
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for path in ["mem:///range/range.bin", os.path.join(tmp, "range.bin")]:
+
+                with fs.open(path, "wb") as wb:
+                    wb.write(msg)
+
+                writer = io.BytesIO()
+                self.assertEqual(fs.download(path, writer), len(msg))
+                self.assertEqual(writer.getvalue(), msg)
+
+                writer = io.BytesIO()
+                self.assertEqual(fs.download(path, writer, 1000, 70000), 70000)
+                self.assertEqual(writer.getvalue(), msg[1000:71000])
+
+                writer = io.BytesIO()
+                fs.download(path, writer, len(msg) - 10)
+                self.assertEqual(writer.getvalue(), msg[-10:])
+
+                fs.remove(path)
+
+    def test_range_writer(self):
+
+        msg = bytes(range(256)) * 16
+
+        for offset, length in [(0, None), (100, None), (100, 1000), (0, 1)]:
+            writer = io.BytesIO()
+            rw = RangeWriter(writer, offset, length)
+            try:
+                for i in range(0, len(msg), 300):
+                    rw.write(msg[i:i + 300])
+            except RangeComplete:
+                pass
+            end = None if length is None else offset + length
+            self.assertEqual(writer.getvalue(), msg[offset:end])
+
     # the following s3 tests check that the parsing of the
     # aws cli tool is done correctly. no attempt is made
     # to connect to an actual s3 bucket
@@ -5,6 +5,8 @@ import sys
 import datetime
 import time
 from threading import Thread, Lock
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from ..util import epoch_time
 boto3 = None
@@ -19,6 +21,7 @@ botocore = None
 
 from .util import sh_escape, AbstractFileSystem, _ProcFile, \
     BytesFIFO, BytesFIFOWriter, BytesFIFOReader, FileRecord
+from .transfer import copyfileobj, statistics
 
 class S3FileSystemImpl(AbstractFileSystem):
     """docstring for S3FileSystemImpl"""
@@ -119,40 +122,44 @@ class S3FileSystemImpl(AbstractFileSystem):
 
 class BotoReaderThread(Thread):
     """docstring for BotoReaderThread"""
-    def __init__(self, fifo, bucket, key):
+    def __init__(self, fifo, fs, path):
         super(BotoReaderThread, self).__init__()
-        self.bucket = bucket
-        self.key = key
+        self.fs = fs
+        self.path = path
         self.fifo = fifo
 
     def run(self):
         writer = BytesFIFOWriter(self.fifo)
         try:
-            self.bucket.download_fileobj(self.key, writer)
+            self.fs.download(self.path, writer)
+        except BrokenPipeError:
+            # the file was closed before it was read completely
+            pass
         finally:
             writer.close()
 
 class BotoReaderFile(object):
     """docstring for BotoReaderFile"""
-    def __init__(self, bucket, key):
+    def __init__(self, fs, path):
         super(BotoReaderFile, self).__init__()
 
-        if not key:
-            raise Exception("%s: invalid key" % bucket)
-
         self.lock = Lock()
         self.fifo = BytesFIFO(lock=self.lock)
         self.reader = BytesFIFOReader(self.fifo)
 
-        self.thread = BotoReaderThread(self.fifo, bucket, key)
+        self.thread = BotoReaderThread(self.fifo, fs, path)
         self.thread.start()
 
     def read(self, size=-1):
         return self.reader.read(size)
 
+    def readinto(self, b):
+        return self.reader.readinto(b)
+
     def close(self):
-        self.thread.join()
+        # close the reader first to unblock a download waiting on a full fifo
         self.reader.close()
+        self.thread.join()
 
     def flush(self):
         self.reader.flush()
@@ -165,33 +172,30 @@ class BotoReaderFile(object):
 
 class BotoWriterThread(Thread):
     """docstring for BotoWriterThread"""
-    def __init__(self, fifo, bucket, key):
+    def __init__(self, fifo, fs, path):
         super(BotoWriterThread, self).__init__()
-        self.bucket = bucket
-        self.key = key
+        self.fs = fs
+        self.path = path
         self.fifo = fifo
 
     def run(self):
         reader = BytesFIFOReader(self.fifo)
         try:
-            self.bucket.upload_fileobj(reader, self.key)
+            self.fs.upload(reader, self.path)
         finally:
             reader.close()
 
 class BotoWriterFile(object):
     """docstring for BotoWriterFile"""
 
-    def __init__(self, bucket, key):
+    def __init__(self, fs, path):
         super(BotoWriterFile, self).__init__()
 
-        if not key:
-            raise Exception("%s: invalid key" % bucket)
-
         self.lock = Lock()
         self.fifo = BytesFIFO(lock=self.lock)
         self.writer = BytesFIFOWriter(self.fifo)
 
-        self.thread = BotoWriterThread(self.fifo, bucket, key)
+        self.thread = BotoWriterThread(self.fifo, fs, path)
         self.thread.start()
 
     def write(self, data):
@@ -211,10 +215,22 @@ class BotoWriterFile(object):
         self.close()
 
 class BotoFileSystemImpl(AbstractFileSystem):
-    """docstring for S3FileSystemImpl"""
+    """docstring for S3FileSystemImpl
+
+    part_size: the size of each part of a multipart upload, and of each
+        ranged GET used when downloading
+    multipart_threshold: files larger than this are uploaded in parts
+    max_concurrency: the number of parts transferred in parallel,
+        for a single upload or download
+    """
     scheme = "s3://"
 
-    def __init__(self, endpoint_url, region, access_key, secret_key):
+    # the number of recent transfers kept for metrics
+    TRANSFER_HISTORY = 100
+
+    def __init__(self, endpoint_url, region, access_key, secret_key,
+      part_size=8 * 1024 * 1024, multipart_threshold=8 * 1024 * 1024,
+      max_concurrency=4):
         super(BotoFileSystemImpl, self).__init__()
 
         global boto3
@@ -246,6 +262,46 @@ class BotoFileSystemImpl(AbstractFileSystem):
             aws_access_key_id=access_key,
             aws_secret_access_key=secret_key)
 
+        self._part_size = part_size
+        self._max_concurrency = max(1, max_concurrency)
+        self._transfer_config = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=part_size,
+            max_concurrency=self._max_concurrency,
+            num_download_attempts=5,
+        )
+
+        # ranged GETs for all downloads share one pool
+        self._executor = ThreadPoolExecutor(
+            max_workers=self._max_concurrency,
+            thread_name_prefix="s3-download")
+
+        self._transfers_lock = Lock()
+        self._transfers = deque(maxlen=self.TRANSFER_HISTORY)
+
+    def _record_transfer(self, direction, path, nbytes, parts, elapsed):
+        """ update the metrics for a completed upload or download """
+
+        with self._transfers_lock:
+            self._statistics[direction + "_count"] += 1
+            self._statistics[direction + "_bytes"] += nbytes
+            self._statistics[direction + "_parts"] += parts
+            self._transfers.append({
+                "direction": direction,
+                "path": path,
+                "bytes": nbytes,
+                "parts": parts,
+                "seconds": elapsed,
+                "rate": nbytes / elapsed if elapsed > 0 else 0,
+            })
+
+        statistics.record("s3_" + direction, nbytes, elapsed)
+
+    def transfers(self):
+        """ returns metrics for the most recent uploads and downloads """
+        with self._transfers_lock:
+            return list(self._transfers)
+
     def _parse_path(self, path):
         """extract bucket name and key from the path"""
         if not path.startswith(self.scheme):
@@ -308,57 +364,115 @@ class BotoFileSystemImpl(AbstractFileSystem):
             raise Exception(mode)
 
         bucket_name, key = self._parse_path(path)
-        bucket = self.s3.Bucket(bucket_name)
+        if not key:
+            raise Exception("%s: invalid key" % bucket_name)
 
         if 'w' in mode:
-            return BotoWriterFile(bucket, key)
+            return BotoWriterFile(self, path)
         else:
-            return BotoReaderFile(bucket, key)
+            return BotoReaderFile(self, path)
 
     def upload(self, reader, path):
+        """ upload the contents of reader to a key
+
+        files larger than the multipart threshold are uploaded
+        in parts, in parallel
+        """
         bucket_name, key = self._parse_path(path)
         bucket = self.s3.Bucket(bucket_name)
 
-        #config = boto3.s3.transfer.TransferConfig(
-        #    multipart_threshold=4096,
-        #    max_concurrency=1,
-        #    multipart_chunksize=4096,
-        #    num_download_attempts=5,
-        #    max_io_queue=10,
-        #    io_chunksize=4096,
-        #    use_threads=False
-        #)
-
-        config = boto3.s3.transfer.TransferConfig(
-            max_concurrency=2,
-            num_download_attempts=5,
-            max_io_queue=2,
-        )
+        start = time.perf_counter()
 
         xfer_bytes = 0
         def callback(n_bytes):
             nonlocal xfer_bytes
             xfer_bytes += n_bytes
 
-        bucket.upload_fileobj(reader, key, Config=config, Callback=callback)
+        bucket.upload_fileobj(reader, key,
+            Config=self._transfer_config, Callback=callback)
+
+        parts = 1
+        if xfer_bytes >= self._transfer_config.multipart_threshold:
+            parts = -(-xfer_bytes // self._part_size)
+        self._record_transfer("upload", path, xfer_bytes, parts,
+            time.perf_counter() - start)
+
         return xfer_bytes
 
-    def download(self, path, writer):
+    def _get_range(self, bucket_name, key, etag, start, end):
+        """ returns the bytes from start to end, inclusive, of a key """
+        response = self.client.get_object(Bucket=bucket_name, Key=key,
+            IfMatch=etag, Range="bytes=%d-%d" % (start, end))
+        body = response['Body']
+        try:
+            data = body.read()
+        finally:
+            body.close()
+
+        if len(data) != end - start + 1:
+            raise IOError("%s: short read for range %d-%d" % (key, start, end))
+
+        return data
+
+    def download(self, path, writer, offset=0, length=None):
+        """ write the contents of a key to writer
+
+        offset: the first byte to write
+        length: if given, write at most length bytes
+
+        the key is split into ranges of part_size bytes which are
+        fetched in parallel, and written in order. at most
+        max_concurrency parts are held in memory at a time.
+        """
         bucket_name, key = self._parse_path(path)
-        bucket = self.s3.Bucket(bucket_name)
 
-        config = boto3.s3.transfer.TransferConfig(
-            max_concurrency=2,
-            num_download_attempts=5,
-            max_io_queue=2,
-        )
+        start = time.perf_counter()
 
-        xfer_bytes = 0
-        def callback(n_bytes):
-            nonlocal xfer_bytes
-            xfer_bytes += n_bytes
+        head = self.client.head_object(Bucket=bucket_name, Key=key)
+        size = head['ContentLength']
+        etag = head['ETag']
 
-        bucket.download_fileobj(key, writer, Config=config, Callback=callback)
+        end = size if length is None else min(size, offset + length)
+        ranges = [(i, min(i + self._part_size, end) - 1)
+            for i in range(offset, end, self._part_size)]
+
+        xfer_bytes = 0
+        if len(ranges) == 1:
+            # stream a single part directly to the writer
+            first, last = ranges[0]
+            response = self.client.get_object(Bucket=bucket_name, Key=key,
+                IfMatch=etag, Range="bytes=%d-%d" % (first, last))
+            body = response['Body']
+            try:
+                xfer_bytes = copyfileobj(body, writer, last - first + 1)
+            finally:
+                body.close()
+
+        elif ranges:
+            pending = iter(ranges)
+            futures = deque()
+
+            def submit():
+                item = next(pending, None)
+                if item is not None:
+                    futures.append(self._executor.submit(
+                        self._get_range, bucket_name, key, etag, *item))
+
+            try:
+                for i in range(self._max_concurrency):
+                    submit()
+
+                while futures:
+                    data = futures.popleft().result()
+                    submit()
+                    writer.write(data)
+                    xfer_bytes += len(data)
+            finally:
+                for future in futures:
+                    future.cancel()
+
+        self._record_transfer("download", path, xfer_bytes, len(ranges),
+            time.perf_counter() - start)
 
         return xfer_bytes
 
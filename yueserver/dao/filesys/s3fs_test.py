@@ -0,0 +1,141 @@
+import os
+import io
+import unittest
+import threading
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+try:
+    import moto
+except ImportError:
+    moto = None
+
+from .s3fs import BotoFileSystemImpl
+
+class FakeS3Client(object):
+    """ a stand-in for the boto s3 client, supporting ranged GETs """
+
+    def __init__(self, objects):
+        super(FakeS3Client, self).__init__()
+        self.objects = objects
+        self.lock = threading.Lock()
+        self.ranges = []
+
+    def head_object(self, Bucket, Key):
+        data = self.objects[(Bucket, Key)]
+        return {"ContentLength": len(data), "ETag": '"%d"' % len(data)}
+
+    def get_object(self, Bucket, Key, IfMatch=None, Range=None):
+        data = self.objects[(Bucket, Key)]
+        if IfMatch is not None and IfMatch != '"%d"' % len(data):
+            raise Exception("precondition failed")
+
+        start, end = Range[len("bytes="):].split("-")
+        start, end = int(start), int(end)
+        with self.lock:
+            self.ranges.append((start, end))
+        return {"Body": io.BytesIO(data[start:end + 1])}
+
+def make_fs(**kwargs):
+    return BotoFileSystemImpl("http://localhost:9", "us-east-1",
+        "access", "secret", **kwargs)
+
+@unittest.skipIf(boto3 is None, "boto3 not installed")
+class BotoDownloadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(100 * 1024 + 17)
+        self.fs = make_fs(part_size=16 * 1024, max_concurrency=3)
+        self.fs.client = FakeS3Client({("bucket", "key"): self.data})
+
+    def test_download_parts(self):
+
+        writer = io.BytesIO()
+        n = self.fs.download("s3://bucket/key", writer)
+        self.assertEqual(n, len(self.data))
+        self.assertEqual(writer.getvalue(), self.data)
+
+        # 7 parts, the last part is short
+        ranges = sorted(self.fs.client.ranges)
+        self.assertEqual(len(ranges), 7)
+        self.assertEqual(ranges[-1], (6 * 16 * 1024, len(self.data) - 1))
+
+        transfer = self.fs.transfers()[-1]
+        self.assertEqual(transfer['direction'], "download")
+        self.assertEqual(transfer['bytes'], len(self.data))
+        self.assertEqual(transfer['parts'], 7)
+
+        stats = self.fs.fsstats("s3://bucket/key")
+        self.assertEqual(stats['download_count'], 1)
+        self.assertEqual(stats['download_bytes'], len(self.data))
+
+    def test_download_range(self):
+
+        writer = io.BytesIO()
+        n = self.fs.download("s3://bucket/key", writer, 1000, 40000)
+        self.assertEqual(n, 40000)
+        self.assertEqual(writer.getvalue(), self.data[1000:41000])
+
+        # a single part is streamed using one GET
+        self.fs.client.ranges = []
+        writer = io.BytesIO()
+        self.fs.download("s3://bucket/key", writer, 100, 10)
+        self.assertEqual(writer.getvalue(), self.data[100:110])
+        self.assertEqual(self.fs.client.ranges, [(100, 109)])
+
+    def test_open_read(self):
+
+        with self.fs.open("s3://bucket/key", "rb") as rb:
+            self.assertEqual(rb.read(), self.data)
+
+        # closing early does not block the download
+        with self.fs.open("s3://bucket/key", "rb") as rb:
+            self.assertEqual(rb.read(10), self.data[:10])
+
+@unittest.skipIf(moto is None, "moto not installed")
+class BotoMotoTestCase(unittest.TestCase):
+
+    def setUp(self):
+        mock = getattr(moto, "mock_aws", None) or getattr(moto, "mock_s3")
+        self.mock = mock()
+        self.mock.start()
+
+        # the minimum part size allowed by s3 is 5MB
+        self.fs = BotoFileSystemImpl(None, "us-east-1", "access", "secret",
+            part_size=5 * 1024 * 1024, multipart_threshold=5 * 1024 * 1024)
+        self.fs.client.create_bucket(Bucket="bucket")
+
+        self.data = os.urandom(12 * 1024 * 1024)
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def test_multipart(self):
+
+        n = self.fs.upload(io.BytesIO(self.data), "s3://bucket/key")
+        self.assertEqual(n, len(self.data))
+        self.assertEqual(self.fs.transfers()[-1]['parts'], 3)
+
+        writer = io.BytesIO()
+        self.fs.download("s3://bucket/key", writer)
+        self.assertEqual(writer.getvalue(), self.data)
+
+    def test_open(self):
+
+        with self.fs.open("s3://bucket/key", "wb") as wb:
+            wb.write(self.data)
+
+        with self.fs.open("s3://bucket/key", "rb") as rb:
+            self.assertEqual(rb.read(), self.data)
+
+def main():
+    suite = unittest.TestSuite()
+    suite.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(BotoDownloadTestCase))
+    suite.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(BotoMotoTestCase))
+    unittest.TextTestRunner().run(suite)
+
+if __name__ == '__main__':
+    main()
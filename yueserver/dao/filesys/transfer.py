@@ -0,0 +1,221 @@
+"""
+A copy engine for moving bytes between file-like objects
+
+copyfileobj replaces the read/write loops used throughout the file
+system layer. When both ends are real files the copy is performed by
+the kernel, using copy_file_range or sendfile. Otherwise bytes are read
+into a single preallocated buffer using readinto, when the reader
+supports it.
+
+Writers must not keep a reference to the data passed to write,
+the buffer is reused for the next chunk.
+"""
+import os
+import io
+import stat
+import time
+import errno
+import threading
+
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+# the maximum number of bytes to request from the kernel in one call
+_KERNEL_CHUNK_SIZE = 2**30
+
+# errors which indicate that the kernel can not copy between two files
+_KERNEL_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF,
+    errno.EOPNOTSUPP, errno.ENOTSOCK}
+
+_chunk_size = DEFAULT_CHUNK_SIZE
+
+def set_chunk_size(size):
+    """ set the default buffer size used when copying """
+    global _chunk_size
+    size = int(size)
+    if size <= 0:
+        raise ValueError("invalid chunk size: %d" % size)
+    _chunk_size = size
+
+def get_chunk_size():
+    """ returns the default buffer size used when copying """
+    return _chunk_size
+
+class TransferStatistics(object):
+    """ running totals of the bytes copied using each copy method """
+
+    def __init__(self):
+        super(TransferStatistics, self).__init__()
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def record(self, method, nbytes, elapsed):
+        with self.lock:
+            item = self.counters.get(method, None)
+            if item is None:
+                item = self.counters[method] = [0, 0, 0.0]
+            item[0] += 1
+            item[1] += nbytes
+            item[2] += elapsed
+
+    def snapshot(self):
+        """ returns a map of copy method to the number of copies, bytes,
+        seconds and the average rate in bytes per second
+        """
+        with self.lock:
+            return {method: {
+                "count": count,
+                "bytes": nbytes,
+                "seconds": elapsed,
+                "rate": nbytes / elapsed if elapsed > 0 else 0,
+            } for method, (count, nbytes, elapsed) in self.counters.items()}
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+
+statistics = TransferStatistics()
+
+# file objects returned by open() in binary mode
+_FILE_TYPES = (io.FileIO, io.BufferedReader, io.BufferedWriter, io.BufferedRandom)
+
+def _fileno(f):
+    """ returns the file descriptor of a binary file returned by open()
+
+    returns None for any other file-like object. wrappers, such as gzip,
+    may return the descriptor of the underlying file.
+    """
+    if not isinstance(f, _FILE_TYPES):
+        return None
+    try:
+        return f.fileno()
+    except (OSError, ValueError):
+        return None
+
+def _copy_kernel(reader, writer, length):
+    """ copy from a regular file using copy_file_range or sendfile
+
+    returns a pair (method, nbytes) or None if the kernel can not
+    copy between the two files
+    """
+
+    rfd = _fileno(reader)
+    wfd = _fileno(writer)
+    if rfd is None or wfd is None:
+        return None
+
+    try:
+        if not stat.S_ISREG(os.fstat(rfd).st_mode):
+            return None
+        if not os.get_blocking(wfd):
+            return None
+        is_reg = stat.S_ISREG(os.fstat(wfd).st_mode)
+        offset = reader.tell()
+        writer.flush()
+    except (OSError, ValueError):
+        return None
+
+    methods = []
+    if is_reg and hasattr(os, "copy_file_range"):
+        methods.append("copy_file_range")
+    if hasattr(os, "sendfile"):
+        methods.append("sendfile")
+
+    for method in methods:
+        xfer_bytes = 0
+        try:
+            while length is None or xfer_bytes < length:
+                count = _KERNEL_CHUNK_SIZE
+                if length is not None:
+                    count = min(count, length - xfer_bytes)
+
+                if method == "copy_file_range":
+                    n = os.copy_file_range(rfd, wfd, count, offset + xfer_bytes)
+                else:
+                    n = os.sendfile(wfd, rfd, offset + xfer_bytes, count)
+
+                if n == 0:
+                    break
+                xfer_bytes += n
+
+        except OSError as e:
+            if xfer_bytes == 0 and e.errno in _KERNEL_ERRORS:
+                continue
+            raise
+
+        # the kernel does not update the position of the python file objects
+        reader.seek(offset + xfer_bytes)
+        if writer.seekable():
+            writer.seek(os.lseek(wfd, 0, os.SEEK_CUR))
+
+        return method, xfer_bytes
+
+    return None
+
+def _copy_buffered(reader, writer, length, chunk_size):
+    """ copy using a single preallocated buffer """
+
+    view = memoryview(bytearray(chunk_size))
+    readinto = getattr(reader, "readinto", None)
+    method = "read" if readinto is None else "readinto"
+
+    xfer_bytes = 0
+    while length is None or xfer_bytes < length:
+        n = chunk_size
+        if length is not None:
+            n = min(n, length - xfer_bytes)
+
+        if readinto is not None:
+            n = readinto(view[:n])
+            if not n:
+                break
+            writer.write(view[:n])
+        else:
+            buf = reader.read(n)
+            if not buf:
+                break
+            n = len(buf)
+            writer.write(buf)
+
+        xfer_bytes += n
+
+    return method, xfer_bytes
+
+def copyfileobj(reader, writer, length=None, chunk_size=None):
+    """ copy bytes from reader to writer
+
+    length: if given, copy at most length bytes
+    chunk_size: the size of the buffer, by default get_chunk_size()
+
+    returns the number of bytes copied
+    """
+
+    start = time.perf_counter()
+
+    result = _copy_kernel(reader, writer, length)
+    if result is None:
+        result = _copy_buffered(reader, writer, length,
+            chunk_size or _chunk_size)
+
+    method, xfer_bytes = result
+    statistics.record(method, xfer_bytes, time.perf_counter() - start)
+
+    return xfer_bytes
+
+def iter_chunks(reader, chunk_size=None):
+    """ yield the contents of reader, as a sequence of byte strings
+
+    used when the consumer keeps a reference to each chunk
+    """
+
+    chunk_size = chunk_size or _chunk_size
+
+    start = time.perf_counter()
+    xfer_bytes = 0
+    try:
+        buf = reader.read(chunk_size)
+        while buf:
+            xfer_bytes += len(buf)
+            yield buf
+            buf = reader.read(chunk_size)
+    finally:
+        statistics.record("iter", xfer_bytes, time.perf_counter() - start)
@@ -0,0 +1,126 @@
+import os
+import io
+import unittest
+import tempfile
+import threading
+
+from .transfer import copyfileobj, iter_chunks, statistics, \
+    set_chunk_size, get_chunk_size, DEFAULT_CHUNK_SIZE
+
+class NoReadInto(object):
+    """ a reader which does not support readinto """
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, n=-1):
+        return self.stream.read(n)
+
+class TransferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        statistics.reset()
+        self.data = os.urandom(300 * 1024)
+
+    def tearDown(self):
+        set_chunk_size(DEFAULT_CHUNK_SIZE)
+
+    def test_copy_buffered(self):
+
+        writer = io.BytesIO()
+        n = copyfileobj(io.BytesIO(self.data), writer, chunk_size=1000)
+        self.assertEqual(n, len(self.data))
+        self.assertEqual(writer.getvalue(), self.data)
+
+        writer = io.BytesIO()
+        n = copyfileobj(NoReadInto(self.data), writer, 5000, chunk_size=1000)
+        self.assertEqual(n, 5000)
+        self.assertEqual(writer.getvalue(), self.data[:5000])
+
+        stats = statistics.snapshot()
+        self.assertEqual(stats['readinto']['bytes'], len(self.data))
+        self.assertEqual(stats['read']['bytes'], 5000)
+
+    def test_copy_file_to_file(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "src")
+            dst = os.path.join(tmp, "dst")
+
+            with open(src, "wb") as wb:
+                wb.write(self.data)
+
+            with open(src, "rb") as rb:
+                rb.read(100)
+                with open(dst, "wb") as wb:
+                    wb.write(b"header")
+                    n = copyfileobj(rb, wb, 200000)
+                    self.assertEqual(n, 200000)
+                    wb.write(b"footer")
+
+                # the position of the reader is updated
+                self.assertEqual(rb.tell(), 200100)
+
+            with open(dst, "rb") as rb:
+                expected = b"header" + self.data[100:200100] + b"footer"
+                self.assertEqual(rb.read(), expected)
+
+        stats = statistics.snapshot()
+        self.assertNotIn('readinto', stats)
+
+    def test_copy_file_to_pipe(self):
+
+        with tempfile.TemporaryFile() as tf:
+            tf.write(self.data)
+            tf.seek(0)
+
+            rfd, wfd = os.pipe()
+            reader = open(rfd, "rb")
+            writer = open(wfd, "wb")
+
+            received = []
+            thread = threading.Thread(target=lambda: received.append(reader.read()))
+            thread.start()
+
+            copyfileobj(tf, writer)
+            writer.close()
+            thread.join()
+            reader.close()
+
+        self.assertEqual(received[0], self.data)
+
+    def test_copy_append(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "dst")
+
+            with open(path, "wb") as wb:
+                wb.write(b"abc")
+
+            # the kernel can not copy into a file opened for appending
+            with tempfile.TemporaryFile() as tf:
+                tf.write(self.data)
+                tf.seek(0)
+                with open(path, "ab") as wb:
+                    copyfileobj(tf, wb)
+
+            with open(path, "rb") as rb:
+                self.assertEqual(rb.read(), b"abc" + self.data)
+
+    def test_iter_chunks(self):
+
+        set_chunk_size(4096)
+        self.assertEqual(get_chunk_size(), 4096)
+
+        chunks = list(iter_chunks(io.BytesIO(self.data)))
+        self.assertEqual(len(chunks), (len(self.data) + 4095) // 4096)
+        self.assertEqual(b"".join(chunks), self.data)
+
+        with self.assertRaises(ValueError):
+            set_chunk_size(0)
+
+def main():
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TransferTestCase)
+    unittest.TextTestRunner().run(suite)
+
+if __name__ == '__main__':
+    main()
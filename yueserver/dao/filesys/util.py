@@ -1,6 +1,7 @@
 
 import io
 import os
+import hashlib
 import sys
 import posixpath
 
@@ -23,6 +24,8 @@ class FileRecord(object):
         self.permission = permission
         self.encrypted = 0
         self.storage_path = ""
+        # the number of files in a directory
+        self.count = 0
 
     @staticmethod
     def fromDict(**kwargs):
@@ -163,6 +166,67 @@ class AbstractFileSystem(object):
     def url(self, path):
         return path
 
+class RangeComplete(Exception):
+    """ raised by a RangeWriter once the range has been written """
+    pass
+
+class RangeWriter(object):
+    """ wrap a writable file, writing only part of a stream
+
+    the first offset bytes are discarded, then at most length bytes are
+    written. RangeComplete is raised once length bytes have been written,
+    so that the producer can stop early.
+    """
+    def __init__(self, wf, offset=0, length=None):
+        super(RangeWriter, self).__init__()
+        self.wf = wf
+        self.skip = offset
+        self.remaining = length
+
+    def write(self, b):
+        n = len(b)
+
+        if self.skip:
+            if n <= self.skip:
+                self.skip -= n
+                return n
+            b = memoryview(b)[self.skip:]
+            self.skip = 0
+
+        if self.remaining is not None:
+            if len(b) >= self.remaining:
+                self.wf.write(b[:self.remaining])
+                self.remaining = 0
+                raise RangeComplete()
+            self.remaining -= len(b)
+
+        self.wf.write(b)
+        return n
+
+    def close(self):
+        self.wf.close()
+
+class HashReader(object):
+    """ wrap a readable file, computing a hash of the bytes read
+
+    hexdigest() returns the hash once the stream has been read
+    """
+    def __init__(self, rf, algorithm="sha256"):
+        super(HashReader, self).__init__()
+        self.rf = rf
+        self.hash = hashlib.new(algorithm)
+
+    def read(self, n=-1):
+        buf = self.rf.read(n)
+        self.hash.update(buf)
+        return buf
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def close(self):
+        self.rf.close()
+
 class _ProcFile(object):
     """A file-like object which writes to a process
 
@@ -209,151 +273,156 @@ class _ProcFile(object):
 
         self.returncode = self.proc.returncode
 
+DEFAULT_FIFO_SIZE = 1024 * 1024
+
 class BytesFIFO(object):
     """
-    A FIFO that can store a fixed number of bytes.
+    A fixed capacity ring buffer for passing bytes between two threads
+
+    writes block while the buffer is full and reads block while the
+    buffer is empty. data is copied directly between the caller's buffer
+    and the ring, without intermediate copies.
     """
-    def __init__(self, init_size=2048, incr_size=2048, lock=None, max_size=None):
-        """ Create a FIFO of ``init_size`` bytes.
+    def __init__(self, capacity=DEFAULT_FIFO_SIZE, lock=None):
+        if capacity < 1:
+            raise ValueError("invalid capacity: %d" % capacity)
 
-        max_size: optional, if set will attempt to keep the size of the
-            internal buffer below this size. internal size still depends
-            on the size of individual writes and reads
-            TODO: disabled by default, still seems to cause deadlock
-        """
-        self._buffer = io.BytesIO(b"\x00" * init_size)
-        self._size = init_size
+        self._view = memoryview(bytearray(capacity))
+        self._size = capacity
         self._filled = 0
         self._read_ptr = 0
         self._write_ptr = 0
         self._writer_closed = False
         self._reader_closed = False
-        self._max_size = max_size
-
-        self._capacity_increase = incr_size
 
         self._lock = lock or Lock()
-        self._cond = Condition(self._lock)
-
-    def read(self, request_size=-1):
-        """
-        Read at most ``size`` bytes from the FIFO.
-
-        If less than ``size`` bytes are available, or ``size`` is negative,
-        return all remaining bytes.
-        """
-
-        # TODO: reads should block if the writer is not closed and the
-        #       filled size is empty
-
-        with self._lock:
-            try:
-                data = self._read(request_size)
-            finally:
-                self._cond.notify()
-            return data
+        # readers wait for data, writers wait for free space
+        self._not_empty = Condition(self._lock)
+        self._not_full = Condition(self._lock)
 
-    def _read_size_impl(self, request_size):
+    def _wait_readable(self):
+        """ block until bytes are available or the writer is closed """
+        while self._filled == 0 and not self._writer_closed:
+            self._not_empty.wait()
 
-        if request_size < 0:
-            size = self._filled
-        else:
-            size = min(request_size, self._filled)
-        contig = self._size - self._read_ptr
-        contig_read = min(contig, size)
+    def _read_into(self, view):
+        """ copy at most len(view) bytes out of the ring """
 
-        return contig_read, size
+        size = min(len(view), self._filled)
+        contig = min(size, self._size - self._read_ptr)
+        view[:contig] = self._view[self._read_ptr:self._read_ptr + contig]
+        if contig < size:
+            view[contig:size] = self._view[:size - contig]
 
-    def _read_size(self, request_size, blocking):
-        contig_read, size = self._read_size_impl(request_size)
+        self._read_ptr = (self._read_ptr + size) % self._size
+        self._filled -= size
+        if size:
+            self._not_full.notify()
+        return size
 
-        # block until some bytes are avilable
-        # do not block if some bytes are available
-        if blocking:
-            if (request_size == -1):
-                while not self._writer_closed:
-                    self._cond.wait()
-                    contig_read, size = self._read_size_impl(request_size)
-            else:
-                while not self._writer_closed and contig_read == 0:
-                    self._cond.wait()
-                    contig_read, size = self._read_size_impl(request_size)
+    def readinto(self, b):
+        """
+        Read bytes into the buffer ``b``, returning the number of bytes read
 
-        return contig_read, size
+        blocks until at least one byte is available. returns 0 once
+        the writer is closed and the fifo is empty.
+        """
+        view = memoryview(b).cast("B")
+        if not len(view):
+            return 0
 
-    def _read(self, request_size, blocking=True):
+        with self._lock:
+            self._wait_readable()
+            return self._read_into(view)
 
-        #TODO: refactor this duplicate logic which waits for data
-        # to be available
-        # Figure out how many bytes we can really read
+    def read(self, request_size=-1):
+        """
+        Read at most ``size`` bytes from the FIFO.
 
-        # sys.stderr.write("[%s] read 1\n" % current_thread())
+        blocks until at least one byte is available. If ``size`` is
+        negative, read until the writer is closed.
+        """
 
-        contig_read, size = self._read_size(request_size, blocking)
+        if request_size is None or request_size < 0:
+            chunks = []
+            buf = self.read(self._size)
+            while buf:
+                chunks.append(buf)
+                buf = self.read(self._size)
+            return b"".join(chunks)
 
-        # Go to read pointer
-        self._buffer.seek(self._read_ptr)
+        if request_size == 0:
+            return b""
 
-        ret = self._buffer.read(contig_read)
-        self._read_ptr += contig_read
-        if contig_read < size:
-            leftover_size = size - contig_read
-            self._buffer.seek(0)
-            ret += self._buffer.read(leftover_size)
-            self._read_ptr = leftover_size
+        with self._lock:
+            self._wait_readable()
 
-        self._filled -= size
-        return ret
+            size = min(request_size, self._filled)
+            start = self._read_ptr
+            if start + size <= self._size:
+                # the common case, copy once from the ring into a new bytes
+                data = self._view[start:start + size].tobytes()
+                self._read_ptr = (start + size) % self._size
+                self._filled -= size
+                if size:
+                    self._not_full.notify()
+                return data
+
+            buf = bytearray(size)
+            self._read_into(memoryview(buf))
+            return bytes(buf)
 
     def write(self, data):
         """
-        Write as many bytes of ``data`` as are free in the FIFO.
+        Write all of ``data`` to the FIFO, blocking while the FIFO is full
 
-        If less than ``len(data)`` bytes are free, write as many as can be written.
-        Returns the number of bytes written.
+        Returns the number of bytes written. raises BrokenPipeError
+        if the reader is closed before all of the data is written
         """
 
-        with self._lock:
+        view = memoryview(data).cast("B")
+        total = len(view)
+        offset = 0
 
-            try:
-                write_size = self._write(data)
-            finally:
-                self._cond.notify()
+        with self._lock:
 
-            return write_size
+            if self._writer_closed:
+                raise ValueError("write to closed fifo")
 
-    def _write(self, data):
+            while offset < total:
 
-        write_size = len(data)
+                while self._filled == self._size and not self._reader_closed:
+                    self._not_full.wait()
 
-        while self._max_size and self._filled > self._max_size and \
-          (self._size - self._read_ptr) > 0:
-            self._cond.wait()
-            self._cond.notify()
+                if self._reader_closed:
+                    raise BrokenPipeError("fifo reader closed")
 
-        if self._size < self._filled + write_size:
-            new_size = self._filled + write_size + self._capacity_increase
-            self._resize(new_size)
+                size = min(total - offset, self._size - self._filled)
+                contig = min(size, self._size - self._write_ptr)
+                self._view[self._write_ptr:self._write_ptr + contig] = \
+                    view[offset:offset + contig]
+                if contig < size:
+                    self._view[:size - contig] = \
+                        view[offset + contig:offset + size]
 
-        if write_size:
-            contig = self._size - self._write_ptr
-            contig_write = min(contig, write_size)
-            # TODO: avoid 0 write
-            # TODO: avoid copy
-            # TODO: test performance of above
-            self._buffer.seek(self._write_ptr)
-            self._buffer.write(data[:contig_write])
-            self._write_ptr += contig_write
+                self._write_ptr = (self._write_ptr + size) % self._size
+                self._filled += size
+                offset += size
+                self._not_empty.notify()
 
-            if contig < write_size:
-                self._buffer.seek(0)
-                self._buffer.write(data[contig_write:write_size])
-                #self._buffer.write(buffer(data, contig_write, write_size - contig_write))
-                self._write_ptr = write_size - contig_write
+        return total
 
-        self._filled += write_size
+    def close_writer(self):
+        """ signal end of file to the reader """
+        with self._lock:
+            self._writer_closed = True
+            self._not_empty.notify_all()
 
-        return write_size
+    def close_reader(self):
+        """ signal to the writer that no more data will be read """
+        with self._lock:
+            self._reader_closed = True
+            self._not_full.notify_all()
 
     def close(self):
         pass
@@ -377,47 +446,12 @@ class BytesFIFO(object):
         with self._lock:
             return self._filled
 
-    def __nonzero__(self):
-        with self._lock:
-            return self._filled > 0
-
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, tb):
         self.close()
 
-    #def resize(self, new_size):
-    #    with self._lock:
-    #        return self._resize(new_size)
-
-    def _resize(self, new_size):
-        """
-        Resize FIFO to contain ``new_size`` bytes. If FIFO currently has
-        more than ``new_size`` bytes filled, :exc:`ValueError` is raised.
-        If ``new_size`` is less than 1, :exc:`ValueError` is raised.
-        If ``new_size`` is smaller than the current size, the internal
-        buffer is not contracted (yet).
-        """
-
-        if new_size < 1:
-            raise ValueError("Cannot resize to zero or less bytes.")
-
-        if new_size < self._filled:
-            raise ValueError("Cannot contract FIFO to less than {} bytes, "
-                             "or data will be lost.".format(self._filled))
-        # original data is non-contiguous. we need to copy old data,
-        # re-write to the beginning of the buffer, and re-sync
-        # the read and write pointers.
-        if self._read_ptr >= self._write_ptr:
-            old_data = self._read(self._filled, False)
-            self._buffer.seek(0)
-            self._buffer.write(old_data)
-            self._filled = len(old_data)
-            self._read_ptr = 0
-            self._write_ptr = self._filled
-        self._size = new_size
-
 class BytesFIFOWriter(object):
     """docstring for BytesFIFOWriter"""
 
@@ -429,10 +463,8 @@ class BytesFIFOWriter(object):
         return self.fifo.write(data)
 
     def close(self):
-        with self.fifo._lock:
-            self.fifo._writer_closed = True
-            self.fifo._cond.notify()
-            self.fifo.close()
+        self.fifo.close_writer()
+        self.fifo.close()
 
     def flush(self):
         self.fifo.flush()
@@ -453,11 +485,12 @@ class BytesFIFOReader(object):
     def read(self, size=-1):
         return self.fifo.read(size)
 
+    def readinto(self, b):
+        return self.fifo.readinto(b)
+
     def close(self):
-        with self.fifo._lock:
-            self.fifo._reader_closed = True
-            self.fifo._cond.notify()
-            self.fifo.close()
+        self.fifo.close_reader()
+        self.fifo.close()
 
     def flush(self):
         self.fifo.flush()
@@ -1,14 +1,16 @@
 
+import os
 import sys
 import unittest
 import json
 import io
 from threading import Thread
 import time
+import hashlib
 
 from ..db import main_test
 
-from .util import BytesFIFO, BytesFIFOWriter, BytesFIFOReader
+from .util import BytesFIFO, BytesFIFOWriter, BytesFIFOReader, HashReader
 from .filesys import FileSystem, sh_escape
 from .s3fs import S3FileSystemImpl
 
@@ -65,10 +67,9 @@ class BytesFifoTestCase(unittest.TestCase):
         self.assertEqual(reader.count, writer.count)
 
     def test_rw_b(self):
-        # force a resize when writing
-        # a resize is a write, which calls resize, which calls read
-        # potential for deadlock when not implemented correctly
-        fifo = BytesFIFO()
+        # writes larger than the capacity block until the reader
+        # has made room, potential for deadlock when not implemented correctly
+        fifo = BytesFIFO(1024)
         reader = TestReaderThread(fifo, 256)
         writer = TestWriterThread(fifo, 4096, 10)
         reader.start()
@@ -91,8 +92,8 @@ class BytesFifoTestCase(unittest.TestCase):
         self.assertEqual(reader.count, writer.count)
 
     def test_rw_d(self):
-        # read all data
-        fifo = BytesFIFO(max_size=1024)
+        # back-pressure: the writer is faster than the reader
+        fifo = BytesFIFO(1024)
         reader = TestReaderThread(fifo, 1024)
         writer = TestWriterThread(fifo, 2048, 10)
         reader.start()
@@ -102,6 +103,82 @@ class BytesFifoTestCase(unittest.TestCase):
 
         self.assertEqual(reader.count, writer.count)
 
+    def test_rw_integrity(self):
+        # reads and writes of different sizes wrap around the ring
+        data = os.urandom(100000)
+        fifo = BytesFIFO(4099)
+
+        def produce():
+            with BytesFIFOWriter(fifo) as writer:
+                for i in range(0, len(data), 777):
+                    writer.write(memoryview(data)[i:i + 777])
+
+        thread = Thread(target=produce)
+        thread.start()
+
+        received = []
+        buf = bytearray(1000)
+        with BytesFIFOReader(fifo) as reader:
+            while True:
+                n = reader.readinto(buf)
+                if not n:
+                    break
+                received.append(bytes(buf[:n]))
+                received.append(reader.read(333))
+        thread.join()
+
+        self.assertEqual(b"".join(received), data)
+        self.assertTrue(fifo.empty())
+
+    def test_back_pressure(self):
+
+        fifo = BytesFIFO(16)
+        writer = TestWriterThread(fifo, 100, 1)
+        writer.start()
+
+        # the writer blocks until the reader drains the fifo
+        writer.join(0.1)
+        self.assertTrue(writer.is_alive())
+        self.assertTrue(fifo.full())
+        self.assertEqual(fifo.capacity(), 16)
+
+        reader = BytesFIFOReader(fifo)
+        self.assertEqual(len(reader.read()), 100)
+        writer.join()
+
+    def test_reader_closed(self):
+
+        fifo = BytesFIFO(16)
+        BytesFIFOReader(fifo).close()
+
+        with self.assertRaises(BrokenPipeError):
+            BytesFIFOWriter(fifo).write(b"0" * 100)
+
+    def test_writer_closed(self):
+
+        fifo = BytesFIFO(16)
+        writer = BytesFIFOWriter(fifo)
+        writer.write(b"abc")
+        writer.close()
+
+        reader = BytesFIFOReader(fifo)
+        self.assertEqual(reader.read(10), b"abc")
+        self.assertEqual(reader.read(10), b"")
+        self.assertEqual(reader.readinto(bytearray(10)), 0)
+
+        with self.assertRaises(ValueError):
+            writer.write(b"abc")
+
+class HashReaderTestCase(unittest.TestCase):
+
+    def test_hash(self):
+
+        data = os.urandom(1000)
+        reader = HashReader(io.BytesIO(data))
+        self.assertEqual(reader.read(100), data[:100])
+        self.assertEqual(reader.read(), data[100:])
+        self.assertEqual(reader.hexdigest(), hashlib.sha256(data).hexdigest())
+
 if __name__ == '__main__':
     main_test(sys.argv, globals())
 
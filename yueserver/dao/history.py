@@ -2,12 +2,21 @@
 """
 A Data Access Object for manipulating the history table
 """
-from sqlalchemy import and_, or_, not_, select, column, update, insert
+import time
+import logging
+
+from sqlalchemy import and_, or_, not_, select, column, update, insert, \
+    inspect
+from sqlalchemy.dialects import postgresql
 
 from .library import Song, SongQueryFormatter
 
 class HistoryDao(object):
     """docstring for HistoryDao"""
+
+    # the number of records inserted by a single statement
+    BATCH_SIZE = 250
+
     def __init__(self, db, dbtables, sanitize=False):
         super(HistoryDao, self).__init__()
         self.db = db
@@ -15,6 +24,10 @@ class HistoryDao(object):
 
         self.formatter = SongQueryFormatter(dbtables, sanitize)
 
+        # true once the unique index on the history table is known to
+        # exist, checked again by each bulk insert until it is created
+        self._unique = None
+
     def insert(self, user_id, song_id, timestamp, commit=True):
         SongHistoryTable = self.dbtables.SongHistoryTable
 
@@ -28,6 +41,99 @@ class HistoryDao(object):
         if commit:
             self.db.session.commit()
 
+    def bulkInsert(self, user_id, records, commit=True):
+        """ insert a list of history records, ignoring duplicates
+
+        records: a list of objects containing a `song_id`, and `timestamp`.
+
+        a record is a duplicate when the user already has a record
+        for the same song and timestamp, the key of the unique index.
+
+        returns the number of records inserted
+        """
+
+        SongHistoryTable = self.dbtables.SongHistoryTable
+
+        if not records:
+            return 0
+
+        if self._hasUniqueIndex():
+            # the unique index ignores the duplicates
+            rows = [{"user_id": user_id,
+                     "song_id": r['song_id'],
+                     "timestamp": r['timestamp']} for r in records]
+        else:
+            rows = self._removeDuplicates(user_id, records)
+
+        count = 0
+        for i in range(0, len(rows), self.BATCH_SIZE):
+            batch = rows[i:i + self.BATCH_SIZE]
+            start = time.perf_counter()
+
+            if self.db.kind() == "postgresql":
+                query = postgresql.insert(SongHistoryTable) \
+                    .values(batch) \
+                    .on_conflict_do_nothing()
+            else:
+                query = insert(SongHistoryTable) \
+                    .values(batch) \
+                    .prefix_with("OR IGNORE")
+
+            result = self.db.session.execute(query)
+            count += max(0, result.rowcount)
+
+            logging.debug("history batch: inserted %d of %d records in %.3fs",
+                result.rowcount, len(batch), time.perf_counter() - start)
+
+        if commit:
+            self.db.session.commit()
+
+        return count
+
+    def _hasUniqueIndex(self):
+        """ returns true if the unique index on the history table exists
+
+        the index is created by migrate_indexes, for databases created
+        before the index was added
+        """
+
+        if not self._unique:
+            names = set(ix['name'] for ix in
+                inspect(self.db.engine).get_indexes("song_history"))
+            self._unique = "uix_song_history" in names
+
+        return self._unique
+
+    def _removeDuplicates(self, user_id, records):
+        """ returns the rows for the records which are not already
+        recorded, for a database without the unique index
+        """
+
+        SongHistoryTable = self.dbtables.SongHistoryTable
+
+        # get the set of existing records for the same time span
+        # as the records that are given
+        start = min(r['timestamp'] for r in records)
+        end = max(r['timestamp'] for r in records)
+        query = select([SongHistoryTable.c.song_id,
+                        SongHistoryTable.c.timestamp]).where(
+            and_(SongHistoryTable.c.user_id == user_id,
+                 SongHistoryTable.c.timestamp >= start,
+                 SongHistoryTable.c.timestamp <= end))
+        keys = set(tuple(row) for row in
+            self.db.session.execute(query).fetchall())
+
+        rows = []
+        for r in records:
+            key = (r['song_id'], r['timestamp'])
+            if key not in keys:
+                keys.add(key)
+                rows.append({"user_id": user_id,
+                             "song_id": r['song_id'],
+                             "timestamp": r['timestamp']})
+
+        return rows
+
     def retrieve(self, user_id, start, end=None, offset=None, limit=None):
         """
         retrieve all history records between the given start and end time
@@ -4,6 +4,8 @@ import tempfile
 import json
 import datetime
 
+from sqlalchemy import event
+
 from .user import UserDao
 from .library import Song, LibraryDao
 from .history import HistoryDao
@@ -97,6 +99,68 @@ class SongHistoryTestCase(unittest.TestCase):
         records = self.history.retrieve(user_id, start, end)
         self.assertEqual(len(records), len(self.SONGS))
 
+    def test_history_bulk_insert(self):
+
+        user_id = self.USER['id']
+
+        timestamp = 1000
+        records = [{"song_id": song[Song.id], "timestamp": timestamp + i}
+            for i, song in enumerate(self.SONGS)]
+
+        count = self.history.bulkInsert(user_id, records[:10])
+        self.assertEqual(count, 10)
+
+        # records which already exist are not inserted a second time.
+        # the database ignores them, without selecting existing records
+        statements = []
+        def execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.db.engine, "before_cursor_execute", execute)
+        try:
+            count = self.history.bulkInsert(user_id, records + records[:1])
+        finally:
+            event.remove(self.db.engine, "before_cursor_execute", execute)
+        self.assertEqual(count, len(self.SONGS) - 10)
+        self.assertFalse([s for s in statements if s.startswith("SELECT")])
+
+        records = self.history.retrieve(user_id, timestamp,
+            timestamp + len(self.SONGS))
+        self.assertEqual(len(records), len(self.SONGS))
+
+        # a record is a duplicate if it is for the same song and timestamp
+        other = [{"song_id": self.SONGS[1][Song.id], "timestamp": timestamp}]
+        self.assertEqual(self.history.bulkInsert(user_id, other), 1)
+
+    def test_history_bulk_insert_unindexed(self):
+
+        user_id = self.USER['id']
+
+        # duplicates are ignored in a database which has not
+        # been migrated to include the unique index
+        self.db.engine.execute("DROP INDEX uix_song_history")
+        try:
+            history = HistoryDao(self.db, self.db.tables)
+
+            timestamp = 2000
+            records = [{"song_id": song[Song.id], "timestamp": timestamp}
+                for song in self.SONGS[:2]]
+
+            count = history.bulkInsert(user_id, records + records[:1])
+            self.assertEqual(count, 2)
+
+            count = history.bulkInsert(user_id, records)
+            self.assertEqual(count, 0)
+
+            records = history.retrieve(user_id, timestamp, timestamp)
+            self.assertEqual(len(records), 2)
+        finally:
+            self.db.session.execute(self.db.tables.SongHistoryTable.delete()
+                .where(self.db.tables.SongHistoryTable.c.timestamp == 2000))
+            self.db.session.commit()
+            for index in self.db.tables.SongHistoryTable.indexes:
+                if index.name == "uix_song_history":
+                    index.create(self.db.engine)
+
 def main():
     suite = unittest.defaultTestLoader.loadTestsFromTestCase(SongHistoryTestCase)
     unittest.TextTestRunner().run(suite)
@@ -1,5 +1,7 @@
 import io
 
+from .filesys.transfer import copyfileobj
+
 Image = None
 ImageOps = None
 
@@ -105,16 +107,27 @@ def scale_image_stream(inputStream, outputStream, scale):
     # use case at present, this is a workaround until other use
     # cases are determined.
 
-    nBytes = 0
     with io.BytesIO() as bImg:
         img.save(bImg, format="png")
         bImg.seek(0)
-        for dat in iter(lambda: bImg.read(2048), b""):
-            nBytes += len(dat)
-            outputStream.write(dat)
+        nBytes = copyfileobj(bImg, outputStream)
 
     return img.size[0], img.size[1], nBytes
 
+def scale_image_bytes(data, scale):
+    """ scale an image given as bytes
+
+    returns the png encoded image, width, height and size.
+    suitable for running in a process pool
+    """
+
+    if Image is None:
+        init()
+
+    with io.BytesIO() as wb:
+        w, h, s = scale_image_stream(io.BytesIO(data), wb, scale)
+        return wb.getvalue(), w, h, s
+
 def scale_image_file(fs, src_path, tgt_path, scale):
 
     with fs.open(src_path, "rb") as rb:
@@ -5,12 +5,18 @@ A Data Access Object for manipulating the library table
 """
 
 import logging
+import json
+import base64
 
 from sqlalchemy.orm import relationship
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy import and_, or_, not_, case, select, update, column, func, asc, desc
 from sqlalchemy.sql.expression import bindparam
+from sqlalchemy.types import Integer
 from .search import SearchGrammar, ParseError, Rule
+from .library_index import LibraryIndex
+from .library_summary import LibrarySummary, SummaryCounts, parseGenres
+from .shuffle import binshuffle
 
 import datetime, time
 import uuid
@@ -268,10 +274,49 @@ class SongQueryFormatter(object):
 class LibraryException(Exception):
     pass
 
+def encodePageToken(order, key):
+    """ return an opaque token for resuming a keyset search
+
+    order: the list of (column, descending) used to sort the results
+    key: the sort key of the last song returned
+    """
+    data = json.dumps([order, key], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("utf-8")
+
+def decodePageToken(order, token):
+    """ return the sort key stored in a token created by encodePageToken
+
+    raises LibraryException if the token was not created
+    for the given order
+    """
+    try:
+        data = base64.urlsafe_b64decode(token.encode("utf-8"))
+        token_order, key = json.loads(data.decode("utf-8"))
+    except Exception as e:
+        raise LibraryException("invalid page token")
+
+    if [list(item) for item in order] != token_order or \
+       not isinstance(key, list) or len(key) != len(order):
+        raise LibraryException("page token does not match the search order")
+
+    return key
+
 class LibraryDao(object):
     """docstring for Library"""
 
-    def __init__(self, db, dbtables, sanitize=False):
+    # the number of songs drawn for each song returned by sample()
+    SAMPLE_FACTOR = 2
+
+    # the number of songs modified by a single bulk update
+    BATCH_SIZE = 250
+
+    def __init__(self, db, dbtables, sanitize=False, index=False, summary=False):
+        """
+        index: when true, searches are served from an in-memory
+            column index of each domain instead of the database.
+        summary: when true, the domain info is served from an in-memory
+            summary of each domain instead of the database.
+        """
         super(LibraryDao, self).__init__()
         self.db = db
         self.dbtables = dbtables
@@ -284,6 +329,18 @@ class LibraryDao(object):
         self.song_keys = set(self.formatter.cols_song)
         self.user_keys = set(self.formatter.cols_user)
 
+        # incremented whenever a song is changed by this dao
+        self.version = 0
+
+        self.index = None
+        if index:
+            self.index = LibraryIndex(db, dbtables,
+                self.formatter, self.grammar.text_fields, Song.textFields())
+
+        self.summary = None
+        if summary:
+            self.summary = LibrarySummary(db, dbtables)
+
     def insert(self, user_id, domain_id, song, commit=True):
 
         song_id = self.insertSongData(domain_id, song, False)
@@ -337,6 +394,14 @@ class LibraryDao(object):
 
         song_id = result.inserted_primary_key[0]
 
+        self.version += 1
+
+        if self.index is not None:
+            self.index.insertSong(domain_id, result.last_inserted_params())
+
+        if self.summary is not None:
+            self.summary.insertSong(domain_id, result.last_inserted_params())
+
         if commit:
             self.db.session.commit()
 
@@ -382,6 +447,15 @@ class LibraryDao(object):
             if result.rowcount != 1:
                 raise LibraryException("User Data insert failed for %s" % song_id)
 
+            self.version += 1
+
+            if self.index is not None:
+                self.index.updateUserData(user_id, song_id,
+                    result.last_inserted_params())
+
+            if self.summary is not None:
+                self.summary.updateUserData(user_id, song_id, user_data)
+
             if commit:
                 self.db.session.commit()
 
@@ -415,6 +489,14 @@ class LibraryDao(object):
             if result.rowcount != 1:
                 raise LibraryException("Song Data update failed for %s" % song_id)
 
+            self.version += 1
+
+            if self.index is not None:
+                self.index.updateSong(domain_id, song_id, song_data)
+
+            if self.summary is not None:
+                self.summary.updateSong(domain_id, song_id, song_data)
+
             if commit:
                 self.db.session.commit()
 
@@ -435,6 +517,14 @@ class LibraryDao(object):
             # if the update fails, insert the row instead
             if result.rowcount == 0:
                 self.insertUserData(user_id, song_id, song, commit=False)
+            else:
+                self.version += 1
+
+                if self.index is not None:
+                    self.index.updateUserData(user_id, song_id, user_data)
+
+                if self.summary is not None:
+                    self.summary.updateUserData(user_id, song_id, user_data)
 
             if commit:
                 self.db.session.commit()
@@ -460,6 +550,14 @@ class LibraryDao(object):
 
         self.db.session.execute(query)
 
+        self.version += 1
+
+        if self.index is not None:
+            self.index.removeSong(domain_id, song_id)
+
+        if self.summary is not None:
+            self.summary.removeSong(domain_id, song_id)
+
         if commit:
             self.db.session.commit()
 
@@ -471,6 +569,14 @@ class LibraryDao(object):
 
         self.db.session.execute(query)
 
+        self.version += 1
+
+        if self.index is not None:
+            self.index.removeUserData(song_id)
+
+        if self.summary is not None:
+            self.summary.removeUserData(song_id)
+
         if commit:
             self.db.session.commit()
 
@@ -498,6 +604,70 @@ class LibraryDao(object):
 
         result = self.db.session.execute(query)
 
+        self.version += 1
+
+        if self.index is not None:
+            self.index.incrementPlaycount(user_id, song_id)
+
+        if commit:
+            self.db.session.commit()
+
+    def bulkIncrementPlaycount(self, user_id, song_ids, commit=True):
+        """ increment the playcount for a list of songs
+
+        a song id may appear more than once, in which case the playcount
+        is incremented once for each time the song appears.
+
+        song_user_data has no unique constraint on (user_id, song_id),
+        which an upsert requires. instead each batch of songs uses one
+        select, one update and one insert.
+        """
+
+        tab = self.dbtables.SongUserDataTable
+
+        counts = {}
+        for song_id in song_ids:
+            counts[song_id] = counts.get(song_id, 0) + 1
+
+        ids = list(counts)
+        for i in range(0, len(ids), self.BATCH_SIZE):
+            batch = ids[i:i + self.BATCH_SIZE]
+            start = time.perf_counter()
+
+            query = select([tab.c.song_id]).where(
+                and_(tab.c.user_id == user_id,
+                     tab.c.song_id.in_(batch)))
+            existing = set(row[0] for row in
+                self.db.session.execute(query).fetchall())
+
+            if existing:
+                delta = case({song_id: counts[song_id]
+                              for song_id in existing},
+                             value=tab.c.song_id, else_=0)
+                query = tab.update() \
+                    .values({tab.c.play_count: tab.c.play_count + delta}) \
+                    .where(
+                        and_(tab.c.user_id == user_id,
+                             tab.c.song_id.in_(existing)))
+                self.db.session.execute(query)
+
+            missing = [{"song_id": song_id,
+                        "user_id": user_id,
+                        "play_count": counts[song_id]}
+                       for song_id in batch if song_id not in existing]
+
+            if missing:
+                self.db.session.execute(tab.insert().values(missing))
+
+            logging.debug("playcount batch: %d updated, %d inserted in %.3fs",
+                len(existing), len(missing), time.perf_counter() - start)
+
+        self.version += 1
+
+        if self.index is not None:
+            for song_id, count in counts.items():
+                self.index.incrementPlaycount(user_id, song_id, count)
+
         if commit:
             self.db.session.commit()
 
@@ -579,6 +749,9 @@ class LibraryDao(object):
         Remove songs blocked by a user
 
         """
+        if self.summary is not None:
+            return self.summary.get(domain_id).info(user_id)
+
         columns = [column(Song.artist),
                    column(Song.artist_key),
                    column(Song.album),
@@ -607,6 +780,9 @@ class LibraryDao(object):
 
         in testing, this takes about 1/4 of the time of calling search()
         """
+        if self.summary is not None:
+            return self.summary.get(domain_id).info()
+
         columns = [column(Song.artist),
                    column(Song.artist_key),
                    column(Song.album),
@@ -619,22 +795,21 @@ class LibraryDao(object):
 
         return self._getDomainSongInfo(query)
 
-    def _getDomainSongInfo(self, query):
+    def domainSongUserInfoVersion(self, user_id, domain_id):
+        """
+        return a string which changes whenever the result of
+        domainSongUserInfo changes, or None if it is not known.
+        """
+        if self.summary is not None:
+            return self.summary.get(domain_id).getVersion(user_id)
+        return None
 
-        keys = {}
-        artists = {}
-        genres = {}
-        n_records1 = 0
-        total = 0
+    def _getDomainSongInfo(self, query):
 
-        genre_artists = {}
+        counts = SummaryCounts()
 
         for record in self.db.session.execute(query).fetchall():
-            key = record[Song.artist_key]
-            art = record[Song.artist]
-            alb = record[Song.album]
 
-            n_records1 += 1
             # ignored songs banished by the domain
             if record[Song.banished]:
                 continue
@@ -643,68 +818,15 @@ class LibraryDao(object):
             if Song.blocked in record and record[Song.blocked]:
                 continue
 
-            # genres are comma or colon deliminated
-            gen = record[Song.genre].replace(",", ";").strip()
-            if not gen:
-                gen  = [ ]
-            else:
-                # attempt to de-duplicate genre names
-                gen = [g.strip().title() for g in gen.split(";")]
-                gen = [g for g in gen if g]
-
-            # count artist and album
-            if art not in artists:
-                artists[art] = {"count": 0,
-                                "albums": {},
-                                "name": art,
-                                "genres": []}
-                keys[art] = key
-
-            artists[art]['count'] += 1
-            albums = artists[art]['albums']
-
-            # count genres for the record
-            for g in gen:
-                if g and g not in genres:
-                    genres[g] = {"name": g, "count": 0, "artist_count": 0}
-                genres[g]['count'] += 1
-                if g not in artists[art]['genres']:
-                    artists[art]['genres'].append(g)
-
-                if g not in genre_artists:
-                    genre_artists[g] = set()
-                genre_artists[g].add(art)
-
-            # count the number of artists in each genre
-            for g, items in genre_artists.items():
-                genres[g]['artist_count'] = len(items)
-
-            # count the number of songs for this album
-            if alb not in albums:
-                albums[alb] = 0
-            albums[alb] += 1
-
-            total += 1
-
-        artists = sorted(artists.values(), key=lambda x: keys[x['name']])
-        genres = sorted(genres.values(), key=lambda x: x['name'])
-
-        data = {
-            # artists is a sorted list of items containing fields:
-            # count, name, albums, genres
-            # albums: map str -> item :: item: map str -> count
-            # genres: seq str
-            "artists": artists,
-
-            # genres is a sorted list of items containing fields:
-            # name, count, artist_count
-            "genres": genres,
-
-            # the total number of songs counted
-            "num_songs": total
-        }
-
-        return data
+            entry = (record[Song.artist],
+                     record[Song.artist_key],
+                     record[Song.album],
+                     parseGenres(record[Song.genre]),
+                     False)
+
+            counts.apply(entry, 1)
+
+        return counts.document()
 
     def search(self,
         user_id,
@@ -720,6 +842,13 @@ class LibraryDao(object):
         if not isinstance(rule, Rule):
             rule = self.grammar.ruleFromString(rule)
 
+        if self.index is not None:
+            if debug:
+                logging.debug(rule)
+            return self.index.get(domain_id).search(user_id, rule,
+                self._getIndexOrder(orderby), limit, offset,
+                showBanished, case_insensitive)
+
         SongTable = self.dbtables.SongDataTable.c
         UserTable = self.dbtables.SongUserDataTable.c
 
@@ -765,11 +894,14 @@ class LibraryDao(object):
         to skip to a particular page efficiently
 
         """
-        print(user_id, domain_id, rule, case_insensitive, last_id, limit)
-
         if not isinstance(rule, Rule):
             rule = self.grammar.ruleFromString(rule)
 
+        if self.index is not None:
+            return self.index.get(domain_id).search(user_id, rule,
+                [(Song.id, False)], limit, None, showBanished,
+                case_insensitive, last_id)
+
         SongTable = self.dbtables.SongDataTable.c
         UserTable = self.dbtables.SongUserDataTable.c
 
@@ -796,6 +928,248 @@ class LibraryDao(object):
 
         return self._query(user_id, domain_id, sql_rule, orderby, limit)
 
+    def seek(self,
+        user_id,
+        domain_id,
+        rule,
+        case_insensitive=True,
+        orderby=None,
+        limit=None,
+        token=None,
+        showBanished=False):
+        """
+        keyset pagination for any order accepted by search
+
+        returns a tuple (songs, token). The token is None after the last
+        page, otherwise it can be passed to the next call to continue
+        the search from the last song returned.
+
+        instead of an offset, the sort key of the last song is used to
+        filter the next page. The cost of fetching a page does not depend
+        on the number of pages that came before it. The song id is always
+        the last sort key, so that the order is total.
+        """
+
+        if not isinstance(rule, Rule):
+            rule = self.grammar.ruleFromString(rule)
+
+        order = self._getKeysetOrder(orderby, case_insensitive)
+        after = None if token is None else decodePageToken(order, token)
+        directions = [(name, descending) for name, descending, _ in order]
+
+        if self.index is not None:
+            songs, key = self.index.get(domain_id).seek(user_id, rule,
+                directions, limit, after, showBanished, case_insensitive)
+        else:
+            songs, key = self._seek(user_id, domain_id, rule,
+                case_insensitive, directions, limit, after, showBanished)
+
+        if key is None or limit is None or len(songs) < limit:
+            return songs, None
+
+        return songs, encodePageToken(order, key)
+
+    def stream(self,
+        user_id,
+        domain_id,
+        rule,
+        case_insensitive=True,
+        orderby=None,
+        showBanished=False,
+        page_size=1000):
+        """
+        return a generator of every song matching the search,
+        read one page at a time
+
+        only a single page of songs is held in memory at once. the rule
+        and order are checked before the generator is returned.
+        """
+
+        if not isinstance(rule, Rule):
+            rule = self.grammar.ruleFromString(rule)
+
+        # raises LibraryException for orders that can not be paginated
+        self._getKeysetOrder(orderby, case_insensitive)
+
+        return self._stream(user_id, domain_id, rule, case_insensitive,
+            orderby, showBanished, page_size)
+
+    def _stream(self, user_id, domain_id, rule, case_insensitive,
+        orderby, showBanished, page_size):
+
+        token = None
+        while True:
+            songs, token = self.seek(user_id, domain_id, rule,
+                case_insensitive, orderby, page_size, token, showBanished)
+
+            yield from songs
+
+            if token is None:
+                break
+
+    def sample(self,
+        user_id,
+        domain_id,
+        rule,
+        limit=None,
+        exclude=None,
+        showBanished=False):
+        """
+        return up to limit song ids matching the rule, in a random order
+
+        only the id and artist of each matching song are read, instead
+        of the full song. songs by the same artist are spread apart
+        using binshuffle.
+
+        when a limit is given, a random sample of the matching songs is
+        drawn first, so that the cost of the shuffle depends on the limit
+        and not on the number of songs matching the rule.
+
+        exclude: a set of song ids that should not be returned
+        """
+
+        if not isinstance(rule, Rule):
+            rule = self.grammar.ruleFromString(rule)
+
+        names = [Song.id, Song.artist]
+
+        count = None
+        if limit is not None:
+            # oversample, so that there are enough songs to spread
+            # the artists apart after removing excluded songs
+            count = self.SAMPLE_FACTOR * limit + len(exclude or ())
+
+        if self.index is not None:
+            rows = self.index.get(domain_id).values(user_id, rule,
+                names, showBanished, sample=count)
+        else:
+            rows = self._values(user_id, domain_id, rule, names,
+                showBanished, sample=count)
+
+        if exclude:
+            rows = [row for row in rows if row[0] not in exclude]
+
+        rows = binshuffle(rows, lambda row: row[1])
+
+        if limit is not None:
+            rows = rows[:limit]
+
+        return [row[0] for row in rows]
+
+    def findSongsById(self, user_id, domain_id, song_ids):
+        """ return the songs for a list of song ids, in the same order
+
+        song ids which do not exist are not returned
+        """
+
+        SongData = self.dbtables.SongDataTable
+
+        songs = {}
+        # limit the number of bound parameters in a single query
+        for i in range(0, len(song_ids), 500):
+            where = SongData.c.id.in_(song_ids[i:i + 500])
+            for song in self._query(user_id, domain_id, where):
+                songs[song['id']] = song
+
+        return [songs[song_id] for song_id in song_ids if song_id in songs]
+
+    def _values(self, user_id, domain_id, rule, names, showBanished,
+        sample=None):
+        """ return a list of tuples, one per song matching the rule,
+        containing only the given columns
+
+        sample: if given, return at most this many rows, chosen at random
+        """
+
+        SongTable = self.dbtables.SongDataTable.c
+        UserTable = self.dbtables.SongUserDataTable.c
+
+        sql_rule = rule.psql() if self.db.kind() == "postgresql" else rule.sql()
+
+        if not showBanished:
+            # remove entries that have either the blocked or banished bit set
+            stmt1 = SongTable.banished == 0
+            # if the left outer join produces a null, default to 0 and compare.
+            stmt2 = case([(UserTable.blocked == None, 0)],
+                         else_=UserTable.blocked) == 0
+            stmt3 = and_(stmt1, stmt2)
+            sql_rule = stmt3 if sql_rule is None else and_(sql_rule, stmt3)
+
+        columns = [self.grammar.getColumnType(name) for name in names]
+
+        if sample is not None:
+            # song ids are random uuids, so the songs following a random
+            # id are a random sample. reading forward from a random id,
+            # and wrapping around to the first id, walks the primary key
+            # index instead of sorting every matching song
+            start = str(uuid.uuid4())
+            results = []
+            for stmt in [SongTable.id >= start, SongTable.id < start]:
+                if sql_rule is not None:
+                    stmt = and_(sql_rule, stmt)
+                results.extend(self._execute(user_id, domain_id, stmt,
+                    orderby=[asc(SongTable.id)],
+                    limit=sample - len(results), columns=columns))
+                if len(results) >= sample:
+                    break
+        else:
+            results = self._execute(user_id, domain_id, sql_rule,
+                columns=columns)
+
+        return [tuple(row) for row in results]
+
+    def _seek(self, user_id, domain_id, rule, case_insensitive, order,
+        limit, after, showBanished):
+
+        SongTable = self.dbtables.SongDataTable.c
+        UserTable = self.dbtables.SongUserDataTable.c
+
+        sql_rule = rule.psql() if self.db.kind() == "postgresql" else rule.sql()
+
+        # the user data is a left outer join, replace null with the
+        # default value so that the keys can be compared
+        keys = []
+        for name, descending in order:
+            col = self.grammar.getColumnType(name)
+            expr = col
+            if case_insensitive and name in Song.textFields():
+                expr = func.lower(expr)
+            default = 0 if isinstance(col.type, Integer) else ""
+            keys.append((func.coalesce(expr, default), descending))
+
+        if after is not None:
+            # (k1 > v1) or (k1 == v1 and k2 > v2) or ...
+            terms = []
+            for i, (expr, descending) in enumerate(keys):
+                cmp = expr < after[i] if descending else expr > after[i]
+                eqs = [keys[j][0] == after[j] for j in range(i)]
+                terms.append(and_(*eqs, cmp) if eqs else cmp)
+            stmt = or_(*terms)
+            sql_rule = stmt if sql_rule is None else and_(sql_rule, stmt)
+
+        if not showBanished:
+            # remove entries that have either the blocked or banished bit set
+            stmt1 = SongTable.banished == 0
+            # if the left outer join produces a null, default to 0 and compare.
+            stmt2 = case([(UserTable.blocked == None, 0)],
+                         else_=UserTable.blocked) == 0
+            stmt3 = and_(stmt1, stmt2)
+            sql_rule = stmt3 if sql_rule is None else and_(sql_rule, stmt3)
+
+        orderby = [desc(expr) if descending else asc(expr)
+            for expr, descending in keys]
+
+        extra = [expr.label("_key%d" % i) for i, (expr, _) in enumerate(keys)]
+
+        results = self._execute(user_id, domain_id, sql_rule, orderby,
+            limit, None, extra)
+
+        key = None
+        if results:
+            key = list(results[-1][len(self.formatter.cols):])
+
+        return self.formatter.format(user_id, results), key
+
     def _query(self,
         user_id,
         domain_id,
@@ -803,6 +1177,27 @@ class LibraryDao(object):
         orderby=None,
         limit=None,
         offset=None):
+
+        results = self._execute(user_id, domain_id, where, orderby,
+            limit, offset)
+
+        return self.formatter.format(user_id, results)
+
+    def _execute(self,
+        user_id,
+        domain_id,
+        where=None,
+        orderby=None,
+        limit=None,
+        offset=None,
+        extra=None,
+        columns=None):
+        """ return the raw rows for a query
+
+        extra: additional column expressions to select, after
+            the formatter columns
+        columns: the columns to select, instead of the formatter columns
+        """
         SongData = self.dbtables.SongDataTable
         SongUserData = self.dbtables.SongUserDataTable
 
@@ -811,7 +1206,15 @@ class LibraryDao(object):
         else:
             where = SongData.c.domain_id == domain_id
 
-        query = select([column(c) for c in self.formatter.cols]) \
+        if columns is None:
+            columns = [column(c) for c in self.formatter.cols]
+        else:
+            columns = list(columns)
+
+        if extra:
+            columns.extend(extra)
+
+        query = select(columns) \
             .select_from(
                     SongData.join(
                         SongUserData,
@@ -829,9 +1232,7 @@ class LibraryDao(object):
         if offset is not None:
             query = query.offset(offset)
 
-        results = self.db.session.execute(query).fetchall()
-
-        return self.formatter.format(user_id, results)
+        return self.db.session.execute(query).fetchall()
 
     def _getSearchOrder(self, case_insensitive, orderby):
 
@@ -876,4 +1277,48 @@ class LibraryDao(object):
 
         return order
 
+    def _getKeysetOrder(self, orderby, case_insensitive):
+        """
+        like _getIndexOrder, but the song id is always the last key.
+        returns a list of (column, descending, case_insensitive)
+        """
+
+        order = self._getIndexOrder(orderby) or []
+
+        if order == "random":
+            raise LibraryException("random order can not be paginated")
+
+        if Song.id not in [name for name, _ in order]:
+            order.append((Song.id, False))
+
+        return [(name, descending,
+                    case_insensitive and name in Song.textFields())
+                for name, descending in order]
+
+    def _getIndexOrder(self, orderby):
+        """
+        like _getSearchOrder, but returns a list of (column, descending)
+        for sorting results from the library index
+        """
+
+        if orderby is None:
+            return None
+
+        if isinstance(orderby, str) and orderby.upper() == Song.random:
+            return "random"
+
+        if not isinstance(orderby, (tuple, list)):
+            orderby = [orderby, ]
 
+        order = []
+        for item in orderby:
+            if isinstance(item, (tuple, list)):
+                item, direction = item
+                descending = direction.upper() != Song.asc
+            else:
+                descending = False
+            # raises ParseError for invalid column names
+            name = self.grammar.getColumnType(item).name
+            order.append((name, descending))
+
+        return order
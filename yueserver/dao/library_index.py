@@ -0,0 +1,588 @@
+"""
+An in-memory, column oriented index of the song library
+
+A SongIndex holds one array per column of the song_data table for a
+single domain, and a per-user overlay for the columns of song_user_data.
+Search rules are evaluated one column at a time, producing a mask over all
+rows in the domain, instead of running a SQL join and formatting every
+matching row.
+
+The index is kept in sync by the LibraryDao, which patches it whenever
+a song is inserted, updated or removed, once the change is committed.
+"""
+import re
+import random
+import logging
+import threading
+from array import array
+
+from sqlalchemy import select
+
+from .util import after_commit
+
+from .search import BlankSearchRule, AndSearchRule, OrSearchRule, \
+    NotSearchRule, MultiColumnSearchRule, RangeSearchRule, \
+    NotRangeSearchRule, RegExpSearchRule, PartialStringSearchRule, \
+    InvertedPartialStringSearchRule, ExactSearchRule, \
+    InvertedExactSearchRule, LessThanSearchRule, LessThanEqualSearchRule, \
+    GreaterThanSearchRule, GreaterThanEqualSearchRule
+
+def _make_column(values, integer):
+    """ return a typed array for integer columns, otherwise a list """
+    if integer:
+        try:
+            return array('q', values)
+        except (TypeError, OverflowError):
+            pass
+    return list(values)
+
+def _lower(value):
+    return value.lower() if hasattr(value, "lower") else value
+
+def _default(value, default):
+    """ replace missing values, but not other false values such as 0 """
+    return default if value is None else value
+
+# map a column rule to a function comparing (value, rule value)
+# and whether the comparison ignores case. This follows the database:
+# partial matches use ILIKE, while other comparisons are case sensitive.
+_column_operators = {
+    PartialStringSearchRule: (lambda v, x: x in v, True),
+    InvertedPartialStringSearchRule: (lambda v, x: x not in v, True),
+    ExactSearchRule: (lambda v, x: v == x, False),
+    InvertedExactSearchRule: (lambda v, x: v != x, False),
+    LessThanSearchRule: (lambda v, x: v < x, False),
+    LessThanEqualSearchRule: (lambda v, x: v <= x, False),
+    GreaterThanSearchRule: (lambda v, x: v > x, False),
+    GreaterThanEqualSearchRule: (lambda v, x: v >= x, False),
+}
+
+def _follows(values, key, directions):
+    """ return true if values sort after key """
+    for v, k, descending in zip(values, key, directions):
+        if v != k:
+            return v < k if descending else v > k
+    return False
+
+class SongIndex(object):
+    """ column store for every song in a single domain
+
+    rows are unordered. removing a song moves the last row into the
+    removed slot, so that every column stays dense.
+
+    text_fields: columns which are matched ignoring case
+    sort_fields: columns which are sorted ignoring case
+    """
+
+    def __init__(self, domain_id, formatter, text_fields, sort_fields):
+        super(SongIndex, self).__init__()
+
+        self.domain_id = domain_id
+        self.formatter = formatter
+        self.text_fields = set(text_fields)
+        self.sort_fields = set(sort_fields)
+
+        self.cols_song = list(formatter.cols_song)
+        self.cols_user = list(formatter.cols_user)
+        self.defs_song = dict(zip(formatter.cols_song, formatter.defs_song))
+        self.defs_user = list(formatter.defs_user)
+        self.user_index = self.cols_user.index("user_id")
+
+        self.lock = threading.RLock()
+
+        self.ids = []
+        self.rowmap = {}
+        self.columns = {}
+        self.lowered = {}
+
+        # user_id -> song_id -> list of values, in cols_user order
+        self.overlay = {}
+        # user_id -> col -> list of values, one per row
+        self._user_columns = {}
+
+    def load(self, songs, user_records):
+        """
+        songs: a sequence of formatted rows, in cols_song order
+        user_records: a sequence of (user_id, song_id, values)
+        """
+
+        with self.lock:
+            rows = list(songs)
+            table = self.formatter.dbtables.SongDataTable.c
+
+            self.ids = [row[self.cols_song.index("id")] for row in rows]
+            self.rowmap = {sid: i for i, sid in enumerate(self.ids)}
+            self.columns = {}
+            self.lowered = {}
+            for j, name in enumerate(self.cols_song):
+                integer = self._isInteger(table, name)
+                self.columns[name] = _make_column(
+                    [row[j] for row in rows], integer)
+                if name in self.text_fields:
+                    self.lowered[name] = [_lower(v) for v in self.columns[name]]
+
+            self.overlay = {}
+            for user_id, song_id, values in user_records:
+                self.overlay.setdefault(user_id, {})[song_id] = list(values)
+            self._user_columns = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    # mutation
+
+    def insertSong(self, values):
+        """ add or replace a song given a mapping of column -> value """
+        with self.lock:
+            song_id = values['id']
+            if song_id in self.rowmap:
+                return self.updateSong(song_id, values)
+
+            self.rowmap[song_id] = len(self.ids)
+            self.ids.append(song_id)
+            for name in self.cols_song:
+                self._append(name,
+                    _default(values.get(name, None), self.defs_song[name]))
+            self._user_columns = {}
+
+    def updateSong(self, song_id, values):
+        """ update a subset of columns for a song """
+        with self.lock:
+            row = self.rowmap.get(song_id, None)
+            if row is None:
+                return
+            for name, value in values.items():
+                if name in self.columns:
+                    self._assign(name, row,
+                        _default(value, self.defs_song[name]))
+
+    def removeSong(self, song_id):
+        with self.lock:
+            row = self.rowmap.pop(song_id, None)
+            if row is None:
+                return
+            last = len(self.ids) - 1
+            if row != last:
+                moved = self.ids[last]
+                self.ids[row] = moved
+                self.rowmap[moved] = row
+                for name, col in self.columns.items():
+                    col[row] = col[last]
+                for name, col in self.lowered.items():
+                    col[row] = col[last]
+            self.ids.pop()
+            for col in self.columns.values():
+                col.pop()
+            for col in self.lowered.values():
+                col.pop()
+            for songs in self.overlay.values():
+                songs.pop(song_id, None)
+            self._user_columns = {}
+
+    def updateUserData(self, user_id, song_id, values):
+        """ update a subset of the user columns for a song """
+        with self.lock:
+            if song_id not in self.rowmap:
+                return
+            record = self._userRecord(user_id, song_id)
+            for name, value in values.items():
+                if name in self.cols_user and name != "user_id":
+                    j = self.cols_user.index(name)
+                    record[j] = _default(value, self.defs_user[j])
+                    self._patchUserColumn(user_id, song_id, name, record[j])
+
+    def incrementPlaycount(self, user_id, song_id, count=1):
+        with self.lock:
+            if song_id not in self.rowmap:
+                return
+            record = self._userRecord(user_id, song_id)
+            j = self.cols_user.index("play_count")
+            record[j] = (record[j] or 0) + count
+            self._patchUserColumn(user_id, song_id, "play_count", record[j])
+
+    def removeUserData(self, song_id):
+        with self.lock:
+            for user_id, songs in self.overlay.items():
+                if songs.pop(song_id, None) is not None:
+                    self._user_columns.pop(user_id, None)
+
+    # query
+
+    def search(self, user_id, rule, orderby=None, limit=None, offset=None,
+        showBanished=False, case_insensitive=True, last_id=None):
+        """ return formatted songs matching the rule
+
+        orderby: None, "random", or a list of (column, descending)
+        last_id: only return songs with an id greater than this value
+        """
+
+        with self.lock:
+            columns = _ColumnView(self, user_id)
+
+            rows = self._select(rule, columns, showBanished)
+
+            if last_id is not None:
+                ids = self.ids
+                rows = [i for i in rows if ids[i] > last_id]
+
+            if orderby == "random":
+                random.shuffle(rows)
+            elif orderby:
+                self._sort(rows, columns, orderby, case_insensitive)
+
+            if offset:
+                rows = rows[offset:]
+
+            if limit is not None:
+                rows = rows[:limit]
+
+            return self._format(user_id, rows)
+
+    def seek(self, user_id, rule, orderby, limit=None, after=None,
+        showBanished=False, case_insensitive=True):
+        """ keyset pagination
+
+        orderby: a list of (column, descending), ending in a unique column
+        after: the sort key of the last song of the previous page
+
+        returns a tuple (songs, key), where key is the sort key
+        of the last song returned.
+        """
+
+        with self.lock:
+            columns = _ColumnView(self, user_id)
+
+            keys = [columns.get(name, case_insensitive and name in self.sort_fields)
+                for name, _ in orderby]
+
+            rows = self._select(rule, columns, showBanished)
+
+            if after is not None:
+                directions = [descending for _, descending in orderby]
+                rows = [i for i in rows if
+                    _follows([k[i] for k in keys], after, directions)]
+
+            self._sort(rows, columns, orderby, case_insensitive)
+
+            if limit is not None:
+                rows = rows[:limit]
+
+            key = [k[rows[-1]] for k in keys] if rows else None
+
+            return self._format(user_id, rows), key
+
+    def values(self, user_id, rule, names, showBanished=False, sample=None):
+        """ return a list of tuples, one per song matching the rule,
+        containing only the given columns
+
+        sample: if given, return at most this many rows, chosen at random
+        """
+
+        with self.lock:
+            columns = _ColumnView(self, user_id)
+
+            rows = self._select(rule, columns, showBanished)
+
+            if sample is not None and sample < len(rows):
+                rows = random.sample(rows, sample)
+
+            cols = [columns.get(name) for name in names]
+
+            return [tuple(col[i] for col in cols) for i in rows]
+
+    # private
+
+    def _select(self, rule, columns, showBanished):
+        """ return the rows matching the rule """
+
+        mask = self._mask(rule, columns, len(self.ids))
+
+        if not showBanished:
+            banished = columns.get("banished")
+            blocked = columns.get("blocked")
+            mask = [m and not a and not b
+                for m, a, b in zip(mask, banished, blocked)]
+
+        return [i for i, m in enumerate(mask) if m]
+
+    def _sort(self, rows, columns, orderby, case_insensitive):
+        """ sort rows in place, using a stable sort for each column """
+        for name, descending in reversed(orderby):
+            lower = case_insensitive and name in self.sort_fields
+            col = columns.get(name, lower)
+            rows.sort(key=col.__getitem__, reverse=descending)
+
+    def _isInteger(self, table, name):
+        col = getattr(table, name, None)
+        try:
+            return col is not None and col.type.python_type is int
+        except NotImplementedError:
+            return False
+
+    def _append(self, name, value):
+        col = self.columns[name]
+        try:
+            col.append(value)
+        except TypeError:
+            col = self.columns[name] = list(col)
+            col.append(value)
+        if name in self.lowered:
+            self.lowered[name].append(_lower(value))
+
+    def _assign(self, name, row, value):
+        col = self.columns[name]
+        try:
+            col[row] = value
+        except TypeError:
+            col = self.columns[name] = list(col)
+            col[row] = value
+        if name in self.lowered:
+            self.lowered[name][row] = _lower(value)
+
+    def _userRecord(self, user_id, song_id):
+        songs = self.overlay.setdefault(user_id, {})
+        if song_id not in songs:
+            record = list(self.defs_user)
+            record[self.user_index] = user_id
+            songs[song_id] = record
+        return songs[song_id]
+
+    def _patchUserColumn(self, user_id, song_id, name, value):
+        cache = self._user_columns.get(user_id, None)
+        if cache is None:
+            return
+        row = self.rowmap[song_id]
+        if name in cache:
+            cache[name][row] = value
+        key = (name, True)
+        if key in cache:
+            cache[key][row] = _lower(value)
+
+    def _mask(self, rule, columns, n):
+        """ return a list of booleans, one per row, for rows matching rule """
+
+        if isinstance(rule, BlankSearchRule):
+            return [True] * n
+
+        if isinstance(rule, MultiColumnSearchRule):
+            return self._mask(rule.rule, columns, n)
+
+        if isinstance(rule, AndSearchRule):
+            mask = self._mask(rule.rules[0], columns, n)
+            for other in rule.rules[1:]:
+                mask = [a and b for a, b in
+                    zip(mask, self._mask(other, columns, n))]
+            return mask
+
+        if isinstance(rule, OrSearchRule):
+            mask = self._mask(rule.rules[0], columns, n)
+            for other in rule.rules[1:]:
+                mask = [a or b for a, b in
+                    zip(mask, self._mask(other, columns, n))]
+            return mask
+
+        if isinstance(rule, NotSearchRule):
+            return [not a for a in self._mask(rule.rules[0], columns, n)]
+
+        if isinstance(rule, RangeSearchRule):
+            values = columns.get(rule.column.name, True)
+            a = rule.type_(_lower(rule.value_low))
+            b = rule.type_(_lower(rule.value_high))
+            if isinstance(rule, NotRangeSearchRule):
+                return [v < a or v > b for v in values]
+            return [a <= v <= b for v in values]
+
+        if isinstance(rule, RegExpSearchRule):
+            values = columns.get(rule.column.name, False)
+            expr = re.compile(rule.value, re.IGNORECASE)
+            return [expr.search(v) is not None for v in values]
+
+        if type(rule) in _column_operators:
+            operator, fold = _column_operators[type(rule)]
+            values = columns.typed(rule.column.name, rule.type_, fold)
+            value = rule.type_(_lower(rule.value) if fold else rule.value)
+            return [operator(v, value) for v in values]
+
+        # unknown rule types fall back to checking one record at a time
+        return [rule.check(columns.record(i)) for i in range(n)]
+
+    def _format(self, user_id, rows):
+        songs = self.overlay.get(user_id, {})
+        defs = list(self.defs_user)
+        defs[self.user_index] = user_id
+        song_cols = [self.columns[name] for name in self.cols_song]
+        result = []
+        for i in rows:
+            values = [col[i] for col in song_cols]
+            values.extend(songs.get(self.ids[i], defs))
+            result.append(dict(zip(self.formatter.cols, values)))
+        return result
+
+class _ColumnView(object):
+    """ resolves column names for a single user of a SongIndex
+
+    user columns are built from the overlay on first use and cached
+    by the index until the set of rows changes.
+    """
+
+    def __init__(self, index, user_id):
+        super(_ColumnView, self).__init__()
+        self.index = index
+        self.user_id = user_id
+
+    def get(self, name, lower=False):
+        index = self.index
+        if name in index.columns:
+            if lower and name in index.lowered:
+                return index.lowered[name]
+            return index.columns[name]
+
+        cache = index._user_columns.setdefault(self.user_id, {})
+        if name not in cache:
+            j = index.cols_user.index(name)
+            songs = index.overlay.get(self.user_id, {})
+            default = index.defs_user[j]
+            if name == "user_id":
+                default = self.user_id
+            cache[name] = [songs[sid][j] if sid in songs else default
+                for sid in index.ids]
+
+        if lower:
+            key = (name, True)
+            if key not in cache:
+                cache[key] = [_lower(v) for v in cache[name]]
+            return cache[key]
+
+        return cache[name]
+
+    def typed(self, name, type_, fold):
+        """ return the column converted to type_, optionally lower case """
+        index = self.index
+        if type_ is str and name in index.lowered:
+            return index.lowered[name] if fold else index.columns[name]
+        if type_ is int and isinstance(index.columns.get(name, None), array):
+            return index.columns[name]
+        if fold:
+            return [type_(_lower(v)) for v in self.get(name)]
+        return [type_(v) for v in self.get(name)]
+
+    def record(self, i):
+        values = {name: col[i] for name, col in self.index.columns.items()}
+        for name in self.index.cols_user:
+            values[name] = self.get(name)[i]
+        return values
+
+class LibraryIndex(object):
+    """ a collection of SongIndex, one per domain, built on first use """
+
+    def __init__(self, db, dbtables, formatter, text_fields, sort_fields):
+        super(LibraryIndex, self).__init__()
+        self.db = db
+        self.dbtables = dbtables
+        self.formatter = formatter
+        self.text_fields = text_fields
+        self.sort_fields = sort_fields
+
+        self.lock = threading.Lock()
+        self.domains = {}
+
+    def get(self, domain_id):
+        """ return the index for a domain, building it if required """
+        with self.lock:
+            index = self.domains.get(domain_id, None)
+            if index is None:
+                index = self._build(domain_id)
+                self.domains[domain_id] = index
+            return index
+
+    def find(self, domain_id):
+        """ return the index for a domain, or None if it has not been built """
+        return self.domains.get(domain_id, None)
+
+    def invalidate(self, domain_id=None):
+        """ drop the index for a domain, or all domains """
+        with self.lock:
+            if domain_id is None:
+                self.domains = {}
+            else:
+                self.domains.pop(domain_id, None)
+
+    def insertSong(self, domain_id, values):
+        self._patch(lambda index: index.insertSong(values), domain_id)
+
+    def updateSong(self, domain_id, song_id, values):
+        self._patch(lambda index: index.updateSong(song_id, values), domain_id)
+
+    def removeSong(self, domain_id, song_id):
+        self._patch(lambda index: index.removeSong(song_id), domain_id)
+
+    def updateUserData(self, user_id, song_id, values):
+        self._patch(lambda index: index.updateUserData(user_id, song_id, values))
+
+    def incrementPlaycount(self, user_id, song_id, count=1):
+        self._patch(lambda index: index.incrementPlaycount(user_id, song_id, count))
+
+    def removeUserData(self, song_id):
+        self._patch(lambda index: index.removeUserData(song_id))
+
+    def _patch(self, fn, domain_id=None):
+        """ apply fn to the index for a domain, or for every domain,
+        once the current transaction is committed
+
+        an index built after the change was written may already include
+        the change, and is dropped so that it is built again
+        """
+
+        with self.lock:
+            before = dict(self.domains)
+
+        def apply():
+            with self.lock:
+                for key, index in list(self.domains.items()):
+                    if domain_id is not None and key != domain_id:
+                        continue
+                    if before.get(key, None) is index:
+                        fn(index)
+                    else:
+                        del self.domains[key]
+
+        after_commit(self.db.session, apply)
+
+    def _build(self, domain_id):
+
+        SongData = self.dbtables.SongDataTable
+        SongUserData = self.dbtables.SongUserDataTable
+
+        cols_song = self.formatter.cols_song
+        defs_song = self.formatter.defs_song
+        cols_user = [c for c in self.formatter.cols_user if c != "user_id"]
+        defs_user = dict(zip(self.formatter.cols_user, self.formatter.defs_user))
+
+        query = select([getattr(SongData.c, c) for c in cols_song]) \
+            .where(SongData.c.domain_id == domain_id)
+        songs = [[_default(v, d) for v, d in zip(row, defs_song)]
+            for row in self.db.session.execute(query).fetchall()]
+
+        query = select([SongUserData.c.user_id, SongUserData.c.song_id] +
+                       [getattr(SongUserData.c, c) for c in cols_user]) \
+            .select_from(SongUserData.join(SongData,
+                SongData.c.id == SongUserData.c.song_id)) \
+            .where(SongData.c.domain_id == domain_id)
+
+        records = []
+        for row in self.db.session.execute(query).fetchall():
+            user_id, song_id = row[0], row[1]
+            values = dict(zip(cols_user, row[2:]))
+            values['user_id'] = user_id
+            record = [_default(values[c], defs_user[c])
+                for c in self.formatter.cols_user]
+            records.append((user_id, song_id, record))
+
+        index = SongIndex(domain_id, self.formatter, self.text_fields,
+            self.sort_fields)
+        index.load(songs, records)
+
+        logging.info("built library index for domain %s: %d songs",
+            domain_id, len(index))
+
+        return index
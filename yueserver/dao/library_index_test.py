@@ -0,0 +1,354 @@
+import os
+import unittest
+
+from .db import db_init_main, db_connect
+
+from .user import UserDao
+from .library import Song, LibraryDao, LibraryException
+from .search import ParseError
+
+class LibraryIndexTestCase(unittest.TestCase):
+    """
+    check that searching the in-memory index returns the same results
+    as searching the database
+    """
+
+    @classmethod
+    def setUpClass(cls):
+
+        db = db_connect(None)
+
+        env_cfg = {
+            'features': ['test', ],
+            'domains': ['test'],
+            'filesystems': {},
+            'roles': [
+                {'test': {'features': ['all'], 'filesystems': []}},
+            ],
+            'users': [
+                {'email': 'user000',
+                 'password': 'user000',
+                 'domains': ['test'],
+                 'roles': ['test']},
+                {'email': 'user001',
+                 'password': 'user001',
+                 'domains': ['test'],
+                 'roles': ['test']},
+            ]
+        }
+
+        db_init_main(db, db.tables, env_cfg)
+
+        cls.userDao = UserDao(db, db.tables)
+        cls.USER = cls.userDao.findUserByEmail("user000")
+        cls.USER2 = cls.userDao.findUserByEmail("user001")
+
+        cls.sqlDao = LibraryDao(db, db.tables)
+        cls.indexDao = LibraryDao(db, db.tables, index=True)
+
+        user_id = cls.USER['id']
+        domain_id = cls.USER['domain_id']
+
+        for a in range(3):
+            for b in range(3):
+                for t in range(3):
+                    song = {
+                        Song.artist: "The Artist%03d" % a,
+                        Song.album: "Album%03d" % b,
+                        Song.title: "Title%03d" % t,
+                        Song.genre: "rock" if t else "pop",
+                        Song.year: 1990 + a * 10 + b,
+                        Song.album_index: t,
+                        Song.rating: (a + b + t) % 10,
+                        Song.banished: 1 if (a, b, t) == (2, 2, 2) else 0,
+                    }
+                    # the index dao is used to insert so that both the
+                    # database and the index are updated
+                    cls.sqlDao.insert(user_id, domain_id, song)
+
+        cls.db = db
+
+    def assertSameResults(self, query, orderby=None, user=None, **kwargs):
+        user = user or self.USER
+
+        expected = self.sqlDao.search(user['id'], user['domain_id'],
+            query, orderby=orderby, **kwargs)
+        actual = self.indexDao.search(user['id'], user['domain_id'],
+            query, orderby=orderby, **kwargs)
+
+        if orderby is None:
+            expected.sort(key=lambda s: s[Song.id])
+            actual.sort(key=lambda s: s[Song.id])
+
+        self.assertEqual(len(expected), len(actual), query)
+        for a, b in zip(expected, actual):
+            self.assertEqual(a, b, query)
+
+    def test_001_search(self):
+
+        queries = [
+            "",
+            "artist=artist001",
+            "title001",
+            "art=artist001 || alb=album002",
+            "! art=artist001",
+            "art=~\"artist00[12]$\"",
+            "year > 2000",
+            "year >= 2010 && year < 2012",
+            "rating = 5",
+            "rating != 5",
+            "gen==;rock;",
+            "index < 2",
+            "pcnt > 0",
+            "added < 5",
+        ]
+
+        for query in queries:
+            self.assertSameResults(query)
+
+        self.assertSameResults("", showBanished=True)
+
+    def test_002_search_order(self):
+
+        orders = [
+            Song.artist_key,
+            [Song.artist_key, Song.album, Song.title],
+            [(Song.year, Song.desc), (Song.title, Song.asc)],
+        ]
+
+        for orderby in orders:
+            self.assertSameResults("", orderby=orderby)
+            self.assertSameResults("", orderby=orderby, limit=5, offset=3)
+
+    def test_003_insert_update_remove(self):
+
+        user_id = self.USER['id']
+        domain_id = self.USER['domain_id']
+
+        # build the index before modifying the library
+        self.indexDao.search(user_id, domain_id, "")
+
+        song = {
+            Song.artist: "New Artist",
+            Song.album: "New Album",
+            Song.title: "New Title",
+            Song.rating: 7,
+        }
+        song_id = self.indexDao.insert(user_id, domain_id, song)
+        self.assertSameResults("art=\"new artist\"")
+
+        self.indexDao.update(user_id, domain_id, song_id,
+            {Song.title: "Other Title", Song.rating: 3})
+        self.assertSameResults("ttl=other")
+        self.assertSameResults("rating=3")
+
+        self.indexDao.incrementPlaycount(user_id, song_id)
+        self.indexDao.incrementPlaycount(self.USER2['id'], song_id)
+        self.assertSameResults("pcnt=1")
+        self.assertSameResults("pcnt=1", user=self.USER2)
+
+        self.indexDao.update(self.USER2['id'], domain_id, song_id,
+            {Song.blocked: 1})
+        self.assertSameResults("art=\"new artist\"", user=self.USER2)
+
+        self.indexDao.removeSong(domain_id, song_id)
+        self.assertSameResults("")
+        self.assertSameResults("art=\"new artist\"")
+
+    def test_004_paginate(self):
+
+        user_id = self.USER['id']
+        domain_id = self.USER['domain_id']
+
+        last_id = None
+        for i in range(4):
+            expected = self.sqlDao.paginate(user_id, domain_id, "",
+                limit=7, last_id=last_id)
+            actual = self.indexDao.paginate(user_id, domain_id, "",
+                limit=7, last_id=last_id)
+            self.assertEqual(expected, actual)
+            if not actual:
+                break
+            last_id = actual[-1][Song.id]
+
+    def test_005_seek(self):
+
+        user_id = self.USER['id']
+        domain_id = self.USER['domain_id']
+
+        orders = [
+            None,
+            Song.artist_key,
+            [(Song.year, Song.desc), (Song.title, Song.asc)],
+            [(Song.rating, Song.desc), (Song.album, Song.asc)],
+        ]
+
+        for orderby in orders:
+            if orderby is None:
+                order = [(Song.id, Song.asc)]
+            elif isinstance(orderby, list):
+                order = orderby + [(Song.id, Song.asc)]
+            else:
+                order = [(orderby, Song.asc), (Song.id, Song.asc)]
+
+            expected = self.sqlDao.search(user_id, domain_id, "",
+                orderby=order)
+
+            for dao in [self.sqlDao, self.indexDao]:
+                songs = []
+                token = None
+                for i in range(10):
+                    page, token = dao.seek(user_id, domain_id, "",
+                        orderby=orderby, limit=4, token=token)
+                    self.assertTrue(len(page) <= 4)
+                    songs.extend(page)
+                    if token is None:
+                        break
+
+                self.assertEqual(expected, songs, orderby)
+
+                songs = list(dao.stream(user_id, domain_id, "",
+                    orderby=orderby, page_size=5))
+                self.assertEqual(expected, songs, orderby)
+
+    def test_006_seek_invalid(self):
+
+        user_id = self.USER['id']
+        domain_id = self.USER['domain_id']
+
+        _, token = self.sqlDao.seek(user_id, domain_id, "",
+            orderby=Song.title, limit=1)
+
+        with self.assertRaises(LibraryException):
+            self.sqlDao.seek(user_id, domain_id, "",
+                orderby=Song.album, limit=1, token=token)
+
+        with self.assertRaises(LibraryException):
+            self.sqlDao.seek(user_id, domain_id, "",
+                orderby=Song.title, limit=1, token="invalid")
+
+        with self.assertRaises(LibraryException):
+            self.sqlDao.seek(user_id, domain_id, "",
+                orderby=Song.random, limit=1)
+
+        with self.assertRaises(LibraryException):
+            self.sqlDao.seek(user_id, domain_id, "",
+                orderby="random", limit=1)
+
+        # errors are raised before the first song is read
+        with self.assertRaises(LibraryException):
+            self.sqlDao.stream(user_id, domain_id, "", orderby="random")
+
+        with self.assertRaises(ParseError):
+            self.sqlDao.stream(user_id, domain_id, "invalid=")
+
+    def test_007_sample(self):
+
+        user_id = self.USER['id']
+        domain_id = self.USER['domain_id']
+
+        songs = self.sqlDao.search(user_id, domain_id, "art=artist001")
+        expected = set(song[Song.id] for song in songs)
+        exclude = set(list(expected)[:2])
+
+        for dao in [self.sqlDao, self.indexDao]:
+            song_ids = dao.sample(user_id, domain_id, "art=artist001")
+            self.assertEqual(len(song_ids), len(expected))
+            self.assertEqual(set(song_ids), expected)
+
+            song_ids = dao.sample(user_id, domain_id, "art=artist001",
+                limit=3, exclude=exclude)
+            self.assertEqual(len(song_ids), 3)
+            self.assertTrue(set(song_ids) < expected - exclude)
+
+    def test_008_sample_songs(self):
+
+        user_id = self.USER['id']
+        domain_id = self.USER['domain_id']
+
+        songs = self.sqlDao.search(user_id, domain_id, "")
+        expected = set(song[Song.id] for song in songs)
+
+        for dao in [self.sqlDao, self.indexDao]:
+            song_ids = dao.sample(user_id, domain_id, "", limit=5)
+            self.assertEqual(len(song_ids), 5)
+            self.assertEqual(len(set(song_ids)), 5)
+            self.assertTrue(set(song_ids) < expected)
+
+            songs = dao.findSongsById(user_id, domain_id, song_ids)
+            self.assertEqual([song[Song.id] for song in songs], song_ids)
+
+            # a sample of every song
+            song_ids = dao.sample(user_id, domain_id, "",
+                limit=len(expected))
+            self.assertEqual(set(song_ids), expected)
+
+    def test_009_insert_values(self):
+
+        user_id = self.USER['id']
+        domain_id = self.USER['domain_id']
+
+        # build the index before modifying the library
+        self.indexDao.search(user_id, domain_id, "")
+
+        song_ids = []
+        for path in ["/B.mp3", "/a.mp3", "/c.mp3"]:
+            song = {
+                Song.artist: "Path Artist",
+                Song.album: "Path Album",
+                Song.title: path,
+                Song.path: path,
+            }
+            song_ids.append(self.indexDao.insert(user_id, domain_id, song))
+
+        try:
+            # the path is sorted using the same case as the database
+            self.assertSameResults("art=\"path artist\"",
+                orderby=[Song.path])
+
+            # false values are not replaced by the column default
+            for song_id in song_ids:
+                self.indexDao.update(user_id, domain_id, song_id,
+                    {Song.date_added: 0})
+            songs = self.indexDao.search(user_id, domain_id,
+                "art=\"path artist\"", orderby=Song.date_added)
+            self.assertEqual([song[Song.date_added] for song in songs],
+                [0, 0, 0])
+        finally:
+            for song_id in song_ids:
+                self.indexDao.removeSong(domain_id, song_id)
+
+    def test_010_rollback(self):
+
+        user_id = self.USER['id']
+        domain_id = self.USER['domain_id']
+
+        # build the index before modifying the library
+        self.indexDao.search(user_id, domain_id, "")
+
+        song = {
+            Song.artist: "Rollback Artist",
+            Song.album: "Rollback Album",
+            Song.title: "Rollback Title",
+        }
+
+        # the index is not changed until the session is committed
+        self.indexDao.insert(user_id, domain_id, song, commit=False)
+        self.db.session.rollback()
+        self.assertSameResults("art=\"rollback artist\"")
+        self.assertSameResults("")
+
+        song_id = self.indexDao.insert(user_id, domain_id, song, commit=False)
+        self.indexDao.incrementPlaycount(user_id, song_id, commit=False)
+        self.db.session.commit()
+        self.assertSameResults("art=\"rollback artist\" pcnt=1")
+
+        self.indexDao.removeSong(domain_id, song_id)
+        self.assertSameResults("")
+
+def main():
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(LibraryIndexTestCase)
+    unittest.TextTestRunner().run(suite)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+"""
+An in-memory summary of the artists, albums and genres in a domain
+
+A DomainSummary keeps running counts for every song in a single domain,
+along with the set of songs each user has blocked. The summary document
+returned by /api/library/info is generated from the counts, instead
+of scanning every song in the domain.
+
+The summary is kept in sync by the LibraryDao, which patches it whenever
+a song is inserted, updated or removed, once the change is committed.
+Every change increments a version
+number, which can be used as an ETag.
+"""
+import uuid
+import threading
+from collections import Counter
+
+from sqlalchemy import select, and_
+
+from .util import after_commit
+
+def parseGenres(text):
+    """ return the list of genres in a comma or semi-colon separated string
+    """
+    if not text:
+        return []
+    text = text.replace(",", ";").strip()
+    # attempt to de-duplicate genre names
+    genres = [g.strip().title() for g in text.split(";")]
+    return [g for g in genres if g]
+
+def _entry(values):
+    """ return the summary entry for a song record """
+    return (values.get('artist', None) or "",
+            values.get('artist_key', None) or "",
+            values.get('album', None) or "",
+            tuple(parseGenres(values.get('genre', None))),
+            bool(values.get('banished', None)))
+
+class SummaryCounts(object):
+    """ counts of artists, albums and genres for a set of songs """
+
+    def __init__(self):
+        super(SummaryCounts, self).__init__()
+        self.artists = Counter()
+        self.artist_keys = Counter()  # (artist, artist_key)
+        self.albums = Counter()  # (artist, album)
+        self.artist_genres = Counter()  # (artist, genre)
+        self.genres = Counter()
+        self.genre_artists = Counter()
+        self.total = 0
+
+    def copy(self):
+        other = SummaryCounts()
+        other.artists = self.artists.copy()
+        other.artist_keys = self.artist_keys.copy()
+        other.albums = self.albums.copy()
+        other.artist_genres = self.artist_genres.copy()
+        other.genres = self.genres.copy()
+        other.genre_artists = self.genre_artists.copy()
+        other.total = self.total
+        return other
+
+    def apply(self, entry, delta):
+        """ add (delta=1) or remove (delta=-1) a song entry """
+        art, key, alb, genres, _ = entry
+
+        self.total += delta
+        self._add(self.artists, art, delta)
+        self._add(self.artist_keys, (art, key), delta)
+        self._add(self.albums, (art, alb), delta)
+
+        for g in genres:
+            self._add(self.genres, g, delta)
+            n = self._add(self.artist_genres, (art, g), delta)
+            # count the number of distinct artists in each genre
+            if delta > 0 and n == delta:
+                self._add(self.genre_artists, g, 1)
+            elif delta < 0 and n == 0:
+                self._add(self.genre_artists, g, -1)
+
+    def _add(self, counter, key, delta):
+        n = counter[key] + delta
+        if n > 0:
+            counter[key] = n
+        else:
+            del counter[key]
+        return n
+
+    def document(self):
+        """ return the domain info document """
+
+        artists = {}
+        for art, count in self.artists.items():
+            artists[art] = {"count": count,
+                            "albums": {},
+                            "name": art,
+                            "genres": []}
+
+        keys = {}
+        for art, key in sorted(self.artist_keys):
+            keys.setdefault(art, key)
+
+        for (art, alb), count in self.albums.items():
+            artists[art]['albums'][alb] = count
+
+        for (art, g) in sorted(self.artist_genres):
+            artists[art]['genres'].append(g)
+
+        genres = [{"name": g,
+                   "count": count,
+                   "artist_count": self.genre_artists[g]}
+                  for g, count in self.genres.items()]
+
+        artists = sorted(artists.values(), key=lambda x: keys[x['name']])
+        genres = sorted(genres, key=lambda x: x['name'])
+
+        return {
+            # artists is a sorted list of items containing fields:
+            # count, name, albums, genres
+            # albums: map str -> item :: item: map str -> count
+            # genres: seq str
+            "artists": artists,
+
+            # genres is a sorted list of items containing fields:
+            # name, count, artist_count
+            "genres": genres,
+
+            # the total number of songs counted
+            "num_songs": self.total
+        }
+
+class DomainSummary(object):
+    """ summary of every song in a single domain
+
+    songs banished by the domain are not counted. songs blocked by
+    a user are removed from the counts when generating the summary
+    for that user.
+    """
+
+    def __init__(self, domain_id):
+        super(DomainSummary, self).__init__()
+        self.domain_id = domain_id
+
+        self.lock = threading.RLock()
+
+        self.songs = {}
+        self.counts = SummaryCounts()
+        self.blocked = {}
+
+        # a unique id for this instance, so that versions are not
+        # reused after the summary is rebuilt.
+        self.uid = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.user_versions = {}
+
+        self.cache = {}
+
+    def info(self, user_id=None):
+        """ return the domain info document
+
+        user_id: if given, remove songs blocked by this user
+        """
+
+        with self.lock:
+            version = self.getVersion(user_id)
+
+            item = self.cache.get(user_id, None)
+            if item is not None and item[0] == version:
+                return item[1]
+
+            blocked = self.blocked.get(user_id, None) if user_id else None
+
+            if blocked:
+                counts = self.counts.copy()
+                for song_id in blocked:
+                    entry = self.songs.get(song_id, None)
+                    if entry is not None and not entry[4]:
+                        counts.apply(entry, -1)
+            else:
+                counts = self.counts
+
+            data = counts.document()
+            self.cache[user_id] = (version, data)
+            return data
+
+    def getVersion(self, user_id=None):
+        """ return a string which changes whenever the info changes """
+        if user_id is None:
+            return "%s-%d" % (self.uid, self.version)
+        return "%s-%d-%d" % (self.uid, self.version,
+            self.user_versions.get(user_id, 0))
+
+    def insertSong(self, song_id, values):
+        with self.lock:
+            if song_id in self.songs:
+                self._remove(song_id)
+            entry = _entry(values)
+            self.songs[song_id] = entry
+            if not entry[4]:
+                self.counts.apply(entry, 1)
+            self._changed()
+
+    def updateSong(self, song_id, values):
+        with self.lock:
+            entry = self.songs.get(song_id, None)
+            if entry is None:
+                return
+
+            record = {
+                'artist': entry[0],
+                'artist_key': entry[1],
+                'album': entry[2],
+                'genre': ";".join(entry[3]),
+                'banished': entry[4],
+            }
+            changed = False
+            for key in record.keys():
+                if key in values:
+                    record[key] = values[key]
+                    changed = True
+
+            if changed:
+                self._remove(song_id)
+                self.insertSong(song_id, record)
+
+    def removeSong(self, song_id):
+        with self.lock:
+            if song_id in self.songs:
+                self._remove(song_id)
+                self._changed()
+
+    def setBlocked(self, user_id, song_id, blocked):
+        with self.lock:
+            songs = self.blocked.setdefault(user_id, set())
+            if blocked and song_id not in songs:
+                songs.add(song_id)
+            elif not blocked and song_id in songs:
+                songs.remove(song_id)
+            else:
+                return
+            self._userChanged(user_id)
+
+    def removeUserData(self, song_id):
+        with self.lock:
+            for user_id, songs in self.blocked.items():
+                if song_id in songs:
+                    songs.remove(song_id)
+                    self._userChanged(user_id)
+
+    def _remove(self, song_id):
+        entry = self.songs.pop(song_id)
+        if not entry[4]:
+            self.counts.apply(entry, -1)
+
+    def _changed(self):
+        self.version += 1
+        self.cache = {}
+
+    def _userChanged(self, user_id):
+        self.user_versions[user_id] = self.user_versions.get(user_id, 0) + 1
+        self.cache.pop(user_id, None)
+
+class LibrarySummary(object):
+    """ a collection of DomainSummary, one per domain, built on first use """
+
+    def __init__(self, db, dbtables):
+        super(LibrarySummary, self).__init__()
+        self.db = db
+        self.dbtables = dbtables
+
+        self.lock = threading.Lock()
+        self.domains = {}
+
+    def get(self, domain_id):
+        """ return the summary for a domain, building it if required """
+        with self.lock:
+            summary = self.domains.get(domain_id, None)
+            if summary is None:
+                summary = self._build(domain_id)
+                self.domains[domain_id] = summary
+            return summary
+
+    def find(self, domain_id):
+        """ return the summary for a domain, or None if it has not been built """
+        return self.domains.get(domain_id, None)
+
+    def invalidate(self, domain_id=None):
+        """ drop the summary for a domain, or all domains """
+        with self.lock:
+            if domain_id is None:
+                self.domains = {}
+            else:
+                self.domains.pop(domain_id, None)
+
+    def insertSong(self, domain_id, values):
+        self._patch(lambda summary: summary.insertSong(values['id'], values),
+            domain_id)
+
+    def updateSong(self, domain_id, song_id, values):
+        self._patch(lambda summary: summary.updateSong(song_id, values),
+            domain_id)
+
+    def removeSong(self, domain_id, song_id):
+        self._patch(lambda summary: summary.removeSong(song_id), domain_id)
+
+    def updateUserData(self, user_id, song_id, values):
+        if 'blocked' not in values:
+            return
+
+        def apply(summary):
+            if song_id in summary.songs:
+                summary.setBlocked(user_id, song_id, bool(values['blocked']))
+
+        self._patch(apply)
+
+    def removeUserData(self, song_id):
+        self._patch(lambda summary: summary.removeUserData(song_id))
+
+    def _patch(self, fn, domain_id=None):
+        """ apply fn to the summary for a domain, or for every domain,
+        once the current transaction is committed
+
+        a summary built after the change was written may already include
+        the change, and is dropped so that it is built again
+        """
+
+        with self.lock:
+            before = dict(self.domains)
+
+        def apply():
+            with self.lock:
+                for key, summary in list(self.domains.items()):
+                    if domain_id is not None and key != domain_id:
+                        continue
+                    if before.get(key, None) is summary:
+                        fn(summary)
+                    else:
+                        del self.domains[key]
+
+        after_commit(self.db.session, apply)
+
+    def _build(self, domain_id):
+
+        SongData = self.dbtables.SongDataTable
+        SongUserData = self.dbtables.SongUserDataTable
+
+        summary = DomainSummary(domain_id)
+
+        query = select([SongData.c.id,
+                        SongData.c.artist,
+                        SongData.c.artist_key,
+                        SongData.c.album,
+                        SongData.c.genre,
+                        SongData.c.banished]) \
+            .where(SongData.c.domain_id == domain_id)
+
+        for record in self.db.session.execute(query).fetchall():
+            summary.insertSong(record['id'], dict(record))
+
+        query = select([SongUserData.c.user_id, SongUserData.c.song_id]) \
+            .select_from(SongUserData.join(SongData,
+                SongData.c.id == SongUserData.c.song_id)) \
+            .where(and_(SongData.c.domain_id == domain_id,
+                        SongUserData.c.blocked != 0))
+
+        for user_id, song_id in self.db.session.execute(query).fetchall():
+            summary.setBlocked(user_id, song_id, True)
+
+        return summary
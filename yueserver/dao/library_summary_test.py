@@ -0,0 +1,160 @@
+import os
+import unittest
+
+from .db import db_init_main, db_connect
+
+from .user import UserDao
+from .library import Song, LibraryDao
+
+class LibrarySummaryTestCase(unittest.TestCase):
+    """
+    check that the in-memory domain summary matches the summary
+    generated by scanning the database
+    """
+
+    @classmethod
+    def setUpClass(cls):
+
+        db = db_connect(None)
+
+        env_cfg = {
+            'features': ['test', ],
+            'domains': ['test'],
+            'filesystems': {},
+            'roles': [
+                {'test': {'features': ['all'], 'filesystems': []}},
+            ],
+            'users': [
+                {'email': 'user000',
+                 'password': 'user000',
+                 'domains': ['test'],
+                 'roles': ['test']},
+                {'email': 'user001',
+                 'password': 'user001',
+                 'domains': ['test'],
+                 'roles': ['test']},
+            ]
+        }
+
+        db_init_main(db, db.tables, env_cfg)
+
+        cls.userDao = UserDao(db, db.tables)
+        cls.USER = cls.userDao.findUserByEmail("user000")
+        cls.USER2 = cls.userDao.findUserByEmail("user001")
+
+        cls.sqlDao = LibraryDao(db, db.tables)
+        cls.summaryDao = LibraryDao(db, db.tables, summary=True)
+
+        user_id = cls.USER['id']
+        domain_id = cls.USER['domain_id']
+
+        for a in range(3):
+            for b in range(3):
+                for t in range(3):
+                    song = {
+                        Song.artist: "Artist%03d" % a,
+                        Song.album: "Album%03d" % b,
+                        Song.title: "Title%03d" % t,
+                        Song.genre: "rock, Genre%03d" % b,
+                        Song.banished: 1 if t == 2 else 0,
+                        Song.blocked: 1 if t == 1 and a == 1 else 0,
+                    }
+                    cls.sqlDao.insert(user_id, domain_id, song)
+
+        cls.db = db
+
+    def assertSameInfo(self):
+        domain_id = self.USER['domain_id']
+
+        expected = self.sqlDao.domainSongInfo(domain_id)
+        actual = self.summaryDao.domainSongInfo(domain_id)
+        self.assertEqual(expected, actual)
+
+        for user in [self.USER, self.USER2]:
+            expected = self.sqlDao.domainSongUserInfo(user['id'], domain_id)
+            actual = self.summaryDao.domainSongUserInfo(user['id'], domain_id)
+            self.assertEqual(expected, actual)
+
+    def test_001_info(self):
+
+        self.assertSameInfo()
+
+        info = self.summaryDao.domainSongInfo(self.USER['domain_id'])
+        self.assertEqual(info['num_songs'], 3 * 3 * 2)
+        genres = {g['name']: g for g in info['genres']}
+        self.assertEqual(genres['Rock']['count'], 3 * 3 * 2)
+        self.assertEqual(genres['Rock']['artist_count'], 3)
+
+    def test_002_update(self):
+
+        user_id = self.USER['id']
+        user2_id = self.USER2['id']
+        domain_id = self.USER['domain_id']
+
+        version = self.summaryDao.domainSongUserInfoVersion(user_id, domain_id)
+        version2 = self.summaryDao.domainSongUserInfoVersion(user2_id, domain_id)
+
+        song = {
+            Song.artist: "New Artist",
+            Song.album: "New Album",
+            Song.title: "New Title",
+            Song.genre: "pop",
+        }
+        song_id = self.summaryDao.insert(user_id, domain_id, song)
+        self.assertSameInfo()
+
+        version_ = self.summaryDao.domainSongUserInfoVersion(user_id, domain_id)
+        self.assertNotEqual(version, version_)
+
+        self.summaryDao.update(user_id, domain_id, song_id,
+            {Song.album: "Other Album", Song.genre: "rock"})
+        self.assertSameInfo()
+
+        version = self.summaryDao.domainSongUserInfoVersion(user_id, domain_id)
+        version2 = self.summaryDao.domainSongUserInfoVersion(user2_id, domain_id)
+
+        # blocking a song only changes the version for that user
+        self.summaryDao.update(user_id, domain_id, song_id, {Song.blocked: 1})
+        self.assertSameInfo()
+
+        version_ = self.summaryDao.domainSongUserInfoVersion(user_id, domain_id)
+        self.assertNotEqual(version, version_)
+
+        version_ = self.summaryDao.domainSongUserInfoVersion(user2_id, domain_id)
+        self.assertEqual(version2, version_)
+
+        self.summaryDao.update(user_id, domain_id, song_id, {Song.blocked: 0})
+        self.assertSameInfo()
+
+        self.summaryDao.removeSong(domain_id, song_id)
+        self.assertSameInfo()
+
+    def test_003_rollback(self):
+
+        user_id = self.USER['id']
+        domain_id = self.USER['domain_id']
+
+        self.assertSameInfo()
+        version = self.summaryDao.domainSongUserInfoVersion(user_id, domain_id)
+
+        song = {
+            Song.artist: "Rollback Artist",
+            Song.album: "Rollback Album",
+            Song.title: "Rollback Title",
+            Song.genre: "jazz",
+        }
+
+        # the summary is not changed until the session is committed
+        self.summaryDao.insert(user_id, domain_id, song, commit=False)
+        self.db.session.rollback()
+        self.assertSameInfo()
+
+        version_ = self.summaryDao.domainSongUserInfoVersion(user_id, domain_id)
+        self.assertEqual(version, version_)
+
+def main():
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(LibrarySummaryTestCase)
+    unittest.TextTestRunner().run(suite)
+
+if __name__ == '__main__':
+    main()
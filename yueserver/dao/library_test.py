@@ -363,6 +363,39 @@ class LibraryTestCase(unittest.TestCase):
         self.assertEqual(song000[Song.play_count], 2)
         self.assertEqual(song001[Song.play_count], 1)
 
+    def test_003d_bulk_increment_playcount(self):
+
+        user000 = self.userDao.findUserByEmail("user000")
+        user001 = self.userDao.findUserByEmail("user001")
+
+        song = {
+            "artist": "test",
+            "title": "test",
+            "album": "test",
+        }
+
+        song_id1 = self.libraryDao.insert(
+            user000['id'], user000['domain_id'], song)
+        song_id2 = self.libraryDao.insert(
+            user000['id'], user000['domain_id'], song)
+
+        # user data exists for the first song, but not the second
+        self.libraryDao.incrementPlaycount(user000['id'], song_id1)
+
+        self.libraryDao.bulkIncrementPlaycount(user000['id'],
+            [song_id1, song_id2, song_id1])
+        self.libraryDao.bulkIncrementPlaycount(user001['id'], [song_id2])
+
+        def playcount(user, song_id):
+            song = self.libraryDao.findSongById(
+                user['id'], user['domain_id'], song_id)
+            return song[Song.play_count]
+
+        self.assertEqual(playcount(user000, song_id1), 3)
+        self.assertEqual(playcount(user000, song_id2), 1)
+        self.assertEqual(playcount(user001, song_id1), 0)
+        self.assertEqual(playcount(user001, song_id2), 1)
+
     def test_004a_search_blocked(self):
 
         user000 = self.userDao.findUserByEmail("user000")
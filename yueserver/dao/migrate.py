@@ -5,10 +5,18 @@ import sys
 from sqlalchemy.schema import Table, Column, ForeignKey
 from sqlalchemy.types import Integer, String
 from sqlalchemy import and_, or_, not_, select, column, update, insert, delete
-
-from .tables.storage import FileSystemStorageTableV1, FileSystemStorageTableV2
-from .db import db_connect_impl, db_add_column, db_get_columns, db_iter_rows
-from .util import format_storage_path
+from sqlalchemy import inspect
+from sqlalchemy.sql import func
+
+from .tables.storage import FileSystemStorageTableV1, FileSystemStorageTableV2, \
+    FileSystemStorageTableV3, FileSystemStorageTableV3a, \
+    FileSystemPreviewStorageTableV1
+from .tables.tables import DatabaseTablesV1, DatabaseTablesV2, \
+    DatabaseTablesV3, DatabaseTablesV4, DatabaseTablesV5, DatabaseTablesV6, \
+    DatabaseTablesV7
+from .db import db_connect_impl, db_add_column, db_get_columns, db_iter_rows, \
+    db_reconnect
+from .util import format_storage_path, parent_path, directory_paths
 from .filesys.crypt import generate_secure_password
 from .settings import SettingsDao, Settings
 from .user import UserDao
@@ -65,7 +73,7 @@ class _MigrateV1Context(object):
 
         # init the new settings table
         db.session.execute(insert(db.tables.ApplicationSchemaTable)
-            .values({"key": "db_version", "value": str(db.tables.version)}))
+            .values({"key": "db_version", "value": "1"}))
 
         db.session.execute(insert(db.tables.ApplicationSchemaTable)
             .values({
@@ -118,7 +126,7 @@ class _MigrateV2Context(object):
         db = self.dbv2
 
         settingsDao = SettingsDao(db, db.tables)
-        settingsDao.set("db_version", str(db.tables.version))
+        settingsDao.set("db_version", "2")
 
         # create a connection for the old FileSystemStorageTable
         tbl = FileSystemStorageTableV2(db.metadata)
@@ -141,7 +149,7 @@ class _MigrateV3Context(object):
         db = self.dbv3
 
         settingsDao = SettingsDao(db, db.tables)
-        settingsDao.set(Settings.db_version, str(db.tables.version))
+        settingsDao.set(Settings.db_version, "3")
         default_user_quota = 2**30
         settingsDao.set(Settings.default_user_quota, str(default_user_quota), commit=False)
 
@@ -161,6 +169,111 @@ class _MigrateV3Context(object):
                     })
                     db.session.execute(statement)
 
+class _MigrateV4Context(object):
+    def __init__(self, dbv4):
+        super(_MigrateV4Context, self).__init__()
+        self.dbv4 = dbv4
+
+    def migrate(self):
+
+        db = self.dbv4
+
+        settingsDao = SettingsDao(db, db.tables)
+        settingsDao.set(Settings.db_version, "4")
+
+        tab = db.tables.FileSystemStorageTable
+        dirtab = db.tables.FileSystemDirectoryTable
+
+        # set the parent path for every file, and count the
+        # number of files and bytes in every directory
+        directories = {}
+        for row in list(db_iter_rows(db, tab)):
+            db.session.execute(tab.update()
+                .values({"parent_path": parent_path(row['file_path'])})
+                .where(tab.c.id == row['id']))
+
+            for path in directory_paths(row['file_path']):
+                key = (row['user_id'], row['filesystem_id'], path)
+                count, size = directories.get(key, (0, 0))
+                directories[key] = (count + 1, size + (row['size'] or 0))
+
+        for (user_id, fs_id, path), (count, size) in directories.items():
+            db.session.execute(dirtab.insert().values({
+                "user_id": user_id,
+                "filesystem_id": fs_id,
+                "path": path,
+                "parent_path": parent_path(path),
+                "count": count,
+                "size": size,
+            }))
+
+class _MigrateV5Context(object):
+    def __init__(self, dbv5):
+        super(_MigrateV5Context, self).__init__()
+        self.dbv5 = dbv5
+
+    def migrate(self):
+
+        db = self.dbv5
+
+        settingsDao = SettingsDao(db, db.tables)
+        settingsDao.set(Settings.db_version, "5")
+
+        tab = db.tables.FileSystemStorageTable
+        usagetab = db.tables.FileSystemUserUsageTable
+
+        # count the number of files and bytes owned by each user
+        query = select([tab.c.user_id,
+                        func.count(tab.c.size),
+                        func.sum(tab.c.size)]) \
+            .group_by(tab.c.user_id)
+
+        for user_id, count, size in db.session.execute(query).fetchall():
+            db.session.execute(usagetab.insert().values({
+                "user_id": user_id,
+                "count": count,
+                "size": size or 0,
+            }))
+
+class _MigrateV6Context(object):
+    def __init__(self, dbv6):
+        super(_MigrateV6Context, self).__init__()
+        self.dbv6 = dbv6
+
+    def migrate(self):
+
+        db = self.dbv6
+
+        settingsDao = SettingsDao(db, db.tables)
+        settingsDao.set(Settings.db_version, "6")
+
+        # copy the old storage and preview tables using
+        # INSERT INTO ... SELECT, so that no rows are read by python
+        tbl = FileSystemStorageTableV3a(db.metadata)
+        columns = list(tbl.c)
+        st = db.tables.FileSystemStorageTable.insert().from_select(
+            [c.name for c in columns], select(columns))
+        db.session.execute(st)
+
+        # the preview id is not referenced, let the database assign it
+        tbl = FileSystemPreviewStorageTableV1(db.metadata)
+        columns = [c for c in tbl.c if c.name != 'id']
+        st = db.tables.FileSystemPreviewStorageTable.insert().from_select(
+            [c.name for c in columns], select(columns))
+        db.session.execute(st)
+
+class _MigrateV7Context(object):
+    def __init__(self, dbv7):
+        super(_MigrateV7Context, self).__init__()
+        self.dbv7 = dbv7
+
+    def migrate(self):
+
+        db = self.dbv7
+
+        settingsDao = SettingsDao(db, db.tables)
+        settingsDao.set(Settings.db_version, "7")
+
 def migratev1(dbv1):
     """
     dbv1: a database connection, db.tables must implement v1
@@ -245,6 +358,252 @@ def migratev3(dbv3):
 
     return
 
+def migratev4(dbv4):
+    """
+    a parent path column was added to the file system storage table
+    a table summarizing the directories of each file system was added
+    """
+
+    tab = dbv4.tables.FileSystemStorageTable
+    if 'parent_path' not in db_get_columns(dbv4, tab):
+        db_add_column(dbv4, tab, tab.c.parent_path)
+
+    existing = set(ix['name'] for ix in
+        inspect(dbv4.engine).get_indexes(tab.name))
+    for index in tab.indexes:
+        if index.name not in existing:
+            index.create(dbv4.engine)
+
+    dbv4.session = dbv4.session()
+
+    try:
+        dbv4.tables.FileSystemDirectoryTable.create(dbv4.engine)
+
+        ctxt = _MigrateV4Context(dbv4)
+        ctxt.migrate()
+        dbv4.session.commit()
+    except:
+        dbv4.session.rollback()
+        raise
+    finally:
+        dbv4.session.close()
+
+    return
+
+def migratev5(dbv5):
+    """
+    a table containing the disk usage of each user was added
+    """
+
+    dbv5.session = dbv5.session()
+
+    try:
+        dbv5.tables.FileSystemUserUsageTable.create(dbv5.engine)
+
+        ctxt = _MigrateV5Context(dbv5)
+        ctxt.migrate()
+        dbv5.session.commit()
+    except:
+        dbv5.session.rollback()
+        raise
+    finally:
+        dbv5.session.close()
+
+    return
+
+def migratev6(dbv6):
+    """
+    the storage table no longer requires a unique storage path,
+    and records the hash of the file contents
+    a table of deduplicated blobs was added
+    """
+
+    dbv6.session = dbv6.session()
+
+    try:
+        dbv6.tables.FileSystemStorageTable.create(dbv6.engine)
+        dbv6.tables.FileSystemPreviewStorageTable.create(dbv6.engine)
+        dbv6.tables.FileSystemBlobTable.create(dbv6.engine)
+
+        ctxt = _MigrateV6Context(dbv6)
+        ctxt.migrate()
+        dbv6.session.commit()
+    except:
+        dbv6.session.rollback()
+        raise
+    finally:
+        dbv6.session.close()
+
+    return
+
+def migratev7(dbv7):
+    """
+    a table of previews waiting to be generated was added
+    """
+
+    dbv7.session = dbv7.session()
+
+    try:
+        dbv7.tables.FileSystemPreviewJobTable.create(dbv7.engine)
+
+        ctxt = _MigrateV7Context(dbv7)
+        ctxt.migrate()
+        dbv7.session.commit()
+    except:
+        dbv7.session.rollback()
+        raise
+    finally:
+        dbv7.session.close()
+
+    return
+
+def _remove_duplicate_history(db):
+    """ remove duplicate history records, so that the unique index
+    on the history table can be created
+    """
+
+    if db.kind() == "postgresql":
+        statement = "DELETE FROM song_history a USING song_history b " \
+                    "WHERE a.ctid > b.ctid " \
+                    "AND a.user_id = b.user_id " \
+                    "AND a.song_id = b.song_id " \
+                    "AND a.timestamp = b.timestamp"
+    else:
+        statement = "DELETE FROM song_history WHERE rowid NOT IN " \
+                    "(SELECT MIN(rowid) FROM song_history " \
+                    "GROUP BY user_id, song_id, timestamp)"
+
+    db.engine.execute(statement)
+
+def migrate_indexes(db):
+    """
+    create the indexes declared by the current schema which
+    do not exist in the database
+
+    returns the names of the indexes that were created
+    """
+
+    inspector = inspect(db.engine)
+    table_names = set(inspector.get_table_names())
+
+    created = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in table_names:
+            continue
+
+        existing = set(ix['name'] for ix in inspector.get_indexes(table.name))
+
+        for index in sorted(table.indexes, key=lambda ix: ix.name):
+            if index.name in existing:
+                continue
+
+            if table.name == "song_history" and index.unique:
+                _remove_duplicate_history(db)
+
+            index.create(db.engine)
+            created.append(index.name)
+
+        # dialect specific indexes use CREATE INDEX IF NOT EXISTS
+        for ddl in table.info.get('ddl', []):
+            ddl.execute(bind=db.engine, target=table)
+
+    return created
+
+def _explain(db, query):
+    """ return the query plan for a query, and the lines of the
+    plan which scan an entire table
+    """
+
+    compiled = query.compile(dialect=db.engine.dialect)
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+
+    with db.engine.connect() as conn:
+        if db.kind() == "postgresql":
+            # a sequential scan may be cheaper for a small table,
+            # discourage the planner from using one when an index exists
+            conn.execute("SET enable_seqscan = off")
+            try:
+                rows = conn.execute("EXPLAIN " + str(compiled), params)
+                plan = [row[0] for row in rows]
+            finally:
+                conn.execute("RESET enable_seqscan")
+            scans = [line for line in plan if "Seq Scan" in line]
+        else:
+            rows = conn.execute("EXPLAIN QUERY PLAN " + str(compiled), params)
+            plan = [row[-1] for row in rows]
+            scans = [line for line in plan if line.startswith("SCAN")]
+
+    return plan, scans
+
+def explain_queries(db):
+    """
+    explain the queries used for common lookups
+
+    returns a list of (name, plan, scans) where scans are the lines of
+    the plan which read an entire table instead of using an index
+    """
+
+    SongData = db.tables.SongDataTable
+    SongUserData = db.tables.SongUserDataTable
+    SongHistory = db.tables.SongHistoryTable
+    FsTab = db.tables.FileSystemStorageTable
+    DirTab = db.tables.FileSystemDirectoryTable
+
+    user_id = "user"
+    domain_id = "domain"
+
+    queries = [
+        ("library search",
+            select([SongData.c.id, SongUserData.c.play_count])
+            .select_from(SongData.join(SongUserData,
+                and_(SongData.c.id == SongUserData.c.song_id,
+                     SongUserData.c.user_id == user_id),
+                isouter=True))
+            .where(SongData.c.domain_id == domain_id)),
+        ("user song data",
+            SongUserData.select().where(
+                and_(SongUserData.c.song_id == "song",
+                     SongUserData.c.user_id == user_id))),
+        ("user blocked songs",
+            select([SongUserData.c.song_id]).where(
+                and_(SongUserData.c.user_id == user_id,
+                     SongUserData.c.blocked != 0))),
+        ("history",
+            SongHistory.select().where(
+                and_(SongHistory.c.user_id == user_id,
+                     SongHistory.c.timestamp >= 0,
+                     SongHistory.c.timestamp <= 1))),
+        ("file info",
+            FsTab.select().where(
+                and_(FsTab.c.user_id == user_id,
+                     FsTab.c.filesystem_id == 1,
+                     FsTab.c.file_path == "/file"))),
+        ("list directory files",
+            FsTab.select().where(
+                and_(FsTab.c.user_id == user_id,
+                     FsTab.c.filesystem_id == 1,
+                     FsTab.c.parent_path == "/dir/"))),
+        ("list directory directories",
+            DirTab.select().where(
+                and_(DirTab.c.user_id == user_id,
+                     DirTab.c.filesystem_id == 1,
+                     DirTab.c.parent_path == "/dir/"))),
+        ("search directory",
+            FsTab.select().where(
+                and_(FsTab.c.user_id == user_id,
+                     FsTab.c.filesystem_id == 1,
+                     FsTab.c.file_path.startswith("/dir/")))),
+    ]
+
+    results = []
+    for name, query in queries:
+        plan, scans = _explain(db, query)
+        results.append((name, plan, scans))
+
+    return results
+
 def migrate_main(db):
 
     settingsDao = SettingsDao(db, db.tables)
@@ -254,20 +613,28 @@ def migrate_main(db):
     except Exception:
         version = 0
 
+    # each step is given the schema of the version it migrates to
     actions = [
-        migratev1,
-        migratev2,
-        migratev3,
+        (migratev1, DatabaseTablesV1),
+        (migratev2, DatabaseTablesV2),
+        (migratev3, DatabaseTablesV3),
+        (migratev4, DatabaseTablesV4),
+        (migratev5, DatabaseTablesV5),
+        (migratev6, DatabaseTablesV6),
+        (migratev7, DatabaseTablesV7),
     ]
 
     if version >= len(actions):
         sys.stdout.write("nothing to migrate. version is %d.\n" % version)
-        return
+    else:
+        action, tables = actions[version]
+        action(db_reconnect(db, tables))
 
-    actions[version](db)
+        version = int(settingsDao.get("db_version"))
+        sys.stdout.write("database migrated: new version is %d.\n" % version)
 
-    version = int(settingsDao.get("db_version"))
-    sys.stdout.write("database migrated: new version is %d.\n" % version)
+    for name in migrate_indexes(db):
+        sys.stdout.write("created index %s\n" % name)
 
 
 
@@ -7,7 +7,9 @@ between schema versions
 import os, sys
 import unittest
 
-from .db import db_connect_impl, db_add_column, db_get_columns, db_iter_rows
+from .db import db_connect, db_connect_impl, db_add_column, db_get_columns, \
+    db_iter_rows
+from .migrate import migrate_indexes, explain_queries
 from .tables.tables import BaseDatabaseTables
 from sqlalchemy.schema import Table, Column, ForeignKey
 from sqlalchemy.types import Integer, String
@@ -173,8 +175,46 @@ class MigrateTestCase(unittest.TestCase):
         nitems = len(list(db_iter_rows(db, db.tables.DomainTable)))
         self.assertEqual(nitems, 1000)
 
+class MigrateIndexTestCase(unittest.TestCase):
+
+    def test_migrate_indexes(self):
+
+        db = db_connect(None)
+        db.create_all()
+
+        # simulate a database created before the indexes were added
+        for name in ["ix_song_data_domain",
+                     "uix_song_history",
+                     "ix_song_history_user_time"]:
+            db.engine.execute("DROP INDEX %s" % name)
+
+        tab = db.tables.SongHistoryTable
+        for i in range(3):
+            db.engine.execute(tab.insert().values(
+                {"user_id": "user", "song_id": "song", "timestamp": 1}))
+
+        scans = {name: scans for name, _, scans in explain_queries(db)}
+        self.assertTrue(scans["library search"])
+        self.assertTrue(scans["history"])
+
+        created = migrate_indexes(db)
+        self.assertEqual(set(created), {"ix_song_data_domain",
+            "uix_song_history", "ix_song_history_user_time"})
+
+        for name, plan, scans in explain_queries(db):
+            self.assertEqual(scans, [], name)
+
+        # duplicate history records are removed
+        rows = db.engine.execute(tab.select()).fetchall()
+        self.assertEqual(len(rows), 1)
+
+        # the migration can be run again
+        self.assertEqual(migrate_indexes(db), [])
+
 def main():
-    suite = unittest.defaultTestLoader.loadTestsFromTestCase(MigrateTestCase)
+    suite = unittest.TestSuite()
+    for case in [MigrateTestCase, MigrateIndexTestCase]:
+        suite.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(case))
     unittest.TextTestRunner().run(suite)
 
 if __name__ == '__main__':
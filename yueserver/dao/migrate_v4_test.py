@@ -0,0 +1,88 @@
+import os, sys
+import unittest
+
+from .db import db_connect_impl, db_reconnect
+
+from .tables.tables import DatabaseTablesV3, DatabaseTablesV4
+from .settings import SettingsDao
+from .storage import StorageDao
+
+from .migrate import migratev4
+
+from sqlalchemy import insert
+
+def v3_init(db, sample_paths):
+
+    db.create_all()
+
+    settingsDao = SettingsDao(db, db.tables)
+    settingsDao.set("db_version", str(db.tables.version))
+
+    fs_id = db.session.execute(insert(db.tables.FileSystemTable)
+        .values({"name": "default", "path": "mem://memtest"})).lastrowid
+
+    domain_id = db.session.execute(insert(db.tables.DomainTable)
+        .values({"name": "production"})).lastrowid
+
+    role_id = db.session.execute(insert(db.tables.RoleTable)
+        .values({"name": "test"})).lastrowid
+
+    user_id = db.session.execute(insert(db.tables.UserTable)
+        .values({"email": "testuser",
+                 "password": "password",
+                 "domain_id": domain_id,
+                 "role_id": role_id})).lastrowid
+
+    for path in sample_paths:
+        st = db.tables.FileSystemStorageTable.insert().values({
+            'user_id': user_id,
+            'filesystem_id': fs_id,
+            'file_path': path,
+            'storage_path': "mem://memtest" + path,
+            'size': 100,
+        })
+        db.session.execute(st)
+
+    db.session.commit()
+
+    return user_id, fs_id
+
+class MigrateV4TestCase(unittest.TestCase):
+
+    def test_migrate_v4(self):
+
+        sample_paths = [
+            "/sample.txt",
+            "/folder/sample2.txt",
+            "/folder/subfolder/sample3.txt",
+        ]
+
+        dbv3 = db_connect_impl(DatabaseTablesV3, 'sqlite:///', False)
+        user_id, fs_id = v3_init(dbv3, sample_paths)
+
+        dbv4 = db_reconnect(dbv3, DatabaseTablesV4)
+        migratev4(dbv4)
+
+        settingsDao = SettingsDao(dbv4, dbv4.tables)
+        version = int(settingsDao.get("db_version"))
+        self.assertEqual(version, 4)
+
+        # check that the directory index was built from the existing files
+        storageDao = StorageDao(dbv4, dbv4.tables)
+
+        records = {rec.name: rec for rec in
+            storageDao.listdir(user_id, fs_id, "/")}
+        self.assertEqual(sorted(records), ["folder", "sample.txt"])
+        self.assertEqual(records["folder"].count, 2)
+        self.assertEqual(records["folder"].size, 200)
+
+        records = {rec.name: rec for rec in
+            storageDao.listdir(user_id, fs_id, "/folder/")}
+        self.assertEqual(sorted(records), ["sample2.txt", "subfolder"])
+
+def main():
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(MigrateV4TestCase)
+    unittest.TextTestRunner().run(suite)
+
+if __name__ == '__main__':
+    main()
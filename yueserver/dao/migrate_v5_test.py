@@ -0,0 +1,56 @@
+
+import os, sys
+import unittest
+
+from .db import db_connect_impl, db_reconnect
+
+from .tables.tables import DatabaseTablesV3, DatabaseTablesV4, DatabaseTablesV5
+from .settings import SettingsDao
+from .storage import StorageDao
+
+from .migrate import migratev4, migratev5
+from .migrate_v4_test import v3_init
+
+class MigrateV5TestCase(unittest.TestCase):
+
+    def test_migrate_v5(self):
+
+        sample_paths = [
+            "/sample.txt",
+            "/folder/sample2.txt",
+            "/folder/subfolder/sample3.txt",
+        ]
+
+        dbv3 = db_connect_impl(DatabaseTablesV3, 'sqlite:///', False)
+        user_id, fs_id = v3_init(dbv3, sample_paths)
+
+        dbv4 = db_reconnect(dbv3, DatabaseTablesV4)
+        migratev4(dbv4)
+
+        # migratev4 replaces the session factory of dbv4
+        dbv5 = db_reconnect(dbv3, DatabaseTablesV5)
+        migratev5(dbv5)
+
+        settingsDao = SettingsDao(dbv5, dbv5.tables)
+        version = int(settingsDao.get("db_version"))
+        self.assertEqual(version, 5)
+
+        # check that the usage was computed from the existing files
+        storageDao = StorageDao(dbv5, dbv5.tables)
+
+        count, usage, quota = storageDao.userDiskUsage(user_id)
+        self.assertEqual(count, 3)
+        self.assertEqual(usage, 300)
+
+        # and that it is updated incrementally
+        storageDao.removeFile(user_id, fs_id, "/sample.txt")
+        count, usage, quota = storageDao.userDiskUsage(user_id)
+        self.assertEqual(count, 2)
+        self.assertEqual(usage, 200)
+
+def main():
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(MigrateV5TestCase)
+    unittest.TextTestRunner().run(suite)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+
+import os, sys
+import unittest
+
+from .db import db_connect_impl, db_reconnect
+
+from .tables.tables import DatabaseTablesV3, DatabaseTablesV4, \
+    DatabaseTablesV5, DatabaseTablesV6
+from .settings import SettingsDao
+from .storage import StorageDao
+
+from .migrate import migratev4, migratev5, migratev6
+from .migrate_v4_test import v3_init
+
+class MigrateV6TestCase(unittest.TestCase):
+
+    def test_migrate_v6(self):
+
+        sample_paths = [
+            "/sample.txt",
+            "/folder/sample2.txt",
+            "/folder/subfolder/sample3.txt",
+        ]
+
+        dbv3 = db_connect_impl(DatabaseTablesV3, 'sqlite:///', False)
+        user_id, fs_id = v3_init(dbv3, sample_paths)
+
+        dbv4 = db_reconnect(dbv3, DatabaseTablesV4)
+        migratev4(dbv4)
+
+        # each migration replaces the session factory
+        dbv5 = db_reconnect(dbv3, DatabaseTablesV5)
+        migratev5(dbv5)
+
+        # a preview of the first file
+        tab = dbv5.tables.FileSystemStorageTable
+        file_id = dbv5.session.execute(tab.select()
+            .where(tab.c.file_path == sample_paths[0])).fetchone()['id']
+        dbv5.session.execute(dbv5.tables.FileSystemPreviewStorageTable
+            .insert().values({
+                "user_id": user_id,
+                "file_id": file_id,
+                "filesystem_id": fs_id,
+                "path": "mem://memtest/preview.png",
+                "scale": "thumb",
+                "valid": 1,
+                "width": 80,
+                "height": 60,
+                "size": 10,
+            }))
+        dbv5.session.commit()
+
+        dbv6 = db_reconnect(dbv3, DatabaseTablesV6)
+        migratev6(dbv6)
+
+        settingsDao = SettingsDao(dbv6, dbv6.tables)
+        version = int(settingsDao.get("db_version"))
+        self.assertEqual(version, 6)
+
+        # check that the files were copied to the new table
+        storageDao = StorageDao(dbv6, dbv6.tables)
+
+        for path in sample_paths:
+            info = storageDao.file_info(user_id, fs_id, path)
+            self.assertEqual(info.storage_path, "mem://memtest" + path)
+            self.assertEqual(info.size, 100)
+
+        files = list(storageDao.listdir(user_id, fs_id, "/folder/"))
+        self.assertEqual(len(files), 2)
+
+        # and the previews
+        preview = storageDao.previewFind(user_id, file_id, "thumb")
+        self.assertEqual(preview.path, "mem://memtest/preview.png")
+        self.assertEqual(preview.size, 10)
+
+        # a storage path may now be used by several files
+        storageDao.insertFile(user_id, fs_id, "/copy.txt",
+            dict(storage_path="mem://memtest/sample.txt", size=100))
+
+        count, usage, quota = storageDao.userDiskUsage(user_id)
+        self.assertEqual(count, 4)
+        self.assertEqual(usage, 400)
+
+def main():
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(MigrateV6TestCase)
+    unittest.TextTestRunner().run(suite)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import os, sys
+import io
+import unittest
+from unittest import mock
+
+from .db import db_connect_impl, db_reconnect
+
+from .tables.tables import DatabaseTablesV3, DatabaseTablesV4, \
+    DatabaseTablesV5, DatabaseTablesV6, DatabaseTablesV7, DatabaseTables
+from .settings import SettingsDao
+from .storage import StorageDao
+
+from .migrate import migratev4, migratev5, migratev6, migratev7, \
+    migrate_main
+from .migrate_v4_test import v3_init
+
+class MigrateV7TestCase(unittest.TestCase):
+
+    def test_migrate_v7(self):
+
+        sample_paths = [
+            "/sample.png",
+            "/folder/sample2.png",
+        ]
+
+        dbv3 = db_connect_impl(DatabaseTablesV3, 'sqlite:///', False)
+        user_id, fs_id = v3_init(dbv3, sample_paths)
+
+        # each migration replaces the session factory
+        for tables, migrate in [(DatabaseTablesV4, migratev4),
+                                (DatabaseTablesV5, migratev5),
+                                (DatabaseTablesV6, migratev6),
+                                (DatabaseTablesV7, migratev7)]:
+            db = db_reconnect(dbv3, tables)
+            migrate(db)
+
+        settingsDao = SettingsDao(db, db.tables)
+        version = int(settingsDao.get("db_version"))
+        self.assertEqual(version, 7)
+
+        # check that preview jobs can be submitted for existing files
+        storageDao = StorageDao(db, db.tables)
+
+        info = storageDao.file_info(user_id, fs_id, "/sample.png")
+        storageDao.previewJobEnqueue(user_id, info.file_id, fs_id, "thumb")
+
+        job = storageDao.previewJobClaim()
+        self.assertEqual(job.file_id, info.file_id)
+        self.assertTrue(storageDao.previewJobComplete(job))
+
+    def test_migrate_main(self):
+
+        sample_paths = [
+            "/sample.png",
+            "/folder/sample2.png",
+        ]
+
+        dbv3 = db_connect_impl(DatabaseTablesV3, 'sqlite:///', False)
+        user_id, fs_id = v3_init(dbv3, sample_paths)
+
+        # manage.py migrate connects using the current schema,
+        # and migrates one version each time it is run
+        db = db_reconnect(dbv3, DatabaseTables)
+        settingsDao = SettingsDao(db, db.tables)
+        for version in range(4, 8):
+            with mock.patch('sys.stdout', new_callable=io.StringIO):
+                migrate_main(db)
+            self.assertEqual(int(settingsDao.get("db_version")), version)
+
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            migrate_main(db)
+        self.assertIn("nothing to migrate", stdout.getvalue())
+
+        storageDao = StorageDao(db, db.tables)
+        info = storageDao.file_info(user_id, fs_id, "/folder/sample2.png")
+        self.assertEqual(info.size, 100)
+
+        count, usage, quota = storageDao.userDiskUsage(user_id)
+        self.assertEqual(count, 2)
+        self.assertEqual(usage, 200)
+
+        names = [item.name for item in
+            storageDao.listdir(user_id, fs_id, "/")]
+        self.assertEqual(sorted(names), ["folder", "sample.png"])
+
+def main():
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(MigrateV7TestCase)
+    unittest.TextTestRunner().run(suite)
+
+if __name__ == '__main__':
+    main()
@@ -1,197 +1,314 @@
-
 """
 A Data Access Object for manipulating the queue table
 
 """
+import threading
+
 from sqlalchemy import and_, or_, not_, select, column, update, insert
 
 from .library import Song, SongQueryFormatter
+from .util import after_commit
+
+class UserQueue(object):
+    """ the cached state of a single users queue
+
+    ids: the ordered list of song ids in the queue
+    query: the default query used to populate the queue
+    songs: map song_id -> formatted song, for songs in the queue
+    version: the library version when the songs were formatted
+    """
+
+    def __init__(self, ids, query):
+        super(UserQueue, self).__init__()
+        self.ids = ids
+        self.query = query
+        self.songs = {}
+        self.version = None
 
 class SongQueueDao(object):
     """docstring for Queue"""
 
-    def __init__(self, db, dbtables, sanitize=False):
+    def __init__(self, db, dbtables, sanitize=False, library=None, cache=False):
+        """
+        library: the LibraryDao used to modify songs. when given, cached
+            songs are discarded whenever the library changes.
+        cache: when true, the queue for each user is kept in memory,
+            along with the formatted songs.
+        """
         super(SongQueueDao, self).__init__()
         self.db = db
         self.dbtables = dbtables
 
         self.formatter = SongQueryFormatter(dbtables, sanitize)
 
-    def set(self, user_id, domain_id, song_ids):
+        self.library = library
 
-        SongQueueTable = self.dbtables.SongQueueTable
+        self.cache = {} if cache else None
 
-        # create the queue if it does not exist
-        query = SongQueueTable.select() \
-            .where(SongQueueTable.c.user_id == user_id)
-        lst = self.db.session.execute(query).fetchall()
+        # per user locks, so that modifying the queue is atomic
+        self.lock = threading.Lock()
+        self.locks = {}
 
-        if not lst:
-            query = insert(SongQueueTable) \
-                .values({"user_id": user_id, "songs": song_ids, "query": ""})
-        else:
-            query = update(SongQueueTable) \
-                .values({"songs": song_ids, }) \
-                .where(SongQueueTable.c.user_id == user_id)
+    def set(self, user_id, domain_id, song_ids, commit=True):
 
-        self.db.session.execute(query)
-        self.db.session.commit()
+        with self._lock(user_id):
+            self._save(user_id, {"songs": list(song_ids)}, commit)
 
     def get(self, user_id, domain_id):
 
-        SongQueueTable = self.dbtables.SongQueueTable
+        with self._lock(user_id):
+            queue = self._load(user_id)
+            return self._hydrate(user_id, domain_id, queue, queue.ids)
 
-        query = SongQueueTable.select() \
-            .where(SongQueueTable.c.user_id == user_id)
-        result = self.db.session.execute(query).fetchone()
+    def head(self, user_id, domain_id):
 
-        if not result:
-            return []
+        with self._lock(user_id):
+            queue = self._load(user_id)
 
-        id, lst, _ = result
+            if not queue.ids:
+                return None
 
-        if not lst:
-            return []
+            songs = self._hydrate(user_id, domain_id, queue, queue.ids[:1])
+            return songs[0] if songs else None
 
-        SongData = self.dbtables.SongDataTable
-        SongUserData = self.dbtables.SongUserDataTable
+    def rest(self, user_id, domain_id):
 
-        query = select([column(c) for c in self.formatter.cols]) \
-            .select_from(
-                    SongData.join(
-                        SongUserData,
-                        and_(SongData.c.id == SongUserData.c.song_id,
-                             SongUserData.c.user_id == user_id),
-                        isouter=True)) \
-            .where(and_(SongData.c.domain_id == domain_id,
-                        SongData.c.id.in_(lst)))
+        with self._lock(user_id):
+            queue = self._load(user_id)
 
-        results = self.db.session.execute(query).fetchall()
+            if len(queue.ids) < 2:
+                return None
 
-        # todo: anywhere that defs are used to populate the songs,
-        # if the uer does not have a record available, the user_id must be
-        # updated.
+            return self._hydrate(user_id, domain_id, queue, queue.ids[1:])
 
-        # todo: in addition, sanitize the output, remove:
-        #  - song_id : redundant information
-        #  - file_path
-        #  - art_path
+    def push(self, user_id, domain_id, song_ids, index=None, commit=True):
+        """ insert songs into the queue at the given index
 
-        # todo: the above changes have been made for this function
-        # tests need to be written and changes need to propogate
-        # into a common library
+        by default songs are appended to the end of the queue
+        """
 
-        songs = self.formatter.format(user_id, results)
+        with self._lock(user_id):
+            ids = list(self._load(user_id).ids)
 
-        map = {k: i for i, k in enumerate(lst)}
-        songs.sort(key=lambda s: map[s['id']])
-        return songs
+            if index is None:
+                ids.extend(song_ids)
+            else:
+                ids[index:index] = song_ids
 
-    def head(self, user_id, domain_id):
+            self._save(user_id, {"songs": ids}, commit)
 
-        SongQueueTable = self.dbtables.SongQueueTable
+            return len(ids)
 
-        query = SongQueueTable.select() \
-            .where(SongQueueTable.c.user_id == user_id)
-        result = self.db.session.execute(query).fetchone()
+    def pop(self, user_id, domain_id, commit=True):
+        """ remove the head of the queue and return it
 
-        if not result:
-            return None
+        returns None if the queue is empty
+        """
 
-        id, lst, _ = result
+        with self._lock(user_id):
+            queue = self._load(user_id)
 
-        if not lst:
-            return None
+            if not queue.ids:
+                return None
 
-        SongData = self.dbtables.SongDataTable
-        SongUserData = self.dbtables.SongUserDataTable
+            songs = self._hydrate(user_id, domain_id, queue, queue.ids[:1])
 
-        query = select([column(c) for c in self.formatter.cols]) \
-            .select_from(
-                    SongData.join(
-                        SongUserData,
-                        and_(SongData.c.id == SongUserData.c.song_id,
-                             SongUserData.c.user_id == user_id),
-                        isouter=True)) \
-            .where(and_(SongData.c.domain_id == domain_id,
-                        SongData.c.id == lst[0]))
+            self._save(user_id, {"songs": queue.ids[1:]}, commit)
 
-        res = self.db.session.execute(query).fetchone()
-        return self.formatter.format(user_id, [res, ])[0]
+            return songs[0] if songs else None
 
-    def rest(self, user_id, domain_id):
+    def next(self, user_id, domain_id, commit=True):
+        """ remove the head of the queue and return the new head
 
-        SongQueueTable = self.dbtables.SongQueueTable
+        returns None if the queue is empty after removing the head
+        """
 
-        # session.query(SongData).filter(SongData.id.in_(seq)).all()
-        query = SongQueueTable.select() \
-            .where(SongQueueTable.c.user_id == user_id)
-        result = self.db.session.execute(query).fetchone()
+        with self._lock(user_id):
+            queue = self._load(user_id)
 
-        if not result:
-            return None
+            ids = queue.ids[1:]
 
-        id, lst, _ = result
+            self._save(user_id, {"songs": ids}, commit)
 
-        lst = lst[1:]
+            if not ids:
+                return None
 
-        if not lst:
-            return None
+            songs = self._hydrate(user_id, domain_id, queue, ids[:1])
+            return songs[0] if songs else None
 
-        SongData = self.dbtables.SongDataTable
-        SongUserData = self.dbtables.SongUserDataTable
+    def refill(self, user_id, domain_id, limit, sample, commit=True):
+        """ add songs to the end of the queue until it contains limit songs
 
-        query = select([column(c) for c in self.formatter.cols]) \
-            .select_from(
-                    SongData.join(
-                        SongUserData,
-                        and_(SongData.c.id == SongUserData.c.song_id,
-                             SongUserData.c.user_id == user_id),
-                        isouter=True)) \
-            .where(and_(SongData.c.domain_id == domain_id,
-                        SongData.c.id.in_(lst)))
+        sample: a function sample(query, count, exclude) which returns
+            a list of up to count song ids matching the query, and not
+            contained in the set exclude.
 
-        results = self.db.session.execute(query).fetchall()
+        returns the songs in the queue
+        """
 
-        songs = self.formatter.format(user_id, results)
+        with self._lock(user_id):
+            queue = self._load(user_id)
 
-        map = {k: i for i, k in enumerate(lst)}
-        songs.sort(key=lambda s: map[s['id']])
-        return songs
+            ids = queue.ids[:limit]
 
-    def next(self):
-        pass
+            count = limit - len(ids)
+            if count > 0:
+                ids.extend(sample(queue.query, count, set(ids)))
+
+            if ids != queue.ids:
+                self._save(user_id, {"songs": ids}, commit)
+
+            return self._hydrate(user_id, domain_id, queue, ids)
 
     def getDefaultQuery(self, user_id):
+        with self._lock(user_id):
+            # in the rare chance that a user does not have a queue
+            # typically happens when the user constructs their first playlist
+            return self._load(user_id).query
+
+    def setDefaultQuery(self, user_id, query_str, commit=True):
+
+        with self._lock(user_id):
+            self._save(user_id, {"query": query_str}, commit)
+
+    def invalidate(self, user_id=None):
+        """ drop the cached queue for a user, or all users """
+        if self.cache is None:
+            return
+        with self.lock:
+            if user_id is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(user_id, None)
+
+    def _lock(self, user_id):
+        with self.lock:
+            lk = self.locks.get(user_id, None)
+            if lk is None:
+                lk = self.locks[user_id] = threading.RLock()
+            return lk
+
+    def _load(self, user_id):
+        """ return the UserQueue for a user """
+
+        if self.cache is not None:
+            queue = self.cache.get(user_id, None)
+            if queue is not None:
+                return queue
+
         SongQueueTable = self.dbtables.SongQueueTable
-        query = SongQueueTable.select() \
+
+        query = select([SongQueueTable.c.songs, SongQueueTable.c.query]) \
             .where(SongQueueTable.c.user_id == user_id)
         result = self.db.session.execute(query).fetchone()
-        # in the rare chance that a user does not have a queue
-        # typically happens when the user constructs their first playlist
+
         if result is None:
-            return ""
-        return result['query']
+            queue = UserQueue([], "")
+        else:
+            queue = UserQueue(list(result[0] or []), result[1] or "")
 
-    def setDefaultQuery(self, user_id, query_str):
+        if self.cache is not None:
+            self.cache[user_id] = queue
+
+        return queue
+
+    def _save(self, user_id, values, commit):
+        """ update the queue for a user, creating it if it does not exist
+
+        values: a dictionary containing songs, query, or both
+
+        the cached queue is updated once the change is committed
+        """
 
         SongQueueTable = self.dbtables.SongQueueTable
 
-        # create the queue if it does not exist
-        query = SongQueueTable.select() \
+        query = update(SongQueueTable) \
+            .values(values) \
             .where(SongQueueTable.c.user_id == user_id)
-        lst = self.db.session.execute(query).fetchall()
 
-        if not lst:
-            query = insert(SongQueueTable) \
-                .values({"user_id": user_id, "songs": [], "query": query_str})
-        else:
-            query = update(SongQueueTable) \
-                .values({"query": query_str, }) \
-                .where(SongQueueTable.c.user_id == user_id)
+        result = self.db.session.execute(query)
+
+        if result.rowcount == 0:
+            row = {"user_id": user_id, "songs": [], "query": ""}
+            row.update(values)
+            self.db.session.execute(insert(SongQueueTable).values(row))
+
+        if self.cache is not None:
+            self._patch(user_id, values)
+
+        if commit:
+            self.db.session.commit()
+
+    def _patch(self, user_id, values):
+        """ update the cached queue for a user after the next commit
+
+        a queue loaded after the change was written may not include
+        the change, and is dropped so that it is loaded again
+        """
+
+        queue = self.cache.get(user_id, None)
+
+        def apply():
+            current = self.cache.get(user_id, None)
+            if current is None:
+                return
+            if current is not queue:
+                self.cache.pop(user_id, None)
+                return
+            if "songs" in values:
+                queue.ids = list(values["songs"])
+            if "query" in values:
+                queue.query = values["query"]
 
-        self.db.session.execute(query)
-        self.db.session.commit()
+        after_commit(self.db.session, apply)
 
+    def _hydrate(self, user_id, domain_id, queue, song_ids):
+        """ return the formatted songs for a list of song ids, in order
 
+        song ids which no longer exist are not returned
+        """
+
+        if not song_ids:
+            return []
+
+        version = None if self.library is None else self.library.version
+
+        if self.cache is None or version is None or queue.version != version:
+            queue.songs = {}
+            queue.version = version
+
+        missing = [song_id for song_id in song_ids
+            if song_id not in queue.songs]
+
+        if missing:
+            for song in self._query(user_id, domain_id, missing):
+                queue.songs[song['id']] = song
+
+        songs = queue.songs
+        result = [songs[song_id] for song_id in song_ids if song_id in songs]
+
+        # only keep songs that are still in the queue
+        if self.cache is not None and len(songs) > len(queue.ids):
+            ids = set(queue.ids)
+            queue.songs = {k: v for k, v in songs.items() if k in ids}
+
+        return result
+
+    def _query(self, user_id, domain_id, song_ids):
+
+        SongData = self.dbtables.SongDataTable
+        SongUserData = self.dbtables.SongUserDataTable
+
+        query = select([column(c) for c in self.formatter.cols]) \
+            .select_from(
+                    SongData.join(
+                        SongUserData,
+                        and_(SongData.c.id == SongUserData.c.song_id,
+                             SongUserData.c.user_id == user_id),
+                        isouter=True)) \
+            .where(and_(SongData.c.domain_id == domain_id,
+                        SongData.c.id.in_(song_ids)))
+
+        results = self.db.session.execute(query).fetchall()
 
+        return self.formatter.format(user_id, results)
@@ -46,6 +46,9 @@ class SongQueueTestCase(unittest.TestCase):
 
         cls.libraryDao = LibraryDao(db, db.tables)
 
+        cls.cached_queue = SongQueueDao(db, db.tables,
+            library=cls.libraryDao, cache=True)
+
         cls.SONGS = []
         for a in range(3):
             for b in range(3):
@@ -115,6 +118,90 @@ class SongQueueTestCase(unittest.TestCase):
         for item, song_id in zip(items, self.SONG_IDS):
             self.assertEqual(item['id'], song_id)
 
+    def test_queue_push_pop(self):
+
+        user_id = self.USER['id']
+        domain_id = self.USER['domain_id']
+
+        for queue in [self.queue, self.cached_queue]:
+
+            queue.set(user_id, domain_id, self.SONG_IDS[:2])
+
+            n = queue.push(user_id, domain_id, self.SONG_IDS[2:4])
+            self.assertEqual(n, 4)
+
+            n = queue.push(user_id, domain_id, self.SONG_IDS[4:5], 0)
+            self.assertEqual(n, 5)
+
+            items = queue.get(user_id, domain_id)
+            expected = self.SONG_IDS[4:5] + self.SONG_IDS[:4]
+            self.assertEqual([item['id'] for item in items], expected)
+
+            item = queue.pop(user_id, domain_id)
+            self.assertEqual(item['id'], self.SONG_IDS[4])
+
+            item = queue.next(user_id, domain_id)
+            self.assertEqual(item['id'], self.SONG_IDS[1])
+
+            items = self.queue.get(user_id, domain_id)
+            self.assertEqual([item['id'] for item in items], self.SONG_IDS[1:4])
+
+            queue.set(user_id, domain_id, [])
+            self.assertIsNone(queue.pop(user_id, domain_id))
+            self.assertIsNone(queue.next(user_id, domain_id))
+
+    def test_queue_refill(self):
+
+        user_id = self.USER['id']
+        domain_id = self.USER['domain_id']
+
+        def sample(query, count, exclude):
+            self.assertEqual(query, "art=Artist001")
+            return [song_id for song_id in self.SONG_IDS
+                if song_id not in exclude][:count]
+
+        for queue in [self.queue, self.cached_queue]:
+            queue.setDefaultQuery(user_id, "art=Artist001")
+            queue.set(user_id, domain_id, self.SONG_IDS[1:2])
+
+            items = queue.refill(user_id, domain_id, 5, sample)
+            expected = self.SONG_IDS[1:2] + self.SONG_IDS[0:1] + self.SONG_IDS[2:5]
+            self.assertEqual([item['id'] for item in items], expected)
+
+            items = self.queue.get(user_id, domain_id)
+            self.assertEqual([item['id'] for item in items], expected)
+
+    def test_queue_cache(self):
+
+        user_id = self.USER['id']
+        domain_id = self.USER['domain_id']
+
+        self.cached_queue.set(user_id, domain_id, self.SONG_IDS[:3])
+        item = self.cached_queue.head(user_id, domain_id)
+        self.assertEqual(item[Song.play_count], 0)
+
+        # changes to the library are visible in the cached queue
+        self.libraryDao.incrementPlaycount(user_id, self.SONG_IDS[0])
+        item = self.cached_queue.head(user_id, domain_id)
+        self.assertEqual(item[Song.play_count], 1)
+
+    def test_queue_cache_rollback(self):
+
+        user_id = self.USER['id']
+        domain_id = self.USER['domain_id']
+
+        self.cached_queue.set(user_id, domain_id, self.SONG_IDS[:3])
+
+        # the cached queue is not changed until the session is committed
+        self.cached_queue.push(user_id, domain_id, self.SONG_IDS[3:5],
+            commit=False)
+        self.db.session.rollback()
+
+        for queue in [self.queue, self.cached_queue]:
+            items = queue.get(user_id, domain_id)
+            self.assertEqual([item['id'] for item in items],
+                self.SONG_IDS[:3])
+
 def main():
     suite = unittest.defaultTestLoader.loadTestsFromTestCase(SongQueueTestCase)
     unittest.TextTestRunner().run(suite)
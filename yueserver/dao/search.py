@@ -12,6 +12,8 @@ import re
 import calendar
 from datetime import datetime, timedelta
 import time
+import threading
+from collections import OrderedDict
 
 from sqlalchemy import and_, or_, not_, select, between
 
@@ -455,6 +457,134 @@ class MultiColumnSearchRule(SearchRule):
     def sql(self):
         return self.rule.sql()
 
+def fold_str(value):
+    """ the case folding applied by check() to text columns """
+    if isinstance(value, str):
+        return value.lower()
+    return str(case_(value, True))
+
+class RuleCompiler(object):
+    """
+    Compile a Rule tree into a single python function
+
+    The returned function, f(elem), is equivalent to
+    rule.check(elem, ignoreCase). Values given in the rule are converted,
+    case folded and compiled (for regular expressions) once, and the tree
+    is evaluated as a single expression instead of one method call per
+    node of the tree.
+
+    Rules which the compiler does not recognize are evaluated by
+    calling their check() method.
+    """
+
+    operators = {
+        PartialStringSearchRule: "(%(v)s in %(e)s)",
+        InvertedPartialStringSearchRule: "(%(v)s not in %(e)s)",
+        ExactSearchRule: "(%(e)s == %(v)s)",
+        InvertedExactSearchRule: "(%(e)s != %(v)s)",
+        LessThanSearchRule: "(%(e)s < %(v)s)",
+        LessThanEqualSearchRule: "(%(e)s <= %(v)s)",
+        GreaterThanSearchRule: "(%(e)s > %(v)s)",
+        GreaterThanEqualSearchRule: "(%(e)s >= %(v)s)",
+    }
+
+    def __init__(self, ignoreCase=True):
+        super(RuleCompiler, self).__init__()
+        self.ignoreCase = ignoreCase
+        self.namespace = {}
+
+    def compile(self, rule):
+        self.namespace = {
+            "_case": case_,
+            "_fold": fold_str,
+            "_str": str,
+            "_int": int,
+        }
+        source = "lambda elem: " + self.expression(rule)
+        function = eval(source, self.namespace)
+        function.source = source
+        return function
+
+    def expression(self, rule):
+        # dispatch on the exact type. subclasses may override check()
+        kind = type(rule)
+
+        if kind is BlankSearchRule:
+            return "True"
+
+        if kind is MultiColumnSearchRule:
+            return self.expression(rule.rule)
+
+        if kind is AndSearchRule:
+            return "(" + " and ".join(map(self.expression, rule.rules)) + ")"
+
+        if kind is OrSearchRule:
+            return "(" + " or ".join(map(self.expression, rule.rules)) + ")"
+
+        if kind is NotSearchRule:
+            return "(not %s)" % self.expression(rule.rules[0])
+
+        try:
+            if kind in (RangeSearchRule, NotRangeSearchRule):
+                return self.rangeExpression(rule)
+
+            if kind is RegExpSearchRule:
+                expr = self.constant(rexcmp(rule.value))
+                return "(%s.search(%s) is not None)" % (
+                    expr, self.element(rule.column))
+
+            template = RuleCompiler.operators.get(kind, None)
+            if template is not None:
+                value = rule.type_(case_(rule.value, self.ignoreCase))
+                return template % {
+                    "v": self.constant(value),
+                    "e": self.typedElement(rule.column, rule.type_)}
+        except (ValueError, TypeError):
+            # the value cannot be converted to the column type. defer
+            # the error until the rule is applied, as check() would.
+            pass
+
+        return "%s.check(elem, %r)" % (self.constant(rule), self.ignoreCase)
+
+    def rangeExpression(self, rule):
+        low = rule.type_(case_(rule.value_low, self.ignoreCase))
+        high = rule.type_(case_(rule.value_high, self.ignoreCase))
+        elem = self.element(rule.column)
+        if self.ignoreCase:
+            elem = "_case(%s, True)" % elem
+        expr = "(%s <= %s <= %s)" % (
+            self.constant(low), elem, self.constant(high))
+        if type(rule) is NotRangeSearchRule:
+            expr = "(not %s)" % expr
+        return expr
+
+    def constant(self, value):
+        name = "_k%d" % len(self.namespace)
+        self.namespace[name] = value
+        return name
+
+    def element(self, column):
+        name = column.name
+        if isinstance(name, str):
+            return "elem[%r]" % str(name)
+        if isinstance(name, int):
+            return "elem[%d]" % name
+        return "elem[%s]" % self.constant(name)
+
+    def typedElement(self, column, type_):
+        elem = self.element(column)
+        if type_ is str:
+            return ("_fold(%s)" if self.ignoreCase else "_str(%s)") % elem
+        if type_ is int:
+            return "_int(%s)" % elem
+        return "%s(_case(%s, %r))" % (
+            self.constant(type_), elem, self.ignoreCase)
+
+def compile_rule(rule, ignoreCase=True):
+    """ return a function f(elem) equivalent to rule.check(elem, ignoreCase)
+    """
+    return RuleCompiler(ignoreCase).compile(rule)
+
 def naive_search(seq, rule, case_insensitive=True, orderby=None, \
     reverse=False, limit=None, offset=0, echo=False, columns=None):
     """ return elements from seq which match the given rule
@@ -465,12 +595,14 @@ def naive_search(seq, rule, case_insensitive=True, orderby=None, \
     TODO: reverse is deprecated. it is handled by order by
 
     """
+    check = compile_rule(rule, case_insensitive)
+
     # filter the sequence using the rule
     if columns is not None:
         out = [{k: v for k, v in elem.items() if k in columns}
-            for elem in seq if rule.check(elem)]
+            for elem in seq if check(elem)]
     else:
-        out = [elem for elem in seq if rule.check(elem)]
+        out = [elem for elem in seq if check(elem)]
 
     if orderby is not None:
         if not isinstance(orderby, (tuple, list)):
@@ -536,6 +668,23 @@ class FormatConversion(object):
 
         self.datetime_now = dtn or datetime.now()
 
+        # the window of time, relative to datetime_now, for which the
+        # values returned by this instance remain correct. None when
+        # no relative date has been parsed.
+        self.valid_from = None
+        self.valid_until = None
+
+    def resetValidity(self):
+        self.valid_from = None
+        self.valid_until = None
+
+    def restrictValidity(self, start, end):
+        """ narrow the window of time that parsed values remain valid """
+        if self.valid_from is None or start > self.valid_from:
+            self.valid_from = start
+        if self.valid_until is None or end < self.valid_until:
+            self.valid_until = end
+
     def formatDateDelta(self, sValue):
         """
         parse strings of the form
@@ -577,6 +726,11 @@ class FormatConversion(object):
         dtn = self.datetime_now
         dt1 = self.computeDateDelta(dtn.year, dtn.month, dtn.day, dy, dm, dd)
         dt2 = dt1 + timedelta(1)
+
+        # the result changes at midnight
+        today = datetime(dtn.year, dtn.month, dtn.day)
+        self.restrictValidity(today, today + timedelta(1))
+
         return mktime(dt1), mktime(dt2)
 
     def computeDateDelta(self, y, m, d, dy, dm, dd=0):
@@ -720,7 +874,13 @@ class FormatConversion(object):
 
     def parseNLPDate(self, value):
 
-        dt = NLPDateRange(self.datetime_now).parse(value)
+        dtn = self.datetime_now
+        dt = NLPDateRange(dtn).parse(value)
+
+        # the smallest unit supported is an hour
+        hour = datetime(dtn.year, dtn.month, dtn.day, dtn.hour)
+        self.restrictValidity(hour, hour + timedelta(hours=1))
+
         if dt:
             cf = mktime(dt[0])
             if cf < 0:
@@ -729,6 +889,70 @@ class FormatConversion(object):
             return cf, rf
         return None
 
+class RuleCache(object):
+    """ a bounded LRU cache of parsed rules
+
+    Each entry records the window of time that the rule is valid for.
+    rules which contain relative dates (e.g. `date < 5`) expire when
+    the current day (or hour) rolls over. Other rules never expire
+    and are only evicted when the cache is full.
+    """
+
+    def __init__(self, capacity=256):
+        super(RuleCache, self).__init__()
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def get(self, key, now):
+        """ return the cached value for key, or None """
+        with self.lock:
+            entry = self.entries.get(key, None)
+
+            if entry is not None:
+                value, start, end = entry
+                if start is not None and not (start <= now < end):
+                    del self.entries[key]
+                    self.expired += 1
+                    entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, start=None, end=None):
+        if self.capacity <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = (value, start, end)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """ return a dictionary of cache statistics """
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+            }
+
 class Grammar(object):
     """SearchGrammar is a generic class for building a db search engine
 
@@ -776,6 +1000,9 @@ class Grammar(object):
     META_OFFSET = "offset"  # sql offset
     META_DEBUG  = "debug"   # write output to stdout
 
+    # number of parsed queries to keep. set to zero to disable caching
+    RULE_CACHE_SIZE = 256
+
     class TokenState(object):
         """ state variables for tokenizer """
 
@@ -842,10 +1069,15 @@ class Grammar(object):
         self.autoset_datetime = True
         self.fc = FormatConversion(dtn)
 
+        self.rule_cache = RuleCache(self.RULE_CACHE_SIZE)
+
     # public
 
     def ruleFromString(self, string):
-        """ return a rule AST from a given input string """
+        """ return a rule AST from a given input string
+
+        parsed rules are cached, the returned rule should not be modified
+        """
         if self.autoset_datetime:
             self.fc.datetime_now = datetime.now()
 
@@ -854,8 +1086,19 @@ class Grammar(object):
 
         if string is None or not string.strip():
             return BlankSearchRule()
-        tokens = self.tokenizeString(string)
-        rule = self.parseTokens(tokens)
+
+        key = (self.__class__, string)
+        entry = self.rule_cache.get(key, self.fc.datetime_now)
+        if entry is not None:
+            rule, meta_options = entry
+            self.meta_options = dict(meta_options)
+        else:
+            self.fc.resetValidity()
+            tokens = self.tokenizeString(string)
+            rule = self.parseTokens(tokens)
+            self.rule_cache.put(key, (rule, dict(self.meta_options)),
+                self.fc.valid_from, self.fc.valid_until)
+
         if self.getMetaValue(Grammar.META_DEBUG) == 1:
             sys.stdout.write("%r\n" % (rule))
         elif self.getMetaValue(Grammar.META_DEBUG) == 2:
@@ -47,6 +47,8 @@ from .search import SearchGrammar, \
         LHSError, \
         StrPos, \
         naive_search, \
+        compile_rule, \
+        RuleCache, \
         mktime
 
 def extract(field, items):
@@ -116,6 +118,17 @@ class TestSearchMeta(type):
                 self.assertEqual(s1,s2,m)
             return test
 
+        def gen_compile_test(rule):
+            """ check that a compiled rule agrees with rule.check """
+            def test(self):
+                for ignoreCase in (True, False):
+                    check = compile_rule(rule, ignoreCase)
+                    for song in self.SONGS:
+                        self.assertEqual(check(song),
+                            rule.check(song, ignoreCase),
+                            "\nrule: %s\nsource: %s" % (rule, check.source))
+            return test
+
         def gen_compare_count_test(rule,count):
             """ check that a rule returns the expected number of results"""
             def test(self):
@@ -171,6 +184,7 @@ class TestSearchMeta(type):
         for i, rule in enumerate(rules):
             test_name = "test_rule_%d" % i
             attr[test_name] = gen_compare_test(rule)
+            attr["test_compile_%d" % i] = gen_compile_test(rule)
 
         attr["test_and"] = gen_compare_rule_test(and1, rng1)
         attr["test_or"] = gen_compare_rule_test(or1, rng2)
@@ -519,6 +533,55 @@ class SearchGrammarTestCase(unittest.TestCase):
         with self.assertRaises(ParseError):
             self.sg.ruleFromString("debug=0 debug=1")
 
+    def test_rulegen_cache(self):
+
+        r1 = self.sg.ruleFromString("limit=5 count=1")
+        r2 = self.sg.ruleFromString("limit=5 count=1")
+        self.assertIs(r1, r2)
+        self.assertEqual(self.sg.meta_options['limit'], 5)
+
+        stats = self.sg.rule_cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+        # meta options are restored for each query
+        self.sg.ruleFromString("count=1")
+        self.assertFalse('limit' in self.sg.meta_options)
+        self.sg.ruleFromString("limit=5 count=1")
+        self.assertEqual(self.sg.meta_options['limit'], 5)
+
+    def test_rulegen_cache_date(self):
+
+        # relative dates are re-parsed once the day rolls over
+        r1 = self.sg.ruleFromString("date < 5")
+        self.sg.fc.datetime_now = self.dtn + datetime.timedelta(hours=23)
+        r2 = self.sg.ruleFromString("date < 5")
+        self.assertIs(r1, r2)
+
+        self.sg.fc.datetime_now = self.dtn + datetime.timedelta(days=1)
+        r3 = self.sg.ruleFromString("date < 5")
+        self.assertIsNot(r1, r3)
+        self.assertEqual(r3.value - r1.value, 24 * 60 * 60)
+        self.assertEqual(self.sg.rule_cache.stats()['expired'], 1)
+
+        # absolute dates never expire
+        r1 = self.sg.ruleFromString("date < 2018/1/1")
+        self.sg.fc.datetime_now = self.dtn + datetime.timedelta(days=30)
+        r2 = self.sg.ruleFromString("date < 2018/1/1")
+        self.assertIs(r1, r2)
+
+    def test_rulegen_cache_capacity(self):
+
+        cache = RuleCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a", self.dtn), 1)
+        cache.put("c", 3)
+        # b was the least recently used
+        self.assertEqual(cache.get("b", self.dtn), None)
+        self.assertEqual(cache.get("a", self.dtn), 1)
+        self.assertEqual(cache.get("c", self.dtn), 3)
+
 class SearchTestCase(unittest.TestCase):
     """
     """
@@ -619,6 +682,31 @@ class SearchTestCase(unittest.TestCase):
             self.assertTrue(r['number'] > 2)
             self.assertTrue(r['number'] < 8)
 
+    def test_compile_rule(self):
+
+        items = [{"name": "Abc", "number": i} for i in range(10)]
+
+        rule = AndSearchRule([
+            PartialStringSearchRule(StrPos("name", 0, 0), "ABC"),
+            NotSearchRule([LessThanSearchRule(StrPos("number", 0, 0), 5,
+                type_=int)])])
+
+        check = compile_rule(rule)
+        self.assertEqual([check(item) for item in items],
+                         [rule.check(item) for item in items])
+
+        # case folding is only applied when ignoring case
+        check = compile_rule(rule, ignoreCase=False)
+        self.assertFalse(any(check(item) for item in items))
+
+        # values which cannot be converted raise when the rule is applied
+        rule = ExactSearchRule(StrPos("number", 0, 0), "abc", type_=int)
+        check = compile_rule(rule)
+        with self.assertRaises(ValueError):
+            check(items[0])
+
+        self.assertTrue(compile_rule(BlankSearchRule())(items[0]))
+
     def test_rule(self):
 
         rulea = LessThanSearchRule(StrPos("number", 0, 0), 8)
@@ -8,19 +8,19 @@ shuffling. An ordering that produces, for example, multiple
 Spades in a row for a deck of cards may be the result of
 a random shuffle, but is not perceived as such.
 
+binshuffle computes the scores for every element in bulk, using numpy
+when it is installed and the array module otherwise.
 """
 # https://labs.spotify.com/2014/02/28/how-to-shuffle-songs/
 # Fisher-Yates
 import math
 import random
+from array import array
 
-class ShuffleElement(object):
-
-    def __init__(self, key, ref, index):
-        self.key = key
-        self.ref = ref
-        self.index = index
-        self.score = 0
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 def fisher_yates(data):
     N = len(data)
@@ -28,51 +28,85 @@ def fisher_yates(data):
         j = random.randint(i, N - 1)
         data[i], data[j] = data[j], data[i]
 
-def binshuffle(data, group_mapping=lambda x: x):
-    grpcounts = {}
-    grpoffset = {}
-    temp = []
+def _groups(keys):
+    """ map each key to a group number, numbered from zero """
+    numbers = {}
+    return [numbers.setdefault(k, len(numbers)) for k in keys], len(numbers)
 
-    N = len(data)
+def _order_numpy(keys):
+
+    groups, G = _groups(keys)
+    N = len(groups)
+
+    # seed from the random module so that random.seed is respected
+    rng = np.random.default_rng(random.getrandbits(64))
+
+    # pre shuffle, so that the order within a group is random
+    perm = rng.permutation(N)
+    grp = np.asarray(groups, dtype=np.intp)[perm]
+
+    # the index of each element within its group, in shuffled order
+    counts = np.bincount(grp, minlength=G)
+    order = np.argsort(grp, kind="stable")
+    starts = np.cumsum(counts) - counts
+    index = np.empty(N, dtype=np.float64)
+    index[order] = np.arange(N) - starts[grp[order]]
+
+    # elements in a group are spaced N/count apart, starting at a
+    # random offset for the group, with a jitter of +/- h/2
+    gap = N / counts
+    h = gap[grp] / 2
+    offset = rng.random(G) * gap
+    score = index * gap[grp] + offset[grp] + rng.random(N) * h - h / 2
+
+    return perm[np.argsort(score, kind="stable")].tolist()
+
+def _order_array(keys):
+
+    groups, G = _groups(keys)
+    N = len(groups)
+
+    # pre shuffle, so that the order within a group is random
+    perm = list(range(N))
+    random.shuffle(perm)
+
+    # the index of each element within its group, in shuffled order
+    counts = array('l', bytes(array('l').itemsize * G))
+    index = array('l', bytes(array('l').itemsize * N))
+    for i in perm:
+        g = groups[i]
+        index[i] = counts[g]
+        counts[g] += 1
+
+    gap = array('d', [N / count for count in counts])
+    offset = array('d', [random.random() * g for g in gap])
+
+    rnd = random.random
+    score = array('d', [
+        index[i] * gap[g] + offset[g] + (rnd() - 0.5) * gap[g] / 2
+        for i, g in enumerate(groups)])
+
+    perm.sort(key=score.__getitem__)
+
+    return perm
+
+def binshuffle_order(keys):
+    """ return a permutation of range(len(keys)) which spreads
+    elements with the same key evenly apart
+    """
+    if len(keys) < 2:
+        return list(range(len(keys)))
+
+    if np is not None:
+        return _order_numpy(keys)
+
+    return _order_array(keys)
+
+def binshuffle(data, group_mapping=lambda x: x):
 
-    if N < 2:
+    if len(data) < 2:
         return data
 
-    # pre shuffle the data to randomize the output
-    # Otherwise items within a group would always be output
-    # in the same order found in the input array
-    fisher_yates(data)
-
-    # count the number of elements in each group
-    # assign a value from 0 to G to each element in a group
-    for elem in data:
-        k = group_mapping(elem)
-        if k not in grpcounts:
-            grpcounts[k] = 1
-        else:
-            grpcounts[k] += 1
-        temp.append(ShuffleElement(k, elem, grpcounts[k] - 1))
-
-    # generate an initial offset for each group
-    # the offset is random, and the range is chosen to
-    # solve the degenerate problem where some groups contain a few
-    # elements, and others contain many elements.
-    for grp, count in grpcounts.items():
-        grpoffset[grp] = random.random() * (N / count)
-
-    # calculate a score for each element
-    # the score ranges from 0-h/2 to N+h/2.
-    # elements within a group are spaced
-    # evenly within this range.
-    for i, elem in enumerate(temp):
-        count = grpcounts[elem.key]
-        h = (N / count) / 2
-        offset = random.random() * h - h / 2 + grpoffset[elem.key]
-        elem.score = N * elem.index / count + offset
-
-    # finally sort by the score, randomizing the elements
-    # while separating items that belong to the same group
-    temp = sorted(temp, key=lambda x: x.score)
-
-    return [x.ref for x in temp]
+    order = binshuffle_order([group_mapping(elem) for elem in data])
 
+    return [data[i] for i in order]
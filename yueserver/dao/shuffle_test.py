@@ -4,7 +4,9 @@ import json
 import time
 import random
 
+from . import shuffle
 from .shuffle import binshuffle
+from ..tools.benchmark import binshuffle_reference
 
 class ShuffleTestCase(unittest.TestCase):
 
@@ -30,6 +32,38 @@ class ShuffleTestCase(unittest.TestCase):
 
         self.assertEqual(seq, out)
 
+    def _adjacent(self, func, seq, trials):
+        """ return the average number of adjacent equal elements """
+        count = 0
+        for i in range(trials):
+            out = func(list(seq))
+            count += sum(out[j] == out[j - 1] for j in range(1, len(out)))
+        return count / trials
+
+    def test_order(self):
+
+        keys = [i % 7 for i in range(1000)]
+
+        orders = [shuffle._order_array]
+        if shuffle.np is not None:
+            orders.append(shuffle._order_numpy)
+
+        for order in orders:
+            perm = order(keys)
+            self.assertEqual(sorted(perm), list(range(len(keys))))
+
+    def test_distribution(self):
+
+        # the vectorized shuffle should separate groups as well
+        # as the original implementation
+        seq = list("1111222233334444" + "5555555555" + "6")
+
+        random.seed(4)
+        expected = self._adjacent(binshuffle_reference, seq, 2000)
+        actual = self._adjacent(binshuffle, seq, 2000)
+
+        self.assertLess(abs(expected - actual), 0.25)
+
 def main():
     suite = unittest.defaultTestLoader.loadTestsFromTestCase(ShuffleTestCase)
     unittest.TextTestRunner().run(suite)
@@ -7,12 +7,16 @@ from sqlalchemy import and_, or_, not_, select, column, \
     update, insert, delete, asc, desc
 
 from sqlalchemy.sql.expression import bindparam
+from sqlalchemy.dialects import postgresql
 from .search import SearchGrammar, ParseError, Rule
 from .filesys.filesys import FileSystem
 from .filesys.util import FileRecord
 from .filesys.crypt import cryptkey, decryptkey, recryptkey
 from .exception import BackendException
-from .util import format_storage_path, hash_password, check_password_hash
+from .storage_preview import PreviewCache
+from .storage_usage import UsageLedger
+from .util import format_storage_path, hash_password, check_password_hash, \
+    parent_path, directory_paths, after_commit
 from .search import AndSearchRule, PartialStringSearchRule
 import os
 import sys
@@ -24,7 +28,7 @@ import posixpath
 import base64
 import logging
 
-from functools import lru_cache
+from collections import namedtuple
 from enum import Enum
 
 # taken from werkzeug.util.secure_file
@@ -104,6 +108,10 @@ class FileRecord2(object):
     def fromRow(row):
         pass
 
+# the columns of the preview table returned by previewListBatch
+PreviewRecord = namedtuple("PreviewRecord",
+    ["path", "size", "width", "height", "valid"])
+
 def url_uuid_v2():
     """returns a randomly generated unique identifier"""
     b = uuid.uuid4().bytes
@@ -196,6 +204,15 @@ class StorageDao(object):
 
         self.grammar = StorageSearchGrammar(self.dbtables)
 
+        # the disk usage of each user, shared with other daos
+        self.usage = UsageLedger.instance(db, dbtables)
+
+        # recently used previews, shared with other daos
+        self.previews = PreviewCache.instance(db)
+
+        # (role_id, root_name) => filesystem id
+        self._filesystems = {}
+
     # FileSystem util
 
     def localPathToNormalPath(self, local_path):
@@ -248,6 +265,8 @@ class StorageDao(object):
         data['user_id'] = user_id
         data['filesystem_id'] = fs_id
         data['file_path'] = file_path
+        # a null file path is rejected by the database
+        data['parent_path'] = parent_path(file_path) if file_path else None
 
         if 'version' not in data or data['version'] is None:
             data['version'] = 1
@@ -261,6 +280,10 @@ class StorageDao(object):
         try:
             result = self.db.session.execute(query)
 
+            self._updateDirectories(user_id, fs_id, file_path,
+                1, data.get('size', None) or 0)
+            self.usage.update(user_id, 1, data.get('size', None) or 0)
+
             if commit:
                 self.db.session.commit()
 
@@ -284,12 +307,42 @@ class StorageDao(object):
         if 'version' not in data or data['version'] is None:
             data['version'] = tab.c.version + 1
 
+        # the directory index must be updated when a file moves
+        # or the size of the file changes
+        item = None
+        if 'file_path' in data or 'size' in data:
+            query = select([tab.c.user_id, tab.c.filesystem_id,
+                            tab.c.file_path, tab.c.size]) \
+                .where(tab.c.id == file_id)
+            item = self.db.session.execute(query).fetchone()
+
+        if 'file_path' in data:
+            data['parent_path'] = parent_path(data['file_path'])
+
         query = tab.update() \
             .values(data) \
             .where(tab.c.id == file_id)
 
         self.db.session.execute(query)
 
+        self._invalidatePreviews(file_id)
+
+        if item is not None:
+            old_size = item.size or 0
+            new_size = data.get('size', old_size) or 0
+            new_path = data.get('file_path', item.file_path)
+            if new_path != item.file_path:
+                self._updateDirectories(item.user_id, item.filesystem_id,
+                    item.file_path, -1, -old_size)
+                self._updateDirectories(item.user_id, item.filesystem_id,
+                    new_path, 1, new_size)
+            elif new_size != old_size:
+                self._updateDirectories(item.user_id, item.filesystem_id,
+                    item.file_path, 0, new_size - old_size)
+
+            if new_size != old_size:
+                self.usage.update(item.user_id, 0, new_size - old_size)
+
         if commit:
             self.db.session.commit()
 
@@ -321,6 +374,9 @@ class StorageDao(object):
     def removeFile(self, user_id, fs_id, file_path, commit=True):
 
         tab = self.dbtables.FileSystemStorageTable
+
+        item = self.selectFile(user_id, fs_id, file_path)
+
         query = tab.delete() \
             .where(
                 and_(tab.c.user_id == user_id,
@@ -330,6 +386,12 @@ class StorageDao(object):
 
         result = self.db.session.execute(query)
 
+        if item is not None:
+            self._updateDirectories(user_id, fs_id, file_path,
+                -1, -(item.size or 0))
+            self.usage.update(user_id, -1, -(item.size or 0))
+            self._invalidatePreviews(item.id)
+
         logging.info("removed %d files", result.rowcount)
 
         if commit:
@@ -344,16 +406,124 @@ class StorageDao(object):
         """
 
         tab = self.dbtables.FileSystemStorageTable
+
+        query = tab.select().where(tab.c.storage_path == storage_path)
+        items = self.db.session.execute(query).fetchall()
+
         query = tab.delete() \
             .where(tab.c.storage_path == storage_path)
 
         result = self.db.session.execute(query)
 
+        for item in items:
+            self._updateDirectories(item.user_id, item.filesystem_id,
+                item.file_path, -1, -(item.size or 0))
+            self.usage.update(item.user_id, -1, -(item.size or 0))
+            self._invalidatePreviews(item.id)
+
         logging.info("removed %d files", result.rowcount)
 
         if commit:
             self.db.session.commit()
 
+    # Deduplicated Storage
+
+    def findBlob(self, user_id, fs_id, content_hash, encryption):
+        """ returns the blob with the given contents, or None
+
+        encryption: the encryption mode of the blob, None for no encryption
+        """
+
+        tab = self.dbtables.FileSystemBlobTable
+
+        query = tab.select().where(
+            and_(tab.c.user_id == user_id,
+                 tab.c.filesystem_id == fs_id,
+                 tab.c.content_hash == content_hash,
+                 tab.c.encryption == (encryption or CryptMode.none)))
+
+        return self.db.session.execute(query).fetchone()
+
+    def acquireBlob(self, user_id, fs_id, content_hash, encryption,
+      storage_path, size, commit=True):
+        """ add a reference to the blob with the given contents
+
+        if the blob does not exist, storage_path is registered as
+        the location of the blob.
+
+        returns the storage path of the blob, which will be different
+        from storage_path if the contents were already stored.
+        """
+
+        tab = self.dbtables.FileSystemBlobTable
+
+        item = self.findBlob(user_id, fs_id, content_hash, encryption)
+
+        if item is None:
+            query = tab.insert().values({
+                "user_id": user_id,
+                "filesystem_id": fs_id,
+                "content_hash": content_hash,
+                "encryption": encryption or CryptMode.none,
+                "storage_path": storage_path,
+                "size": size,
+                "refcount": 1,
+            })
+        else:
+            storage_path = item.storage_path
+            query = tab.update() \
+                .values({tab.c.refcount: tab.c.refcount + 1}) \
+                .where(tab.c.storage_path == storage_path)
+
+        try:
+            self.db.session.execute(query)
+        except IntegrityError as e:
+            ex = StorageException("%s" % e.args[0])
+            ex.original = e
+            raise ex
+
+        if commit:
+            self.db.session.commit()
+
+        return storage_path
+
+    def isBlob(self, storage_path):
+        """ returns true if a storage path may be shared by several files """
+
+        tab = self.dbtables.FileSystemBlobTable
+
+        query = select([tab.c.refcount]).where(tab.c.storage_path == storage_path)
+
+        return self.db.session.execute(query).fetchone() is not None
+
+    def releaseBlob(self, storage_path, commit=True):
+        """ remove a reference to the file at storage_path
+
+        returns true if the file is no longer used, and can be
+        removed from the file system. A path which is not a blob
+        is only used by a single file.
+        """
+
+        tab = self.dbtables.FileSystemBlobTable
+
+        query = tab.update() \
+            .values({tab.c.refcount: tab.c.refcount - 1}) \
+            .where(tab.c.storage_path == storage_path)
+
+        result = self.db.session.execute(query)
+
+        unused = True
+        if result.rowcount > 0:
+            query = tab.delete().where(
+                and_(tab.c.storage_path == storage_path,
+                     tab.c.refcount <= 0))
+            result = self.db.session.execute(query)
+            unused = result.rowcount > 0
+
+        if commit:
+            self.db.session.commit()
+
+        return unused
 
     def moveFileLocation(self, user_id, fs_id, srcPath, dstPath, commit=True):
         """
@@ -449,8 +619,11 @@ class StorageDao(object):
 
         return files
 
-    def _item2dir(self, name):
-        return FileRecord(name, True, 0, 0)
+    def _dir2record(self, item, path_prefix, delimiter):
+        name = item['path'][len(path_prefix):].rstrip(delimiter)
+        record = FileRecord(name, True, item['size'] or 0, 0)
+        record.count = item['count'] or 0
+        return record
 
     def _item2file(self, name, item):
         record = FileRecord(name, False, item['size'], item['mtime'],
@@ -464,15 +637,65 @@ class StorageDao(object):
         record.file_id = item['id']
         return record
 
-    def _item2record(self, item, path_prefix, delimiter):
-        item_path = item['file_path']
-        if item_path.startswith(path_prefix):
-            item_path = item_path[len(path_prefix):]
-        if delimiter in item_path:
-            name, _ = item_path.split(delimiter, 1)
-            return self._item2dir(name)
-        else:
-            return self._item2file(item_path, item)
+    def _updateDirectories(self, user_id, fs_id, file_path, count, size):
+        """ add (count=1) or remove (count=-1) a file from the
+        directories which contain it
+
+        size: the change in the total size of each directory
+        """
+
+        DirTab = self.dbtables.FileSystemDirectoryTable
+
+        paths = directory_paths(file_path)
+        if not paths:
+            return
+
+        where = and_(DirTab.c.user_id == user_id,
+                     DirTab.c.filesystem_id == fs_id,
+                     DirTab.c.path.in_(paths))
+
+        if count > 0 and self.db.kind() == "postgresql":
+            # concurrent uploads may create the same directory,
+            # sqlite serializes writers and does not need the upsert
+            query = postgresql.insert(DirTab).values([
+                {"user_id": user_id,
+                 "filesystem_id": fs_id,
+                 "path": path,
+                 "parent_path": parent_path(path),
+                 "count": count,
+                 "size": size} for path in paths])
+            query = query.on_conflict_do_update(
+                constraint='uix_fs_directory',
+                set_={"count": DirTab.c.count + query.excluded['count'],
+                      "size": DirTab.c.size + query.excluded['size']})
+            self.db.session.execute(query)
+            return
+
+        query = DirTab.update() \
+            .values({DirTab.c.count: DirTab.c.count + count,
+                     DirTab.c.size: DirTab.c.size + size}) \
+            .where(where)
+
+        result = self.db.session.execute(query)
+
+        if count > 0 and result.rowcount < len(paths):
+            query = select([DirTab.c.path]).where(where)
+            existing = set(row[0] for row in
+                self.db.session.execute(query).fetchall())
+
+            rows = [{"user_id": user_id,
+                     "filesystem_id": fs_id,
+                     "path": path,
+                     "parent_path": parent_path(path),
+                     "count": count,
+                     "size": size} for path in paths if path not in existing]
+
+            self.db.session.execute(DirTab.insert().values(rows))
+
+        if count < 0:
+            # a directory no longer exists once it contains no files
+            query = DirTab.delete().where(and_(where, DirTab.c.count <= 0))
+            self.db.session.execute(query)
 
     def list(self):
         FsTab = self.dbtables.FileSystemStorageTable
@@ -516,40 +739,59 @@ class StorageDao(object):
             yield obj
 
     def listdir(self, user_id, fs_id, path_prefix, limit=None, offset=None, delimiter='/'):
-        # search for persistent objects with prefix, that also do not contain
-        # the delimiter
+        """ list the files and directories contained in a directory
+
+        directories are listed first, followed by files. the record
+        for a directory contains the number of files and total size
+        of all files within that directory.
+        """
 
         FsTab = self.dbtables.FileSystemStorageTable
+        DirTab = self.dbtables.FileSystemDirectoryTable
 
         if not path_prefix.endswith(delimiter):
             raise StorageException("invalid directory path. must end with `%s`" % delimiter)
 
-        where = and_(FsTab.c.user_id == user_id,
-                     FsTab.c.filesystem_id == fs_id,
-                     FsTab.c.file_path.startswith(
-                        bindparam('file_path', path_prefix)))
-
-        query = FsTab.select().where(where)
+        query = DirTab.select().where(
+            and_(DirTab.c.user_id == user_id,
+                 DirTab.c.filesystem_id == fs_id,
+                 DirTab.c.parent_path == path_prefix)) \
+            .order_by(asc(DirTab.c.path))
 
-        if limit is not None:
-            query = query.limit(limit)
+        dirs = self.db.session.execute(query).fetchall()
 
+        # apply the offset and limit to the directories, then the files
         if offset is not None:
-            query = query.offset(offset).order_by(asc(FsTab.c.file_path))
+            n = min(offset, len(dirs))
+            dirs = dirs[n:]
+            offset -= n
+
+        if limit is not None:
+            dirs = dirs[:limit]
+            limit -= len(dirs)
 
-        dirs = set()
         count = 0
-        result = self.db.session.execute(query)
-        for item in result.fetchall():
-            rec = self._item2record(item, path_prefix, delimiter)
-
-            if rec.isDir:
-                if rec.name not in dirs:
-                    dirs.add(rec.name)
-                    yield rec
-                    count += 1
-            else:
-                yield rec
+        for item in dirs:
+            yield self._dir2record(item, path_prefix, delimiter)
+            count += 1
+
+        if limit is None or limit > 0:
+            query = FsTab.select().where(
+                and_(FsTab.c.user_id == user_id,
+                     FsTab.c.filesystem_id == fs_id,
+                     FsTab.c.parent_path == path_prefix)) \
+                .order_by(asc(FsTab.c.file_path))
+
+            if limit is not None:
+                query = query.limit(limit)
+
+            if offset:
+                query = query.offset(offset)
+
+            result = self.db.session.execute(query)
+            for item in result.fetchall():
+                name = item['file_path'][len(path_prefix):]
+                yield self._item2file(name, item)
                 count += 1
 
         # TODO: this disallows empty directories, which seems
@@ -559,6 +801,7 @@ class StorageDao(object):
 
     def file_info(self, user_id, fs_id, path_prefix, delimiter='/'):
         FsTab = self.dbtables.FileSystemStorageTable
+        DirTab = self.dbtables.FileSystemDirectoryTable
 
         scheme, base_path = self.splitScheme(path_prefix)
 
@@ -566,17 +809,18 @@ class StorageDao(object):
             raise StorageException("empty path component")
 
         if path_prefix.endswith(delimiter):
-            where = FsTab.c.file_path.startswith(bindparam('file_path', path_prefix))
-            where = and_(FsTab.c.user_id == user_id,
-                         FsTab.c.filesystem_id == fs_id,
-                         where)
+            where = and_(DirTab.c.user_id == user_id,
+                         DirTab.c.filesystem_id == fs_id,
+                         DirTab.c.path == path_prefix)
+            table = DirTab
             exact = False
         else:
             where = FsTab.c.file_path == path_prefix
+            table = FsTab
             exact = True
 
         query = select(['*']) \
-            .select_from(FsTab) \
+            .select_from(table) \
             .where(where).limit(1)
 
         result = self.db.session.execute(query)
@@ -589,11 +833,36 @@ class StorageDao(object):
             name = path_prefix.split(delimiter)[-1]
             return self._item2file(name, item)
         else:
-            name = base_path.rstrip(delimiter).split(delimiter)[-1]
-            return self._item2dir(name)
+            return self._dir2record(item, parent_path(path_prefix), delimiter)
+
+    def fileInfoById(self, user_id, file_id, delimiter='/'):
+        """ returns the record for a file given the file id """
+
+        FsTab = self.dbtables.FileSystemStorageTable
+
+        query = FsTab.select().where(
+            and_(FsTab.c.user_id == user_id, FsTab.c.id == file_id))
+
+        item = self.db.session.execute(query).fetchone()
+
+        if item is None:
+            raise StorageNotFoundException("[file_info] not found: %s" % file_id)
+
+        name = item.file_path.split(delimiter)[-1]
+        return self._item2file(name, item)
 
-    @lru_cache(maxsize=16)
     def getFilesystemId(self, user_id, role_id, root_name):
+        """ returns the id of a filesystem the role has permission to use
+
+        the id only depends on the role, and is cached for every user
+        with that role. permission changes are not seen until the
+        server is restarted.
+        """
+
+        fs_id = self._filesystems.get((role_id, root_name), None)
+        if fs_id is not None:
+            return fs_id
+
         FsTab = self.dbtables.FileSystemTable
         FsPermissionTab = self.dbtables.FileSystemPermissionTable
 
@@ -613,6 +882,7 @@ class StorageDao(object):
             raise StorageException(
                 "FileSystem %s not defined or permission denied" % root_name)
 
+        self._filesystems[(role_id, root_name)] = item.id
         return item.id
 
     def rootPath(self, user_id, role_id, root_name):
@@ -647,6 +917,23 @@ class StorageDao(object):
 
         return root_path
 
+    def filesystemRootPath(self, user_id, fs_id):
+        """
+        returns the root path for the given filesystem id
+        """
+
+        FsTab = self.dbtables.FileSystemTable
+
+        query = select([FsTab.c.path]).where(FsTab.c.id == fs_id)
+
+        item = self.db.session.execute(query).fetchone()
+
+        if item is None:
+            raise StorageException("FileSystem %s not defined" % fs_id)
+
+        return format_storage_path(item.path,
+            user_id=user_id, pwd=os.getcwd())
+
     # TODO: refactor absoluteFilePath, absolutePath
     # be more clear on return value
     # remove call to rootPath
@@ -717,24 +1004,12 @@ class StorageDao(object):
         return self.fs.join(root_path, rel_path)
 
     def userDiskUsage(self, user_id):
-        """ returns the number of files and bytes consumed by a user
-        """
-        columns = [func.count(column("size")), func.sum(column("size"))]
-        query = select(columns) \
-            .select_from(self.dbtables.FileSystemStorageTable) \
-            .where(self.dbtables.FileSystemStorageTable.c.user_id == user_id)
-        result = self.db.session.execute(query)
-        _count, _sum = result.fetchone()
-
-        _quota = self.userDiskQuota(user_id)
+        """ returns the number of files and bytes consumed by a user,
+        and the quota for that user
 
-        #view = self.dbtables.FileSystemUserUsageView
-        #query = view.select().where(view.c.user_id == user_id)
-        #item = self.db.session.execute(query).fetchone()
-        #if not item:
-        #    raise StorageException("Quota Not Set or no files")
-        #return item.count, (item.usage or 0), item.quota
-        return _count, (_sum or 0), _quota
+        the usage is read from the usage ledger
+        """
+        return self.usage.usage(user_id)
 
     def setUserDiskQuota(self, user_id, quota, commit=True):
 
@@ -757,6 +1032,8 @@ class StorageDao(object):
 
         result = self.db.session.execute(statement)
 
+        self.usage.setQuota(user_id, quota)
+
         if commit:
             self.db.session.commit()
 
@@ -1006,6 +1283,8 @@ class StorageDao(object):
 
         item = self.previewFind(user_id, file_id, scale)
 
+        self._invalidatePreviews(file_id)
+
         if item is None:
             self.previewInsert(user_id, file_id, scale, info, commit)
         else:
@@ -1024,6 +1303,74 @@ class StorageDao(object):
         else:
             return self.db.session.execute(query).fetchone()
 
+    def previewListBatch(self, user_id, fs_id, scale, file_paths=None,
+      path_prefix=None, extensions=None, limit=None, offset=None,
+      delimiter='/'):
+        """ returns the files, and a preview of each file, using one query
+
+        file_paths: a list of absolute file paths
+        path_prefix: the path of a directory, ending with a delimiter.
+            the files in the directory are returned.
+        extensions: if given, only files with one of these lower case
+            extensions are returned
+        limit, offset: return a page of the files, ordered by path
+
+        yields a pair (file record, PreviewRecord) for each file. the
+        preview is None if the file has no preview at the given scale.
+        """
+
+        FsTab = self.dbtables.FileSystemStorageTable
+        PvTab = self.dbtables.FileSystemPreviewStorageTable
+
+        where = and_(FsTab.c.user_id == user_id,
+                     FsTab.c.filesystem_id == fs_id)
+        if file_paths is not None:
+            where = and_(where, FsTab.c.file_path.in_(file_paths))
+        if path_prefix is not None:
+            where = and_(where, FsTab.c.parent_path == path_prefix)
+        if extensions is not None:
+            path = func.lower(FsTab.c.file_path)
+            where = and_(where, or_(*[path.like("%%.%s" % ext)
+                for ext in sorted(extensions)]))
+
+        columns = list(FsTab.c) + [
+            PvTab.c.path.label("pv_path"),
+            PvTab.c.size.label("pv_size"),
+            PvTab.c.width.label("pv_width"),
+            PvTab.c.height.label("pv_height"),
+            PvTab.c.valid.label("pv_valid"),
+        ]
+
+        query = select(columns) \
+            .select_from(FsTab.join(PvTab,
+                and_(PvTab.c.file_id == FsTab.c.id, PvTab.c.scale == scale),
+                isouter=True)) \
+            .where(where) \
+            .order_by(asc(FsTab.c.file_path))
+
+        if limit is not None:
+            query = query.limit(limit)
+        if offset is not None:
+            query = query.offset(offset)
+
+        for item in self.db.session.execute(query).fetchall():
+            name = item['file_path'].split(delimiter)[-1]
+            preview = None
+            if item['pv_path'] is not None:
+                preview = PreviewRecord(item['pv_path'],
+                    item['pv_size'], item['pv_width'],
+                    item['pv_height'], item['pv_valid'])
+            yield self._item2file(name, item), preview
+
+    def _invalidatePreviews(self, file_id):
+        """ drop the cached previews of a file now, and again once the
+        transaction is committed. another request may cache a preview
+        of the old version before the change is committed
+        """
+        self.previews.invalidate(file_id)
+        after_commit(self.db.session,
+            lambda: self.previews.invalidate(file_id))
+
     def previewInvalidate(self, user_id, file_id, commit=True):
         """ invalidate all preview files for an entry """
         tab = self.dbtables.FileSystemPreviewStorageTable
@@ -1035,6 +1382,8 @@ class StorageDao(object):
 
         self.db.session.execute(query)
 
+        self._invalidatePreviews(file_id)
+
         if commit:
             self.db.session.commit()
 
@@ -1048,6 +1397,135 @@ class StorageDao(object):
 
         self.db.session.execute(query)
 
+        self._invalidatePreviews(file_id)
+
+        if commit:
+            self.db.session.commit()
+
+    # the preview job table is a queue of previews to be generated
+    # by a pool of workers, which may be in a different process
+
+    def previewJobEnqueue(self, user_id, file_id, fs_id, scale, commit=True):
+        """ submit a job to generate a preview
+
+        a job which already exists is run again, even if it is running
+        """
+
+        tab = self.dbtables.FileSystemPreviewJobTable
+
+        query = tab.update() \
+            .values({tab.c.state: 0,
+                     tab.c.version: tab.c.version + 1,
+                     tab.c.mtime: int(time.time())}) \
+            .where(and_(tab.c.file_id == file_id, tab.c.scale == scale))
+
+        result = self.db.session.execute(query)
+
+        if result.rowcount == 0:
+            query = tab.insert().values({
+                "user_id": user_id,
+                "file_id": file_id,
+                "filesystem_id": fs_id,
+                "scale": scale,
+                "state": 0,
+                "version": 0,
+                "attempts": 0,
+                "mtime": int(time.time()),
+            })
+            self.db.session.execute(query)
+
+        if commit:
+            self.db.session.commit()
+
+    def previewJobFind(self, user_id, file_id, scale):
+
+        tab = self.dbtables.FileSystemPreviewJobTable
+        query = tab.select().where(
+            and_(tab.c.user_id == user_id,
+                 tab.c.file_id == file_id,
+                 tab.c.scale == scale))
+
+        return self.db.session.execute(query).fetchone()
+
+    def previewJobClaim(self, lease=300):
+        """ returns the oldest job which is waiting, or None
+
+        the job is marked as running. a running job which has not
+        completed after lease seconds is assumed to have failed and
+        may be claimed again
+        """
+
+        tab = self.dbtables.FileSystemPreviewJobTable
+
+        now = int(time.time())
+        where = or_(tab.c.state == 0,
+                    and_(tab.c.state == 1, tab.c.mtime < now - lease))
+
+        query = tab.select().where(where).order_by(asc(tab.c.mtime)).limit(8)
+
+        for job in self.db.session.execute(query).fetchall():
+            # another worker may claim the job first
+            query = tab.update() \
+                .values({tab.c.state: 1,
+                         tab.c.attempts: tab.c.attempts + 1,
+                         tab.c.mtime: now}) \
+                .where(and_(tab.c.id == job.id,
+                            tab.c.state == job.state,
+                            tab.c.version == job.version))
+            result = self.db.session.execute(query)
+            self.db.session.commit()
+
+            if result.rowcount == 1:
+                return job
+
+        return None
+
+    def previewJobComplete(self, job, commit=True):
+        """ remove a job once it has been run
+
+        returns false if the job was submitted again while it was running
+        """
+
+        tab = self.dbtables.FileSystemPreviewJobTable
+
+        query = tab.delete().where(
+            and_(tab.c.id == job.id, tab.c.version == job.version))
+
+        result = self.db.session.execute(query)
+
+        if commit:
+            self.db.session.commit()
+
+        return result.rowcount > 0
+
+    def previewJobRetry(self, job, commit=True):
+        """ return a running job to the queue, so that it is run again
+
+        the attempts of the job are not reset
+        """
+
+        tab = self.dbtables.FileSystemPreviewJobTable
+
+        query = tab.update() \
+            .values({tab.c.state: 0,
+                     tab.c.mtime: int(time.time())}) \
+            .where(and_(tab.c.id == job.id, tab.c.version == job.version))
+
+        self.db.session.execute(query)
+
+        if commit:
+            self.db.session.commit()
+
+    def previewJobRemove(self, user_id, file_id, commit=True):
+        """ remove all jobs for a file """
+
+        tab = self.dbtables.FileSystemPreviewJobTable
+        query = tab.delete() \
+            .where(and_(tab.c.user_id == user_id,
+                        tab.c.file_id == file_id))
+
+        self.db.session.execute(query)
+
         if commit:
             self.db.session.commit()
 
@@ -0,0 +1,190 @@
+"""
+An in-memory cache of the previews of files
+
+A preview which has been found once can be served again without querying
+the database, or checking that the preview file exists. Entries are keyed
+by (user, file_id, version, scale), and a second index maps the path of a
+file to its id and version, so that the ETag of a preview request can be
+checked before any database access.
+
+The StorageDao drops the entries for a file whenever the file, or its
+previews, change, and again once the change is committed. Changes made
+by another process are not seen, so the
+cache should not be relied upon when several processes share a database.
+
+Small previews, such as thumbnails, may also be kept in memory. The total
+size of the preview content is limited to a byte budget, and the least
+recently used content is discarded first.
+"""
+import threading
+import weakref
+from collections import OrderedDict
+
+class PreviewCacheEntry(object):
+    """ a preview of a single version of a file """
+
+    __slots__ = ('user_id', 'file_id', 'version', 'encryption', 'file_path',
+        'scale', 'path', 'size', 'width', 'height')
+
+    def __init__(self, user_id, fileItem, scale, previewItem):
+        super(PreviewCacheEntry, self).__init__()
+        self.user_id = user_id
+        self.file_id = fileItem.file_id
+        self.version = fileItem.version
+        self.encryption = fileItem.encryption
+        self.file_path = fileItem.file_path
+        self.scale = scale
+        self.path = previewItem.path
+        self.size = previewItem.size
+        self.width = previewItem.width
+        self.height = previewItem.height
+
+    def key(self):
+        return (self.user_id, self.file_id, self.version, self.scale)
+
+class PreviewCache(object):
+    """ previews of recently requested files
+
+    max_entries: the maximum number of previews to remember
+    budget: the number of bytes of preview content kept in memory
+    """
+
+    # the previews which are small enough to keep in memory
+    MEMORY_SCALES = {"xxsmall", "thumb"}
+
+    _instances = weakref.WeakKeyDictionary()
+    _instances_lock = threading.Lock()
+
+    def __init__(self, max_entries=4096, budget=0):
+        super(PreviewCache, self).__init__()
+        self.max_entries = max_entries
+        self.budget = budget
+
+        self._lock = threading.Lock()
+        # (user_id, file_id, version, scale) => entry
+        self._entries = OrderedDict()
+        # (user_id, fs_id, file_path) => (file_id, version)
+        self._files = {}
+        # file_id => set of keys into _files
+        self._paths = {}
+        # file_id => set of keys into _entries
+        self._keys = {}
+        # (user_id, file_id, version, scale) => bytes
+        self._content = OrderedDict()
+        self._content_size = 0
+
+    @staticmethod
+    def instance(db):
+        """ returns the cache for a database """
+        with PreviewCache._instances_lock:
+            cache = PreviewCache._instances.get(db, None)
+            if cache is None:
+                cache = PreviewCache()
+                PreviewCache._instances[db] = cache
+            return cache
+
+    def lookup(self, user_id, fs_id, file_path, scale):
+        """ returns the preview of the current version of a file, or None """
+        with self._lock:
+            item = self._files.get((user_id, fs_id, file_path), None)
+            if item is None:
+                return None
+            key = (user_id, item[0], item[1], scale)
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, user_id, fs_id, fileItem, scale, previewItem):
+        """ add the preview of a file and return the new entry """
+
+        entry = PreviewCacheEntry(user_id, fileItem, scale, previewItem)
+        key = entry.key()
+        path_key = (user_id, fs_id, entry.file_path)
+
+        with self._lock:
+            self._files[path_key] = (entry.file_id, entry.version)
+            self._paths.setdefault(entry.file_id, set()).add(path_key)
+
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._keys.setdefault(entry.file_id, set()).add(key)
+
+            while len(self._entries) > self.max_entries:
+                old_key, _ = self._entries.popitem(last=False)
+                self._discard(old_key)
+
+        return entry
+
+    def content(self, entry):
+        """ returns the content of a preview kept in memory, or None """
+        with self._lock:
+            data = self._content.get(entry.key(), None)
+            if data is not None:
+                self._content.move_to_end(entry.key())
+            return data
+
+    def keepsContent(self, entry):
+        """ returns true if the content of a preview should be kept
+        in memory. only unencrypted previews are kept.
+        """
+        return entry.encryption is None and \
+            entry.scale in self.MEMORY_SCALES and \
+            0 < (entry.size or 0) <= self.budget
+
+    def setContent(self, entry, data):
+
+        key = entry.key()
+        with self._lock:
+            if key not in self._entries:
+                # the entry was invalidated while the content was read
+                return
+            self._discard_content(key)
+            self._content[key] = data
+            self._content_size += len(data)
+            while self._content_size > self.budget:
+                _, old = self._content.popitem(last=False)
+                self._content_size -= len(old)
+
+    def _discard_content(self, key):
+        """ must be called while holding the lock """
+        data = self._content.pop(key, None)
+        if data is not None:
+            self._content_size -= len(data)
+
+    def _discard(self, key):
+        """ remove the index entries for a key which has been evicted
+
+        the path of a file is forgotten once it has no previews
+        must be called while holding the lock
+        """
+        self._discard_content(key)
+        file_id = key[1]
+        keys = self._keys.get(file_id, None)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys[file_id]
+                self._forget(file_id)
+
+    def _forget(self, file_id):
+        """ must be called while holding the lock """
+        for path_key in self._paths.pop(file_id, ()):
+            self._files.pop(path_key, None)
+
+    def invalidate(self, file_id):
+        """ remove all entries for a file """
+        with self._lock:
+            self._forget(file_id)
+            for key in self._keys.pop(file_id, ()):
+                self._entries.pop(key, None)
+                self._discard_content(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._files.clear()
+            self._paths.clear()
+            self._keys.clear()
+            self._content.clear()
+            self._content_size = 0
@@ -0,0 +1,211 @@
+import unittest
+
+from .db import db_init_main, db_connect
+from .user import UserDao
+from .storage import StorageDao
+from .storage_preview import PreviewCache
+
+def preview_info(fs_id, path, size=100):
+    return {
+        'width': 80,
+        'height': 60,
+        'filesystem_id': fs_id,
+        'size': size,
+        'path': path,
+        'valid': 1
+    }
+
+class PreviewCacheTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        db = db_connect(None)
+
+        env_cfg = {
+            'features': ['test', ],
+            'filesystems': {
+                "default": "mem://memtest",
+            },
+            'domains': ['test'],
+            'roles': [
+                {'test': {'features': ['all'], 'filesystems': ["default"]}},
+            ],
+            'users': [
+                {'email': 'user000',
+                 'password': 'user000',
+                 'domains': ['test'],
+                 'roles': ['test']},
+            ]
+        }
+
+        db_init_main(db, db.tables, env_cfg)
+
+        cls.userDao = UserDao(db, db.tables)
+        cls.USER = cls.userDao.findUserByEmail("user000")
+
+        cls.storageDao = StorageDao(db, db.tables)
+        cls.fs_id = cls.storageDao.getFilesystemId(
+            cls.USER['id'], cls.USER['role_id'], "default")
+
+        cls.db = db
+
+    def setUp(self):
+        self.db.delete(self.db.tables.FileSystemPreviewStorageTable)
+        self.db.delete(self.db.tables.FileSystemStorageTable)
+        self.db.delete(self.db.tables.FileSystemDirectoryTable)
+        self.db.delete(self.db.tables.FileSystemUserUsageTable)
+        self.storageDao.usage.clear()
+        self.storageDao.previews.clear()
+
+    def _insert(self, path):
+        """ insert a file with a preview, and cache the preview """
+        user_id = self.USER['id']
+        self.storageDao.insertFile(user_id, self.fs_id, path,
+            dict(storage_path="mem://memtest" + path, size=10))
+        info = self.storageDao.file_info(user_id, self.fs_id, path)
+        self.storageDao.previewUpsert(user_id, info.file_id, "thumb",
+            preview_info(self.fs_id, "mem://memtest/preview" + path))
+        item = self.storageDao.previewFind(user_id, info.file_id, "thumb")
+        return self.storageDao.previews.put(
+            user_id, self.fs_id, info, "thumb", item)
+
+    def _lookup(self, path, scale="thumb"):
+        return self.storageDao.previews.lookup(
+            self.USER['id'], self.fs_id, path, scale)
+
+    def test_shared_cache(self):
+        other = StorageDao(self.db, self.db.tables)
+        self.assertIs(other.previews, self.storageDao.previews)
+
+    def test_lookup(self):
+
+        entry = self._insert("/a.png")
+        self.assertEqual(entry.version, 1)
+        self.assertEqual(entry.path, "mem://memtest/preview/a.png")
+        self.assertIs(self._lookup("/a.png"), entry)
+        self.assertIsNone(self._lookup("/a.png", "small"))
+        self.assertIsNone(self._lookup("/b.png"))
+
+    def test_invalidate(self):
+
+        user_id = self.USER['id']
+
+        # a new version of the file
+        entry = self._insert("/a.png")
+        self.storageDao.upsertFile(user_id, self.fs_id, "/a.png", dict(size=20))
+        self.assertIsNone(self._lookup("/a.png"))
+
+        # moving the file
+        entry = self._insert("/b.png")
+        self.storageDao.moveFileLocation(user_id, self.fs_id,
+            "/b.png", "/c.png")
+        self.assertIsNone(self._lookup("/b.png"))
+        self.assertIsNone(self._lookup("/c.png"))
+
+        # invalidating the previews
+        entry = self._insert("/d.png")
+        self.storageDao.previewInvalidate(user_id, entry.file_id)
+        self.assertIsNone(self._lookup("/d.png"))
+
+        # removing the file
+        entry = self._insert("/e.png")
+        self.storageDao.removeFile(user_id, self.fs_id, "/e.png")
+        self.assertIsNone(self._lookup("/e.png"))
+
+        # a preview cached before the change is committed
+        entry = self._insert("/f.png")
+        self.storageDao.previewInvalidate(user_id, entry.file_id,
+            commit=False)
+        item = self.storageDao.fileInfoById(user_id, entry.file_id)
+        self.storageDao.previews.put(user_id, self.fs_id, item, "thumb", entry)
+        self.assertIsNotNone(self._lookup("/f.png"))
+        self.db.session.commit()
+        self.assertIsNone(self._lookup("/f.png"))
+
+    def test_max_entries(self):
+
+        cache = PreviewCache(max_entries=2)
+        entries = [self._insert("/%d.png" % i) for i in range(3)]
+        for entry in entries:
+            item = self.storageDao.fileInfoById(self.USER['id'], entry.file_id)
+            cache.put(self.USER['id'], self.fs_id, item, "thumb", entry)
+
+        self.assertIsNone(cache.lookup(self.USER['id'], self.fs_id, "/0.png", "thumb"))
+        self.assertIsNotNone(cache.lookup(self.USER['id'], self.fs_id, "/2.png", "thumb"))
+        # the path of a file without previews is forgotten
+        self.assertEqual(len(cache._files), 2)
+
+    def test_content(self):
+
+        cache = self.storageDao.previews
+        cache.budget = 250
+
+        try:
+            entries = [self._insert("/%d.png" % i) for i in range(3)]
+            for entry in entries:
+                self.assertTrue(cache.keepsContent(entry))
+                cache.setContent(entry, b"0" * entry.size)
+
+            # the least recently used content is discarded
+            self.assertIsNone(cache.content(entries[0]))
+            self.assertEqual(cache.content(entries[1]), b"0" * 100)
+            self.assertEqual(cache.content(entries[2]), b"0" * 100)
+
+            # content is discarded with the entry
+            self.storageDao.previewInvalidate(self.USER['id'], entries[1].file_id)
+            self.assertIsNone(cache.content(entries[1]))
+            cache.setContent(entries[1], b"0" * 100)
+            self.assertIsNone(cache.content(entries[1]))
+        finally:
+            cache.budget = 0
+
+        self.assertFalse(cache.keepsContent(entries[2]))
+
+    def test_list_batch(self):
+
+        user_id = self.USER['id']
+
+        self._insert("/dir/a.png")
+        self.storageDao.insertFile(user_id, self.fs_id, "/dir/b.png",
+            dict(storage_path="mem://memtest/dir/b.png", size=10))
+        self.storageDao.insertFile(user_id, self.fs_id, "/dir/sub/c.png",
+            dict(storage_path="mem://memtest/dir/sub/c.png", size=10))
+
+        items = list(self.storageDao.previewListBatch(user_id, self.fs_id,
+            "thumb", path_prefix="/dir/"))
+        self.assertEqual([f.file_path for f, _ in items],
+            ["/dir/a.png", "/dir/b.png"])
+        self.assertEqual(items[0][1].path, "mem://memtest/preview/dir/a.png")
+        self.assertEqual(items[0][1].size, 100)
+        self.assertIsNone(items[1][1])
+
+        items = list(self.storageDao.previewListBatch(user_id, self.fs_id,
+            "thumb", file_paths=["/dir/sub/c.png", "/dir/a.png", "/dne.png"]))
+        self.assertEqual([f.file_path for f, _ in items],
+            ["/dir/a.png", "/dir/sub/c.png"])
+
+        # only the requested scale is returned
+        items = list(self.storageDao.previewListBatch(user_id, self.fs_id,
+            "small", file_paths=["/dir/a.png"]))
+        self.assertEqual(len(items), 1)
+        self.assertIsNone(items[0][1])
+
+        # directories are listed a page at a time
+        self.storageDao.insertFile(user_id, self.fs_id, "/dir/c.TXT",
+            dict(storage_path="mem://memtest/dir/c.TXT", size=10))
+        self.storageDao.insertFile(user_id, self.fs_id, "/dir/d.JPG",
+            dict(storage_path="mem://memtest/dir/d.JPG", size=10))
+
+        items = list(self.storageDao.previewListBatch(user_id, self.fs_id,
+            "thumb", path_prefix="/dir/", extensions={"png", "jpg"},
+            limit=2, offset=1))
+        self.assertEqual([f.file_path for f, _ in items],
+            ["/dir/b.png", "/dir/d.JPG"])
+
+def main():
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(PreviewCacheTestCase)
+    unittest.TextTestRunner().run(suite)
+
+if __name__ == '__main__':
+    main()
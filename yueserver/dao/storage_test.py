@@ -9,6 +9,7 @@ import time
 
 from .db import db_init_main, db_connect, main_test
 from .user import UserDao
+from .storage_usage import UsageLedger
 from .storage import StorageDao, \
     StorageException, StorageNotFoundException, FileRecord2
 from sqlalchemy import and_
@@ -269,6 +270,9 @@ class StorageTestCase(unittest.TestCase):
         user_id = self.USER['id']
 
         self.db.delete(self.db.tables.FileSystemStorageTable)
+        self.db.delete(self.db.tables.FileSystemDirectoryTable)
+        self.db.delete(self.db.tables.FileSystemUserUsageTable)
+        UsageLedger.instance(self.db, self.db.tables).clear()
         self.db.delete(self.db.tables.FileSystemTable)
         self.db.delete(self.db.tables.FileSystemPermissionTable)
 
@@ -369,6 +373,69 @@ class StorageTestCase(unittest.TestCase):
         # output is guaranteed sorted
         self.assertEqual(files[0].name, 'file1.txt')
 
+    def test_002h_listdir_directory_index(self):
+        """
+        show that the directory records contain the number of files
+        and total size, and are updated when files move or are removed
+        """
+
+        user_id = self.USER['id']
+        fs_id = self.fs_default_id
+
+        for path, size in [("/index/a/1.txt", 10),
+                           ("/index/a/b/2.txt", 20),
+                           ("/index/c/3.txt", 30),
+                           ("/index/4.txt", 40)]:
+            data = dict(storage_path='file://' + path, size=size)
+            self.storageDao.insertFile(user_id, fs_id, path, data)
+
+        def listdir(path, **kwargs):
+            return {rec.name: rec for rec in
+                self.storageDao.listdir(user_id, fs_id, path, **kwargs)}
+
+        records = listdir("/index/")
+        self.assertEqual(sorted(records), ["4.txt", "a", "c"])
+        self.assertTrue(records['a'].isDir)
+        self.assertEqual(records['a'].count, 2)
+        self.assertEqual(records['a'].size, 30)
+        self.assertFalse(records['4.txt'].isDir)
+
+        # directories are listed before files
+        self.assertEqual(sorted(listdir("/index/", limit=2)), ["a", "c"])
+        self.assertEqual(sorted(listdir("/index/", offset=2)), ["4.txt"])
+
+        info = self.storageDao.file_info(user_id, fs_id, "/index/a/")
+        self.assertTrue(info.isDir)
+        self.assertEqual(info.name, "a")
+        self.assertEqual(info.count, 2)
+
+        # moving a file updates both directories
+        self.storageDao.moveFileLocation(user_id, fs_id,
+            "/index/a/b/2.txt", "/index/c/2.txt")
+        records = listdir("/index/a/")
+        self.assertEqual(sorted(records), ["1.txt"])
+        records = listdir("/index/")
+        self.assertEqual(records['c'].count, 2)
+        self.assertEqual(records['c'].size, 50)
+
+        # changing the size of a file updates the directory size
+        item = self.storageDao.selectFile(user_id, fs_id, "/index/c/3.txt")
+        self.storageDao.updateFile(item.id, {"size": 35})
+        self.assertEqual(listdir("/index/")['c'].size, 55)
+
+        # a directory is removed once it is empty
+        self.storageDao.removeFile(user_id, fs_id, "/index/a/1.txt")
+        self.assertEqual(sorted(listdir("/index/")), ["4.txt", "c"])
+
+        with self.assertRaises(StorageNotFoundException):
+            list(self.storageDao.listdir(user_id, fs_id, "/index/a/"))
+
+        for path in ["/index/c/2.txt", "/index/c/3.txt", "/index/4.txt"]:
+            self.storageDao.removeFile(user_id, fs_id, path)
+
+        with self.assertRaises(StorageNotFoundException):
+            list(self.storageDao.listdir(user_id, fs_id, "/index/"))
+
     def test_003a_preview(self):
 
         user_id = self.USER['id']
@@ -612,6 +679,9 @@ class Storage2TestCase(unittest.TestCase):
     def setUp(self):
 
         self.db.delete(self.db.tables.FileSystemStorageTable)
+        self.db.delete(self.db.tables.FileSystemDirectoryTable)
+        self.db.delete(self.db.tables.FileSystemUserUsageTable)
+        UsageLedger.instance(self.db, self.db.tables).clear()
         self.db.delete(self.db.tables.FileSystemTable)
         self.db.delete(self.db.tables.FileSystemPermissionTable)
 
@@ -830,6 +900,95 @@ class Storage2TestCase(unittest.TestCase):
         with self.assertRaises(StorageNotFoundException):
             self.storageDao.publicFileInfo("dne")
 
+    def test_009_blob(self):
+
+        user_id = self.USER['id']
+        fs_id = self.fs_default_id
+        hash1 = "0" * 64
+
+        self.assertIsNone(self.storageDao.findBlob(user_id, fs_id, hash1, None))
+
+        # the first reference registers the storage path
+        path = self.storageDao.acquireBlob(user_id, fs_id, hash1, None,
+            "mem://test/blob1", 10)
+        self.assertEqual(path, "mem://test/blob1")
+
+        # later references use the existing storage path
+        path = self.storageDao.acquireBlob(user_id, fs_id, hash1, None,
+            "mem://test/blob2", 10)
+        self.assertEqual(path, "mem://test/blob1")
+
+        # the encryption mode is part of the key
+        path = self.storageDao.acquireBlob(user_id, fs_id, hash1, "client",
+            "mem://test/blob3", 90)
+        self.assertEqual(path, "mem://test/blob3")
+
+        blob = self.storageDao.findBlob(user_id, fs_id, hash1, None)
+        self.assertEqual(blob.refcount, 2)
+        self.assertEqual(blob.size, 10)
+        self.assertTrue(self.storageDao.isBlob("mem://test/blob1"))
+
+        # the file can be removed once the last reference is released
+        self.assertFalse(self.storageDao.releaseBlob("mem://test/blob1"))
+        self.assertTrue(self.storageDao.releaseBlob("mem://test/blob1"))
+        self.assertIsNone(self.storageDao.findBlob(user_id, fs_id, hash1, None))
+        self.assertTrue(self.storageDao.releaseBlob("mem://test/blob3"))
+
+        # a path which is not a blob is used by a single file
+        self.assertFalse(self.storageDao.isBlob("mem://test/other"))
+        self.assertTrue(self.storageDao.releaseBlob("mem://test/other"))
+
+        # files may share a storage path
+        for i in range(2):
+            self.storageDao.insertFile(user_id, fs_id, "/blob%d.txt" % i,
+                dict(storage_path="mem://test/blob4", size=10))
+        self.storageDao.removeFile(user_id, fs_id, "/blob0.txt")
+        self.storageDao.removeFile(user_id, fs_id, "/blob1.txt")
+
+    def test_010_preview_job(self):
+
+        user_id = self.USER['id']
+        fs_id = self.fs_default_id
+
+        self.storageDao.insertFile(user_id, fs_id, "/image.png",
+            dict(storage_path="mem://test/image.png", size=10))
+        file_id = self.storageDao.file_info(user_id, fs_id, "/image.png").file_id
+
+        self.assertIsNone(self.storageDao.previewJobClaim())
+
+        # jobs are unique for each file and scale
+        self.storageDao.previewJobEnqueue(user_id, file_id, fs_id, "thumb")
+        self.storageDao.previewJobEnqueue(user_id, file_id, fs_id, "thumb")
+        self.storageDao.previewJobEnqueue(user_id, file_id, fs_id, "small")
+
+        job1 = self.storageDao.previewJobClaim()
+        job2 = self.storageDao.previewJobClaim()
+        self.assertIsNotNone(job1)
+        self.assertIsNotNone(job2)
+        self.assertEqual({job1.scale, job2.scale}, {"thumb", "small"})
+        self.assertIsNone(self.storageDao.previewJobClaim())
+
+        # a job which is submitted again while running is not removed
+        self.storageDao.previewJobEnqueue(user_id, file_id, fs_id, job1.scale)
+        self.assertFalse(self.storageDao.previewJobComplete(job1))
+        self.assertTrue(self.storageDao.previewJobComplete(job2))
+
+        job3 = self.storageDao.previewJobClaim()
+        self.assertEqual(job3.scale, job1.scale)
+        self.assertTrue(self.storageDao.previewJobComplete(job3))
+        self.assertIsNone(self.storageDao.previewJobFind(
+            user_id, file_id, job1.scale))
+
+        # a running job which has expired can be claimed again
+        self.storageDao.previewJobEnqueue(user_id, file_id, fs_id, "thumb")
+        self.assertIsNotNone(self.storageDao.previewJobClaim())
+        self.assertIsNone(self.storageDao.previewJobClaim())
+        self.assertIsNotNone(self.storageDao.previewJobClaim(lease=-1))
+
+        self.storageDao.previewJobRemove(user_id, file_id)
+        self.assertIsNone(self.storageDao.previewJobFind(
+            user_id, file_id, "thumb"))
+
     # todo:
     #   test that a user cannot CRUD other users files
 
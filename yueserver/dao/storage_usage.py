@@ -0,0 +1,215 @@
+"""
+An in-memory ledger of the disk usage of each user
+
+The ledger keeps the number of files and bytes owned by each user, along
+with the bytes reserved by uploads which are still in progress. Quota
+checks against the ledger are O(1) and are made while holding a lock,
+so that parallel uploads by the same user can not exceed the quota.
+
+The usage is persisted to the user usage table by the StorageDao, in the
+same transaction as the change to the storage table, and the ledger is
+updated once that transaction is committed. The entry for a user is
+loaded from the database on first use. One ledger is shared by every
+StorageDao using the same database.
+"""
+import threading
+import weakref
+
+from sqlalchemy import select
+
+from .exception import BackendException
+from .util import after_commit
+
+class QuotaExceededException(BackendException):
+    HTTP_STATUS = 413
+
+class UserUsage(object):
+    """ the usage, quota and in-flight uploads of a single user """
+
+    def __init__(self, count, size, quota):
+        super(UserUsage, self).__init__()
+        self.count = count
+        self.size = size
+        # zero is no limit
+        self.quota = quota
+        # upload id => reserved bytes
+        self.reservations = {}
+        self.reserved = 0
+        # true if the count and size must be reloaded from the database
+        self.stale = False
+
+class UsageLedger(object):
+    """ disk usage and quota for every user, built on first use """
+
+    _instances = weakref.WeakKeyDictionary()
+    _instances_lock = threading.Lock()
+
+    def __init__(self, db, dbtables):
+        super(UsageLedger, self).__init__()
+        self.db = db
+        self.dbtables = dbtables
+
+        self._lock = threading.Lock()
+        self._users = {}
+
+    @staticmethod
+    def instance(db, dbtables):
+        """ returns the ledger for a database """
+        with UsageLedger._instances_lock:
+            ledger = UsageLedger._instances.get(db, None)
+            if ledger is None:
+                ledger = UsageLedger(db, dbtables)
+                UsageLedger._instances[db] = ledger
+            return ledger
+
+    def _load(self, user_id):
+
+        tab = self.dbtables.FileSystemUserUsageTable
+        query = select([tab.c.count, tab.c.size]) \
+            .where(tab.c.user_id == user_id)
+        item = self.db.session.execute(query).fetchone()
+
+        count, size = (0, 0) if item is None else (item[0], item[1])
+
+        tab = self.dbtables.FileSystemUserSupplementaryTable
+        query = select([tab.c.quota]).where(tab.c.user_id == user_id)
+        item = self.db.session.execute(query).fetchone()
+
+        quota = 0 if item is None else item[0]
+
+        return UserUsage(count or 0, size or 0, quota or 0)
+
+    def _get(self, user_id):
+        """ returns the entry for a user, loading it if required
+
+        must be called while holding the lock
+        """
+        entry = self._users.get(user_id, None)
+        if entry is None:
+            entry = self._users[user_id] = self._load(user_id)
+        elif entry.stale:
+            item = self._load(user_id)
+            entry.count, entry.size, entry.quota = \
+                item.count, item.size, item.quota
+            entry.stale = False
+        return entry
+
+    def update(self, user_id, count, size):
+        """ add count files and size bytes to the usage of a user
+
+        the change is written to the database, but not committed.
+        the ledger is updated when the session is committed.
+        """
+
+        tab = self.dbtables.FileSystemUserUsageTable
+
+        query = tab.update() \
+            .values({tab.c.count: tab.c.count + count,
+                     tab.c.size: tab.c.size + size}) \
+            .where(tab.c.user_id == user_id)
+        result = self.db.session.execute(query)
+
+        if result.rowcount == 0:
+            self.db.session.execute(tab.insert().values({
+                "user_id": user_id,
+                "count": count,
+                "size": size,
+            }))
+
+        with self._lock:
+            entry = self._users.get(user_id, None)
+
+        def apply():
+            with self._lock:
+                current = self._users.get(user_id, None)
+                if current is None:
+                    return
+                if current is entry:
+                    current.count += count
+                    current.size += size
+                else:
+                    # loaded after the change was written, the
+                    # change may or may not be included
+                    current.stale = True
+
+        after_commit(self.db.session, apply)
+
+    def setQuota(self, user_id, quota):
+        """ set the quota of a user when the session is committed """
+
+        def apply():
+            with self._lock:
+                entry = self._users.get(user_id, None)
+                if entry is not None:
+                    entry.quota = quota
+
+        after_commit(self.db.session, apply)
+
+    def usage(self, user_id):
+        """ returns the number of files, bytes and the quota of a user """
+        with self._lock:
+            entry = self._get(user_id)
+            return entry.count, entry.size, entry.quota
+
+    def reserve(self, user_id, uid, size, credit=0):
+        """ reserve space for an upload in progress
+
+        uid: a unique id for the upload
+        size: the number of bytes uploaded so far
+        credit: the size of the file being replaced, if any
+
+        raises QuotaExceededException if the usage, plus all reserved
+        bytes, would exceed the quota of the user.
+        """
+        size = max(0, size - credit)
+
+        with self._lock:
+            entry = self._get(user_id)
+
+            reserved = entry.reserved - entry.reservations.get(uid, 0) + size
+
+            if entry.quota and entry.size + reserved > entry.quota:
+                raise QuotaExceededException("quota exceeded")
+
+            entry.reservations[uid] = size
+            entry.reserved = reserved
+
+    def release(self, user_id, uid):
+        """ release the space reserved for an upload """
+        with self._lock:
+            entry = self._users.get(user_id, None)
+            if entry is not None:
+                entry.reserved -= entry.reservations.pop(uid, 0)
+
+    def clear(self):
+        """ discard all entries, which will be reloaded from the database """
+        with self._lock:
+            self._users = {}
+
+class QuotaReader(object):
+    """ a reader which reserves space for every byte read from a stream
+
+    raises QuotaExceededException when the user runs out of space
+    """
+
+    def __init__(self, stream, ledger, user_id, uid, credit=0):
+        super(QuotaReader, self).__init__()
+        self.stream = stream
+        self.ledger = ledger
+        self.user_id = user_id
+        self.uid = uid
+        self.credit = credit
+        self.size = 0
+
+        # an upload is rejected up front if the user is already over quota
+        self.ledger.reserve(self.user_id, self.uid, 0, self.credit)
+
+    def _reserve(self, n):
+        if n:
+            self.size += n
+            self.ledger.reserve(self.user_id, self.uid, self.size, self.credit)
+
+    def read(self, n=-1):
+        buf = self.stream.read(n)
+        self._reserve(len(buf))
+        return buf
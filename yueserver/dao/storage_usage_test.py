@@ -0,0 +1,199 @@
+import io
+import unittest
+import threading
+
+from .db import db_init_main, db_connect
+from .user import UserDao
+from .storage import StorageDao
+from .storage_usage import QuotaReader, QuotaExceededException
+
+class UsageLedgerTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        db = db_connect(None)
+
+        env_cfg = {
+            'features': ['test', ],
+            'filesystems': {
+                "default": "mem://memtest",
+            },
+            'domains': ['test'],
+            'roles': [
+                {'test': {'features': ['all'], 'filesystems': ["default"]}},
+            ],
+            'users': [
+                {'email': 'user000',
+                 'password': 'user000',
+                 'domains': ['test'],
+                 'roles': ['test']},
+            ]
+        }
+
+        db_init_main(db, db.tables, env_cfg)
+
+        cls.userDao = UserDao(db, db.tables)
+        cls.USER = cls.userDao.findUserByEmail("user000")
+
+        cls.storageDao = StorageDao(db, db.tables)
+        cls.fs_id = cls.storageDao.getFilesystemId(
+            cls.USER['id'], cls.USER['role_id'], "default")
+
+        cls.db = db
+
+    def setUp(self):
+        self.db.delete(self.db.tables.FileSystemStorageTable)
+        self.db.delete(self.db.tables.FileSystemDirectoryTable)
+        self.db.delete(self.db.tables.FileSystemUserUsageTable)
+        self.storageDao.usage.clear()
+        self.storageDao.setUserDiskQuota(self.USER['id'], 2**30)
+
+    def test_shared_ledger(self):
+        # every dao for the same database shares a ledger
+        other = StorageDao(self.db, self.db.tables)
+        self.assertIs(other.usage, self.storageDao.usage)
+
+    def test_usage_persisted(self):
+
+        user_id = self.USER['id']
+
+        self.storageDao.insertFile(user_id, self.fs_id, "/a/file1.txt",
+            dict(storage_path="mem://memtest/file1.txt", size=1000))
+        self.storageDao.insertFile(user_id, self.fs_id, "/file2.txt",
+            dict(storage_path="mem://memtest/file2.txt", size=24))
+
+        # changing the size of a file, moving files
+        self.storageDao.upsertFile(user_id, self.fs_id, "/file2.txt",
+            dict(size=48))
+        self.storageDao.moveFileLocation(user_id, self.fs_id,
+            "/a/file1.txt", "/b/file1.txt")
+
+        self.assertEqual(self.storageDao.userDiskUsage(user_id),
+            (2, 1048, 2**30))
+
+        # reloading the ledger from the database gives the same result
+        self.storageDao.usage.clear()
+        self.assertEqual(self.storageDao.userDiskUsage(user_id),
+            (2, 1048, 2**30))
+
+        self.storageDao.removeFile(user_id, self.fs_id, "/b/file1.txt")
+        self.storageDao.removeRecord("mem://memtest/file2.txt")
+        self.assertEqual(self.storageDao.userDiskUsage(user_id),
+            (0, 0, 2**30))
+
+    def test_usage_rollback(self):
+
+        user_id = self.USER['id']
+
+        self.storageDao.insertFile(user_id, self.fs_id, "/file1.txt",
+            dict(storage_path="mem://memtest/file1.txt", size=1000))
+        self.assertEqual(self.storageDao.userDiskUsage(user_id),
+            (1, 1000, 2**30))
+
+        # the ledger is not changed until the session is committed
+        self.storageDao.insertFile(user_id, self.fs_id, "/file2.txt",
+            dict(storage_path="mem://memtest/file2.txt", size=24),
+            commit=False)
+        self.storageDao.setUserDiskQuota(user_id, 2**20, commit=False)
+        self.assertEqual(self.storageDao.usage.usage(user_id),
+            (1, 1000, 2**30))
+
+        self.db.session.rollback()
+        self.assertEqual(self.storageDao.userDiskUsage(user_id),
+            (1, 1000, 2**30))
+
+        self.storageDao.insertFile(user_id, self.fs_id, "/file2.txt",
+            dict(storage_path="mem://memtest/file2.txt", size=24),
+            commit=False)
+        self.db.session.commit()
+        self.assertEqual(self.storageDao.userDiskUsage(user_id),
+            (2, 1024, 2**30))
+
+    def test_usage_loaded_before_commit(self):
+
+        user_id = self.USER['id']
+
+        self.storageDao.insertFile(user_id, self.fs_id, "/file1.txt",
+            dict(storage_path="mem://memtest/file1.txt", size=1000),
+            commit=False)
+
+        # the entry is loaded after the change was written, in the same
+        # transaction, and is reloaded once the change is committed
+        self.assertEqual(self.storageDao.usage.usage(user_id),
+            (1, 1000, 2**30))
+        self.db.session.commit()
+        self.assertEqual(self.storageDao.userDiskUsage(user_id),
+            (1, 1000, 2**30))
+
+    def test_reserve(self):
+
+        user_id = self.USER['id']
+        ledger = self.storageDao.usage
+
+        self.storageDao.setUserDiskQuota(user_id, 1000)
+        self.storageDao.insertFile(user_id, self.fs_id, "/file1.txt",
+            dict(storage_path="mem://memtest/file1.txt", size=400))
+
+        ledger.reserve(user_id, "a", 300)
+        ledger.reserve(user_id, "b", 300)
+
+        # a reservation can grow, as long as the total fits in the quota
+        with self.assertRaises(QuotaExceededException):
+            ledger.reserve(user_id, "a", 301)
+
+        # the credit for replacing a file is not counted
+        ledger.reserve(user_id, "a", 400, credit=100)
+
+        ledger.release(user_id, "b")
+        ledger.reserve(user_id, "c", 300)
+
+        ledger.release(user_id, "a")
+        ledger.release(user_id, "c")
+        ledger.reserve(user_id, "d", 600)
+
+        # a quota of zero is no limit
+        self.storageDao.setUserDiskQuota(user_id, 0)
+        ledger.reserve(user_id, "d", 2**40)
+
+    def test_parallel_uploads(self):
+
+        user_id = self.USER['id']
+        ledger = self.storageDao.usage
+        self.storageDao.setUserDiskQuota(user_id, 10000)
+        # load the entry before starting, the test database
+        # can only be used from the main thread
+        self.assertEqual(ledger.usage(user_id), (0, 0, 10000))
+
+        results = []
+        lock = threading.Lock()
+
+        def upload(uid):
+            reader = QuotaReader(io.BytesIO(b"0" * 3000), ledger, user_id, uid)
+            try:
+                while reader.read(100):
+                    pass
+                result = True
+            except QuotaExceededException:
+                ledger.release(user_id, uid)
+                result = False
+            with lock:
+                results.append(result)
+
+        threads = [threading.Thread(target=upload, args=("u%d" % i,))
+            for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # at most three uploads fit in the quota
+        self.assertLessEqual(results.count(True), 3)
+        self.assertGreater(results.count(True), 0)
+
+def main():
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(UsageLedgerTestCase)
+    unittest.TextTestRunner().run(suite)
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,7 @@
 """
 The set of tables which represent a song and records pertaining to the user
 """
-from sqlalchemy.schema import Table, Column, ForeignKey
+from sqlalchemy.schema import Table, Column, ForeignKey, Index
 from sqlalchemy.types import Integer, String
 
 from .util import generate_uuid, StringArrayType
@@ -59,7 +59,9 @@ def SongDataTable(metadata):
         Column('banished', Integer, default=0),
         Column('file_size', Integer, default=0),
         # date
-        Column('date_added', Integer, default=lambda: int(time.time()))
+        Column('date_added', Integer, default=lambda: int(time.time())),
+
+        Index('ix_song_data_domain', 'domain_id'),
     )
 
 def SongUserDataTable(metadata):
@@ -93,7 +95,10 @@ def SongUserDataTable(metadata):
         Column('blocked', Integer, default=0),
         Column('frequency', Integer, default=0),
         # date
-        Column('last_played', Integer, default=0)
+        Column('last_played', Integer, default=0),
+
+        Index('ix_song_user_data_song_user', 'song_id', 'user_id'),
+        Index('ix_song_user_data_user', 'user_id'),
     )
 
 def SongHistoryTable(metadata):
@@ -102,11 +107,16 @@ def SongHistoryTable(metadata):
 
     when playback completes normally (the song is not skipped) an entry
     is added recording the song, user, and date of completion
+
+    the unique index allows clients to push the same records
+    more than once, without creating duplicates
     """
     return Table('song_history', metadata,
         Column('user_id', ForeignKey('user.id')),
         Column('song_id', ForeignKey("song_data.id")),
         Column('timestamp', Integer),
+        Index('uix_song_history', 'user_id', 'song_id', 'timestamp', unique=True),
+        Index('ix_song_history_user_time', 'user_id', 'timestamp'),
     )
 
 def SongQueueTable(metadata):
@@ -1,6 +1,8 @@
 
 
-from sqlalchemy.schema import Table, Column, ForeignKey, UniqueConstraint
+from sqlalchemy.schema import Table, Column, ForeignKey, UniqueConstraint, \
+    Index, DDL
+from sqlalchemy import event
 from sqlalchemy.types import BigInteger, Integer, String, Boolean
 from sqlalchemy.sql import func
 from sqlalchemy.sql import select
@@ -8,6 +10,16 @@ from sqlalchemy.sql import select
 from .util import generate_uuid, StringArrayType, CreateView
 import time
 
+def _dialect_index(table, dialect, statement):
+    """ create an index, using dialect specific sql, when the table is created
+
+    the statement is also saved in table.info so that it can be
+    applied to an existing database.
+    """
+    ddl = DDL(statement).execute_if(dialect=dialect)
+    event.listen(table, 'after_create', ddl)
+    table.info.setdefault('ddl', []).append(ddl)
+
 def FileSystemStorageTableV1(metadata):
     """ returns a table describing items in persistent storage
 
@@ -125,7 +137,7 @@ def FileSystemStorageTableV3(metadata):
     mtime: the last time the file file was modified
            (the creation date for the latest version)
     """
-    return Table('filesystem_storage_v3', metadata,
+    table = Table('filesystem_storage_v3', metadata,
         Column('id', String, primary_key=True, default=generate_uuid),
         Column('user_id', ForeignKey("user.id"), nullable=False),
         Column('filesystem_id', ForeignKey("filesystem.id"), nullable=False),
@@ -156,12 +168,170 @@ def FileSystemStorageTableV3(metadata):
         UniqueConstraint('user_id', 'filesystem_id', 'file_path', name='uix_fs'),
     )
 
-FileSystemStorageTableCurrentVersionName = 'filesystem_storage_v3'
+    # postgresql can only use an index for a prefix search
+    # (file_path LIKE 'prefix%') when the index uses a pattern operator
+    # class. sqlite can use the unique constraint to find the files
+    # for a user and filesystem.
+    _dialect_index(table, 'postgresql',
+        "CREATE INDEX IF NOT EXISTS ix_fs_path_prefix ON %(table)s "
+        "(user_id, filesystem_id, file_path varchar_pattern_ops)")
+
+    return table
+
+def FileSystemStorageTableV3a(metadata):
+    """ returns a table describing items in persistent storage
+
+    the v3 table, as altered by the v4 migration
+
+    parent_path: the directory containing the file, ending with '/'
+    """
+    table = Table('filesystem_storage_v3', metadata,
+        Column('id', String, primary_key=True, default=generate_uuid),
+        Column('user_id', ForeignKey("user.id"), nullable=False),
+        Column('filesystem_id', ForeignKey("filesystem.id"), nullable=False),
+        # file_path must not be null, and start with '/'
+        # but may not be unique.
+        # the set (user_id, filesystem, file_path) must be unique
+        Column('file_path', String, nullable=False),
+        Column('storage_path', String, unique=True, nullable=False),
+        # however preview path may not be unique
+        # e.g. one album with 10 songs using the same jpeg.
+        Column('preview_path', String),
+
+        Column('permission', Integer, default=0o644),
+        Column('version', Integer, default=0),
+        Column('size', Integer, default=0),
+        Column('expired', Integer, nullable=True),
+
+        # encryption can be set to 'client', 'server', 'system'. or None
+        # indicates the encryption mode
+        Column('encryption', String, default=None),
+        # an optional password to protect public files
+        Column('public_password', String, nullable=True),
+        # a unique public identifier for this file
+        Column('public', String, unique=True, default=None),
+
+        Column('mtime', Integer, default=lambda: int(time.time())),
+
+        Column('parent_path', String, nullable=True),
+
+        UniqueConstraint('user_id', 'filesystem_id', 'file_path', name='uix_fs'),
+        Index('ix_fs_parent', 'user_id', 'filesystem_id', 'parent_path'),
+    )
+
+    _dialect_index(table, 'postgresql',
+        "CREATE INDEX IF NOT EXISTS ix_fs_path_prefix ON %(table)s "
+        "(user_id, filesystem_id, file_path varchar_pattern_ops)")
+
+    return table
+
+def FileSystemStorageTableV4(metadata):
+    """ returns a table describing items in persistent storage
+
+    the columns are the same as v3, with the following changes:
+
+    storage_path: is no longer unique. files with the same content
+                  may share a blob when deduplication is enabled
+    content_hash: the sha256 of the file contents, as uploaded,
+                  or null if the file was not hashed
+    """
+    table = Table('filesystem_storage_v4', metadata,
+        Column('id', String, primary_key=True, default=generate_uuid),
+        Column('user_id', ForeignKey("user.id"), nullable=False),
+        Column('filesystem_id', ForeignKey("filesystem.id"), nullable=False),
+        # file_path must not be null, and start with '/'
+        # but may not be unique.
+        # the set (user_id, filesystem, file_path) must be unique
+        Column('file_path', String, nullable=False),
+        Column('storage_path', String, nullable=False),
+        # however preview path may not be unique
+        # e.g. one album with 10 songs using the same jpeg.
+        Column('preview_path', String),
+
+        Column('permission', Integer, default=0o644),
+        Column('version', Integer, default=0),
+        Column('size', Integer, default=0),
+        Column('expired', Integer, nullable=True),
+
+        # encryption can be set to 'client', 'server', 'system'. or None
+        # indicates the encryption mode
+        Column('encryption', String, default=None),
+        # an optional password to protect public files
+        Column('public_password', String, nullable=True),
+        # a unique public identifier for this file
+        Column('public', String, unique=True, default=None),
+
+        Column('mtime', Integer, default=lambda: int(time.time())),
+
+        Column('parent_path', String, nullable=True),
+
+        Column('content_hash', String, nullable=True),
+
+        UniqueConstraint('user_id', 'filesystem_id', 'file_path', name='uix_fs_v4'),
+        Index('ix_fs_v4_parent', 'user_id', 'filesystem_id', 'parent_path'),
+        Index('ix_fs_v4_storage_path', 'storage_path'),
+    )
+
+    _dialect_index(table, 'postgresql',
+        "CREATE INDEX IF NOT EXISTS ix_fs_v4_path_prefix ON %(table)s "
+        "(user_id, filesystem_id, file_path varchar_pattern_ops)")
+
+    return table
+
+FileSystemStorageTableCurrentVersionName = 'filesystem_storage_v4'
+
+def FileSystemBlobTableV1(metadata):
+    """ returns a table of deduplicated file contents
+
+    a blob is stored once for each user, file system, content hash
+    and encryption mode. refcount is the number of files in the
+    storage table which use the blob. the blob is removed when the
+    last file using it is removed or replaced.
+
+    encryption: the encryption mode, 'none' for unencrypted files
+    storage_path: the location of the blob
+    size: the size of the blob in bytes
+    """
+    return Table('filesystem_blob_v1', metadata,
+        Column('user_id', ForeignKey("user.id"), nullable=False),
+        Column('filesystem_id', ForeignKey("filesystem.id"), nullable=False),
+        Column('content_hash', String, nullable=False),
+        Column('encryption', String, nullable=False),
+        Column('storage_path', String, unique=True, nullable=False),
+        Column('size', BigInteger, default=0),
+        Column('refcount', Integer, default=0),
+        UniqueConstraint('user_id', 'filesystem_id', 'content_hash',
+            'encryption', name='uix_fs_blob'),
+    )
 
 def FileSystemPreviewStorageTableV1(metadata):
     """ returns a table for storing keyframes of user files
     """
     return Table('filesystem_preview_storage_v1', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('user_id', ForeignKey("user.id"), nullable=False),
+        Column('file_id', ForeignKey("filesystem_storage_v3.id"), nullable=False),
+        # resource file system and absolute url
+        Column('filesystem_id', ForeignKey("filesystem.id"), nullable=False),
+        Column('path', String, nullable=False),
+        # description of the image scale
+        Column('scale', String, nullable=False),
+        # 1 if up to date, 0 if it needs to be regenerated
+        Column('valid', Integer, nullable=False),
+        # dimensions of the image
+        Column('width', Integer, nullable=False),
+        Column('height', Integer, nullable=False),
+        # size of the file in bytes
+        Column('size', Integer, nullable=False),
+        UniqueConstraint('file_id', 'scale', name='uix_fs_preview'),
+    )
+
+def FileSystemPreviewStorageTableV2(metadata):
+    """ returns a table for storing keyframes of user files
+
+    the same as v1, referencing the v4 storage table
+    """
+    return Table('filesystem_preview_storage_v2', metadata,
         Column('id', Integer, primary_key=True),
         Column('user_id', ForeignKey("user.id"), nullable=False),
         Column('file_id',
@@ -179,7 +349,34 @@ def FileSystemPreviewStorageTableV1(metadata):
         Column('height', Integer, nullable=False),
         # size of the file in bytes
         Column('size', Integer, nullable=False),
-        UniqueConstraint('file_id', 'scale', name='uix_fs_preview'),
+        UniqueConstraint('file_id', 'scale', name='uix_fs_preview_v2'),
+    )
+
+def FileSystemPreviewJobTableV1(metadata):
+    """ returns a table of previews waiting to be generated
+
+    there is at most one job for each file and scale.
+
+    state: 0 if the job is waiting, 1 if a worker is generating the preview
+    version: incremented each time the job is submitted, a job which
+             is submitted again while running is run again
+    attempts: the number of times a worker has started the job
+    mtime: the last time the state changed
+    """
+    return Table('filesystem_preview_job_v1', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('user_id', ForeignKey("user.id"), nullable=False),
+        Column('file_id',
+            ForeignKey("%s.id" % FileSystemStorageTableCurrentVersionName),
+            nullable=False),
+        Column('filesystem_id', ForeignKey("filesystem.id"), nullable=False),
+        Column('scale', String, nullable=False),
+        Column('state', Integer, default=0),
+        Column('version', Integer, default=0),
+        Column('attempts', Integer, default=0),
+        Column('mtime', Integer, default=lambda: int(time.time())),
+        UniqueConstraint('file_id', 'scale', name='uix_fs_preview_job'),
+        Index('ix_fs_preview_job_state', 'state', 'mtime'),
     )
 
 def FileSystemTempFileTableV1(metadata):
@@ -194,6 +391,45 @@ def FileSystemTempFileTableV1(metadata):
         Column('size', Integer, nullable=False),
     )
 
+def FileSystemDirectoryTableV1(metadata):
+    """ returns a table describing the directories of a file system
+
+    a directory exists as long as it contains at least one file.
+    the count and size include all files in sub directories.
+
+    path: the directory path, starting and ending with '/'
+    parent_path: the directory containing this directory, or
+                 an empty string for the root directory
+    count: the number of files in the directory
+    size: the total size in bytes of the files in the directory
+    """
+    return Table('filesystem_directory_v1', metadata,
+        Column('user_id', ForeignKey("user.id"), nullable=False),
+        Column('filesystem_id', ForeignKey("filesystem.id"), nullable=False),
+        Column('path', String, nullable=False),
+        Column('parent_path', String, nullable=False),
+        Column('count', Integer, default=0),
+        Column('size', BigInteger, default=0),
+        UniqueConstraint('user_id', 'filesystem_id', 'path', name='uix_fs_directory'),
+        Index('ix_fs_directory_parent', 'user_id', 'filesystem_id', 'parent_path'),
+    )
+
+def FileSystemUserUsageTableV1(metadata):
+    """ returns a table with the total disk usage of each user
+
+    the usage is updated whenever a file is added, removed or
+    changes size, so that quota checks do not need to scan
+    the storage table.
+
+    count: the number of files owned by the user
+    size: the total size in bytes of the files owned by the user
+    """
+    return Table('filesystem_user_usage_v1', metadata,
+        Column('user_id', ForeignKey("user.id"), nullable=False, unique=True),
+        Column('count', Integer, default=0),
+        Column('size', BigInteger, default=0),
+    )
+
 def FileSystemTable(metadata):
     """ returns a table which maps a 'root' name to a file system location
     """
@@ -13,13 +13,19 @@ from .user import DomainTable, RoleTable, UserTable, \
 from .song import SongDataTable, SongUserDataTable, \
                   SongQueueTable, SongHistoryTable, SongPlaylistTable
 from .storage import FileSystemStorageTableV1, FileSystemStorageTableV2, \
-                     FileSystemStorageTableV3, \
+                     FileSystemStorageTableV3, FileSystemStorageTableV3a, \
+                     FileSystemStorageTableV4, \
                      FileSystemTable, FileSystemPermissionTable, \
                      FileSystemUserSupplementaryTable, \
                      FileSystemUserEncryptionTable, \
                      FileSystemUserUsageView, \
                      FileSystemPreviewStorageTableV1, \
-                     FileSystemTempFileTableV1
+                     FileSystemPreviewStorageTableV2, \
+                     FileSystemBlobTableV1, \
+                     FileSystemPreviewJobTableV1, \
+                     FileSystemTempFileTableV1, \
+                     FileSystemDirectoryTableV1, \
+                     FileSystemUserUsageTableV1
 from .schema import ApplicationSchemaTable
 
 class BaseDatabaseTables(object):
@@ -185,7 +191,166 @@ class DatabaseTablesV3(BaseDatabaseTables):
         #    f(engine, self)
         return
 
-DatabaseTables = DatabaseTablesV3
+class DatabaseTablesV4(BaseDatabaseTables):
+    """define all tables required for the database"""
+    version = 4
+
+    def __init__(self, metadata):
+        super(DatabaseTablesV4, self).__init__()
+
+        self.ApplicationSchemaTable = ApplicationSchemaTable(metadata)
+
+        self.DomainTable = DomainTable(metadata)
+        self.RoleTable = RoleTable(metadata)
+        self.UserTable = UserTable(metadata)
+        self.GrantedDomainTable = GrantedDomainTable(metadata)
+        self.GrantedRoleTable = GrantedRoleTable(metadata)
+        self.FeatureTable = FeatureTable(metadata)
+        self.RoleFeatureTable = RoleFeatureTable(metadata)
+        self.UserSessionTable = UserSessionTable(metadata)
+        self.UserPreferencesTable = UserPreferencesTable(metadata)
+
+        self.SongDataTable = SongDataTable(metadata)
+        self.SongUserDataTable = SongUserDataTable(metadata)
+        self.SongQueueTable = SongQueueTable(metadata)
+        self.SongHistoryTable = SongHistoryTable(metadata)
+        self.SongPlaylistTable = SongPlaylistTable(metadata)
+
+        self.FileSystemStorageTable = FileSystemStorageTableV3a(metadata)
+        self.FileSystemDirectoryTable = FileSystemDirectoryTableV1(metadata)
+        self.FileSystemPreviewStorageTable = \
+            FileSystemPreviewStorageTableV1(metadata)
+        self.FileSystemTempFileTable = \
+            FileSystemTempFileTableV1(metadata)
+        self.FileSystemTable = FileSystemTable(metadata)
+        self.FileSystemPermissionTable = FileSystemPermissionTable(metadata)
+        self.FileSystemUserSupplementaryTable = \
+            FileSystemUserSupplementaryTable(metadata)
+        self.FileSystemUserEncryptionTable = \
+            FileSystemUserEncryptionTable(metadata)
+
+class DatabaseTablesV5(BaseDatabaseTables):
+    """define all tables required for the database"""
+    version = 5
+
+    def __init__(self, metadata):
+        super(DatabaseTablesV5, self).__init__()
+
+        self.ApplicationSchemaTable = ApplicationSchemaTable(metadata)
+
+        self.DomainTable = DomainTable(metadata)
+        self.RoleTable = RoleTable(metadata)
+        self.UserTable = UserTable(metadata)
+        self.GrantedDomainTable = GrantedDomainTable(metadata)
+        self.GrantedRoleTable = GrantedRoleTable(metadata)
+        self.FeatureTable = FeatureTable(metadata)
+        self.RoleFeatureTable = RoleFeatureTable(metadata)
+        self.UserSessionTable = UserSessionTable(metadata)
+        self.UserPreferencesTable = UserPreferencesTable(metadata)
+
+        self.SongDataTable = SongDataTable(metadata)
+        self.SongUserDataTable = SongUserDataTable(metadata)
+        self.SongQueueTable = SongQueueTable(metadata)
+        self.SongHistoryTable = SongHistoryTable(metadata)
+        self.SongPlaylistTable = SongPlaylistTable(metadata)
+
+        self.FileSystemStorageTable = FileSystemStorageTableV3a(metadata)
+        self.FileSystemDirectoryTable = FileSystemDirectoryTableV1(metadata)
+        self.FileSystemPreviewStorageTable = \
+            FileSystemPreviewStorageTableV1(metadata)
+        self.FileSystemTempFileTable = \
+            FileSystemTempFileTableV1(metadata)
+        self.FileSystemTable = FileSystemTable(metadata)
+        self.FileSystemPermissionTable = FileSystemPermissionTable(metadata)
+        self.FileSystemUserSupplementaryTable = \
+            FileSystemUserSupplementaryTable(metadata)
+        self.FileSystemUserUsageTable = FileSystemUserUsageTableV1(metadata)
+        self.FileSystemUserEncryptionTable = \
+            FileSystemUserEncryptionTable(metadata)
+
+class DatabaseTablesV6(BaseDatabaseTables):
+    """define all tables required for the database"""
+    version = 6
+
+    def __init__(self, metadata):
+        super(DatabaseTablesV6, self).__init__()
+
+        self.ApplicationSchemaTable = ApplicationSchemaTable(metadata)
+
+        self.DomainTable = DomainTable(metadata)
+        self.RoleTable = RoleTable(metadata)
+        self.UserTable = UserTable(metadata)
+        self.GrantedDomainTable = GrantedDomainTable(metadata)
+        self.GrantedRoleTable = GrantedRoleTable(metadata)
+        self.FeatureTable = FeatureTable(metadata)
+        self.RoleFeatureTable = RoleFeatureTable(metadata)
+        self.UserSessionTable = UserSessionTable(metadata)
+        self.UserPreferencesTable = UserPreferencesTable(metadata)
+
+        self.SongDataTable = SongDataTable(metadata)
+        self.SongUserDataTable = SongUserDataTable(metadata)
+        self.SongQueueTable = SongQueueTable(metadata)
+        self.SongHistoryTable = SongHistoryTable(metadata)
+        self.SongPlaylistTable = SongPlaylistTable(metadata)
+
+        self.FileSystemStorageTable = FileSystemStorageTableV4(metadata)
+        self.FileSystemDirectoryTable = FileSystemDirectoryTableV1(metadata)
+        self.FileSystemPreviewStorageTable = \
+            FileSystemPreviewStorageTableV2(metadata)
+        self.FileSystemBlobTable = FileSystemBlobTableV1(metadata)
+        self.FileSystemTempFileTable = \
+            FileSystemTempFileTableV1(metadata)
+        self.FileSystemTable = FileSystemTable(metadata)
+        self.FileSystemPermissionTable = FileSystemPermissionTable(metadata)
+        self.FileSystemUserSupplementaryTable = \
+            FileSystemUserSupplementaryTable(metadata)
+        self.FileSystemUserUsageTable = FileSystemUserUsageTableV1(metadata)
+        self.FileSystemUserEncryptionTable = \
+            FileSystemUserEncryptionTable(metadata)
+
+class DatabaseTablesV7(BaseDatabaseTables):
+    """define all tables required for the database"""
+    version = 7
+
+    def __init__(self, metadata):
+        super(DatabaseTablesV7, self).__init__()
+
+        self.ApplicationSchemaTable = ApplicationSchemaTable(metadata)
+
+        self.DomainTable = DomainTable(metadata)
+        self.RoleTable = RoleTable(metadata)
+        self.UserTable = UserTable(metadata)
+        self.GrantedDomainTable = GrantedDomainTable(metadata)
+        self.GrantedRoleTable = GrantedRoleTable(metadata)
+        self.FeatureTable = FeatureTable(metadata)
+        self.RoleFeatureTable = RoleFeatureTable(metadata)
+        self.UserSessionTable = UserSessionTable(metadata)
+        self.UserPreferencesTable = UserPreferencesTable(metadata)
+
+        self.SongDataTable = SongDataTable(metadata)
+        self.SongUserDataTable = SongUserDataTable(metadata)
+        self.SongQueueTable = SongQueueTable(metadata)
+        self.SongHistoryTable = SongHistoryTable(metadata)
+        self.SongPlaylistTable = SongPlaylistTable(metadata)
+
+        self.FileSystemStorageTable = FileSystemStorageTableV4(metadata)
+        self.FileSystemDirectoryTable = FileSystemDirectoryTableV1(metadata)
+        self.FileSystemPreviewStorageTable = \
+            FileSystemPreviewStorageTableV2(metadata)
+        self.FileSystemPreviewJobTable = \
+            FileSystemPreviewJobTableV1(metadata)
+        self.FileSystemBlobTable = FileSystemBlobTableV1(metadata)
+        self.FileSystemTempFileTable = \
+            FileSystemTempFileTableV1(metadata)
+        self.FileSystemTable = FileSystemTable(metadata)
+        self.FileSystemPermissionTable = FileSystemPermissionTable(metadata)
+        self.FileSystemUserSupplementaryTable = \
+            FileSystemUserSupplementaryTable(metadata)
+        self.FileSystemUserUsageTable = FileSystemUserUsageTableV1(metadata)
+        self.FileSystemUserEncryptionTable = \
+            FileSystemUserEncryptionTable(metadata)
+
+DatabaseTables = DatabaseTablesV7
 
 #all_tables= sorted([x for x in locals() if Base], key= x.version)
 # offset = current_version - all_tables[0].version
@@ -15,6 +15,7 @@ from threading import Thread
 from .image import scale_image_stream, ImageScale
 
 from .filesys.util import sh_escape
+from .filesys.transfer import copyfileobj
 
 def find_ffmpeg():
     ffmpeg_paths = [
@@ -32,16 +33,10 @@ def find_ffmpeg():
 # duplicate functions so that errors in the logs
 # will reflect which side of the channel failed
 def _pushsrc(src, dst):
-    buf = src.read(2048)
-    while buf:
-        dst.write(buf)
-        buf = src.read(2048)
+    copyfileobj(src, dst)
 
 def _pushdst(src, dst):
-    buf = src.read(2048)
-    while buf:
-        dst.write(buf)
-        buf = src.read(2048)
+    copyfileobj(src, dst)
 
 def async_transcode(cmd, src, dst, ignore=False):
 
@@ -86,8 +81,7 @@ class _TranscodeFileThread(Thread):
     def run(self):
 
         try:
-            for buf in iter(lambda: self.infile.read(2048), b""):
-                self.outfile.write(buf)
+            copyfileobj(self.infile, self.outfile)
         finally:
             self.outfile.close()
 
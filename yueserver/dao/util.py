@@ -11,6 +11,9 @@ from collections import OrderedDict
 from io import StringIO
 import bcrypt
 
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session
+
 
 def epoch_time(dt=None):
     """
@@ -24,6 +27,34 @@ def epoch_time(dt=None):
         dt = datetime.now()
     return timegm(dt.timetuple())
 
+def after_commit(session, callback):
+    """
+    call callback once the current transaction of a session is committed
+
+    the callback is discarded if the transaction is rolled back, or
+    closed without being committed. this is used to update in-memory
+    state only once the database has been changed.
+    """
+    if isinstance(session, scoped_session):
+        session = session()
+
+    if 'after_commit' not in session.info:
+        session.info['after_commit'] = []
+        event.listen(session, 'after_commit', _run_after_commit)
+        event.listen(session, 'after_transaction_end', _discard_after_commit)
+
+    session.info['after_commit'].append(callback)
+
+def _run_after_commit(session):
+    callbacks = session.info['after_commit']
+    session.info['after_commit'] = []
+    for callback in callbacks:
+        callback()
+
+def _discard_after_commit(session, transaction):
+    if transaction.parent is None:
+        del session.info['after_commit'][:]
+
 def hash_password(password, workfactor=12):
     salt = bcrypt.gensalt(workfactor)
     hashed = bcrypt.hashpw(password.encode("utf-8"), salt)
@@ -38,6 +69,29 @@ def format_storage_path(path, user_id, pwd, **kwargs):
     """
     return path.format(user_id=user_id, pwd=pwd, **kwargs)
 
+def parent_path(path, delimiter='/'):
+    """
+    return the directory containing a file or directory
+
+    the parent path ends with the delimiter. the parent of
+    the root directory is an empty string.
+    """
+    i = path.rstrip(delimiter).rfind(delimiter)
+    return path[:i + 1]
+
+def directory_paths(path, delimiter='/'):
+    """
+    return every directory containing a file, starting with the root
+
+        /a/b/file.txt => ['/', '/a/', '/a/b/']
+    """
+    paths = []
+    i = path.find(delimiter)
+    while i >= 0:
+        paths.append(path[:i + 1])
+        i = path.find(delimiter, i + 1)
+    return paths
+
 def parse_iso_format(dt_str):
     """
     parse a datestring into a datetime object
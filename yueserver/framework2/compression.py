@@ -0,0 +1,267 @@
+"""
+Negotiated compression of response bodies
+
+the encoding is chosen from the Accept-Encoding header of the request.
+gzip is always available, brotli (br) and zstd are used when the brotli
+or zstandard packages are installed.
+
+bodies which are already in memory are compressed in full and sent with
+a Content-Length. streaming bodies (files, generators and callables) are
+compressed as they are written, and sent using chunked transfer encoding.
+"""
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .server_core import copy_payload
+
+class GzipEncoder(object):
+    def __init__(self, level):
+        super(GzipEncoder, self).__init__()
+        # wbits=31 writes a gzip header and trailer
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def finish(self):
+        return self._obj.flush()
+
+class BrotliEncoder(object):
+    def __init__(self, level):
+        super(BrotliEncoder, self).__init__()
+        self._obj = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._obj.process(data)
+
+    def finish(self):
+        return self._obj.finish()
+
+class ZstdEncoder(object):
+    def __init__(self, level):
+        super(ZstdEncoder, self).__init__()
+        self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def finish(self):
+        return self._obj.flush()
+
+# encodings in order of preference, when the client accepts several
+ENCODERS = OrderedDict()
+if brotli is not None:
+    ENCODERS["br"] = BrotliEncoder
+if zstandard is not None:
+    ENCODERS["zstd"] = ZstdEncoder
+ENCODERS["gzip"] = GzipEncoder
+
+DEFAULT_LEVELS = {"gzip": 6, "br": 4, "zstd": 3}
+
+# content which is already compressed
+INCOMPRESSIBLE_TYPES = ("audio/", "video/", "image/", "font/woff",
+    "application/zip", "application/gzip", "application/x-gzip",
+    "application/x-7z-compressed", "application/x-bzip2",
+    "application/x-xz", "application/x-rar-compressed", "application/ogg",
+    "application/pdf")
+
+# text based images compress well
+COMPRESSIBLE_TYPES = ("image/svg+xml", "image/bmp", "image/x-icon")
+
+def parse_accept_encoding(value):
+    """ returns a dict of encoding => quality from an Accept-Encoding header
+    """
+
+    if isinstance(value, bytes):
+        value = value.decode("latin-1")
+
+    accepted = {}
+    for item in (value or "").split(","):
+        parts = item.split(";")
+        name = parts[0].strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            key, _, val = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(val)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+    return accepted
+
+class EncodedWriteFile(object):
+    """ compress bytes written to a writable file
+
+    empty writes are never passed on, an empty chunk ends a chunked response
+    """
+    def __init__(self, wfile, encoder):
+        super(EncodedWriteFile, self).__init__()
+        self.wfile = wfile
+        self.encoder = encoder
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        out = self.encoder.compress(data)
+        if out:
+            self.wfile.write(out)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        out = self.encoder.finish()
+        if out:
+            self.wfile.write(out)
+
+class ResponseCompressor(object):
+    """ compress the payload of a response
+
+    levels: a dict of encoding => compression level
+    min_size: bodies smaller than this are sent uncompressed
+    cache_size: the number of bytes used to keep compressed copies of
+        bodies which are sent with an ETag or Cache-Control header
+    """
+
+    def __init__(self, levels=None, min_size=1024, cache_size=0):
+        super(ResponseCompressor, self).__init__()
+        self.levels = dict(DEFAULT_LEVELS)
+        if levels:
+            self.levels.update(levels)
+        self.min_size = min_size
+        self.cache_size = cache_size
+
+        self._lock = threading.Lock()
+        # (encoding, level, digest) => bytes
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+
+    def negotiate(self, accept_encoding):
+        """ returns the preferred encoding accepted by the client, or None
+        """
+
+        accepted = parse_accept_encoding(accept_encoding)
+        default = accepted.get("*", 0.0)
+
+        best = None
+        best_quality = 0.0
+        for name in ENCODERS:
+            quality = accepted.get(name, default)
+            if quality > best_quality:
+                best = name
+                best_quality = quality
+        return best
+
+    def compressible(self, response):
+        """ returns true if the payload of a response should be compressed
+        """
+
+        if not response.payload or response.status in (204, 206, 304):
+            return False
+
+        if 'Content-Encoding' in response.headers or \
+           'Content-Range' in response.headers:
+            return False
+
+        content_type = response.headers.get('Content-Type', "").lower()
+        if content_type.startswith(INCOMPRESSIBLE_TYPES) and \
+           not content_type.startswith(COMPRESSIBLE_TYPES):
+            return False
+
+        if isinstance(response.payload, (bytes, bytearray, memoryview)):
+            return len(response.payload) >= self.min_size
+
+        if 'Content-Length' in response.headers:
+            return int(response.headers['Content-Length']) >= self.min_size
+
+        return True
+
+    def cacheable(self, response):
+        return self.cache_size > 0 and \
+            isinstance(response.payload, bytes) and \
+            ('ETag' in response.headers or
+             'Cache-Control' in response.headers)
+
+    def encoder(self, encoding):
+        return ENCODERS[encoding](self.levels[encoding])
+
+    def compress(self, request, response):
+        """ replace the payload of a response with a compressed payload
+        """
+
+        if not self.compressible(response):
+            return
+
+        response.headers['Vary'] = 'Accept-Encoding'
+
+        encoding = self.negotiate(request.headers.get(b'Accept-Encoding', None))
+        if encoding is None:
+            return
+
+        if isinstance(response.payload, (bytes, bytearray, memoryview)):
+            response.payload = self._compress_bytes(encoding, response)
+            response.headers['Content-Length'] = str(len(response.payload))
+        else:
+            response.payload = self._compress_stream(encoding, response.payload)
+            response.headers.pop('Content-Length', None)
+            response.headers['Transfer-Encoding'] = 'chunked'
+
+        response.headers['Content-Encoding'] = encoding
+
+    def _compress_bytes(self, encoding, response):
+
+        cacheable = self.cacheable(response)
+        if cacheable:
+            key = (encoding, self.levels[encoding],
+                hashlib.sha1(response.payload).digest())
+            with self._lock:
+                data = self._cache.get(key, None)
+                if data is not None:
+                    self._cache.move_to_end(key)
+                    return data
+
+        encoder = self.encoder(encoding)
+        data = encoder.compress(response.payload) + encoder.finish()
+
+        if cacheable and len(data) <= self.cache_size:
+            with self._lock:
+                if key not in self._cache:
+                    self._cache[key] = data
+                    self._cache_bytes += len(data)
+                while self._cache_bytes > self.cache_size:
+                    _, old = self._cache.popitem(last=False)
+                    self._cache_bytes -= len(old)
+
+        return data
+
+    def _compress_stream(self, encoding, payload):
+
+        encoder = self.encoder(encoding)
+
+        def send(wfile):
+            efile = EncodedWriteFile(wfile, encoder)
+            copy_payload(payload, efile)
+            efile.close()
+
+        return send
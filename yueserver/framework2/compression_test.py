@@ -0,0 +1,133 @@
+import io
+import gzip
+import unittest
+
+from yueserver.framework2.server_core import Response, Namespace, \
+    CaseInsensitiveDict, copy_payload
+from yueserver.framework2.compression import ResponseCompressor, \
+    parse_accept_encoding, ENCODERS
+
+def make_request(accept_encoding):
+    headers = CaseInsensitiveDict()
+    if accept_encoding is not None:
+        headers[b'Accept-Encoding'] = accept_encoding
+    return Namespace(headers=headers)
+
+def send(payload):
+    """ returns the bytes written for a response payload """
+    wfile = io.BytesIO()
+    copy_payload(payload, wfile)
+    return wfile.getvalue()
+
+class CompressionTestCase(unittest.TestCase):
+
+    def test_parse_accept_encoding(self):
+
+        self.assertEqual(parse_accept_encoding(b"gzip, deflate"),
+            {"gzip": 1.0, "deflate": 1.0})
+        self.assertEqual(parse_accept_encoding("br;q=0.5, GZIP;q=0, *;q=x"),
+            {"br": 0.5, "gzip": 0.0, "*": 0.0})
+        self.assertEqual(parse_accept_encoding(None), {})
+
+    def test_negotiate(self):
+
+        compressor = ResponseCompressor()
+
+        self.assertEqual(compressor.negotiate(b"gzip, deflate"), "gzip")
+        self.assertEqual(compressor.negotiate(b"identity"), None)
+        self.assertEqual(compressor.negotiate(b"gzip;q=0"), None)
+        self.assertEqual(compressor.negotiate(b"*"), list(ENCODERS)[0])
+        self.assertEqual(compressor.negotiate(b"*, gzip;q=0"),
+            None if len(ENCODERS) == 1 else list(ENCODERS)[0])
+        self.assertEqual(compressor.negotiate(None), None)
+
+    def test_compress_bytes(self):
+
+        compressor = ResponseCompressor()
+        obj = {"result": ["song%d" % i for i in range(1000)]}
+
+        response = Response(200, {}, obj)
+        data = response.payload
+        compressor.compress(make_request(b"gzip"), response)
+        self.assertEqual(response.headers['Content-Encoding'], "gzip")
+        self.assertEqual(response.headers['Vary'], "Accept-Encoding")
+        self.assertEqual(int(response.headers['Content-Length']),
+            len(response.payload))
+        self.assertEqual(gzip.decompress(response.payload), data)
+
+        # clients which do not accept an encoding
+        response = Response(200, {}, obj)
+        compressor.compress(make_request(None), response)
+        self.assertEqual(response.payload, data)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.headers['Vary'], "Accept-Encoding")
+
+    def test_skip(self):
+
+        compressor = ResponseCompressor(min_size=100)
+
+        # small payloads
+        response = Response(200, {}, {"result": "ok"})
+        compressor.compress(make_request(b"gzip"), response)
+        self.assertNotIn('Content-Encoding', response.headers)
+
+        # content which is already compressed
+        response = Response(200, {'Content-Type': 'audio/mpeg'}, b"0" * 1000)
+        compressor.compress(make_request(b"gzip"), response)
+        self.assertNotIn('Content-Encoding', response.headers)
+
+        response = Response(200, {'Content-Type': 'image/svg+xml'}, b"0" * 1000)
+        compressor.compress(make_request(b"gzip"), response)
+        self.assertEqual(response.headers['Content-Encoding'], "gzip")
+
+        # partial content
+        response = Response(206, {'Content-Range': 'bytes 0-999/2000'}, b"0" * 1000)
+        compressor.compress(make_request(b"gzip"), response)
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_compress_stream(self):
+
+        compressor = ResponseCompressor()
+
+        def generate():
+            for i in range(1000):
+                yield b"line %d\n" % i
+            # an empty write does not end the response early
+            yield b""
+
+        expected = b"".join(b"line %d\n" % i for i in range(1000))
+
+        for payload in [generate(), io.BytesIO(expected),
+                        lambda wfile: wfile.write(expected)]:
+            response = Response(200, {'Content-Length': str(len(expected))}, payload)
+            compressor.compress(make_request(b"gzip"), response)
+            self.assertEqual(response.headers['Transfer-Encoding'], "chunked")
+            self.assertNotIn('Content-Length', response.headers)
+            self.assertEqual(gzip.decompress(send(response.payload)), expected)
+
+    def test_cache(self):
+
+        compressor = ResponseCompressor(cache_size=2**16)
+        data = b"0123456789" * 1000
+
+        response = Response(200, {'ETag': '"1"'}, data)
+        compressor.compress(make_request(b"gzip"), response)
+        first = response.payload
+
+        response = Response(200, {'ETag': '"1"'}, data)
+        compressor.compress(make_request(b"gzip"), response)
+        self.assertIs(response.payload, first)
+
+        # responses without an ETag are not cached
+        response = Response(200, {}, data)
+        compressor.compress(make_request(b"gzip"), response)
+        self.assertIsNot(response.payload, first)
+        self.assertEqual(response.payload, first)
+        self.assertEqual(len(compressor._cache), 1)
+
+def main():
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(CompressionTestCase)
+    unittest.TextTestRunner().run(suite)
+
+if __name__ == '__main__':
+    main()
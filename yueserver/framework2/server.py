@@ -21,6 +21,8 @@ import socket
 import threading
 import socketserver
 import select
+import selectors
+import queue
 import gzip
 import logging
 import argparse
@@ -31,21 +33,31 @@ import gzip
 import json
 from datetime import datetime
 
-from collections import defaultdict
+from collections import defaultdict, deque
 
 from urllib.parse import urlparse, unquote, parse_qs
 from http.client import responses
 
+from .compression import ResponseCompressor
 from .server_core import readword, readline, Namespace, \
-    SocketFile, SocketWriteFile, \
+    SocketFile, SocketReader, SocketWriteFile, \
     CaseInsensitiveDict, UploadChunkedFile, UploadMultiPartFile, \
-    Response, \
-    TLSSocketClosed, ProtocolError
+    Response, copy_payload, sendfile_payload, format_response_header, \
+    TLSSocketClosed, ProtocolError, body_complete
 
 
 class Protocol(object):
 
+    def __init__(self, compressor=None):
+        super(Protocol, self).__init__()
+        # compresses the responses of endpoints marked @compressed
+        self.compressor = ResponseCompressor() if compressor is None else compressor
+
     def handshake(self, request, sock):
+
+        # the reader is shared by every request on the connection
+        request.rfile = SocketReader(sock)
+
         if hasattr(sock, 'do_handshake'):
             try:
                 sock.do_handshake()
@@ -55,7 +67,12 @@ class Protocol(object):
                 logging.error("%016X %s:%d %s" % (threading.get_ident(), host, port, err))
                 return
 
-    def prepare(self, request):
+    def prepare(self, request, timeout=30.0):
+        """ reset the state of the request, before reading the next request
+
+        timeout: the socket timeout, and the number of seconds allowed to
+            receive the request line and headers
+        """
 
         request.method = b"n/a"
         request.transport_protocol = b"n/a"
@@ -68,9 +85,12 @@ class Protocol(object):
 
         request.location = None
 
-        request.rfile = SocketFile(request.request)
+        request.request.settimeout(timeout)
 
-        request.request.settimeout(30.0)
+        # a client which sends the headers a byte at a time can not hold
+        # the connection open for longer than the timeout
+        if isinstance(request.rfile, SocketReader):
+            request.rfile.set_deadline(timeout)
 
         request.t0 = time.perf_counter()
 
@@ -184,6 +204,9 @@ class Protocol(object):
 
                 request.headers[k] = v.strip()
 
+        if isinstance(request.rfile, SocketReader):
+            request.rfile.set_deadline(None)
+
         #print(request.headers)
 
     def parse_body(self, request):
@@ -274,6 +297,13 @@ class Protocol(object):
         if "Access-Control-Allow-Credentials" not in response.headers:
             response.headers['Access-Control-Allow-Credentials'] = "true"
 
+        # an endpoint may respond before reading the whole body, for
+        # example when an upload is rejected or is not needed. the
+        # connection is closed, instead of reading the rest of the body
+        # as the next request
+        if not body_complete(request.body):
+            response.headers['Connection'] = "close"
+
         #response.headers['Allow'] = "OPTIONS, GET, POST, PUT, DELETE"
         #response.headers['Access-Control-Allow-Origin'] = "*"
 
@@ -282,7 +312,19 @@ class Protocol(object):
         #response.headers['Access-Control-Allow-Headers'] = "Content-Type, Content-Length, Authorization"
         #response.headers['Access-Control-Max-Age'] = 86400
 
-    def send_response(self, request, response):
+    def keep_alive(self, request, response):
+        """ returns true if the connection can be used for another request
+        """
+        return response.headers.get('Connection', None) != "close"
+
+    def prepare_response(self, request, response):
+        """ compress and log a response, and format the status line and headers
+
+        returns (chunked, content_length, header)
+        """
+
+        if getattr(response, 'compress', False):
+            self.compressor.compress(request, response)
 
         # parse headers:
         chunked = False
@@ -304,117 +346,112 @@ class Protocol(object):
             threading.get_ident(), host, port, transport_protocol,
             response.status, elapsed, method, path, content_length))
 
-        wsock = request.request
-
-        # send status
-        status_str = responses[response.status].encode("utf-8")
-        resp_str = b"%s %d %s\n" % (request.transport_protocol, response.status, status_str)
-        wsock.sendall(resp_str)
-
-        # send headers
-
         if 'Content-Length' not in response.headers and \
            'Transfer-Encoding' not in response.headers:
             response.headers['Content-Length'] = "0"
 
-        for hdr, val in response.headers.items():
-            hdr_str = b"%s: %s\r\n" % (hdr.encode("utf-8"), str(val).encode("utf-8"))
-            wsock.sendall(hdr_str)
-        wsock.sendall(b"\r\n")
+        # the status line and headers are sent with the start of the body
+        header = format_response_header(request.transport_protocol,
+            response.status, response.headers)
+
+        return chunked, content_length, header
+
+    def send_response(self, request, response):
+
+        chunked, content_length, header = self.prepare_response(request, response)
 
-        # send body
+        wsock = request.request
 
         if not response.payload:
+            wsock.sendall(header)
             return
 
-        wfile = SocketWriteFile(request.request, chunked)
+        # regular files are sent directly from the page cache when
+        # the length of the payload is known
+        if not chunked and content_length > 0 and \
+           hasattr(response.payload, 'read') and \
+           sendfile_payload(wsock, response.payload, content_length, header):
+            response.payload.close()
+            return
 
+        wfile = SocketWriteFile(request.request, chunked, header)
 
-        #
-        # wfile = gzip.GzipFile(mode="wb", fileobj=wfile)
+        copy_payload(response.payload, wfile,
+            None if chunked or content_length < 0 else content_length)
+        wfile.close()
 
-        if isinstance(response.payload, bytes):
+class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
+    router = None
+    protocol = None
 
-            wfile.write(response.payload)
-            wfile.close()
+    @classmethod
+    def connection(cls, request, client_address, server):
+        """ returns a handler for a connection, without handling any requests
 
-        elif hasattr(response.payload, 'read'):
+        used by servers which handle each request on a connection separately
+        """
+        handler = cls.__new__(cls)
+        handler.request = request
+        handler.client_address = client_address
+        handler.server = server
+        handler.rfile = None
+        return handler
 
-            data = response.payload.read(2048)
-            while data:
-                wfile.write(data)
-                data = response.payload.read(2048)
-            wfile.close()
+    def handle(self):
 
-            if hasattr(response.payload, 'close'):
-                response.payload.close()
+        self.protocol.handshake(self, self.request)
 
-        elif inspect.isgenerator(response.payload):
+        while self.handle_one():
+            pass
 
-            for data in response.payload:
-                wfile.write(data)
-            wfile.close()
+    def handle_one(self):
+        """ handle a single request
 
-        elif callable(response.payload):
-            response.payload(wfile)
-            wfile.close()
-        else:
-            raise NotImplementedError(type(response.payload))
+        returns False if the connection should be closed
+        """
 
-class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
-    router = None
-    protocol = None
+        try:
 
-    def handle(self):
+            self.protocol.prepare(self, self.server.idle_timeout)
 
-        self.protocol.handshake(self, self.request)
+            self.protocol.parse_headers(self)
 
-        while True:
+            # todo check security here, on fail close connection
+            self.protocol.parse_body(self)
 
-            try:
+            response = self.protocol.handle_request(self, self.router)
 
-                self.protocol.prepare(self)
+            self.protocol.post_request(self, response)
 
-                self.protocol.parse_headers(self)
+            self.protocol.send_response(self, response)
 
-                # todo check security here, on fail close connection
-                self.protocol.parse_body(self)
+            return self.protocol.keep_alive(self, response)
 
-                response = self.protocol.handle_request(self, self.router)
+        except ConnectionResetError as e:
+            logging.error(*self.fmtError(e))
 
-                self.protocol.post_request(self, response)
+        except ssl.SSLError as e:
+            logging.error(*self.fmtError(e))
 
-                self.protocol.send_response(self, response)
+        except BrokenPipeError as e:
+            logging.error(*self.fmtError(e))
 
-            except ConnectionResetError as e:
-                logging.error(*self.fmtError(e))
-                break
+        except socket.timeout as e:
+            logging.error(*self.fmtError(e))
 
-            except ssl.SSLError as e:
+        except TLSSocketClosed as e:
+            if self.method != b"n/a":
                 logging.error(*self.fmtError(e))
-                break
 
-            except BrokenPipeError as e:
-                logging.error(*self.fmtError(e))
-                break
+        except ProtocolError as e:
+            logging.error(*self.fmtError(e))
+            #self.request.close()
 
-            except socket.timeout as e:
-                logging.error(*self.fmtError(e))
-                break
+        except BaseException as e:
+            logging.exception("unhandled exception")
+            #self.request.close()
 
-            except TLSSocketClosed as e:
-                if self.method != b"n/a":
-                    logging.error(*self.fmtError(e))
-                break
-
-            except ProtocolError as e:
-                logging.error(*self.fmtError(e))
-                #self.request.close()
-                break
-            except BaseException as e:
-                logging.exception("unhandled exception")
-                #self.request.close()
-                break
+        return False
 
     def fmtError(self, e):
 
@@ -440,9 +477,23 @@ def RequestHandlerFactory(_router, _protocol):
 
     return RequestHandler
 
+# connections from these addresses are closed without reading a request
+BLOCKED_IPS = {
+    '91.241.19.84',
+    '128.14.134.134',
+    '74.82.47.3',
+    '188.166.65.216',
+    '162.243.128.166',
+    '151.106.6.62',
+}
+
 class TCPServer(socketserver.TCPServer):
     allow_reuse_address = 1
 
+    # seconds to wait for a request, or for the client while
+    # handling a request
+    idle_timeout = 30.0
+
     def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True):
         super(TCPServer, self).__init__(server_address, RequestHandlerClass, bind_and_activate)
 
@@ -451,14 +502,7 @@ class TCPServer(socketserver.TCPServer):
         self.keyfile = None
         self.password = None
 
-        self.blocked_ips = {
-            '91.241.19.84',
-            '128.14.134.134',
-            '74.82.47.3',
-            '188.166.65.216',
-            '162.243.128.166',
-            '151.106.6.62',
-        }
+        self.blocked_ips = set(BLOCKED_IPS)
 
     def setCert(self, certfile, keyfile, password):
         self.certfile = certfile
@@ -492,12 +536,245 @@ class ThreadingMixIn(socketserver.ThreadingMixIn):
 class ThreadedTCPServer(ThreadingMixIn, TCPServer):
     pass
 
+def log_endpoints(port, router):
+    for method, pattern, _ in router.endpoints:
+        # count is a score which could be used for sorting the endpoints
+        # count could be used for solving the longest match problem
+        parts = pattern.split("/")
+        count = sum([0 if not p or p.endswith("*") else 1 for p in parts])
+
+        logging.info("%5d %-8s %2d %s" % (port, method, count, pattern))
+
+class PooledTCPServer(TCPServer):
+    """ a server which handles requests using a fixed number of threads
+
+    new connections, and idle keep-alive connections, are parked in a
+    selector until they are readable, and then queued for a worker. a
+    worker handles a single request before returning the connection,
+    so that idle clients do not hold a thread.
+
+    workers: the number of threads handling requests
+    max_per_ip: the maximum number of open connections from a single
+        address. 0 for no limit
+    idle_timeout: parked connections are closed after this many seconds.
+        also used as the socket timeout while handling a request, and
+        as the time allowed to receive the headers of a request
+    """
+
+    def __init__(self, server_address, RequestHandlerClass, workers=8,
+            max_per_ip=32, idle_timeout=30.0, bind_and_activate=True):
+        super(PooledTCPServer, self).__init__(server_address,
+            RequestHandlerClass, bind_and_activate)
+
+        self.workers = workers
+        self.max_per_ip = max_per_ip
+        self.idle_timeout = idle_timeout
+
+        self._lock = threading.Lock()
+        # handlers with a readable connection, waiting for a worker
+        self._queue = queue.Queue()
+        # handlers to park, added by workers for the acceptor thread
+        self._pending = deque()
+        # handler => time after which the connection is closed
+        self._parked = {}
+        # host => number of open connections
+        self._connections = {}
+        self._active = 0
+        self._rejected = 0
+
+        self._running = False
+        self._stopped = threading.Event()
+        self._stopped.set()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+
+    def metrics(self):
+        """ returns the current state of the worker pool """
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "active": self._active,
+                "queued": self._queue.qsize(),
+                "parked": len(self._parked),
+                "connections": sum(self._connections.values()),
+                "rejected": self._rejected,
+            }
+
+    def serve_forever(self, poll_interval=0.5):
+
+        self._running = True
+        self._stopped.clear()
+
+        threads = [threading.Thread(target=self._work, daemon=True)
+            for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ)
+        selector.register(self._wakeup_r, selectors.EVENT_READ)
+
+        try:
+            while self._running:
+
+                while self._pending:
+                    handler = self._pending.popleft()
+                    self._parked[handler] = time.monotonic() + self.idle_timeout
+                    selector.register(handler.request, selectors.EVENT_READ, handler)
+
+                for key, _ in selector.select(poll_interval):
+                    if key.fileobj is self.socket:
+                        self._accept()
+                    elif key.fileobj is self._wakeup_r:
+                        self._wakeup_r.recv(4096)
+                    else:
+                        selector.unregister(key.fileobj)
+                        del self._parked[key.data]
+                        self._queue.put(key.data)
+
+                now = time.monotonic()
+                for handler, deadline in list(self._parked.items()):
+                    if deadline <= now:
+                        selector.unregister(handler.request)
+                        del self._parked[handler]
+                        self._close(handler)
+        finally:
+            for thread in threads:
+                self._queue.put(None)
+            for thread in threads:
+                thread.join()
+            for handler in list(self._parked) + list(self._pending):
+                self._close(handler)
+            self._parked.clear()
+            self._pending.clear()
+            selector.close()
+            self._stopped.set()
+
+    def shutdown(self):
+        self._running = False
+        self._wakeup_w.send(b"\x00")
+        self._stopped.wait()
+
+    def server_close(self):
+        super(PooledTCPServer, self).server_close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+    def _accept(self):
+
+        try:
+            request, client_address = self.get_request()
+        except OSError:
+            return
+
+        if not self.verify_request(request, client_address):
+            self.shutdown_request(request)
+            return
+
+        host = client_address[0]
+        with self._lock:
+            count = self._connections.get(host, 0)
+            if self.max_per_ip > 0 and count >= self.max_per_ip:
+                self._rejected += 1
+                request.close()
+                logging.warning("too many connections from address: %s", host)
+                return
+            self._connections[host] = count + 1
+
+        request.settimeout(self.idle_timeout)
+        handler = self.RequestHandlerClass.connection(
+            request, client_address, self)
+        self._pending.append(handler)
+
+    def _park(self, handler):
+        """ wait for the next request on a connection """
+
+        if handler.rfile.buffered() or \
+           (hasattr(handler.request, 'pending') and handler.request.pending()):
+            # the next request has already been received
+            self._queue.put(handler)
+            return
+
+        handler.rfile.release()
+        self._pending.append(handler)
+        try:
+            self._wakeup_w.send(b"\x00")
+        except OSError:
+            pass
+
+    def _close(self, handler):
+
+        self.shutdown_request(handler.request)
+
+        host = handler.client_address[0]
+        with self._lock:
+            count = self._connections.get(host, 0) - 1
+            if count > 0:
+                self._connections[host] = count
+            else:
+                self._connections.pop(host, None)
+
+    def _work(self):
+
+        while True:
+            handler = self._queue.get()
+            if handler is None:
+                break
+
+            with self._lock:
+                self._active += 1
+
+            keep_alive = False
+            try:
+                if handler.rfile is None:
+                    handler.protocol.handshake(handler, handler.request)
+                keep_alive = handler.handle_one()
+            except BaseException as e:
+                logging.exception("unhandled exception")
+            finally:
+                with self._lock:
+                    self._active -= 1
+
+            if keep_alive and self._running:
+                self._park(handler)
+            else:
+                self._close(handler)
+
 class Site(object):
-    def __init__(self, host, protocol=None):
+    """
+    workers: when greater than 0, requests are handled by a fixed number
+        of threads. otherwise each connection is handled by a new thread
+    max_per_ip: the maximum number of connections from a single address,
+        when using a fixed number of threads. 0 for no limit
+    idle_timeout: idle keep-alive connections, and clients which do not
+        send the headers of a request in time, are closed after this
+        many seconds
+    """
+    def __init__(self, host, protocol=None, workers=0, max_per_ip=32, idle_timeout=30.0):
         super(Site, self).__init__()
         self.host = host
         self.threads = []
         self.protocol = Protocol() if protocol is None else protocol
+        self.workers = workers
+        self.max_per_ip = max_per_ip
+        self.idle_timeout = idle_timeout
+
+    def _server(self, port, factory):
+        if self.workers > 0:
+            return PooledTCPServer((self.host, port), factory,
+                workers=self.workers, max_per_ip=self.max_per_ip,
+                idle_timeout=self.idle_timeout)
+        server = ThreadedTCPServer((self.host, port), factory)
+        server.idle_timeout = self.idle_timeout
+        return server
+
+    def metrics(self):
+        """ returns the state of the worker pool for each port """
+        metrics = {}
+        for thread in self.threads:
+            if hasattr(thread.server, 'metrics'):
+                host, port = thread.server.server_address
+                metrics[port] = thread.server.metrics()
+        return metrics
 
     def listenTLS(self, router, port, certfile, keyfile, password=None):
 
@@ -506,7 +783,7 @@ class Site(object):
         if not os.path.exists(keyfile):
             raise FileNotFoundError(keyfile)
         factory = RequestHandlerFactory(router, self.protocol)
-        server = ThreadedTCPServer((self.host, port), factory)
+        server = self._server(port, factory)
         server.router = router
         server.setCert(certfile, keyfile, password)
         server_thread = threading.Thread(target=server.serve_forever)
@@ -517,7 +794,7 @@ class Site(object):
 
     def listenTCP(self, router, port):
         factory = RequestHandlerFactory(router, self.protocol)
-        server = ThreadedTCPServer((self.host, port), factory)
+        server = self._server(port, factory)
         server.router = router
         server_thread = threading.Thread(target=server.serve_forever)
         server_thread.daemon = True
@@ -528,13 +805,7 @@ class Site(object):
     def start(self):
         for thread in self.threads:
             host, port = thread.server.server_address
-            for method, pattern, _ in thread.server.router.endpoints:
-                # count is a score which could be used for sorting the endpoints
-                # count could be used for solving the longest match problem
-                parts = pattern.split("/")
-                count = sum([0 if not p or p.endswith("*") else 1 for p in parts])
-
-                logging.info("%5d %-8s %2d %s" % (port, method, count, pattern))
+            log_endpoints(port, thread.server.router)
             proto = "https://" if thread.ssl else "http://"
             logging.info("now listening on %s%s:%d" % (proto, host, port))
             thread.start()
@@ -0,0 +1,514 @@
+"""
+An asyncio server for a framework2 Router
+
+connections are handled by coroutines on a single event loop thread, so
+that idle or streaming connections do not hold a thread. requests are
+parsed by the same Protocol as the threaded servers, and endpoints,
+which may block, run in a bounded thread pool.
+
+request bodies are read by the endpoint, in the thread pool, from the
+event loop. file and generator payloads are read in the thread pool one
+chunk at a time and written from the event loop. regular files are sent
+using loop.sendfile. callable payloads write from the thread pool, and
+hold a thread until the response is sent.
+"""
+import os
+import ssl
+import stat
+import socket
+import asyncio
+import inspect
+import logging
+import threading
+import concurrent.futures
+from functools import partial
+
+from .server import Protocol, ThreadedTCPRequestHandler, BLOCKED_IPS, \
+    log_endpoints
+from .server_core import BUFFER_SIZE, ProtocolError, TLSSocketClosed
+
+# the maximum size of the request line and headers
+MAX_HEADER_SIZE = 64 * 1024
+
+class AsyncConnection(object):
+    """ a blocking file like view of an asyncio connection
+
+    the request line and headers are read by the event loop before the
+    request is parsed. every other read and write must be made from a
+    thread other than the event loop thread.
+    """
+    def __init__(self, loop, reader, writer, timeout):
+        super(AsyncConnection, self).__init__()
+        self.loop = loop
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+
+        self._head = b""
+        self._head_pos = 0
+
+        self.closed = False
+
+    def set_head(self, head):
+        self._head = head
+        self._head_pos = 0
+
+    def fileno(self):
+        sock = self.writer.get_extra_info('socket')
+        return -1 if sock is None else sock.fileno()
+
+    def settimeout(self, timeout):
+        pass
+
+    def setblocking(self, flag):
+        pass
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def _run(self, coro):
+        """ run a coroutine on the event loop and wait for the result """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            coro.close()
+            raise RuntimeError("blocking read from the event loop")
+
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise socket.timeout("timed out")
+
+    def readuntil(self, delim, maxlen=4096):
+        """ return the bytes before the next delim, and consume the delim """
+
+        if self._head_pos < len(self._head):
+            index = self._head.find(delim, self._head_pos)
+            if index < 0:
+                raise ProtocolError("malformed header")
+            if index - self._head_pos > maxlen:
+                raise ProtocolError("header too large")
+            data = self._head[self._head_pos:index]
+            self._head_pos = index + len(delim)
+            return data
+
+        try:
+            data = self._run(self.reader.readuntil(delim))
+        except asyncio.IncompleteReadError:
+            raise TLSSocketClosed("no data")
+        except asyncio.LimitOverrunError:
+            raise ProtocolError("header too large")
+
+        if len(data) - len(delim) > maxlen:
+            raise ProtocolError("header too large")
+        return data[:-len(delim)]
+
+    def read(self, n=-1):
+        """ read at most n bytes """
+
+        if self._head_pos < len(self._head):
+            end = len(self._head) if n is None or n < 0 else self._head_pos + n
+            data = self._head[self._head_pos:end]
+            self._head_pos += len(data)
+            return data
+
+        if n is None or n < 0:
+            n = BUFFER_SIZE
+
+        return self._run(self.reader.read(n))
+
+    def write(self, data):
+        self._run(self._write(data))
+        return len(data)
+
+    def sendall(self, data):
+        self._run(self._write(data))
+
+    async def _write(self, data):
+        self.writer.write(bytes(data))
+        await self.writer.drain()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+class AsyncResponseWriter(object):
+    """ write the body of a response from the event loop
+
+    the header is sent with the first write, and chunk framing is
+    added when the response is chunked
+    """
+    def __init__(self, writer, chunked, header):
+        super(AsyncResponseWriter, self).__init__()
+        self.writer = writer
+        self.chunked = chunked
+        self._header = header
+
+    def _parts(self):
+        if self._header:
+            parts = [self._header]
+            self._header = None
+            return parts
+        return []
+
+    async def write(self, data):
+        # an empty chunk would end the response
+        if not data:
+            return
+
+        parts = self._parts()
+        if self.chunked:
+            parts.append(b"%X\r\n" % len(data))
+            parts.append(bytes(data))
+            parts.append(b"\r\n")
+        else:
+            parts.append(bytes(data))
+        self.writer.writelines(parts)
+        await self.writer.drain()
+
+    async def close(self):
+        parts = self._parts()
+        if self.chunked:
+            parts.append(b"0\r\n\r\n")
+        if parts:
+            self.writer.writelines(parts)
+        await self.writer.drain()
+
+class BlockingResponseWriter(object):
+    """ a writable file for callable payloads, used from the thread pool """
+    def __init__(self, loop, wfile):
+        super(BlockingResponseWriter, self).__init__()
+        self.loop = loop
+        self.wfile = wfile
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        future = asyncio.run_coroutine_threadsafe(
+            self.wfile.write(bytes(data)), self.loop)
+        future.result()
+        return len(data)
+
+    def flush(self):
+        pass
+
+def _regular_file(payload):
+    try:
+        fd = payload.fileno()
+        return fd >= 0 and stat.S_ISREG(os.fstat(fd).st_mode)
+    except (AttributeError, OSError, ValueError):
+        return False
+
+class AsyncRequestHandler(object):
+    """ handle the requests on a single connection """
+
+    fmtError = ThreadedTCPRequestHandler.fmtError
+
+    def __init__(self, site, router, reader, writer):
+        super(AsyncRequestHandler, self).__init__()
+        self.site = site
+        self.router = router
+        self.protocol = site.protocol
+        self.loop = site.loop
+        self.executor = site.executor
+        self.writer = writer
+
+        peer = writer.get_extra_info('peername')
+        self.client_address = tuple(peer[:2]) if peer else ("", 0)
+
+        self.request = AsyncConnection(self.loop, reader, writer,
+            site.idle_timeout)
+        self.rfile = self.request
+        self.reader = reader
+
+    async def handle(self):
+
+        try:
+            while await self.handle_one():
+                pass
+        finally:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, ssl.SSLError, OSError):
+                pass
+
+    async def handle_one(self):
+        """ handle a single request
+
+        returns False if the connection should be closed
+        """
+
+        try:
+            head = await asyncio.wait_for(
+                self.reader.readuntil(b"\r\n\r\n"), self.site.idle_timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                ConnectionError, ssl.SSLError):
+            return False
+        except asyncio.LimitOverrunError:
+            logging.error("%s:%d header too large" % self.client_address)
+            return False
+
+        try:
+
+            self.protocol.prepare(self)
+
+            self.request.set_head(head)
+            self.protocol.parse_headers(self)
+
+            self.protocol.parse_body(self)
+
+            with self.site._lock:
+                self.site._active += 1
+            try:
+                response = await self.loop.run_in_executor(self.executor,
+                    self.protocol.handle_request, self, self.router)
+            finally:
+                with self.site._lock:
+                    self.site._active -= 1
+
+            self.protocol.post_request(self, response)
+
+            await self.send_response(response)
+
+            return self.protocol.keep_alive(self, response)
+
+        except (ConnectionError, ssl.SSLError, socket.timeout) as e:
+            logging.error(*self.fmtError(e))
+
+        except TLSSocketClosed as e:
+            if self.method != b"n/a":
+                logging.error(*self.fmtError(e))
+
+        except ProtocolError as e:
+            logging.error(*self.fmtError(e))
+
+        except asyncio.CancelledError:
+            raise
+
+        except BaseException as e:
+            logging.exception("unhandled exception")
+
+        return False
+
+    async def send_response(self, response):
+
+        chunked, content_length, header = \
+            self.protocol.prepare_response(self, response)
+
+        payload = response.payload
+
+        if not payload:
+            self.writer.write(header)
+            await self.writer.drain()
+            return
+
+        if not chunked and content_length > 0 and _regular_file(payload):
+            self.writer.write(header)
+            await self.writer.drain()
+            try:
+                await self.loop.sendfile(self.writer.transport, payload,
+                    payload.tell(), content_length)
+            finally:
+                payload.close()
+            return
+
+        wfile = AsyncResponseWriter(self.writer, chunked, header)
+        length = None if chunked or content_length < 0 else content_length
+
+        if isinstance(payload, (bytes, bytearray, memoryview)):
+            await wfile.write(payload)
+
+        elif hasattr(payload, 'read'):
+            try:
+                count = 0
+                while length is None or count < length:
+                    n = BUFFER_SIZE if length is None else \
+                        min(BUFFER_SIZE, length - count)
+                    data = await self.loop.run_in_executor(
+                        self.executor, payload.read, n)
+                    if not data:
+                        break
+                    await wfile.write(data)
+                    count += len(data)
+            finally:
+                if hasattr(payload, 'close'):
+                    payload.close()
+
+        elif inspect.isasyncgen(payload):
+            async for data in payload:
+                await wfile.write(data)
+
+        elif inspect.isgenerator(payload):
+            try:
+                while True:
+                    data = await self.loop.run_in_executor(
+                        self.executor, next, payload, None)
+                    if data is None:
+                        break
+                    await wfile.write(data)
+            finally:
+                payload.close()
+
+        elif callable(payload):
+            await self.loop.run_in_executor(self.executor, payload,
+                BlockingResponseWriter(self.loop, wfile))
+
+        else:
+            raise NotImplementedError(type(payload))
+
+        await wfile.close()
+
+class AsyncSite(object):
+    """ serve routers using asyncio
+
+    an alternative to Site, with the same interface
+
+    workers: the number of threads used to run endpoints
+    idle_timeout: idle keep-alive connections are closed after this
+        many seconds
+    """
+    def __init__(self, host, protocol=None, workers=16, idle_timeout=30.0):
+        super(AsyncSite, self).__init__()
+        self.host = host
+        self.protocol = Protocol() if protocol is None else protocol
+        self.workers = workers
+        self.idle_timeout = idle_timeout
+
+        self.blocked_ips = set(BLOCKED_IPS)
+
+        self.listeners = []
+        self.servers = []
+
+        self.loop = None
+        self.executor = None
+        self.thread = None
+
+        self._lock = threading.Lock()
+        self._connections = 0
+        self._active = 0
+        self._error = None
+
+    def listenTLS(self, router, port, certfile, keyfile, password=None):
+
+        if not os.path.exists(certfile):
+            raise FileNotFoundError(certfile)
+        if not os.path.exists(keyfile):
+            raise FileNotFoundError(keyfile)
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile, password)
+        self.listeners.append((router, port, context))
+
+    def listenTCP(self, router, port):
+        self.listeners.append((router, port, None))
+
+    def addresses(self):
+        """ returns the (host, port) of each listening socket """
+        return [server.sockets[0].getsockname()[:2] for server in self.servers]
+
+    def metrics(self):
+        """ returns the state of the thread pool """
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "active": self._active,
+                "connections": self._connections,
+            }
+
+    def start(self):
+
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.workers,
+            thread_name_prefix="request")
+
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(ready,))
+        self.thread.daemon = True
+        self.thread.start()
+        ready.wait()
+
+        if self._error is not None:
+            self.thread.join()
+            raise self._error
+
+    def join(self):
+        self.thread.join()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown(wait=False)
+
+    def _run(self, ready):
+
+        asyncio.set_event_loop(self.loop)
+
+        try:
+            self.loop.run_until_complete(self._listen())
+        except BaseException as e:
+            self._error = e
+            ready.set()
+            self.loop.close()
+            return
+
+        ready.set()
+
+        try:
+            self.loop.run_forever()
+        finally:
+            for server in self.servers:
+                server.close()
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+
+    async def _listen(self):
+
+        for router, port, context in self.listeners:
+            server = await asyncio.start_server(
+                partial(self._serve, router), self.host, port,
+                ssl=context, limit=MAX_HEADER_SIZE, reuse_address=True)
+            self.servers.append(server)
+
+            host, port = server.sockets[0].getsockname()[:2]
+            log_endpoints(port, router)
+            proto = "https://" if context else "http://"
+            logging.info("now listening on %s%s:%d" % (proto, host, port))
+
+    async def _serve(self, router, reader, writer):
+
+        handler = AsyncRequestHandler(self, router, reader, writer)
+
+        host = handler.client_address[0]
+        if host in self.blocked_ips:
+            logging.error("blocked request from address: %s", host)
+            writer.close()
+            return
+
+        with self._lock:
+            self._connections += 1
+        try:
+            await handler.handle()
+        except asyncio.CancelledError:
+            # the site is stopping
+            pass
+        finally:
+            with self._lock:
+                self._connections -= 1
@@ -0,0 +1,131 @@
+import os
+import socket
+import tempfile
+import unittest
+import http.client
+
+from yueserver.framework2.server_async import AsyncSite
+from yueserver.framework2.server_core import Response
+
+class MockRouter(object):
+    """ a router with a few endpoints, selected by path """
+
+    endpoints = []
+
+    def __init__(self, path):
+        super(MockRouter, self).__init__()
+        self.path = path
+
+    def getRoute(self, method, path):
+
+        if path == "/file":
+            def callback(resource, request):
+                f = open(self.path, "rb")
+                return Response(200, {'Content-Length': str(os.path.getsize(self.path))}, f)
+
+        elif path == "/stream":
+            def callback(resource, request):
+                def go():
+                    for i in range(100):
+                        yield b"%d," % i
+                return Response(200, {'Transfer-Encoding': 'chunked'}, go())
+
+        elif path == "/upload":
+            def callback(resource, request):
+                return Response(200, {}, {"size": len(request.body.read())})
+
+        else:
+            def callback(resource, request):
+                return Response(200, {}, {"path": path})
+
+        return None, callback, {}
+
+class AsyncSiteTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.NamedTemporaryFile(delete=False)
+        cls.tmp.write(os.urandom(300000))
+        cls.tmp.close()
+
+        cls.site = AsyncSite("127.0.0.1", workers=2, idle_timeout=5.0)
+        cls.site.listenTCP(MockRouter(cls.tmp.name), 0)
+        cls.site.start()
+        cls.host, cls.port = cls.site.addresses()[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.site.stop()
+        os.remove(cls.tmp.name)
+
+    def connect(self):
+        return http.client.HTTPConnection(self.host, self.port, timeout=5)
+
+    def test_keep_alive(self):
+
+        conn = self.connect()
+        try:
+            for path in ["/a", "/b"]:
+                conn.request("GET", path)
+                response = conn.getresponse()
+                self.assertEqual(response.status, 200)
+                self.assertEqual(response.read(), b'{"path": "%s"}\n' % path.encode())
+        finally:
+            conn.close()
+
+    def test_payloads(self):
+
+        conn = self.connect()
+        try:
+            conn.request("GET", "/file")
+            response = conn.getresponse()
+            with open(self.tmp.name, "rb") as rf:
+                self.assertEqual(response.read(), rf.read())
+
+            conn.request("GET", "/stream")
+            response = conn.getresponse()
+            self.assertEqual(response.getheader("Transfer-Encoding"), "chunked")
+            self.assertEqual(response.read(),
+                b"".join(b"%d," % i for i in range(100)))
+
+            # the body is read by the endpoint from the thread pool
+            conn.request("POST", "/upload", body=iter([b"0" * 1000, b"1" * 5000]),
+                headers={"Transfer-Encoding": "chunked"}, encode_chunked=True)
+            response = conn.getresponse()
+            self.assertEqual(response.read(), b'{"size": 6000}\n')
+        finally:
+            conn.close()
+
+    def test_idle_connections(self):
+
+        # idle connections do not hold a thread
+        sockets = [socket.create_connection((self.host, self.port))
+            for i in range(20)]
+        try:
+            conn = self.connect()
+            conn.request("GET", "/a")
+            self.assertEqual(conn.getresponse().status, 200)
+            conn.close()
+
+            metrics = self.site.metrics()
+            self.assertEqual(metrics["workers"], 2)
+            self.assertGreaterEqual(metrics["connections"], 20)
+        finally:
+            for sock in sockets:
+                sock.close()
+
+    def test_malformed(self):
+
+        sock = socket.create_connection((self.host, self.port), timeout=5)
+        try:
+            sock.sendall(b"GET\r\n\r\n")
+            self.assertEqual(sock.recv(4096), b"")
+        finally:
+            sock.close()
+
+def main():
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(AsyncSiteTestCase)
+    unittest.TextTestRunner().run(suite)
+
+if __name__ == '__main__':
+    main()
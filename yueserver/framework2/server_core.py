@@ -4,6 +4,8 @@ import sys
 import io
 import re
 import socket
+import ssl
+import stat
 import threading
 import socketserver
 import select
@@ -11,7 +13,11 @@ import gzip
 import logging
 import argparse
 import json
+import time
 import mimetypes
+import inspect
+import uuid
+import email.utils
 
 from datetime import datetime
 
@@ -20,6 +26,8 @@ from collections import defaultdict
 from urllib.parse import urlparse, unquote
 from http.client import responses
 
+from ..dao.filesys.transfer import copyfileobj
+
 # from http import HTTPStatus
 
 HTTP_STATUS_CODES = {
@@ -89,6 +97,15 @@ HTTP_STATUS_CODES = {
     511: "Network Authentication Failed",  # see RFC 6585
 }
 
+# size of the buffer used when copying a payload to a socket
+BUFFER_SIZE = 64 * 1024
+
+# a Range header with more ranges than this is ignored
+MAX_RANGES = 16
+
+# size of the buffer used for reading requests, for each connection
+RECV_BUFFER_SIZE = 16 * 1024
+
 class ProtocolError(Exception):
     pass
 
@@ -96,6 +113,12 @@ class TLSSocketClosed(Exception):
     pass
 
 def readword(file, maxlen=4096):
+    """ read bytes up to the next space, the space is discarded """
+
+    readuntil = getattr(file, "readuntil", None)
+    if readuntil is not None:
+        return readuntil(b" ", maxlen)
+
     data = []
 
     b = file.read(1)
@@ -120,6 +143,12 @@ def readword(file, maxlen=4096):
     return b"".join(data)
 
 def readline(file, maxlen=4096):
+    """ read bytes up to the next CRLF, the CRLF is discarded """
+
+    readuntil = getattr(file, "readuntil", None)
+    if readuntil is not None:
+        return readuntil(b"\r\n", maxlen)
+
     data = []
     a = file.read(1)
     if not a:
@@ -146,6 +175,23 @@ def readline(file, maxlen=4096):
             raise TLSSocketClosed("no data")
     return b"".join(data)
 
+def readexact(file, size):
+    """ read exactly size bytes from a file which may return fewer """
+
+    data = file.read(size)
+    if len(data) == size:
+        return data
+
+    parts = [data]
+    count = len(data)
+    while count < size:
+        data = file.read(size - count)
+        if not data:
+            raise TLSSocketClosed("no data")
+        parts.append(data)
+        count += len(data)
+    return b"".join(parts)
+
 def setupLogger(logger_name, log_file):
     parent, _ = os.path.split(log_file)
 
@@ -215,18 +261,242 @@ class SocketFile(object):
     def close(self):
         self.closed = True
 
+class SocketReader(object):
+    """ a buffered reader for the request side of a socket
+
+    the request line and headers are scanned for delimiters in a
+    reusable buffer, instead of receiving one byte at a time. one
+    reader is used for every request on a connection, bytes received
+    after the end of a request are kept for the next request.
+
+    reads larger than the buffer bypass the buffer, once the bytes
+    already buffered have been consumed.
+    """
+    def __init__(self, sock, size=RECV_BUFFER_SIZE):
+        super(SocketReader, self).__init__()
+
+        self.sock = sock
+
+        self._size = size
+        self._buffer = None
+        self._view = None
+        # the unread bytes are _buffer[_start:_end]
+        self._start = 0
+        self._end = 0
+
+        # the time by which the pending reads must complete, or None
+        self._deadline = None
+        self._timeout = None
+
+        self._allocate()
+
+        self.closed = False
+
+    def _allocate(self):
+        if self._buffer is None:
+            self._buffer = bytearray(self._size)
+            self._view = memoryview(self._buffer)
+
+    def release(self):
+        """ free the buffer of an idle connection, if it is empty
+
+        the buffer is allocated again by the next read
+        """
+        if self._start == self._end:
+            self._start = self._end = 0
+            self._view = None
+            self._buffer = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def buffered(self):
+        """ returns the number of bytes received but not yet read """
+        return self._end - self._start
+
+    def set_deadline(self, timeout):
+        """ fail reads which have not completed within timeout seconds
+
+        unlike the socket timeout, the deadline is not extended each
+        time bytes are received. None to clear the deadline and restore
+        the socket timeout
+        """
+
+        if timeout is None:
+            if self._deadline is not None:
+                self.sock.settimeout(self._timeout)
+            self._deadline = None
+        else:
+            if self._deadline is None:
+                self._timeout = self.sock.gettimeout()
+            self._deadline = time.monotonic() + timeout
+
+    def _fill(self):
+        """ receive more bytes into the buffer
+
+        returns the number of bytes received, zero when the socket
+        is closed or the buffer is full
+        """
+
+        self._allocate()
+
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._buffer) and self._start > 0:
+            # move the unread bytes to the front of the buffer
+            n = self._end - self._start
+            self._buffer[:n] = self._buffer[self._start:self._end]
+            self._start = 0
+            self._end = n
+
+        if self._end == len(self._buffer):
+            return 0
+
+        if self._deadline is not None:
+            remaining = self._deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("timed out")
+            self.sock.settimeout(remaining)
+
+        n = self.sock.recv_into(self._view[self._end:])
+        self._end += n
+        return n
+
+    def readuntil(self, delim, maxlen=4096):
+        """ return the bytes before the next delim, and consume the delim
+
+        raises ProtocolError if the delim is not found within maxlen bytes
+        """
+
+        self._allocate()
+
+        offset = 0
+        while True:
+            index = self._buffer.find(delim, self._start + offset, self._end)
+
+            if index >= 0:
+                if index - self._start > maxlen:
+                    break
+                data = bytes(self._view[self._start:index])
+                self._start = index + len(delim)
+                return data
+
+            count = self._end - self._start
+            if count > maxlen:
+                break
+
+            # the delimiter may span the old and new bytes
+            offset = max(0, count - len(delim) + 1)
+
+            if not self._fill():
+                if self._end - self._start == len(self._buffer):
+                    break
+                raise TLSSocketClosed("no data")
+
+        logging.error("received header: %r" % (
+            bytes(self._view[self._start:self._start + 32])))
+        raise ProtocolError("header too large")
+
+    def read(self, n=-1):
+        """ read at most n bytes
+
+        returns the buffered bytes, if any, otherwise the result of
+        a single receive. returns fewer than n bytes if the remaining
+        bytes have not been received.
+        """
+
+        if n is None or n < 0:
+            n = self._size
+
+        if self._start == self._end:
+            if n >= self._size:
+                return self.sock.recv(n)
+            if not self._fill():
+                return b""
+
+        end = min(self._end, self._start + n)
+        data = bytes(self._view[self._start:end])
+        self._start = end
+        return data
+
+    def write(self, b):
+        self.sock.sendall(b)
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+def format_response_header(transport_protocol, status, headers):
+    """ returns the status line and headers of a response as a single block
+    """
+
+    lines = [b"%s %d %s" % (transport_protocol, status,
+        responses[status].encode("utf-8"))]
+    for hdr, val in headers.items():
+        lines.append(b"%s: %s" % (hdr.encode("utf-8"), str(val).encode("utf-8")))
+    return b"\r\n".join(lines) + b"\r\n\r\n"
+
+def sendv(sock, parts):
+    """ send a list of buffers using as few calls as possible
+
+    plain sockets use scatter/gather io. TLS sockets do not support
+    sendmsg, the buffers are joined so that small responses are sent
+    as a single record.
+    """
+
+    if len(parts) == 1:
+        sock.sendall(parts[0])
+        return
+
+    sendmsg = None
+    if not isinstance(sock, ssl.SSLSocket):
+        sendmsg = getattr(sock, "sendmsg", None)
+
+    if sendmsg is None:
+        sock.sendall(b"".join(parts))
+        return
+
+    views = [memoryview(part) for part in parts if len(part)]
+    while views:
+        n = sendmsg(views)
+        # drop the buffers which were sent, and part of the next one
+        while views and n >= len(views[0]):
+            n -= len(views[0])
+            views.pop(0)
+        if n:
+            views[0] = views[0][n:]
+
 class SocketWriteFile(object):
     """wrap a socket with a writable file like object
 
     used for implementing streaming for a response payload
+
+    header: the status line and headers of the response, which are sent
+        with the first write, or when the file is closed
+
+    each write is sent with a single call, along with the chunk framing
     """
-    def __init__(self, sock, chunked):
+    def __init__(self, sock, chunked, header=None):
         super(SocketWriteFile, self).__init__()
 
         self.sock = sock
         self.chunked = chunked
         self.closed = False
 
+        self._header = header
+
         self.bytes_written = 0
 
     def fileno(self):
@@ -244,18 +514,31 @@ class SocketWriteFile(object):
     def read(self, n=None):
         raise NotImplementedError()
 
+    def _parts(self):
+        if self._header:
+            parts = [self._header]
+            self._header = None
+            return parts
+        return []
+
     def write(self, data):
         if self.closed:
             return
 
+        n = len(data)
+        # an empty chunk would end the response
+        if n == 0:
+            return 0
+
+        parts = self._parts()
         if self.chunked:
-            self.sock.sendall(b"%X\r\n" % len(data))
-            self.sock.sendall(data)
-            self.sock.sendall(b"\r\n")
+            parts.append(b"%X\r\n" % n)
+            parts.append(data)
+            parts.append(b"\r\n")
         else:
-            self.sock.sendall(data)
+            parts.append(data)
+        sendv(self.sock, parts)
 
-        n = len(data)
         self.bytes_written += n
         return n
 
@@ -266,10 +549,60 @@ class SocketWriteFile(object):
         if self.closed:
             return
 
+        parts = self._parts()
         if self.chunked:
-            self.sock.sendall(b"0\r\n\r\n")
+            parts.append(b"0\r\n\r\n")
+        if parts:
+            sendv(self.sock, parts)
         self.closed = True
 
+def sendfile_payload(sock, payload, count, header=None):
+    """ send count bytes of a file payload, starting from the current
+    position, using sendfile
+
+    header: bytes to send before the file, if the file can be sent
+
+    returns False if the payload is not a regular file
+    """
+    try:
+        fd = payload.fileno()
+        if fd < 0 or not stat.S_ISREG(os.fstat(fd).st_mode):
+            return False
+        offset = payload.tell()
+    except (AttributeError, OSError, ValueError):
+        return False
+
+    if header:
+        sock.sendall(header)
+    sock.sendfile(payload, offset, count)
+    return True
+
+def copy_payload(payload, wfile, length=None):
+    """ write a response payload to a writable file
+
+    length: if given, write at most length bytes of a readable payload
+    """
+
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        wfile.write(payload)
+
+    elif hasattr(payload, 'read'):
+        try:
+            copyfileobj(payload, wfile, length, BUFFER_SIZE)
+        finally:
+            if hasattr(payload, 'close'):
+                payload.close()
+
+    elif inspect.isgenerator(payload):
+        for data in payload:
+            wfile.write(data)
+
+    elif callable(payload):
+        payload(wfile)
+
+    else:
+        raise NotImplementedError(type(payload))
+
 class CaseInsensitiveDict(dict):
     def __setitem__(self, key, value):
         super().__setitem__(key.upper(), value)
@@ -382,8 +715,12 @@ class UploadChunkedFile(object):
 
         size = int(readline(self.rfile), 16)
         if size > 0:
-            data = self.rfile.read(size)
+            data = readexact(self.rfile, size)
         else:
+            # discard any trailers and the final \r\n, so that the
+            # next request on the connection starts at the right place
+            while readline(self.rfile):
+                pass
             self.closed = True
             return b""
 
@@ -391,6 +728,10 @@ class UploadChunkedFile(object):
 
         return data
 
+    def complete(self):
+        """ returns true if the final chunk has been read """
+        return self.closed
+
     def detach(self):
         pass
 
@@ -466,7 +807,7 @@ class UploadMultiPartFile(object):
 
         if self.length == 0:
             logging.debug("received all bytes for upload: %d %d", self.content_length, self.bytes_read)
-            self.rfile.read(self.content_extra_length)
+            readexact(self.rfile, self.content_extra_length)
             self.closed = True
 
         data = b"".join(blocks)
@@ -476,6 +817,12 @@ class UploadMultiPartFile(object):
     def fileno(self):
         return self.rfile.fileno()
 
+    def complete(self):
+        """ returns true if every byte of the body has been read """
+        if not self._init:
+            return self.headers.get(b'content-length', b"0").strip() in (b"", b"0")
+        return self.closed
+
     def detach(self):
         pass
 
@@ -526,20 +873,25 @@ class UploadMultiPartFile(object):
 
         self._init = True
 
+def body_complete(body):
+    """ returns true if every byte of a request body has been received
+
+    the bytes of a body which was not read would be read as the
+    start of the next request on the connection
+    """
+
+    if isinstance(body, gzip.GzipFile):
+        body = body.fileobj
+
+    complete = getattr(body, "complete", None)
+    return complete is None or complete()
+
 class Response(object):
     """
-        if compress:
-            gzip_buffer = io.BytesIO()
-            gzip_file = gzip.GzipFile(mode='wb',
-                                      fileobj=gzip_buffer)
-            gzip_file.write(self.payload)
-            gzip_file.close()
-
-            self.payload = gzip_buffer.getvalue()
-
-            self.headers['Vary'] = 'Accept-Encoding'
-            self.headers['Content-Encoding'] = 'gzip'
-            self.headers['Content-Length'] = len(self.payload)
+    the status, headers and payload of a response
+
+    when compress is true the payload is compressed, using an encoding
+    accepted by the client, before it is sent. see compression.py
     """
     def __init__(self, status=200, headers=None, payload=None):
         super(Response, self).__init__()
@@ -808,3 +1160,151 @@ def send_generator(go, attachment_name, file_size=None, headers=None, attachment
     print("sending file", file_size, headers.get('Content-Length', None), headers.get('Transfer-Encoding', None))
 
     return Response(200, headers, go)
+
+def parse_range(value, size):
+    """ parse the value of a Range header for a resource of a given size
+
+    returns None if the header should be ignored, an empty list if none
+    of the ranges can be satisfied, otherwise a sorted list of
+    non-overlapping (start, end) pairs, where end is inclusive.
+    """
+
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+
+    ranges = []
+    for part in spec.split(","):
+        first, sep, last = part.strip().partition("-")
+        first = first.strip()
+        last = last.strip()
+
+        # one of first or last must be given, and both must be integers
+        if not sep or not (first or last):
+            return None
+        if not all(x.isdigit() for x in (first, last) if x):
+            return None
+
+        if not first:
+            # suffix range: the last N bytes of the resource
+            n = int(last)
+            if n > 0 and size > 0:
+                ranges.append((max(0, size - n), size - 1))
+            continue
+
+        start = int(first)
+        end = int(last) if last else None
+
+        if end is not None and end < start:
+            return None
+
+        if start < size:
+            end = size - 1 if end is None else min(end, size - 1)
+            ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    # merge ranges which overlap or are adjacent
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+def check_if_range(value, etag=None, mtime=None):
+    """ return true if the value of an If-Range header matches
+    the current version of a resource
+
+    value: an entity tag or an HTTP date
+    """
+
+    value = value.strip()
+
+    # weak entity tags never match
+    if value.startswith("W/"):
+        return False
+
+    if value.startswith('"'):
+        return etag is not None and value.strip('"') == etag.strip('"')
+
+    if etag is not None and value == etag:
+        return True
+
+    if mtime is None:
+        return False
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return False
+
+    return int(date.timestamp()) == int(mtime)
+
+def send_range(headers, size, download, range_=None, if_range=None, etag=None, mtime=None):
+    """ return a 200, 206 or 416 response for part of a resource
+
+    headers: the response headers, including the Content-Type
+    size: the size of the resource in bytes
+    download: a function download(offset, length) which returns
+        a payload containing length bytes starting at offset.
+        length is None when the complete resource is requested
+    range_: the value of the Range request header, if given
+    if_range: the value of the If-Range request header, if given
+    etag, mtime: the current version of the resource, for If-Range
+    """
+
+    headers['Accept-Ranges'] = "bytes"
+
+    ranges = None
+    if range_ and (not if_range or check_if_range(if_range, etag, mtime)):
+        ranges = parse_range(range_, size)
+
+    if ranges is None:
+        headers['Content-Length'] = str(size)
+        return Response(200, headers, download(0, None))
+
+    if not ranges:
+        return Response(416, {
+            'Accept-Ranges': "bytes",
+            'Content-Range': "bytes */%d" % size,
+        })
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers['Content-Range'] = "bytes %d-%d/%d" % (start, end, size)
+        headers['Content-Length'] = str(end - start + 1)
+        return Response(206, headers, download(start, end - start + 1))
+
+    # send multiple ranges as a multipart/byteranges document
+
+    boundary = uuid.uuid4().hex
+    content_type = headers.get('Content-Type', "application/octet-stream")
+
+    parts = []
+    for start, end in ranges:
+        parts.append((start, end, (
+            "\r\n--%s\r\n"
+            "Content-Type: %s\r\n"
+            "Content-Range: bytes %d-%d/%d\r\n"
+            "\r\n") % (boundary, content_type, start, end, size)))
+    trailer = "\r\n--%s--\r\n" % boundary
+
+    length = len(trailer)
+    for start, end, part in parts:
+        length += len(part) + end - start + 1
+
+    def payload(wfile):
+        for start, end, part in parts:
+            wfile.write(part.encode("utf-8"))
+            copy_payload(download(start, end - start + 1), wfile, end - start + 1)
+        wfile.write(trailer.encode("utf-8"))
+
+    headers.pop('Content-Encoding', None)
+    headers['Content-Type'] = "multipart/byteranges; boundary=%s" % boundary
+    headers['Content-Length'] = str(length)
+
+    return Response(206, headers, payload)
@@ -0,0 +1,289 @@
+import os
+import io
+import socket
+import tempfile
+import threading
+import unittest
+
+from yueserver.framework2.server_core import parse_range, check_if_range, send_range, \
+    copy_payload, sendfile_payload, readword, readline, SocketReader, \
+    UploadChunkedFile, CaseInsensitiveDict, ProtocolError, TLSSocketClosed, \
+    SocketWriteFile, format_response_header, sendv
+
+class MockSocket(object):
+    """ a socket which receives at most step bytes at a time """
+    def __init__(self, data, step=7):
+        super(MockSocket, self).__init__()
+        self.stream = io.BytesIO(data)
+        self.step = step
+        self.sent = []
+
+    def recv(self, n):
+        return self.stream.read(min(n, self.step))
+
+    def recv_into(self, b):
+        data = self.recv(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def sendall(self, b):
+        self.sent.append(b)
+
+    def fileno(self):
+        return -1
+
+class ServerCoreTestCase(unittest.TestCase):
+
+    def test_parse_range(self):
+
+        self.assertEqual(parse_range("bytes=0-499", 1000), [(0, 499)])
+        self.assertEqual(parse_range("bytes=500-", 1000), [(500, 999)])
+        self.assertEqual(parse_range("bytes=-100", 1000), [(900, 999)])
+        self.assertEqual(parse_range("bytes=-2000", 1000), [(0, 999)])
+        self.assertEqual(parse_range("bytes=900-2000", 1000), [(900, 999)])
+
+        # ranges are sorted and merged
+        self.assertEqual(parse_range("bytes=500-599, 0-99", 1000),
+            [(0, 99), (500, 599)])
+        self.assertEqual(parse_range("bytes=0-99,100-199,150-300", 1000),
+            [(0, 300)])
+
+        # unsatisfiable ranges
+        self.assertEqual(parse_range("bytes=1000-", 1000), [])
+        self.assertEqual(parse_range("bytes=-0", 1000), [])
+        self.assertEqual(parse_range("bytes=0-10", 0), [])
+
+        # invalid headers are ignored
+        self.assertIsNone(parse_range("items=0-10", 1000))
+        self.assertIsNone(parse_range("bytes=10-0", 1000))
+        self.assertIsNone(parse_range("bytes=abc", 1000))
+        self.assertIsNone(parse_range("bytes=-", 1000))
+        self.assertIsNone(parse_range("bytes=" + ",".join(
+            "%d-%d" % (i * 10, i * 10 + 1) for i in range(20)), 1000))
+
+    def test_check_if_range(self):
+
+        self.assertTrue(check_if_range("file.txt:1", "file.txt:1"))
+        self.assertTrue(check_if_range('"file.txt:1"', "file.txt:1"))
+        self.assertFalse(check_if_range("file.txt:2", "file.txt:1"))
+        self.assertFalse(check_if_range('W/"file.txt:1"', "file.txt:1"))
+
+        date = "Wed, 21 Oct 2015 07:28:00 GMT"
+        self.assertTrue(check_if_range(date, None, 1445412480))
+        self.assertFalse(check_if_range(date, None, 1445412481))
+        self.assertFalse(check_if_range(date, None, None))
+
+    def test_send_range(self):
+
+        data = bytes(range(256)) * 4
+
+        def download(offset, length):
+            end = None if length is None else offset + length
+            return data[offset:end]
+
+        response = send_range({}, len(data), download)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers['Accept-Ranges'], "bytes")
+        self.assertEqual(response.payload, data)
+
+        response = send_range({}, len(data), download, "bytes=10-19")
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.headers['Content-Range'], "bytes 10-19/1024")
+        self.assertEqual(response.headers['Content-Length'], "10")
+        self.assertEqual(response.payload, data[10:20])
+
+        response = send_range({}, len(data), download, "bytes=2000-")
+        self.assertEqual(response.status, 416)
+        self.assertEqual(response.headers['Content-Range'], "bytes */1024")
+
+        # the range is ignored if the resource has changed
+        response = send_range({}, len(data), download, "bytes=10-19",
+            if_range="a:2", etag="a:1")
+        self.assertEqual(response.status, 200)
+
+        response = send_range({}, len(data), download, "bytes=10-19",
+            if_range="a:1", etag="a:1")
+        self.assertEqual(response.status, 206)
+
+    def test_send_range_multipart(self):
+
+        data = bytes(range(256)) * 4
+
+        def download(offset, length):
+            return io.BytesIO(data[offset:offset + length])
+
+        headers = {'Content-Type': "audio/flac"}
+        response = send_range(headers, len(data), download, "bytes=0-9,100-109")
+        self.assertEqual(response.status, 206)
+
+        content_type = response.headers['Content-Type']
+        self.assertTrue(content_type.startswith("multipart/byteranges"))
+        boundary = content_type.split("boundary=")[1].encode("utf-8")
+
+        wfile = io.BytesIO()
+        copy_payload(response.payload, wfile)
+        body = wfile.getvalue()
+
+        self.assertEqual(len(body), int(response.headers['Content-Length']))
+        self.assertTrue(body.endswith(b"--" + boundary + b"--\r\n"))
+
+        parts = body.split(b"--" + boundary)[1:-1]
+        self.assertEqual(len(parts), 2)
+        self.assertIn(b"Content-Range: bytes 0-9/1024", parts[0])
+        self.assertIn(b"Content-Type: audio/flac", parts[0])
+        self.assertTrue(parts[0].endswith(b"\r\n\r\n" + data[0:10] + b"\r\n"))
+        self.assertTrue(parts[1].endswith(b"\r\n\r\n" + data[100:110] + b"\r\n"))
+
+    def test_copy_payload(self):
+
+        data = os.urandom(200 * 1024)
+
+        wfile = io.BytesIO()
+        copy_payload(io.BytesIO(data), wfile, 100000)
+        self.assertEqual(wfile.getvalue(), data[:100000])
+
+        wfile = io.BytesIO()
+        copy_payload((data[i:i + 10] for i in range(0, 100, 10)), wfile)
+        self.assertEqual(wfile.getvalue(), data[:100])
+
+    def test_sendfile_payload(self):
+
+        data = os.urandom(200 * 1024)
+
+        with tempfile.TemporaryFile() as tf:
+            tf.write(data)
+            tf.seek(1000)
+
+            a, b = socket.socketpair()
+            try:
+                # memory files can not be sent using sendfile
+                self.assertFalse(sendfile_payload(a, io.BytesIO(data), 10))
+
+                self.assertTrue(sendfile_payload(a, tf, 5000))
+                a.close()
+
+                received = []
+                buf = b.recv(4096)
+                while buf:
+                    received.append(buf)
+                    buf = b.recv(4096)
+            finally:
+                a.close()
+                b.close()
+
+        self.assertEqual(b"".join(received), data[1000:6000])
+
+    def test_socket_reader(self):
+
+        request = b"GET /index.html HTTP/1.1\r\nHost: localhost\r\n\r\n"
+        reader = SocketReader(MockSocket(request * 2), 32)
+
+        # pipelined requests are read from the same buffer
+        for i in range(2):
+            self.assertEqual(readword(reader, 16), b"GET")
+            self.assertEqual(readword(reader), b"/index.html")
+            self.assertEqual(readline(reader, 16), b"HTTP/1.1")
+            self.assertEqual(readline(reader), b"Host: localhost")
+            self.assertEqual(readline(reader), b"")
+
+        with self.assertRaises(TLSSocketClosed):
+            readword(reader)
+
+        # a line longer than maxlen, or the buffer, is rejected
+        reader = SocketReader(MockSocket(b"0123456789abcdef\r\n"), 32)
+        with self.assertRaises(ProtocolError):
+            readline(reader, 8)
+
+        reader = SocketReader(MockSocket(b"0" * 64 + b"\r\n"), 32)
+        with self.assertRaises(ProtocolError):
+            readline(reader, 128)
+
+    def test_socket_reader_body(self):
+
+        body = b"".join(b"%x\r\n%s\r\n" % (len(chunk), chunk)
+            for chunk in [b"a" * 20, b"b" * 100, b""])
+        request = b"POST /upload HTTP/1.1\r\n" + \
+            b"Transfer-Encoding: chunked\r\n\r\n" + body + \
+            b"GET / HTTP/1.1\r\n"
+        reader = SocketReader(MockSocket(request), 32)
+
+        while readline(reader):
+            pass
+
+        # the body continues from the bytes buffered with the headers
+        upload = UploadChunkedFile(CaseInsensitiveDict(), reader)
+        self.assertEqual(upload.read(), b"a" * 20 + b"b" * 100)
+
+        # bytes after the body belong to the next request
+        self.assertEqual(readline(reader), b"GET / HTTP/1.1")
+
+        # large reads bypass the buffer
+        reader = SocketReader(MockSocket(b"x" * 100, 100), 32)
+        self.assertEqual(reader.read(4), b"xxxx")
+        self.assertEqual(reader.read(64), b"x" * 28)
+        self.assertEqual(reader.read(64), b"x" * 64)
+        self.assertEqual(reader.read(64), b"x" * 4)
+        self.assertEqual(reader.read(64), b"")
+
+    def test_format_response_header(self):
+
+        header = format_response_header(b"HTTP/1.1", 200,
+            {"Content-Length": 12, "Content-Type": "application/json"})
+        self.assertEqual(header, b"HTTP/1.1 200 OK\r\n"
+            b"Content-Length: 12\r\n"
+            b"Content-Type: application/json\r\n\r\n")
+
+    def test_socket_write_file(self):
+
+        # the header is sent with the first chunk, and each chunk
+        # is sent with its framing in a single call
+        sock = MockSocket(b"")
+        wfile = SocketWriteFile(sock, True, b"HEADER\r\n\r\n")
+        wfile.write(b"abc")
+        wfile.write(b"")
+        wfile.write(b"0123456789")
+        wfile.close()
+        self.assertEqual(sock.sent, [
+            b"HEADER\r\n\r\n3\r\nabc\r\n",
+            b"A\r\n0123456789\r\n",
+            b"0\r\n\r\n"])
+
+        # the header is sent on close for an empty body
+        sock = MockSocket(b"")
+        wfile = SocketWriteFile(sock, True, b"HEADER\r\n\r\n")
+        wfile.close()
+        self.assertEqual(sock.sent, [b"HEADER\r\n\r\n0\r\n\r\n"])
+
+    def test_sendv(self):
+
+        parts = [b"a" * 100000, b"", memoryview(bytearray(b"b" * 300000)), b"c"]
+
+        a, b = socket.socketpair()
+        try:
+            received = []
+
+            def recv():
+                buf = b.recv(65536)
+                while buf:
+                    received.append(buf)
+                    buf = b.recv(65536)
+
+            thread = threading.Thread(target=recv)
+            thread.start()
+            # the buffers are larger than the socket buffer, sendmsg
+            # returns after a partial write
+            sendv(a, parts)
+            a.close()
+            thread.join()
+        finally:
+            a.close()
+            b.close()
+
+        self.assertEqual(b"".join(received), b"".join(parts))
+
+def main():
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(ServerCoreTestCase)
+    unittest.TextTestRunner().run(suite)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import socket
+import threading
+import time
+import unittest
+
+from yueserver.framework2.server import PooledTCPServer, RequestHandlerFactory, \
+    Protocol
+from yueserver.framework2.server_core import Response
+
+class MockRouter(object):
+    """ a router which echoes the request path """
+
+    endpoints = []
+
+    def getRoute(self, method, path):
+        def callback(resource, request):
+            if path == "/quota":
+                # read part of an upload before rejecting it
+                request.body.read(4)
+                return Response(413, {}, {"error": "quota exceeded"})
+            return Response(200, {}, {"path": path})
+        return None, callback, {}
+
+def get(sock, path):
+    """ send a request and return the raw response """
+    sock.sendall(b"GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n" % path)
+    data = b""
+    while b"\r\n\r\n" not in data:
+        data += sock.recv(4096)
+    header, _, body = data.partition(b"\r\n\r\n")
+    length = 0
+    for line in header.split(b"\r\n"):
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":", 1)[1])
+    while len(body) < length:
+        body += sock.recv(4096)
+    return header.split(b"\r\n")[0], body
+
+class PooledTCPServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        factory = RequestHandlerFactory(MockRouter(), Protocol())
+        self.server = PooledTCPServer(("127.0.0.1", 0), factory,
+            workers=1, max_per_ip=3, idle_timeout=1.0)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+            kwargs={"poll_interval": 0.05})
+        self.thread.start()
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def connect(self):
+        sock = socket.create_connection(self.server.server_address, timeout=5)
+        self.sockets.append(sock)
+        return sock
+
+    def wait_for(self, key, value):
+        for i in range(100):
+            if self.server.metrics()[key] == value:
+                return
+            time.sleep(0.02)
+        self.fail("%s != %s: %s" % (key, value, self.server.metrics()))
+
+    def test_keep_alive(self):
+
+        # an idle connection does not hold the only worker
+        a = self.connect()
+        b = self.connect()
+        self.assertEqual(get(a, b"/a")[0], b"HTTP/1.1 200 OK")
+        self.assertEqual(get(b, b"/b")[0], b"HTTP/1.1 200 OK")
+        status, body = get(a, b"/c")
+        self.assertEqual(body, b'{"path": "/c"}\n')
+
+        self.wait_for("parked", 2)
+        metrics = self.server.metrics()
+        self.assertEqual(metrics["workers"], 1)
+        self.assertEqual(metrics["active"], 0)
+        self.assertEqual(metrics["queued"], 0)
+        self.assertEqual(metrics["connections"], 2)
+
+        # pipelined requests are served from the buffered bytes
+        a.sendall(b"GET /d HTTP/1.1\r\n\r\nGET /e HTTP/1.1\r\n\r\n")
+        data = b""
+        while data.count(b"path") < 2:
+            data += a.recv(4096)
+        self.assertLess(data.index(b"/d"), data.index(b"/e"))
+
+    def test_max_per_ip(self):
+
+        sockets = [self.connect() for i in range(4)]
+        self.wait_for("rejected", 1)
+        self.assertEqual(self.server.metrics()["connections"], 3)
+
+        # the extra connection is closed
+        self.assertEqual(sockets[3].recv(4096), b"")
+
+        # closing a connection allows a new one
+        sockets[0].close()
+        self.wait_for("connections", 2)
+        sock = self.connect()
+        self.assertEqual(get(sock, b"/a")[0], b"HTTP/1.1 200 OK")
+
+    def test_idle_timeout(self):
+
+        sock = self.connect()
+        self.assertEqual(get(sock, b"/a")[0], b"HTTP/1.1 200 OK")
+        self.wait_for("connections", 1)
+        # the server closes the connection after the idle timeout
+        self.assertEqual(sock.recv(4096), b"")
+        self.wait_for("connections", 0)
+
+    def test_header_timeout(self):
+
+        # a client sending the headers a byte at a time is closed
+        # after the idle timeout, even though it is never idle
+        sock = self.connect()
+        sock.settimeout(0.2)
+        sock.sendall(b"GET /a HTTP/1.1\r\n")
+        t0 = time.monotonic()
+        closed = False
+        while not closed and time.monotonic() - t0 < 5.0:
+            try:
+                sock.sendall(b"X")
+                closed = sock.recv(4096) == b""
+            except socket.timeout:
+                pass
+            except OSError:
+                closed = True
+        self.assertTrue(closed)
+        self.assertLess(time.monotonic() - t0, 2.0)
+
+        # the worker is available for other clients
+        self.assertEqual(get(self.connect(), b"/b")[0], b"HTTP/1.1 200 OK")
+
+    def read_all(self, sock):
+        data = b""
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                return data
+            data += chunk
+
+    def test_partial_body(self):
+
+        # an upload rejected part way through closes the connection
+        body = b"GET /b HTTP/1.1\r\n\r\n"
+        for header, payload in [
+                (b"Content-Length: %d" % (len(body) + 8), b"01234567" + body),
+                (b"Transfer-Encoding: chunked",
+                    b"8\r\n01234567\r\n%X\r\n%s\r\n0\r\n\r\n" % (
+                        len(body), body))]:
+            sock = self.connect()
+            sock.sendall(b"POST /quota HTTP/1.1\r\n%s\r\n\r\n%s" % (
+                header, payload))
+            data = self.read_all(sock)
+            self.assertTrue(data.startswith(b"HTTP/1.1 413"))
+            self.assertIn(b"Connection: close", data)
+            self.assertNotIn(b"/b", data)
+
+    def test_unread_body(self):
+
+        # the endpoint responds without reading the body, which must
+        # not be read as the next request
+        body = b"GET /b HTTP/1.1\r\n\r\n"
+        sock = self.connect()
+        sock.sendall(b"POST /a HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (
+            len(body), body))
+        data = self.read_all(sock)
+        self.assertIn(b"Connection: close", data)
+        self.assertEqual(data.count(b"HTTP/1.1 200 OK"), 1)
+        self.assertNotIn(b"/b", data)
+
+def main():
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(PooledTCPServerTestCase)
+    unittest.TextTestRunner().run(suite)
+
+if __name__ == '__main__':
+    main()
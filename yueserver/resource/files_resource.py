@@ -13,7 +13,7 @@ from ..dao.util import parse_iso_format, pathCorrectCase
 from ..dao.storage import StorageNotFoundException, CryptMode
 from ..dao.filesys.filesys import MemoryFileSystemImpl
 from ..dao.filesys.crypt import validatekey, FileDecryptorReader, decryptkey
-from ..service.exception import FileSysServiceException
+from ..service.exception import FileSysServiceException, FileSysPreviewPending
 from ..dao.settings import Settings, SettingsDao
 from ..dao.image import ImageScale, scale_image_stream
 
@@ -138,13 +138,16 @@ def _list_path(service, root, path, list_=False, password=None, preview=None, dl
             _, name = service.fs.split(info.file_path)
             # todo: return a object containing size and path?
             # table: file_id, preview_mode, preview_url, preview_size
-            # TODO: investigate this method, previewFile
-            # it is causing a significant amount of request latency
-            # even when the preview already exists
-            url = service.previewFile(g.current_user,
-                root, path, preview, password)
+            try:
+                previewInfo = service.previewFile(g.current_user,
+                    root, path, preview, password)
+            except FileSysPreviewPending:
+                return jsonify(result="pending"), 202, {'Retry-After': '1'}
 
-            stream = service.fs.open(url, "rb")
+            if previewInfo is None:
+                return httpError(422, "Transcode Error")
+
+            stream = service.fs.open(previewInfo.path, "rb")
             if info.encryption in (CryptMode.server, CryptMode.system):
                 if not password and info.encryption == CryptMode.server:
                     return httpError(400, "Invalid Password")
@@ -359,6 +362,7 @@ class FilesResource(WebResource):
     @param("permission", type_=Integer().default(0o644).description("unix file permissions"))
     @param("version", type_=Integer().default(0).description("file version"))
     @param("crypt", type_=validate_mode)
+    @param("hash", type_=String().default(None).description("sha256 of the file contents"))
     @header("X-YUE-PASSWORD")
     @body(BinaryStreamOpenApiBody(),
           content_type="application/octet-stream")
@@ -370,8 +374,11 @@ class FilesResource(WebResource):
         mtime: on a successful upload, set the modified time to mtime,
                unix epoch time in seconds
         version: if greater than 1, validate version
+        hash: the sha256 of the file contents, as a hex string. The body
+              is not read if the contents are already stored.
 
         error codes:
+            400: the contents do not match the hash
             409: file already exists and is a newer version
         """
 
@@ -394,7 +401,8 @@ class FilesResource(WebResource):
         data = self.filesys_service.saveFile(
             g.current_user, root, resPath, stream,
             mtime=g.args.mtime, version=g.args.version,
-            permission=g.args.permission, encryption=g.args.crypt)
+            permission=g.args.permission, encryption=g.args.crypt,
+            content_hash=g.args.hash)
 
         return jsonify(result="OK", file_info=data)
 
@@ -6,6 +6,7 @@ import time
 
 from ..dao.db import main_test
 from ..dao.filesys.filesys import FileSystem, MemoryFileSystemImpl
+from ..dao.storage_usage import UsageLedger
 from ..dao.filesys.crypt import FileDecryptorReader, cryptkey
 from ..app import TestApp
 
@@ -36,6 +37,9 @@ class FilesResourceTestCase(unittest.TestCase):
         super().setUp()
 
         self.db.delete(self.db.tables.FileSystemStorageTable)
+        self.db.delete(self.db.tables.FileSystemDirectoryTable)
+        self.db.delete(self.db.tables.FileSystemUserUsageTable)
+        UsageLedger.instance(self.db, self.db.tables).clear()
 
     def tearDown(self):
         super().tearDown()
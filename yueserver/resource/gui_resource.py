@@ -9,6 +9,7 @@ from ..framework.web_resource import WebResource, \
     int_range, int_min, send_generator, null_validator, boolean
 
 from ..dao.storage import StorageNotFoundException, CryptMode
+from ..service.exception import FileSysPreviewPending
 
 from .gui.pages import AppPage, Palette
 from .gui.exception import AuthenticationError, LibraryException
@@ -435,9 +436,16 @@ class AudioGuiResource(GuiAppResource):
         #---
         if g.args.preview is not None:
             _, name = self.fileService.fs.split(info.file_path)
-            url = self.fileService.previewFile(user,
-                root, path, g.args.preview, password)
-            stream = self.fileService.fs.open(url, "rb")
+            try:
+                previewInfo = self.fileService.previewFile(user,
+                    root, path, g.args.preview, password)
+            except FileSysPreviewPending:
+                return jsonify(result="pending"), 202, {'Retry-After': '1'}
+
+            if previewInfo is None:
+                return httpError(422, "Transcode Error")
+
+            stream = self.fileService.fs.open(previewInfo.path, "rb")
             if info.encryption in (CryptMode.server, CryptMode.system):
                 if not password and info.encryption == CryptMode.server:
                     return httpError(400, "Invalid Password")
@@ -197,8 +197,22 @@ class LibraryResource(WebResource):
     @requires_auth("library_read")
     @compressed
     def get_domain_info(self):
+
+        version = self.audio_service.getDomainSongUserInfoVersion(
+            g.current_user)
+
+        if version is None:
+            data = self.audio_service.getDomainSongUserInfo(g.current_user)
+            return jsonify(result=data)
+
+        ETag = '"%s"' % version
+        if request.headers.get('If-None-Match', None) == ETag:
+            return "", 304, {'ETag': ETag}
+
         data = self.audio_service.getDomainSongUserInfo(g.current_user)
-        return jsonify(result=data)
+        response = jsonify(result=data)
+        response.headers['ETag'] = ETag
+        return response
 
     @get("ref/<ref_id>")
     @requires_auth("library_read")
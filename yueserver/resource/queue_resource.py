@@ -10,7 +10,6 @@ from flask import jsonify, render_template, g, request, send_file
 
 from ..dao.library import Song
 from ..dao.util import parse_iso_format, pathCorrectCase
-from ..dao.shuffle import binshuffle
 
 from ..framework.web_resource import WebResource, \
     get, post, put, delete, compressed, httpError, param, body, \
@@ -62,16 +61,22 @@ class QueueResource(WebResource):
         if g.args.query is None:
             g.args.query = self.audio_service.defaultQuery(g.current_user)
 
-        songs = self.audio_service.search(g.current_user, g.args.query)
-
         # TODO: have role based limits on queue size
-        songs = binshuffle(songs, lambda x: x['artist'])[:g.args.limit]
-
-        song_ids = [song['id'] for song in songs]
-        self.audio_service.setQueue(g.current_user, song_ids)
+        songs = self.audio_service.createQueue(g.current_user,
+            g.args.query, g.args.limit)
 
         return jsonify(result=songs)
 
+    @post("next")
+    @body(EmptyBodyOpenApiBody())
+    @requires_auth("user_write")
+    def next_queue(self):
+        """ remove the head of the queue and return the next song """
+
+        song = self.audio_service.queueNext(g.current_user)
+
+        return jsonify(result=song)
+
     @get("query")
     @requires_auth("user_read")
     def get_default_queue(self):
@@ -11,6 +11,7 @@ from uuid import UUID
 
 from ..dao.util import parse_iso_format
 from ..dao.library import Song
+from ..dao.filesys.transfer import iter_chunks
 from ..dao.exception import BackendException
 
 from ..service.exception import ServiceException
@@ -286,25 +287,20 @@ class UUIDOpenApiBody(object):
 uuid_validator = UUIDOpenApiBody()
 uuid_list_validator = ArrayOpenApiBody(uuid_validator)
 
-def files_generator(fs, filepath, buffer_size=2048):
+def files_generator(fs, filepath, buffer_size=None):
 
     with fs.open(filepath, "rb") as rb:
-        buf = rb.read(buffer_size)
-        while buf:
-            yield buf
-            buf = rb.read(buffer_size)
+        yield from iter_chunks(rb, buffer_size)
 
-def files_generator_v2(stream, buffer_size=2048):
+def files_generator_v2(stream, buffer_size=None):
 
     count = 0
     success = False
     start = time.time()
     try:
-        buf = stream.read(buffer_size)
-        while buf:
+        for buf in iter_chunks(stream, buffer_size):
             count += len(buf)
             yield buf
-            buf = stream.read(buffer_size)
         success = True
     except BaseException:
         logging.exception("exception while streaming data")
@@ -32,6 +32,7 @@ class AppResource(Resource):
 
         self.config = None
         self.db = None
+        self.site = None
 
     @get("/health")
     @requires_no_auth
@@ -51,6 +52,10 @@ class AppResource(Resource):
             "server": server_health()
         }
 
+        if self.site is not None:
+            # queue depth and active workers, when using a worker pool
+            result["http"] = self.site.metrics()
+
         return Response(200, {}, {"result": result})
 
     @get("/robots.txt")
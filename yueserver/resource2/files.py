@@ -18,8 +18,10 @@ import time
 import mimetypes
 import json
 import logging
+import struct
 
-from yueserver.framework2.server_core import Response, send_file, send_generator
+from yueserver.framework2.server_core import Response, send_file, send_generator, \
+    send_range, copy_payload
 
 from yueserver.framework2.openapi import Resource, \
     get, put, post, delete, \
@@ -40,7 +42,7 @@ from ..dao.util import parse_iso_format, pathCorrectCase
 from ..dao.storage import StorageNotFoundException, CryptMode
 from ..dao.filesys.filesys import MemoryFileSystemImpl
 from ..dao.filesys.crypt import validatekey, FileDecryptorReader, decryptkey
-from ..service.exception import FileSysServiceException
+from ..service.exception import FileSysServiceException, FileSysPreviewPending
 from ..dao.settings import Settings, SettingsDao
 from ..dao.image import ImageScale, scale_image_stream
 
@@ -108,6 +110,18 @@ class MoveFileOpenApiBody(JsonOpenApiBody):
 
         return model
 
+class PreviewBatchOpenApiBody(JsonOpenApiBody):
+
+    def model(self):
+
+        model = {
+            "paths": {"type": "array", "items": {"type": "string"}},
+            "path": {"type": "string"},
+            "offset": {"type": "integer"},
+        }
+
+        return model
+
 class NotesOpenApiBody(JsonOpenApiBody):
 
     def model(self):
@@ -118,6 +132,9 @@ class NotesOpenApiBody(JsonOpenApiBody):
         return model
 
 
+# the maximum number of files in a single preview request
+MAX_PREVIEW_BATCH = 500
+
 def validate_key(body):
     """read the response body and decode the encryption key
     validate that the key is well formed
@@ -129,6 +146,49 @@ def validate_key(body):
     text = body.read().decode('utf-8')
     return validatekey(text)
 
+def _send_preview(request, service, root, path, preview, entry, password=None, dl=True):
+    """ returns the response for a preview of a file
+
+    entry: the cached preview of the file
+    """
+
+    # cache control for preview files
+    # check the incoming request to see if the file has changed
+    ETag = "%s:%s" % (path, str(entry.version))
+    if 'If-None-Match' in request.headers:
+        if request.headers['If-None-Match'] == ETag:
+            return Response(304)
+
+    if entry.encryption in (CryptMode.server, CryptMode.system):
+        if not password and entry.encryption == CryptMode.server:
+            return Response(400, {}, {"error": "Invalid Password"})
+
+    _, name = service.fs.split(entry.file_path)
+    name = '%s.%s.png' % (name, preview)
+
+    headers = {
+        'Cache-Control': 'max-age=31536000',
+        'ETag': ETag,
+        'X-YUE-ROOT': root,
+        'X-YUE-PATH': path,
+    }
+
+    payload = service.previewContent(request.current_user, entry, password)
+    headers['Content-Length'] = str(entry.size)
+
+    mimetype, encoding = mimetypes.guess_type(name)
+    if not mimetype:
+        mimetype = 'application/octet-stream'
+    headers['Content-Type'] = mimetype
+    if encoding:
+        headers['Content-Encoding'] = encoding
+
+    mode = "attachment" if dl else "inline"
+    mode += "; filename=%s" % (json.dumps(name))
+    headers['Content-Disposition'] = mode
+
+    return Response(200, headers, payload)
+
 def _list_path(request, service, root, path, list_=False, password=None, preview=None, dl=True):
     # TODO: move this into the service layer
     #       the argument against is it still depends on some framework features
@@ -137,6 +197,15 @@ def _list_path(request, service, root, path, list_=False, password=None, preview
     # it should contain the base64 encoded password for the user
     # use this to decrypt the file
 
+    if preview and not list_:
+        # a preview which has been served before is returned
+        # without querying the database
+        entry = service.previewCached(request.current_user,
+            root, path, preview)
+        if entry is not None:
+            return _send_preview(request, service, root, path, preview,
+                entry, password, dl)
+
     abs_path = service.getFilePath(request.current_user, root, path)
 
     isFile = False
@@ -156,65 +225,24 @@ def _list_path(request, service, root, path, list_=False, password=None, preview
             return Response(200, {}, {"result": result})
         elif preview:
 
-            # cache control for preview files
-            # check the incoming request to see if the file has changed
+            # the preview has not changed if the file has not changed
             ETag = "%s:%s" % (path, str(info.version))
             if 'If-None-Match' in request.headers:
                 if request.headers['If-None-Match'] == ETag:
                     return Response(304)
 
-            _, name = service.fs.split(info.file_path)
-            # todo: return a object containing size and path?
-            # table: file_id, preview_mode, preview_url, preview_size
-            # TODO: investigate this method, previewFile
-            # it is causing a significant amount of request latency
-            # even when the preview already exists
-            previewInfo = service.previewFile(request.current_user,
-                root, path, preview, password)
-
-            if previewInfo is None:
-                return Response(422, {}, {"error": "Transcode Error"})
-
-            #stream = service.fs.open(url, "rb")
-            #if info.encryption in (CryptMode.server, CryptMode.system):
-            #    if not password and info.encryption == CryptMode.server:
-            #        return Response(400, {}, {"error": "Invalid Password"})
-            #    stream = service.decryptStream(request.current_user,
-            #            password, stream, "r", info.encryption)
-            #go = files_generator_v2(stream)
-            headers = {
-                'Cache-Control': 'max-age=31536000',
-                'ETag': ETag,
-                'X-YUE-ROOT': root,
-                'X-YUE-PATH': path,
-            }
-            name = '%s.%s.png' % (name, preview)
+            try:
+                entry = service.previewFile(request.current_user,
+                    root, path, preview, password)
+            except FileSysPreviewPending:
+                return Response(202, {'Retry-After': '1'},
+                    {"result": "pending"})
 
-            if info.encryption in (CryptMode.server, CryptMode.system):
-                if not password and info.encryption == CryptMode.server:
-                    return Response(400, {}, {"error": "Invalid Password"})
-
-            info.storage_path = previewInfo.path
-
-            callback = service.downloadFileFromInfo(request.current_user, info, password)
-            #headers['Transfer-Encoding'] = "chunked"
-            headers['Content-Length'] = str(previewInfo.size)
-
-            mimetype, encoding = mimetypes.guess_type(name)
-            if not mimetype:
-                mimetype = 'application/octet-stream'
-            headers['Content-Type'] = mimetype
-            if encoding:
-                headers['Content-Encoding'] = encoding
-
-            mode = "attachment" if dl else "inline"
-            mode += "; filename=%s" % (json.dumps(name))
-            headers['Content-Disposition'] = mode
-
-            return Response(200, headers, callback)
+            if entry is None:
+                return Response(422, {}, {"error": "Transcode Error"})
 
-            #return send_generator(go, name,
-            #    file_size=None, headers=headers, attachment=dl)
+            return _send_preview(request, service, root, path, preview,
+                entry, password, dl)
         else:
             ETag = "%s:%s" % (path, str(info.version))
             if 'If-None-Match' in request.headers:
@@ -245,9 +273,9 @@ def _list_path(request, service, root, path, list_=False, password=None, preview
                 if not password and info.encryption == CryptMode.server:
                     return Response(400, {}, {"error": "Invalid Password"})
 
-            callback = service.downloadFileFromInfo(request.current_user, info, password)
-            #headers['Transfer-Encoding'] = "chunked"
-            headers['Content-Length'] = str(info.size)
+            def download(offset, length):
+                return service.downloadFileFromInfo(request.current_user,
+                    info, password, offset, length)
 
             mimetype, encoding = mimetypes.guess_type(name)
             if not mimetype:
@@ -260,7 +288,10 @@ def _list_path(request, service, root, path, list_=False, password=None, preview
             mode += "; filename=%s" % (json.dumps(name))
             headers['Content-Disposition'] = mode
 
-            return Response(200, headers, callback)
+            # seeking in audio or video requests part of the file
+            return send_range(headers, info.size, download,
+                request.headers.get('Range', None),
+                request.headers.get('If-Range', None), ETag, info.mtime)
             #return send_generator(go, name,
             #    file_size=None, headers=headers, attachment=dl)
 
@@ -306,6 +337,8 @@ class FileSysResource(Resource):
     @param("preview", type_=ImageScaleType().description(
         "return a preview picture of the resource"))
     @header("X-YUE-PASSWORD")
+    @header("Range")
+    @header("If-Range")
     @requires_auth("filesystem_read")
     @param("dl", type_=Boolean().default(True))
     @returns({200: BinaryStreamResponseOpenApiBody()})
@@ -322,6 +355,94 @@ class FileSysResource(Resource):
             preview=request.query.preview,
             dl=request.query.dl)
 
+    @post("/api/fs/:root/preview")
+    @param("scale", type_=ImageScaleType().required().description(
+        "the size of the previews"))
+    @header("X-YUE-PASSWORD")
+    @body(PreviewBatchOpenApiBody())
+    @requires_auth("filesystem_read")
+    @timed(100)
+    def get_preview_batch(self, request):
+        """
+        return the previews of a list of files, or of the files in a directory
+
+        the body contains either a list of `paths`, or the `path` of a
+        directory. previews which do not exist are generated in the
+        background, and can be requested again later.
+
+        at most MAX_PREVIEW_BATCH files of a directory are returned,
+        starting at the `offset` given in the body. when there may be
+        more files the index contains the `next` offset.
+
+        the response is a 4 byte big-endian length, followed by a json
+        index of that many bytes, followed by the content of every preview
+        which is ready. the index contains, for each file, the path and
+        the status: 'ok', 'pending' or 'error'. for previews which are
+        ready the index contains the version of the file, and the offset
+        and size of the preview in the content following the index.
+        """
+
+        paths = request.body.get('paths', None)
+        directory = request.body.get('path', None)
+
+        if paths is None and directory is None:
+            return Response(400, {}, {"error": "expected paths or path"})
+
+        if paths is not None and len(paths) > MAX_PREVIEW_BATCH:
+            return Response(400, {}, {"error": "too many paths"})
+
+        limit = None
+        offset = None
+        if paths is None:
+            limit = MAX_PREVIEW_BATCH
+            offset = request.body.get('offset', None) or 0
+            if not isinstance(offset, int) or offset < 0:
+                return Response(400, {}, {"error": "invalid offset"})
+
+        password = request.headers.get('X-YUE-PASSWORD', None)
+
+        results = self.filesys_service.previewBatch(request.current_user,
+            request.args.root, request.query.scale,
+            paths=paths, directory=directory, password=password,
+            limit=limit, offset=offset)
+
+        files = []
+        entries = []
+        offset = 0
+        for path, status, entry in results:
+            item = {"path": path, "status": status}
+            if entry is not None:
+                item.update({
+                    "version": entry.version,
+                    "offset": offset,
+                    "size": entry.size,
+                    "width": entry.width,
+                    "height": entry.height,
+                })
+                offset += entry.size
+                entries.append(entry)
+            files.append(item)
+
+        index = {"files": files}
+        if limit is not None and len(files) == limit:
+            index["next"] = offset + limit
+
+        index = json.dumps(index).encode("utf-8")
+        header = struct.pack(">I", len(index)) + index
+
+        def write_previews(writer):
+            writer.write(header)
+            for entry in entries:
+                copy_payload(self.filesys_service.previewContent(
+                    request.current_user, entry, password), writer)
+
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "Content-Length": str(len(header) + offset),
+        }
+
+        return Response(200, headers, write_previews)
+
     @get("/api/fs/public/:fileId/:name")
     @param("dl", type_=Boolean().default(True))
     @param("info", type_=Boolean().default(False))
@@ -446,6 +567,7 @@ class FileSysResource(Resource):
     @param("permission", type_=Integer().default(0o644).description("unix file permissions"))
     @param("version", type_=Integer().default(0).description("file version"))
     @param("crypt", type_=validate_mode)
+    @param("hash", type_=String().default(None).description("sha256 of the file contents"))
     @header("X-YUE-PASSWORD")
     @body(BinaryStreamOpenApiBody())
     @requires_auth("filesystem_write")
@@ -456,8 +578,11 @@ class FileSysResource(Resource):
         mtime: on a successful upload, set the modified time to mtime,
                unix epoch time in seconds
         version: if greater than 1, validate version
+        hash: the sha256 of the file contents, as a hex string. The body
+              is not read if the contents are already stored.
 
         error codes:
+            400: the contents do not match the hash
             409: file already exists and is a newer version
         """
 
@@ -478,7 +603,8 @@ class FileSysResource(Resource):
             mtime=request.query.mtime,
             version=request.query.version,
             permission=request.query.permission,
-            encryption=request.query.crypt)
+            encryption=request.query.crypt,
+            content_hash=request.query.hash)
 
         obj = {
             "result": "OK",
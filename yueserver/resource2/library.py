@@ -1,11 +1,15 @@
 import os
 import sys
 import logging
+import json
+import mimetypes
+import zlib
 
 from calendar import timegm
 import time
 
-from yueserver.framework2.server_core import Response, send_file, send_generator
+from yueserver.framework2.server_core import Response, send_file, send_generator, \
+    send_range
 
 from yueserver.framework2.openapi import Resource, \
     get, put, post, delete, \
@@ -19,10 +23,12 @@ from yueserver.framework2.openapi import Resource, \
 from yueserver.framework2.security import requires_no_auth, requires_auth, \
     register_handler, register_security, ExceptionHandler
 
-from .util import files_generator, files_generator_v2, DateTimeType, ImageScaleType
+from .util import files_generator, files_generator_v2, files_payload, \
+    DateTimeType, ImageScaleType
 
 
 from ..dao.library import Song, LibraryException
+from ..dao.search import ParseError
 from ..dao.util import pathCorrectCase
 from ..service.transcode_service import ImageScale
 from ..service.exception import AudioServiceException
@@ -153,22 +159,86 @@ class LibraryResource(Resource):
     @param("query", type_=String().default(None))
     @param("limit", type_=Integer().min(0).max(5000).default(50))
     @param("last_id", type_=String().default(None))
+    @param("orderby", type_=SearchOrderType().default(None))
+    @param("token", type_=String().default(None))
     @param("showBanished", type_=Boolean().default(False))
     @requires_auth("library_read")
     @compressed
     def paginate_library(self, request):
-        """ return song information from the library """
+        """ return song information from the library
 
-        songs = self.audio_service.paginate(request.current_user,
-            request.query.query, limit=request.query.limit,
-            last_id=request.query.last_id,
-            showBanished=request.query.showBanished)
+        the response contains a token which is used to request the next
+        page of results. the token is null after the last page. The
+        query and orderby must not change between requests.
+
+        last_id is deprecated. when given, results are ordered by id
+        and no token is returned.
+        """
+
+        if request.query.last_id is not None:
+            songs = self.audio_service.paginate(request.current_user,
+                request.query.query, limit=request.query.limit,
+                last_id=request.query.last_id,
+                showBanished=request.query.showBanished)
+
+            return Response(200, {}, {"result": songs})
+
+        try:
+            songs, token = self.audio_service.seek(request.current_user,
+                request.query.query, limit=request.query.limit,
+                orderby=request.query.orderby,
+                token=request.query.token,
+                showBanished=request.query.showBanished)
+        except (LibraryException, ParseError) as e:
+            return Response(400, {}, {"error": "%s" % e})
 
         obj = {
             "result": songs,
+            "token": token,
         }
         return Response(200, {}, obj)
 
+    @get("/api/library/stream")
+    @param("query", type_=String().default(None))
+    @param("orderby", type_=SearchOrderType().default(Song.artist_key))
+    @param("showBanished", type_=Boolean().default(False))
+    @requires_auth("library_read")
+    def stream_library(self, request):
+        """ return every song matching the query
+
+        the response has the same form as a search, but songs are
+        sent as they are read from the database instead of all at once.
+        """
+
+        if request.query.orderby == "random":
+            return Response(400, {}, {"error": "random order can not be streamed"})
+
+        # the query is parsed before the response is sent
+        try:
+            songs = self.audio_service.stream(request.current_user,
+                request.query.query, orderby=request.query.orderby,
+                showBanished=request.query.showBanished)
+        except (LibraryException, ParseError) as e:
+            return Response(400, {}, {"error": "%s" % e})
+
+        def go(chunk_size=64 * 1024):
+            buf = [b'{"result": [']
+            size = 0
+            sep = b''
+            for song in songs:
+                data = sep + json.dumps(song).encode("utf-8")
+                buf.append(data)
+                size += len(data)
+                sep = b','
+                if size > chunk_size:
+                    yield b''.join(buf)
+                    buf = []
+                    size = 0
+            buf.append(b']}')
+            yield b''.join(buf)
+
+        return send_generator(go(), "library.json")
+
     @get("/api/library/forest")
     @param("query", type_=String().default(None))
     @param("showBanished", type_=Boolean().default(False))
@@ -213,11 +283,23 @@ class LibraryResource(Resource):
 
 
     @get("/api/library/info")
+    @header("If-None-Match")
     @requires_auth("library_read")
     @compressed
     def get_domain_info(self, request):
+
+        headers = {}
+        version = self.audio_service.getDomainSongUserInfoVersion(
+            request.current_user)
+
+        if version is not None:
+            ETag = '"%s"' % version
+            if request.headers.get('If-None-Match', None) == ETag:
+                return Response(304, {'ETag': ETag})
+            headers['ETag'] = ETag
+
         data = self.audio_service.getDomainSongUserInfo(request.current_user)
-        return Response(200, {}, {"result": data})
+        return Response(200, headers, {"result": data})
 
     @get("/api/library/ref/:ref_id")
     @requires_auth("library_read")
@@ -255,6 +337,8 @@ class LibraryResource(Resource):
     @param("mode", type_=audio_format)
     @param("quality", type_=audio_quality)
     @param("layout", type_=audio_channels)
+    @header("Range")
+    @header("If-Range")
     @requires_auth("library_read_song")
     def get_song_audio(self, request):
 
@@ -282,10 +366,37 @@ class LibraryResource(Resource):
             if go is not None:
                 return send_generator(go, name)
 
-        size = song[Song.file_size] or None
-        _, name = self.audio_service.fs.split(path)
-        go = files_generator(self.audio_service.fs, path)
-        return send_generator(go, name, file_size=size)
+        fs = self.audio_service.fs
+        _, name = fs.split(path)
+
+        # the song record stores the size of the file, so the storage
+        # is only queried for songs added before the size was recorded.
+        # setting a new file for the song changes the path
+        size = song.get(Song.file_size)
+        mtime = None
+        if size:
+            version = zlib.crc32(path.encode("utf-8"))
+        else:
+            record = fs.file_info(path)
+            size, mtime = record.size, record.mtime
+            version = mtime
+
+        ETag = "%s:%d:%d" % (song[Song.id], size, version)
+
+        mimetype, _ = mimetypes.guess_type(name)
+        headers = {
+            'ETag': ETag,
+            'Content-Type': mimetype or 'application/octet-stream',
+            'Content-Disposition': "inline; filename=%s" % json.dumps(name),
+        }
+
+        def download(offset, length):
+            return files_payload(fs, path, offset, length)
+
+        # seeking in the audio player requests part of the file
+        return send_range(headers, size, download,
+            request.headers.get('Range', None),
+            request.headers.get('If-Range', None), ETag, mtime)
 
     @post("/api/library/:song_id/audio")
     @body(SongResourcePathOpenApiBody())
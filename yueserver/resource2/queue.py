@@ -18,7 +18,6 @@ from yueserver.framework2.security import requires_no_auth, requires_auth, \
 
 from ..dao.library import Song
 from ..dao.util import parse_iso_format, pathCorrectCase
-from ..dao.shuffle import binshuffle
 
 from .util import requires_auth, search_order_validator, \
     uuid_validator, uuid_list_validator
@@ -67,16 +66,22 @@ class QueueResource(Resource):
         if request.query.query is None:
             request.query.query = self.audio_service.defaultQuery(request.current_user)
 
-        songs = self.audio_service.search(request.current_user, request.query.query)
-
         # TODO: have role based limits on queue size
-        songs = binshuffle(songs, lambda x: x['artist'])[:request.query.limit]
-
-        song_ids = [song['id'] for song in songs]
-        self.audio_service.setQueue(request.current_user, song_ids)
+        songs = self.audio_service.createQueue(request.current_user,
+            request.query.query, request.query.limit)
 
         return Response(200, {}, {"result": songs})
 
+    @post("/api/queue/next")
+    @body(EmptyBodyOpenApiBody())
+    @requires_auth("user_write")
+    def next_queue(self, request):
+        """ remove the head of the queue and return the next song """
+
+        song = self.audio_service.queueNext(request.current_user)
+
+        return Response(200, {}, {"result": song})
+
     @get("/api/queue/query")
     @requires_auth("user_read")
     def get_default_queue(self, request):
@@ -9,6 +9,7 @@ from ..framework2.server import Response
 
 from ..dao.util import parse_iso_format
 from ..dao.library import Song
+from ..dao.filesys.transfer import iter_chunks
 
 from ..framework2.openapi import ArrayOpenApiBody, OpenApiParameter
 
@@ -234,25 +235,38 @@ class UUIDOpenApiBody(object):
 uuid_validator = UUIDOpenApiBody()
 uuid_list_validator = ArrayOpenApiBody(uuid_validator)
 
-def files_generator(fs, filepath, buffer_size=2048):
+def files_generator(fs, filepath, buffer_size=None):
 
     with fs.open(filepath, "rb") as rb:
-        buf = rb.read(buffer_size)
-        while buf:
-            yield buf
-            buf = rb.read(buffer_size)
+        yield from iter_chunks(rb, buffer_size)
+
+def files_payload(fs, filepath, offset=0, length=None):
+    """ returns a response payload for part of a file
+
+    local files are returned as an open file, which allows for the
+    file to be sent using sendfile
+    """
+
+    if fs.islocal(filepath):
+        stream = fs.open(filepath, "rb")
+        if offset:
+            stream.seek(offset)
+        return stream
+
+    def callback(writer):
+        fs.download(filepath, writer, offset, length)
+
+    return callback
 
-def files_generator_v2(stream, buffer_size=2048):
+def files_generator_v2(stream, buffer_size=None):
 
     count = 0
     success = False
     start = time.time()
     try:
-        buf = stream.read(buffer_size)
-        while buf:
+        for buf in iter_chunks(stream, buffer_size):
             count += len(buf)
             yield buf
-            buf = stream.read(buffer_size)
         success = True
     except BaseException:
         logging.exception("exception while streaming data")
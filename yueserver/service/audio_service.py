@@ -6,12 +6,12 @@ as well as update metadata and statistics
 """
 import os, sys
 import logging
+import time
 
 from ..dao.user import UserDao
 from ..dao.library import LibraryDao, Song
 from ..dao.queue import SongQueueDao
 from ..dao.history import HistoryDao
-from ..dao.shuffle import binshuffle
 from ..dao.storage import StorageDao, StorageNotFoundException
 from ..dao.filesys.filesys import FileSystem
 
@@ -31,8 +31,12 @@ class AudioService(object):
         self.dbtables = dbtables
 
         self.userDao = UserDao(db, dbtables)
-        self.libraryDao = LibraryDao(db, dbtables)
-        self.queueDao = SongQueueDao(db, dbtables)
+        self.libraryDao = LibraryDao(db, dbtables,
+            index=config.library.index,
+            summary=config.library.summary)
+        self.queueDao = SongQueueDao(db, dbtables,
+            library=self.libraryDao,
+            cache=config.library.queue_cache)
         self.historyDao = HistoryDao(db, dbtables)
         self.storageDao = StorageDao(db, dbtables)
         self.fs = FileSystem()
@@ -185,23 +189,22 @@ class AudioService(object):
         query results are restricted by the users domain and role
         """
 
-        shuffle = False
-        limit_save = limit
+        logging.info("search library limit=%s offset=%s showBanished=%r", limit, offset, showBanished)
+
         if orderby == "random":
-            orderby = None
-            shuffle = True
-            limit = None
+            # sample the song ids, then only fetch the songs returned
+            song_ids = self.libraryDao.sample(
+                user['id'], user['domain_id'],
+                searchTerm, limit, showBanished=showBanished)
 
-        logging.info("search library limit=%d offset=%d showBanished=%r", limit, offset, showBanished)
+            return self.libraryDao.findSongsById(
+                user['id'], user['domain_id'], song_ids)
 
         result = self.libraryDao.search(
             user['id'], user['domain_id'],
             searchTerm, case_insensitive,
             orderby, limit, offset, showBanished)
 
-        if shuffle:
-            result = binshuffle(result, lambda s: s['artist'])[:limit_save]
-
         return result
 
     def paginate(self, user, searchTerm,
@@ -221,6 +224,39 @@ class AudioService(object):
 
         return result
 
+    def seek(self, user, searchTerm,
+        case_insensitive=True,
+        orderby=None,
+        limit=50,
+        token=None,
+        showBanished=False):
+        """ query the library and return a page of songs
+
+        returns a tuple (songs, token). the token is used to request the
+        next page, and is None when there are no more results.
+
+        query results are restricted by the users domain and role
+        """
+
+        return self.libraryDao.seek(
+            user['id'], user['domain_id'],
+            searchTerm, case_insensitive,
+            orderby, limit, token, showBanished)
+
+    def stream(self, user, searchTerm,
+        case_insensitive=True,
+        orderby=None,
+        showBanished=False):
+        """ query the library and return a generator of songs
+
+        query results are restricted by the users domain and role
+        """
+
+        return self.libraryDao.stream(
+            user['id'], user['domain_id'],
+            searchTerm, case_insensitive,
+            orderby, showBanished)
+
     def search_forest(self, user,
         searchTerm,
         case_insensitive=True,
@@ -366,6 +402,14 @@ class AudioService(object):
         """
         return self.libraryDao.domainSongUserInfo(user['id'], user['domain_id'])
 
+    def getDomainSongUserInfoVersion(self, user):
+        """
+        return a string which changes whenever the domain info for the
+        user changes, or None if the version is not known
+        """
+        return self.libraryDao.domainSongUserInfoVersion(
+            user['id'], user['domain_id'])
+
     def getQueue(self, user):
         """ return the list of songs (not song ids) from a users queue """
         return self.queueDao.get(user['id'], user['domain_id'])
@@ -384,8 +428,25 @@ class AudioService(object):
         return self.queueDao.rest(user['id'], user['domain_id'])
 
     def queueNext(self, user):
-        """pop the head element and return the next song"""
-        pass
+        """pop the head element and return the next song
+
+        the queue is populated using the default query once it is empty
+        """
+        song = self.queueDao.next(user['id'], user['domain_id'])
+
+        if song is None:
+            songs = self.populateQueue(user)
+            song = songs[0] if songs else None
+
+        return song
+
+    def pushQueue(self, user, song_ids, index=None):
+        """ insert songs into the queue, by default at the end
+
+        returns the length of the queue
+        """
+        return self.queueDao.push(user['id'], user['domain_id'],
+            song_ids, index)
 
     def defaultQuery(self, user):
         """ retrieve the current default query used by the user
@@ -401,22 +462,30 @@ class AudioService(object):
         """
         use the default query to add new songs to the queue
         """
-        songs = self.queueDao.get(user['id'], user['domain_id'])
-
-        query = self.defaultQuery(user)
 
         # TODO: have role based limits on queue size
         limit = 50
 
-        new_songs = self.search(user,
-            query, limit=limit, orderby=Song.random)
+        def sample(query, count, exclude):
+            return self.libraryDao.sample(user['id'], user['domain_id'],
+                query, count, exclude)
+
+        return self.queueDao.refill(user['id'], user['domain_id'],
+            limit, sample)
 
-        songs = (songs + new_songs)[:limit]
+    def createQueue(self, user, query, limit=50):
+        """
+        replace the queue with songs chosen at random from a query
+
+        returns the songs in the new queue
+        """
+
+        song_ids = self.libraryDao.sample(user['id'], user['domain_id'],
+            query, limit)
 
-        song_ids = [song['id'] for song in songs]
         self.queueDao.set(user['id'], user['domain_id'], song_ids)
 
-        return songs
+        return self.queueDao.get(user['id'], user['domain_id'])
 
     def updatePlayCount(self, user, records, updateHistory=True):
         """
@@ -425,15 +494,21 @@ class AudioService(object):
         records: a list of objects containing a `song_id`, and `timestamp`.
         """
 
-        for record in records:
-            self.libraryDao.incrementPlaycount(
-                user['id'], record['song_id'], commit=False)
-            self.historyDao.insert(user['id'],
-                                   record['song_id'],
-                                   record['timestamp'],
-                                   commit=False)
+        start = time.perf_counter()
+
+        self.libraryDao.bulkIncrementPlaycount(user['id'],
+            [r['song_id'] for r in records], commit=False)
+
+        count = 0
+        if updateHistory:
+            count = self.historyDao.bulkInsert(user['id'], records,
+                commit=False)
+
         self.db.session.commit()
 
+        logging.info("updated playcount for %d records (%d history) in %.3fs",
+            len(records), count, time.perf_counter() - start)
+
     def insertPlayHistory(self, user, records):
         """
         update play history for a user given a list of records
@@ -446,23 +521,14 @@ class AudioService(object):
         returns the number of records successfully imported.
         """
 
-        # get a set of existing records for the same time span
-        # as the records that are given in the request
-        start = min((r['timestamp'] for r in records))
-        end   = max((r['timestamp'] for r in records))
-        db_records = self.historyDao.retrieve(user['id'], start, end)
-        record_set = set((r['timestamp'] for r in db_records))
+        start = time.perf_counter()
 
-        # only insert records if they are unique (by time)
-        count = 0
-        for record in records:
-            if record['timestamp'] not in record_set:
-                self.historyDao.insert(user['id'],
-                                       record['song_id'],
-                                       record['timestamp'],
-                                       commit=False)
-                count += 1
-        self.db.session.commit()
+        # a record for the same song and timestamp as an existing
+        # record is a duplicate, and is not inserted
+        count = self.historyDao.bulkInsert(user['id'], records)
+
+        logging.info("inserted %d of %d history records in %.3fs",
+            count, len(records), time.perf_counter() - start)
 
         return count
 
@@ -35,3 +35,7 @@ class FileSysKeyNotFound(FileSysServiceException):
     def __init__(self, message, status=404):
         super().__init__(message, status)
 
+class FileSysPreviewPending(FileSysServiceException):
+    def __init__(self, message, status=202):
+        super().__init__(message, status)
+
@@ -9,26 +9,36 @@ file system.
 """
 import os, sys
 
-from .exception import FileSysServiceException, FileSysKeyNotFound
+from .exception import FileSysServiceException, FileSysKeyNotFound, \
+    FileSysPreviewPending
 from ..dao.filesys.filesys import FileSystem
+from ..dao.filesys.util import RangeWriter, RangeComplete, HashReader
 from ..dao.filesys.crypt import FileEncryptorWriter, FileEncryptorReader, \
     FileDecryptorReader, FileDecryptorWriter, decryptkey
-from ..dao.storage import StorageDao, \
+from ..dao.storage_usage import QuotaReader, QuotaExceededException
+from ..dao.storage import StorageDao, FileRecord2, \
     StorageNotFoundException, StorageException, CryptMode
 from ..dao.user import UserDao
 from ..dao.settings import Settings, SettingsDao
-from ..dao.image import ImageScale, scale_image_stream
+from ..dao.image import ImageScale, scale_image_stream, scale_image_bytes
 from .transcode_service import TranscodeService, ImageScale
+from .preview_pool import PreviewWorkerPool
 from ..dao.util import format_bytes
 from ..dao.transcode import FFmpeg
 
 from datetime import datetime
+from contextlib import nullcontext
+from concurrent.futures import BrokenExecutor
 
 import logging
 import time
 import base64
 import uuid
 
+# file extensions which support previews
+_preview_image_ext = {"jpg", "jpeg", "png", "gif", 'bmp'}
+_preview_video_ext = {"webm", "mp4"}
+
 # TODO: validate fs_name and path since those values come from a user
 #       use the same validation as storage path,
 #       but path should return a relative path instead
@@ -64,7 +74,6 @@ class FileSysService(object):
         # db is accessed during file upload
         # 2**20 : 1 MB
         # 2**26 : 64 MB
-        self.byte_threshold = 2**26
 
         path = config.transcode.audio.bin_path
 
@@ -73,6 +82,11 @@ class FileSysService(object):
 
         self.transcoder = FFmpeg(path)
 
+        # generates previews in the background, when started
+        self.previewPool = None
+
+        self.storageDao.previews.budget = config.filesystem.preview_cache_size
+
     @staticmethod
     def init(config, db, dbtables):
         if not FileSysService._instance:
@@ -100,6 +114,16 @@ class FileSysService(object):
         the path is guaranteed to be a sub directory of the named fs.
         """
 
+        rel_path = self._getNewStorageName()
+
+        # get the unique absolute path
+
+        return self.storageDao.absolutePath(user['id'], user['role_id'],
+            fs_name, rel_path)
+
+    def _getNewStorageName(self):
+        """ returns a new unique relative path for a file """
+
         part1 = datetime.now().strftime("%Y/%m/%d")
         # create a unique alpha-numerix name for this file
         part2 = base64.b64encode(uuid.uuid4().bytes, b"-_") \
@@ -107,12 +131,16 @@ class FileSysService(object):
             .replace(b"-", b"AA") \
             .replace(b"_", b"AB") \
             .decode("utf-8")
-        rel_path = "%s/%s" % (part1, part2)
+        return "%s/%s" % (part1, part2)
 
-        # get the unique absolute path
+    def _getNewPreviewPath(self, user_id, fs_id):
+        """ returns a new unique absolute path for a preview file
 
-        return self.storageDao.absolutePath(user['id'], user['role_id'],
-            fs_name, rel_path)
+        the same as _getNewStoragePath, for workers which only
+        know the file system id
+        """
+        root_path = self.storageDao.filesystemRootPath(user_id, fs_id)
+        return self.fs.join(root_path, self._getNewStorageName())
 
     def getFilePath(self, user, fs_name, path):
         return self.storageDao.absoluteFilePath(user['id'], user['role_id'],
@@ -285,20 +313,46 @@ class FileSysService(object):
 
         return stream
 
-    def downloadFileFromInfo(self, user, info, password=None):
+    def downloadFileFromInfo(self, user, info, password=None, offset=0, length=None):
+        """ returns a response payload for the contents of a file
+
+        offset: the first byte of the file to return
+        length: if given, return at most length bytes
+
+        unencrypted local files are returned as an open file, which
+        allows for the file to be sent using sendfile. otherwise a
+        callback is returned which writes the file to a given writer.
+        """
 
         #abs_path = self.getFilePath(user, fs_name, path)
         #fs_id = self.storageDao.getFilesystemId(
         #    user['id'], user['role_id'], fs_name)
         #info = self.storageDao.file_info(user['id'], fs_id, abs_path)
 
+        if info.encryption is None and self.fs.islocal(info.storage_path):
+            stream = self.fs.open(info.storage_path, "rb")
+            if offset:
+                stream.seek(offset)
+            return stream
+
         def downloadCallback(writer):
 
-            if info.encryption is not None:
-                writer = self.decryptStream(user, password,
-                    writer, "wb", info.encryption)
+            if info.encryption is None:
+                self.fs.download(info.storage_path, writer, offset, length)
+                return
 
-            self.fs.download(info.storage_path, writer)
+            # the stream cipher must start at the beginning of the file,
+            # bytes before the requested range are decrypted and discarded
+            if offset or length is not None:
+                writer = RangeWriter(writer, offset, length)
+
+            writer = self.decryptStream(user, password,
+                writer, "wb", info.encryption)
+
+            try:
+                self.fs.download(info.storage_path, writer)
+            except RangeComplete:
+                pass
 
         return downloadCallback
 
@@ -340,9 +394,25 @@ class FileSysService(object):
 
         return info, stream
 
+    def _canHash(self, encryption):
+        """ returns true if files with the same contents, uploaded
+        using the given encryption mode, are stored with the same bytes
+
+        server and system encryption use a new nonce for every upload
+        """
+        return encryption not in (CryptMode.server, CryptMode.system)
+
     # TODO: version defaulting to 0 may be a bug, change to None
     def saveFile(self, user, fs_name, path, stream,
-      mtime=None, version=None, permission=0, encryption=None):
+      mtime=None, version=None, permission=0, encryption=None,
+      content_hash=None):
+        """
+        content_hash: the sha256 of the stream, as a hex string, if known
+            by the client. when deduplication is enabled, and the user has
+            already stored a file with the same contents, the stream is
+            not read. Otherwise the hash is validated once the stream
+            has been read.
+        """
 
         if self.fs.isabs(path):
             raise FileSysServiceException(path)
@@ -387,40 +457,103 @@ class FileSysService(object):
             # this is the first version
             version = 1
 
-        if storage_path is None:
-            storage_path = self._getNewStoragePath(user, fs_name, path)
-            dirpath, _ = self.fs.split(storage_path)
-            self.fs.makedirs(dirpath)
-            logging.warning("creating new storage path: %s", storage_path)
+        can_hash = self._canHash(encryption)
+        dedup = can_hash and self.config.filesystem.dedup
+        if not can_hash:
+            content_hash = None
+
+        # a blob may be shared by several files and can not be
+        # overwritten. write to a new location and release the
+        # previous location once the new file has been recorded
+        old_storage_path = None
+        if storage_path is not None and \
+          (dedup or self.storageDao.isBlob(storage_path)):
+            old_storage_path = storage_path
+            storage_path = None
 
         if mtime is None:
             mtime = int(time.time())
 
-        size = self._internalSave(user['id'], storage_path, stream, 4096)
-
-        # if the file is wrapped by an encryptor, subtract the size
-        # of the header information. This allows the user to stat
-        # the file later on, and see the expected file size
-
-        if encryption is not None:
-            size -= FileEncryptorReader.HEADER_SIZE
-
-        # todo: in the future, the logical file path, and the actual
-        # storage path will be different for security reasons.
-        data = dict(
-            storage_path=storage_path,
-            preview_path=None,
-            permission=permission,
-            version=version,
-            size=size,
-            mtime=mtime,
-            encryption=encryption
-        )
+        # reserve space for the upload, releasing it once the new
+        # size of the file has been recorded
+        uid = str(uuid.uuid4())
+        credit = info.size if info is not None else 0
+        try:
+            blob = None
+            if dedup and content_hash:
+                blob = self.storageDao.findBlob(
+                    user['id'], fs_id, content_hash, encryption)
+
+            if blob is not None:
+                # the contents are already stored, skip the upload. the
+                # server closes the connection, as the body is not read
+                try:
+                    self.storageDao.usage.reserve(
+                        user['id'], uid, blob.size, credit)
+                except QuotaExceededException as e:
+                    raise FileSysServiceException("quota exceeded", 413)
+                storage_path = blob.storage_path
+                size = blob.size
+            else:
+                if storage_path is None:
+                    storage_path = self._getNewStoragePath(user, fs_name, path)
+                    dirpath, _ = self.fs.split(storage_path)
+                    self.fs.makedirs(dirpath)
+                    logging.warning("creating new storage path: %s", storage_path)
+
+                if can_hash:
+                    stream = HashReader(stream)
+
+                size = self._internalSave(user['id'], storage_path, stream, uid, credit)
+
+                if can_hash:
+                    digest = stream.hexdigest()
+                    if content_hash and content_hash.lower() != digest:
+                        self._internalRemoveFailed(storage_path)
+                        raise FileSysServiceException(
+                            "content hash mismatch", 400)
+                    content_hash = digest
+
+            if dedup:
+                blob_path = self.storageDao.acquireBlob(user['id'], fs_id,
+                    content_hash, encryption, storage_path, size, commit=False)
+
+                if blob_path != storage_path:
+                    # the same contents were uploaded twice
+                    self._internalRemoveFailed(storage_path)
+                    storage_path = blob_path
+
+            # if the file is wrapped by an encryptor, subtract the size
+            # of the header information. This allows the user to stat
+            # the file later on, and see the expected file size
+
+            if encryption is not None:
+                size -= FileEncryptorReader.HEADER_SIZE
+
+            # todo: in the future, the logical file path, and the actual
+            # storage path will be different for security reasons.
+            data = dict(
+                storage_path=storage_path,
+                preview_path=None,
+                permission=permission,
+                version=version,
+                size=size,
+                mtime=mtime,
+                encryption=encryption,
+                content_hash=content_hash,
+            )
+
+            file_id = self.storageDao.upsertFile(
+                user['id'], fs_id, file_path, data)
+            # existing thumbnails need to be recomputed
+            self.storageDao.previewInvalidate(user['id'], file_id)
+            self._enqueuePreviews(user['id'], fs_id, file_id, file_path,
+                encryption)
+        finally:
+            self.storageDao.usage.release(user['id'], uid)
 
-        file_id = self.storageDao.upsertFile(
-            user['id'], fs_id, file_path, data)
-        # existing thumbnails need to be recomputed
-        self.storageDao.previewInvalidate(user['id'], file_id)
+        if old_storage_path is not None:
+            self._internalRelease(old_storage_path)
 
         # TODO: is it possible to return the new version ?
         #       it is either info.version+1 or version or 1
@@ -434,99 +567,44 @@ class FileSysService(object):
 
         return file_info
 
-    def _internalSave(self, user_id, storage_path, inputStream, chunk_size):
-
-        # QUOTA upload strategy
-        # don't check the quota at the start.
-        # every N bytes (N= 50MB or 100MB) check the usage + transfered
-        # compared to the quota. if over, abandon upload delete file.
-        # on error return http 413 Request To Large
-        # note: parallel uploads can allow going over the quota
-        #       create a locked structure, a dictionary
-        #           user_id => storage_path => transfered bytes
-        #       update this structure then sum transfered bytes and
-        #       compare to the quota. and fail the current upload if need be
-        #       create a per user lock?
-
-        uid = str(uuid.uuid4())
-
-        quota_enabled = False
-
-        if quota_enabled:
+    def _internalSave(self, user_id, storage_path, inputStream, uid, credit=0):
+        """ write the input stream to the storage path
 
-            _, usage, quota = self.storageDao.userDiskUsage(user_id)
-
-            if usage > quota:
-                raise FileSysServiceException("quota exceeded", 413)
-
-        byte_index = 0
-        size = 0
+        every byte read is reserved against the quota of the user,
+        the upload is abandoned, and the file removed, as soon as the
+        quota is exceeded. The rest of the request body is not read,
+        and the server closes the connection after the response.
+        The caller must release the reservation
+        for uid once the file has been recorded in the database.
 
+        credit: the size of the file being replaced
+        """
 
         try:
-            # inputStream -> setNonBlocking(True) ? where?
-
-            size = self.fs.upload(inputStream, storage_path)
-            #with self.fs.open(storage_path, "wb") as outputStream:
-            #    _iter = iter(lambda: inputStream.read(chunk_size), b"")
-            #    cont = True;
-            #    while cont:
-            #        data = b""
-            #        try:
-            #            # load X megabytes before attempting to write
-            #            # to the output file
-            #            for i in range(1000):
-            #                data += next(_iter)
-            #        except StopIteration as e:
-            #            cont = False
-            #        if data:
-            #            outputStream.write(data)
-            #            size += len(data)
-            #            if quota_enabled:
-            #                byte_index = self._internalCheckQuota(
-            #                    user_id, size, byte_index, uid)
-
-            if quota_enabled:
-                self._internalCheckQuota(
-                    user_id, size, -1, uid)
-
+            reader = QuotaReader(inputStream, self.storageDao.usage,
+                user_id, uid, credit)
+            return self.fs.upload(reader, storage_path)
+        except QuotaExceededException as e:
+            logging.warning("upload failed. quota exceeded: %s", storage_path)
+            self._internalRemoveFailed(storage_path)
+            raise FileSysServiceException("quota exceeded", 413)
         except Exception as e:
             logging.exception("upload failed. removing failed file at location: %s", storage_path)
-            self.fs.remove(storage_path)
+            self._internalRemoveFailed(storage_path)
             raise e
-        finally:
-            if quota_enabled:
-                logging.info("removing temp file. size: %d", size)
-                self.storageDao.tempFileRemove(user_id, uid)
-
-
-        return size
-
-    def _internalCheckQuota(self, user_id, size, byte_index, uid):
 
-        # TODO: one minor bug related to upload and quota
-        # replacing a large file, with a smaller version could
-        # trip the quota, and delete the original
-        # its overwriting anyway, so any failed request would have
-        # meant data loss.
-
-        index = size // self.byte_threshold
-        if byte_index == -1 or index > byte_index:
-            self.storageDao.tempFileUpdate(user_id, uid, size)
-            _, temp_usage = self.storageDao.tempFileUsage(user_id)
-            _, usage, quota = self.storageDao.userDiskUsage(user_id)
-
-            #print("%s + %s = %s > %s : %s" % (
-            #    format_bytes(usage), format_bytes(temp_usage),
-            #    format_bytes(temp_usage + usage), format_bytes(quota),
-            #    (temp_usage + usage) > quota))
-
-            if (temp_usage + usage) > quota:
-                raise FileSysServiceException("quota exceeded", 413)
-
-            byte_index += 1
+    def _internalRemoveFailed(self, storage_path):
+        try:
+            self.fs.remove(storage_path)
+        except FileNotFoundError:
+            pass
 
-        return byte_index
+    def _internalRelease(self, storage_path):
+        """ remove the file at storage path, unless it is a blob
+        which is still used by other files
+        """
+        if self.storageDao.releaseBlob(storage_path):
+            self._internalRemoveFailed(storage_path)
 
     def remove(self, user, fs_name, path):
 
@@ -553,7 +631,9 @@ class FileSysService(object):
             logging.warning("remove: remove preview")
             self._removePreviewFiles(user['id'], fs_id, file_path)
             logging.warning("remove: remove fs entry")
-            result = self.fs.remove(record.storage_path)
+            result = None
+            if self.storageDao.releaseBlob(record.storage_path, commit=False):
+                result = self.fs.remove(record.storage_path)
             logging.warning("remove: remove dao entry")
             self.storageDao.removeFile(user['id'], fs_id, file_path)
             return result
@@ -762,119 +842,353 @@ class FileSysService(object):
 
         return files
 
+    def previewCached(self, user, fs_name, path, scale):
+        """ returns the cached preview of the current version of a file,
+        or None if the preview is not cached
+
+        the database is not accessed.
+        """
+        abs_path = self.getFilePath(user, fs_name, path)
+        fs_id = self.storageDao.getFilesystemId(
+            user['id'], user['role_id'], fs_name)
+        return self.storageDao.previews.lookup(
+            user['id'], fs_id, abs_path, ImageScale.name(scale))
+
+    def previewContent(self, user, entry, password=None):
+        """ returns a response payload for the contents of a preview
+
+        small previews are kept in memory, when enabled
+        """
+
+        data = self.storageDao.previews.content(entry)
+        if data is not None:
+            return data
+
+        if self.storageDao.previews.keepsContent(entry):
+            with self.fs.open(entry.path, "rb") as rb:
+                data = rb.read()
+            self.storageDao.previews.setContent(entry, data)
+            return data
+
+        info = FileRecord2(storage_path=entry.path, encryption=entry.encryption)
+        return self.downloadFileFromInfo(user, info, password)
+
     def previewFile(self, user, fs_name, path, scale, password=None):
+        """ returns the cache entry for a preview of a file, or None if
+        a preview can not be generated for the file
+
+        when the preview workers are running the preview is generated in
+        the background, and FileSysPreviewPending is raised until the
+        preview is ready. otherwise the preview is generated now.
+        """
 
         abs_path = self.getFilePath(user, fs_name, path)
         ext1 = abs_path.split('.')[-1].lower()
-        if ext1 not in {"jpg", "jpeg", "png", "gif", 'bmp', "webm", "mp4"}:
+        if ext1 not in _preview_image_ext | _preview_video_ext:
             return None
 
         fs_id = self.storageDao.getFilesystemId(
             user['id'], user['role_id'], fs_name)
-        fileItem = self.storageDao.file_info(user['id'], fs_id, abs_path)
-        ext = fileItem.file_path.split('.')[-1].lower()
 
         name = ImageScale.name(scale)
 
+        entry = self.storageDao.previews.lookup(
+            user['id'], fs_id, abs_path, name)
+        if entry is not None:
+            return entry
+
+        fileItem = self.storageDao.file_info(user['id'], fs_id, abs_path)
+
         previewItem = self.storageDao.previewFind(
             user['id'], fileItem.file_id, name)
 
-        if previewItem and previewItem.path.startswith("err://"):
+        # look for a preview file that already exists
+        # check a database table, not the file system
+        # if it exists return the table entry
+        if previewItem is not None and previewItem.valid:
+            if previewItem.path.startswith("err://"):
+                return None
+
+            if self.fs.exists(previewItem.path):
+                return self.storageDao.previews.put(
+                    user['id'], fs_id, fileItem, name, previewItem)
+
+        if self.previewPool is not None:
+            job = self.storageDao.previewJobFind(
+                user['id'], fileItem.file_id, name)
+            if job is None:
+                self.storageDao.previewJobEnqueue(
+                    user['id'], fileItem.file_id, fs_id, name)
+                self.previewPool.notify()
+            raise FileSysPreviewPending("preview pending: %s" % path)
+
+        # generate a new file path for the preview file.
+        # other than possibly a similar date, there is no relationship
+        # to the preview image file and source file found in the storage
+        # area. this may help to avoid revealing the type of
+        # an encrypted file
+        dst = self._getNewStoragePath(user, fs_name, path)
+
+        if not self._createPreview(user, fileItem, fs_id, scale, dst, password):
+            logging.error("Failed to generate preview for %s `%s`" % (fs_name, abs_path))
             return None
 
-        elif previewItem is None or previewItem.valid == 0 or not self.fs.exists(previewItem.path):
-            inputStream = self.loadFileFromInfo(user, fileItem, password)
-            # look for a preview file that already exists
-            # check a database table, not the file system
-            # if it exists return the table entry
+        previewItem = self.storageDao.previewFind(
+            user['id'], fileItem.file_id, name)
+        return self.storageDao.previews.put(
+            user['id'], fs_id, fileItem, name, previewItem)
 
-            # generate a new file path for the preview file.
-            # other than possibly a similar date, there is no relationship
-            # to the preview image file and source file found in the storage
-            # area. this may help to avoid revealing the type of
-            # an encrypted file
-            dst = self._getNewStoragePath(user, fs_name, path)
+    def previewBatch(self, user, fs_name, scale, paths=None, directory=None,
+      password=None, limit=None, offset=None):
+        """ returns the previews for a list of files, or for the files
+        in a directory
 
-            try:
-                logging.info("creating preview %s %s" % (name, dst))
-                if fileItem.encryption in (CryptMode.server, CryptMode.client):
-                    raise FileSysServiceException("file is encrypted")
-                elif ext in {"jpg", "jpeg", "png", "gif", 'bmp'}:
+        limit, offset: return a page of the files in the directory,
+            ordered by path. only files which can have a preview are
+            counted.
+
+        returns a list of (path, status, entry), where status is one of
+        'ok', 'pending' or 'error', and entry is the cache entry for the
+        preview when the status is 'ok'.
+
+        previews which do not exist are submitted to the preview workers.
+        when the workers are not running the previews are generated now.
+        """
+
+        fs_id = self.storageDao.getFilesystemId(
+            user['id'], user['role_id'], fs_name)
+        name = ImageScale.name(scale)
+
+        results = {}
+
+        order = None
+        file_paths = None
+        path_prefix = None
+        if paths is not None:
+            order = []
+            file_paths = []
+            for path in paths:
+                abs_path = self.getFilePath(user, fs_name, path)
+                order.append(abs_path)
+                entry = self.storageDao.previews.lookup(
+                    user['id'], fs_id, abs_path, name)
+                if entry is not None:
+                    results[abs_path] = ('ok', entry)
+                else:
+                    file_paths.append(abs_path)
+        else:
+            directory = (directory or "").strip("/")
+            path_prefix = "/"
+            if directory:
+                path_prefix = self.getFilePath(user, fs_name, directory) + "/"
+
+        missing = []
+        if file_paths is None or file_paths:
+            extensions = None
+            if path_prefix is not None:
+                extensions = _preview_image_ext | _preview_video_ext
+            items = self.storageDao.previewListBatch(user['id'], fs_id, name,
+                file_paths=file_paths, path_prefix=path_prefix,
+                extensions=extensions, limit=limit, offset=offset)
+
+            for fileItem, previewItem in items:
+                ext = fileItem.file_path.split('.')[-1].lower()
+                if ext not in _preview_image_ext | _preview_video_ext:
+                    if paths is not None:
+                        results[fileItem.file_path] = ('error', None)
+                elif previewItem is None or not previewItem.valid:
+                    missing.append(fileItem)
+                elif previewItem.path.startswith("err://"):
+                    results[fileItem.file_path] = ('error', None)
+                elif not self.fs.exists(previewItem.path):
+                    # the size of every preview reported as ready is
+                    # sent before the content, so the file must exist
+                    missing.append(fileItem)
+                else:
+                    results[fileItem.file_path] = ('ok',
+                        self.storageDao.previews.put(
+                            user['id'], fs_id, fileItem, name, previewItem))
+
+        if self.previewPool is not None:
+            for fileItem in missing:
+                self.storageDao.previewJobEnqueue(user['id'],
+                    fileItem.file_id, fs_id, name, commit=False)
+                results[fileItem.file_path] = ('pending', None)
+            if missing:
+                self.db.session.commit()
+                self.previewPool.notify()
+        else:
+            for fileItem in missing:
+                dst = self._getNewPreviewPath(user['id'], fs_id)
+                if self._createPreview(user, fileItem, fs_id, scale, dst,
+                  password):
+                    previewItem = self.storageDao.previewFind(
+                        user['id'], fileItem.file_id, name)
+                    results[fileItem.file_path] = ('ok',
+                        self.storageDao.previews.put(
+                            user['id'], fs_id, fileItem, name, previewItem))
+                else:
+                    results[fileItem.file_path] = ('error', None)
+
+        if order is None:
+            order = sorted(results)
+
+        # files which were not found are reported as errors
+        return [(abs_path[1:],) + results.get(abs_path, ('error', None))
+            for abs_path in order]
+
+    def _createPreview(self, user, fileItem, fs_id, scale, dst,
+      password=None, executor=None, video_slots=None):
+        """ generate a preview of a file at dst, and record it
+
+        executor: if given, images are scaled using the executor,
+                  for example a process pool
+        video_slots: if given, a semaphore bounding the number of
+                  ffmpeg processes
+
+        a preview which can not be generated is recorded with an err://
+        path, so that it is not attempted again until the file changes.
+        returns true if the preview was generated.
+
+        nothing is recorded if the executor is broken, the BrokenExecutor
+        is raised so that the caller can replace the executor and try again
+        """
+
+        name = ImageScale.name(scale)
+        ext = fileItem.file_path.split('.')[-1].lower()
+
+        try:
+            logging.info("creating preview %s %s" % (name, dst))
+            if fileItem.encryption in (CryptMode.server, CryptMode.client):
+                raise FileSysServiceException("file is encrypted")
+            elif ext in _preview_image_ext:
+
+                inputStream = self.loadFileFromInfo(user, fileItem, password)
+                try:
+                    data = None
+                    if executor is not None:
+                        data, w, h, s = executor.submit(scale_image_bytes,
+                            inputStream.read(), scale).result()
 
                     with self.fs.open(dst, "wb") as outputStream:
                         if fileItem.encryption is not None:
                             outputStream = self.encryptStream(user,
                                 password, outputStream, "w", fileItem.encryption)
-                        w, h, s = scale_image_stream(inputStream, outputStream, scale)
-
-                        info = {
-                            'width': w,
-                            'height': h,
-                            'filesystem_id': fs_id,
-                            'size': s,
-                            'path': dst,
-                            'valid': 1
-                        }
-
-                        self.storageDao.previewUpsert(
-                            user['id'], fileItem.file_id, name, info)
-                elif ext in {"ogg", "mp3", "wav"}:
-
-                    raise FileSysServiceException("not implemented")
-                elif ext in {"webm", "mp4"}:
-                    with self.fs.open(dst, "wb") as outputStream:
-                        if fileItem.encryption is not None:
-                            outputStream = self.encryptStream(user,
-                                password, outputStream, "w", fileItem.encryption)
-                        args = self.transcoder.get_thumb_args()
-                        w, h, s = self.transcoder.thumb(inputStream, outputStream, args, scale)
-
-                        info = {
-                            'width': w,
-                            'height': h,
-                            'filesystem_id': fs_id,
-                            'size': s,
-                            'path': dst,
-                            'valid': 1
-                        }
-
-                        self.storageDao.previewUpsert(
-                            user['id'], fileItem.file_id, name, info)
-                elif ext in ("pdf", "swf"):
-
-                    raise FileSysServiceException("not implemented")
-                else:
-                    raise FileSysServiceException("not implemented")
-
-                # the resource path that is returned should be resource
-                # dependant. all audio files should have the same url
-                #
-                return dst
-            except Exception as e:
-
-                info = {
-                    'width': 0,
-                    'height': 0,
-                    'filesystem_id': fs_id,
-                    'size': 0,
-                    'path': "err://transcode",
-                    'valid': 1
-                }
-
-                self.storageDao.previewUpsert(
-                    user['id'], fileItem.file_id, name, info)
-
-                logging.error("Failed to generate preview for %s `%s`" % (fs_name, abs_path))
-                return None
+                        if data is None:
+                            w, h, s = scale_image_stream(inputStream, outputStream, scale)
+                        else:
+                            outputStream.write(data)
+                finally:
+                    inputStream.close()
+
+            elif ext in _preview_video_ext:
+
+                with video_slots or nullcontext():
+                    inputStream = self.loadFileFromInfo(user, fileItem, password)
+                    try:
+                        with self.fs.open(dst, "wb") as outputStream:
+                            if fileItem.encryption is not None:
+                                outputStream = self.encryptStream(user,
+                                    password, outputStream, "w", fileItem.encryption)
+                            args = self.transcoder.get_thumb_args()
+                            w, h, s = self.transcoder.thumb(inputStream, outputStream, args, scale)
+                    finally:
+                        inputStream.close()
 
-        else:
-            return previewItem
+            else:
+                raise FileSysServiceException("not implemented")
+
+            info = {
+                'width': w,
+                'height': h,
+                'filesystem_id': fs_id,
+                'size': s,
+                'path': dst,
+                'valid': 1
+            }
+
+        except BrokenExecutor:
+            self._internalRemoveFailed(dst)
+            raise
+
+        except Exception as e:
+            logging.exception("unable to create preview %s %s" % (name, dst))
+            self._internalRemoveFailed(dst)
+            self._previewFailed(user['id'], fileItem.file_id, fs_id, name)
+            return False
+
+        self._savePreview(user['id'], fileItem.file_id, name, info)
+        return True
+
+    def _previewFailed(self, user_id, file_id, fs_id, name):
+        """ record that a preview can not be generated """
+
+        info = {
+            'width': 0,
+            'height': 0,
+            'filesystem_id': fs_id,
+            'size': 0,
+            'path': "err://transcode",
+            'valid': 1
+        }
+
+        self._savePreview(user_id, file_id, name, info)
+
+    def _savePreview(self, user_id, file_id, name, info):
+
+        previous = self.storageDao.previewFind(user_id, file_id, name)
+
+        self.storageDao.previewUpsert(user_id, file_id, name, info)
+
+        # remove the out of date preview
+        if previous is not None and previous.path != info['path'] and \
+          not previous.path.startswith("err://"):
+            self._internalRemoveFailed(previous.path)
+
+    def _enqueuePreviews(self, user_id, fs_id, file_id, file_path, encryption):
+        """ submit jobs to generate the default previews of a file,
+        and to regenerate any existing previews
+        """
+
+        if self.config.filesystem.preview_workers <= 0:
+            return
+
+        if encryption in (CryptMode.server, CryptMode.client):
+            return
+
+        ext = file_path.split('.')[-1].lower()
+        if ext not in _preview_image_ext | _preview_video_ext:
+            return
+
+        scales = set(self.config.filesystem.preview_scales)
+        for item in self.storageDao.previewFind(user_id, file_id, None):
+            scales.add(item.scale)
+
+        for name in sorted(scales):
+            if ImageScale.fromName(name):
+                self.storageDao.previewJobEnqueue(
+                    user_id, file_id, fs_id, name, commit=False)
+        self.db.session.commit()
+
+        if self.previewPool is not None:
+            self.previewPool.notify()
+
+    def startPreviewWorkers(self):
+        """ start generating previews in the background """
+
+        if self.previewPool is None and self.config.filesystem.preview_workers > 0:
+            self.previewPool = PreviewWorkerPool(self,
+                self.config.filesystem.preview_workers,
+                self.config.filesystem.preview_video_workers)
+            self.previewPool.start()
 
     def _removePreviewFiles(self, user_id, fs_id, file_path):
         # TODO: exception handling, eventual consistency
         fileItem = self.storageDao.file_info(user_id, fs_id, file_path)
         file_id = fileItem.file_id
         self.storageDao.previewInvalidate(user_id, file_id)
+        self.storageDao.previewJobRemove(user_id, file_id)
         for item in self.storageDao.previewFind(user_id, file_id, None):
-            self.fs.remove(item.path)
+            if not item.path.startswith("err://"):
+                self.fs.remove(item.path)
         self.storageDao.previewRemove(user_id, file_id)
\ No newline at end of file
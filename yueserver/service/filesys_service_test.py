@@ -3,6 +3,7 @@ import sys
 import unittest
 import json
 import time
+import hashlib
 
 from ..dao.db import main_test
 from ..dao.library import Song
@@ -177,7 +178,7 @@ class FileServiceTestCase(unittest.TestCase):
         self.service.saveFile(self.app.USER, root, path, data)
         # generate a thumbnail and show it exists
         url = self.service.previewFile(self.app.USER, root, path,
-            ImageScale.THUMB)
+            ImageScale.THUMB).path
         self.assertTrue(self.service.fs.exists(url))
 
         # delete the file, and thumbnails
@@ -191,7 +192,7 @@ class FileServiceTestCase(unittest.TestCase):
             print(f)
             self.service.remove(self.app.USER, "mem", f['path'])
 
-    def xtest_005a_quota(self):
+    def test_005a_quota(self):
 
         user_id = self.app.USER['id']
 
@@ -227,8 +228,81 @@ class FileServiceTestCase(unittest.TestCase):
         with self.assertRaises(FileSysServiceException):
             self.service.saveFile(self.app.USER, "mem", "c", BytesIO(b"0" * 1024))
 
-        # _internalSave(user_id, storage_path, inputStream, chunk_size)
-        # _internalCheckQuota(user_id, size, byte_index, uid)
+        # replacing a file only counts the change in size
+        dao.setUserDiskQuota(user_id, 2**11)
+        self.service.saveFile(self.app.USER, "mem", "a", BytesIO(b"0" * 1536))
+        count, usage, quota = dao.userDiskUsage(user_id)
+        self.assertEqual(count, 2)
+        self.assertEqual(usage, 2048)
+
+        # restore the quota and remove the files for the next test
+        dao.setUserDiskQuota(user_id, 2**30)
+        self.service.remove(self.app.USER, "mem", "a")
+        self.service.remove(self.app.USER, "mem", "b")
+
+    def test_005b_dedup(self):
+
+        user = self.app.USER
+        dao = self.service.storageDao
+        fs = self.service.fs
+
+        data = b"dedup" * 100
+        digest = hashlib.sha256(data).hexdigest()
+
+        self.service.config.filesystem.dedup = True
+        try:
+            self.service.saveFile(user, "mem", "d1", BytesIO(data))
+            path1 = self.service.getStoragePath(user, "mem", "d1")
+
+            # the same contents are stored once
+            self.service.saveFile(user, "mem", "d2", BytesIO(data))
+            path2 = self.service.getStoragePath(user, "mem", "d2")
+            self.assertEqual(path1, path2)
+
+            # the stream is not read when the hash is known
+            stream = BytesIO(data)
+            info = self.service.saveFile(user, "mem", "d3", stream,
+                content_hash=digest)
+            self.assertEqual(stream.tell(), 0)
+            self.assertEqual(info['size'], len(data))
+            self.assertEqual(self.service.getStoragePath(user, "mem", "d3"), path1)
+
+            # the hash is validated when the contents are not stored
+            with self.assertRaises(FileSysServiceException):
+                self.service.saveFile(user, "mem", "d4", BytesIO(b"abc"),
+                    content_hash=hashlib.sha256(b"xyz").hexdigest())
+
+            # replacing a file releases the shared contents
+            self.service.saveFile(user, "mem", "d1", BytesIO(b"abc"))
+            self.assertNotEqual(
+                self.service.getStoragePath(user, "mem", "d1"), path1)
+
+            # the blob is removed with the last file which uses it
+            self.service.remove(user, "mem", "d2")
+            self.assertTrue(fs.exists(path1))
+            self.service.remove(user, "mem", "d3")
+            self.assertFalse(fs.exists(path1))
+
+            # files encrypted by the server are never shared
+            self.service.saveFile(user, "mem", "e1", BytesIO(data),
+                encryption="system")
+            self.service.saveFile(user, "mem", "e2", BytesIO(data),
+                encryption="system")
+            self.assertNotEqual(
+                self.service.getStoragePath(user, "mem", "e1"),
+                self.service.getStoragePath(user, "mem", "e2"))
+        finally:
+            self.service.config.filesystem.dedup = False
+
+        # a shared blob is not overwritten when dedup is disabled
+        self.service.saveFile(user, "mem", "d1", BytesIO(b"abc"))
+        self.service.saveFile(user, "mem", "d5", BytesIO(b"abc"))
+        self.assertNotEqual(
+            self.service.getStoragePath(user, "mem", "d1"),
+            self.service.getStoragePath(user, "mem", "d5"))
+
+        for path in ["d1", "d5", "e1", "e2"]:
+            self.service.remove(user, "mem", path)
 
     def test_006_search(self):
 
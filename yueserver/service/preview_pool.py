@@ -0,0 +1,178 @@
+"""
+A pool of workers which generate previews in the background
+
+Jobs are read from the preview job table, so that previews requested
+by any process are generated by the pool. Images are scaled in a pool
+of processes, while the number of ffmpeg processes used for videos is
+bounded separately.
+"""
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, BrokenExecutor
+
+from ..dao.image import ImageScale
+from ..dao.storage import StorageNotFoundException
+
+class PreviewWorkerPool(object):
+    """ generate previews for the jobs in the preview job table
+
+    service: the FileSysService
+    workers: the number of threads running jobs
+    video_workers: the maximum number of videos processed at a time
+    processes: the size of the process pool used to scale images,
+               by default the number of workers. 0 to scale images
+               in the worker thread.
+    """
+
+    # seconds between checks for jobs submitted by another process
+    POLL_INTERVAL = 5
+
+    # seconds before a running job is assumed to have failed
+    LEASE = 300
+
+    # the number of times a job is started before the preview
+    # is recorded as failed
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, service, workers=2, video_workers=1, processes=None):
+        super(PreviewWorkerPool, self).__init__()
+        self.service = service
+        self.workers = max(1, workers)
+        self.processes = self.workers if processes is None else processes
+
+        self._video_slots = threading.BoundedSemaphore(max(1, video_workers))
+
+        self._executor = None
+        self._threads = []
+        self._alive = False
+
+        self._lock = threading.Lock()
+        self._cv = threading.Condition(self._lock)
+        self._signaled = False
+
+    def start(self):
+
+        if self.processes > 0:
+            self._executor = self._newExecutor()
+
+        self._alive = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run,
+                name="preview-%d" % i, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+
+        with self._cv:
+            self._alive = False
+            self._cv.notify_all()
+
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _newExecutor(self):
+        return ProcessPoolExecutor(max_workers=self.processes)
+
+    def _replaceExecutor(self, executor):
+        """ replace a process pool which can no longer be used
+
+        a process which exits unexpectedly, for example when it runs
+        out of memory, breaks the pool for every job
+        """
+
+        with self._lock:
+            if self._executor is not executor:
+                # another worker has already replaced the pool
+                return
+            self._executor = self._newExecutor()
+
+        executor.shutdown(wait=False)
+
+    def notify(self):
+        """ wake the workers after a job has been submitted """
+        with self._cv:
+            self._signaled = True
+            self._cv.notify_all()
+
+    def _run(self):
+
+        while self._alive:
+
+            try:
+                done = self.runPending(1)
+            except Exception as e:
+                logging.exception("preview worker failed")
+                done = 0
+            finally:
+                # each thread has a session, which must be released
+                self.service.db.session.remove()
+
+            if done == 0:
+                with self._cv:
+                    if self._alive and not self._signaled:
+                        self._cv.wait(self.POLL_INTERVAL)
+                    self._signaled = False
+
+    def runPending(self, count=None):
+        """ run up to count jobs on the current thread
+
+        returns the number of jobs which were run
+        """
+
+        dao = self.service.storageDao
+
+        done = 0
+        while count is None or done < count:
+            job = dao.previewJobClaim(self.LEASE)
+            if job is None:
+                break
+            self._runJob(job)
+            done += 1
+
+        return done
+
+    def _runJob(self, job):
+
+        service = self.service
+        dao = service.storageDao
+
+        try:
+            fileItem = dao.fileInfoById(job.user_id, job.file_id)
+        except StorageNotFoundException:
+            # the file was removed after the job was submitted
+            dao.previewJobComplete(job)
+            return
+
+        if job.attempts >= self.MAX_ATTEMPTS:
+            # the job was started several times without completing,
+            # for example the file crashes the process scaling it
+            logging.error("preview of file %s failed after %d attempts" % (
+                job.file_id, job.attempts))
+            service._previewFailed(job.user_id, job.file_id,
+                job.filesystem_id, job.scale)
+            dao.previewJobComplete(job)
+            return
+
+        # the system key is the only key available without a password
+        user = {'id': job.user_id}
+
+        scale = ImageScale.fromName(job.scale)
+        dst = service._getNewPreviewPath(job.user_id, job.filesystem_id)
+
+        executor = self._executor
+        try:
+            service._createPreview(user, fileItem, job.filesystem_id, scale,
+                dst, executor=executor, video_slots=self._video_slots)
+        except BrokenExecutor:
+            logging.exception("preview process pool failed")
+            self._replaceExecutor(executor)
+            dao.previewJobRetry(job)
+            return
+
+        dao.previewJobComplete(job)
@@ -0,0 +1,253 @@
+import os
+import sys
+import unittest
+
+from io import BytesIO
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+from sqlalchemy import event
+
+from ..config import Config
+from ..dao.db import db_init_main, db_connect
+from ..dao.user import UserDao
+from ..dao.image import ImageScale, init as init_image
+from .exception import FileSysPreviewPending
+from .filesys_service import FileSysService
+from .preview_pool import PreviewWorkerPool
+
+def png_bytes(width, height):
+    buf = BytesIO()
+    Image.new("RGB", (width, height), (255, 0, 0)).save(buf, format="png")
+    return buf.getvalue()
+
+class BrokenExecutor(object):
+    """ an executor whose worker process has exited """
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_exception(BrokenProcessPool("process exited"))
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+class PreviewWorkerPoolTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        init_image()
+
+        db = db_connect(None)
+
+        env_cfg = {
+            'features': ['test', ],
+            'filesystems': {
+                "mem": "mem://preview",
+            },
+            'domains': ['test'],
+            'roles': [
+                {'test': {'features': ['all'], 'filesystems': ["mem"]}},
+            ],
+            'users': [
+                {'email': 'user000',
+                 'password': 'user000',
+                 'domains': ['test'],
+                 'roles': ['test']},
+                {'email': 'user001',
+                 'password': 'user001',
+                 'domains': ['test'],
+                 'roles': ['test']},
+            ]
+        }
+
+        db_init_main(db, db.tables, env_cfg)
+
+        cls.USER = UserDao(db, db.tables).findUserByEmail("user000")
+        cls.USER2 = UserDao(db, db.tables).findUserByEmail("user001")
+        cls.service = FileSysService(Config.null(), db, db.tables)
+        cls.db = db
+
+    def setUp(self):
+        # run jobs on the main thread, the test database can only be
+        # used from the thread which created it
+        self.pool = PreviewWorkerPool(self.service, 1, 1, processes=0)
+        self.service.previewPool = self.pool
+        # keep thumbnails in memory
+        self.service.storageDao.previews.budget = 2**16
+
+    def tearDown(self):
+        self.service.previewPool = None
+        self.service.storageDao.previews.budget = 0
+        self.service.remove(self.USER, "mem", "image.png")
+
+    def test_preview_pending(self):
+
+        self.service.saveFile(self.USER, "mem", "image.png",
+            BytesIO(png_bytes(400, 300)))
+
+        with self.assertRaises(FileSysPreviewPending) as ctx:
+            self.service.previewFile(self.USER, "mem", "image.png",
+                ImageScale.THUMB)
+        self.assertEqual(ctx.exception.HTTP_STATUS, 202)
+
+        # the job was submitted when the file was saved
+        self.assertEqual(self.pool.runPending(), 1)
+        self.assertEqual(self.pool.runPending(), 0)
+
+        info = self.service.previewFile(self.USER, "mem", "image.png",
+            ImageScale.THUMB)
+        self.assertTrue(self.service.fs.exists(info.path))
+
+        # the preview is found again without querying the database
+        queries = []
+        def count(conn, cursor, statement, *args):
+            queries.append(statement)
+        event.listen(self.db.engine, "before_cursor_execute", count)
+        try:
+            self.assertIs(self.service.previewCached(self.USER, "mem",
+                "image.png", ImageScale.THUMB), info)
+            # the filesystem is shared by every user with the same role
+            self.assertIsNone(self.service.previewCached(self.USER2, "mem",
+                "image.png", ImageScale.THUMB))
+        finally:
+            event.remove(self.db.engine, "before_cursor_execute", count)
+        self.assertEqual(queries, [])
+
+        data = self.service.previewContent(self.USER, info)
+        self.assertEqual(len(data), info.size)
+        self.assertIs(self.service.previewContent(self.USER, info), data)
+        img = Image.open(BytesIO(data))
+        img.load()
+        self.assertEqual(max(img.size), ImageScale.size(ImageScale.THUMB)[0])
+
+        # the preview is regenerated when the file changes
+        self.service.saveFile(self.USER, "mem", "image.png",
+            BytesIO(png_bytes(300, 400)))
+        with self.assertRaises(FileSysPreviewPending):
+            self.service.previewFile(self.USER, "mem", "image.png",
+                ImageScale.THUMB)
+        self.assertEqual(self.pool.runPending(), 1)
+
+        self.assertIsNone(self.service.previewCached(self.USER, "mem",
+            "image.png", ImageScale.THUMB))
+
+        info2 = self.service.previewFile(self.USER, "mem", "image.png",
+            ImageScale.THUMB)
+        self.assertNotEqual(info.path, info2.path)
+        self.assertFalse(self.service.fs.exists(info.path))
+
+    def test_preview_sync(self):
+
+        # without a running pool previews are generated while waiting
+        self.service.previewPool = None
+
+        self.service.saveFile(self.USER, "mem", "image.png",
+            BytesIO(png_bytes(400, 300)))
+
+        info = self.service.previewFile(self.USER, "mem", "image.png",
+            ImageScale.THUMB)
+        self.assertTrue(self.service.fs.exists(info.path))
+
+        # a job which is still queued does not leave a stale preview
+        self.assertEqual(self.pool.runPending(), 1)
+        info2 = self.service.previewFile(self.USER, "mem", "image.png",
+            ImageScale.THUMB)
+        self.assertTrue(self.service.fs.exists(info2.path))
+
+    def test_preview_batch(self):
+
+        paths = ["image.png", "folder/a.png", "folder/b.png", "folder/c.txt"]
+        for path in paths:
+            self.service.saveFile(self.USER, "mem", path,
+                BytesIO(png_bytes(40, 40)))
+
+        try:
+            results = self.service.previewBatch(self.USER, "mem",
+                ImageScale.THUMB, directory="folder")
+            self.assertEqual([(p, s) for p, s, _ in results],
+                [("folder/a.png", "pending"), ("folder/b.png", "pending")])
+
+            # the jobs submitted when the files were saved are reused
+            self.assertEqual(self.pool.runPending(), 3)
+
+            results = self.service.previewBatch(self.USER, "mem",
+                ImageScale.THUMB, paths=["folder/b.png", "image.png",
+                    "folder/c.txt", "folder/dne.png"])
+            self.assertEqual([(p, s) for p, s, _ in results],
+                [("folder/b.png", "ok"), ("image.png", "ok"),
+                 ("folder/c.txt", "error"), ("folder/dne.png", "error")])
+            entry = results[0][2]
+            self.assertTrue(self.service.fs.exists(entry.path))
+
+            # previews are cached after the first request
+            self.assertIs(self.service.previewCached(self.USER, "mem",
+                "folder/b.png", ImageScale.THUMB), entry)
+
+            # without a running pool, previews are generated now
+            self.service.previewPool = None
+            results = self.service.previewBatch(self.USER, "mem",
+                ImageScale.SMALL, directory="folder")
+            self.assertEqual([s for _, s, _ in results], ["ok", "ok"])
+
+            # a page of the directory
+            results = self.service.previewBatch(self.USER, "mem",
+                ImageScale.SMALL, directory="folder", limit=1, offset=1)
+            self.assertEqual([(p, s) for p, s, _ in results],
+                [("folder/b.png", "ok")])
+
+            # a preview file which is missing is generated again
+            self.service.previewPool = self.pool
+            self.service.fs.remove(results[0][2].path)
+            self.service.storageDao.previews.clear()
+            results = self.service.previewBatch(self.USER, "mem",
+                ImageScale.SMALL, directory="folder")
+            self.assertEqual([s for _, s, _ in results], ["ok", "pending"])
+            self.assertEqual(self.pool.runPending(), 1)
+        finally:
+            for path in paths[1:]:
+                self.service.remove(self.USER, "mem", path)
+
+    def test_broken_executor(self):
+
+        self.service.saveFile(self.USER, "mem", "image.png",
+            BytesIO(png_bytes(400, 300)))
+
+        # the pool is replaced and the job is run again
+        broken = BrokenExecutor()
+        self.pool._executor = broken
+        self.pool._newExecutor = lambda: ThreadPoolExecutor(1)
+        try:
+            self.assertEqual(self.pool.runPending(), 2)
+            self.assertIsNot(self.pool._executor, broken)
+        finally:
+            self.pool._executor.shutdown()
+            self.pool._executor = None
+
+        info = self.service.previewFile(self.USER, "mem", "image.png",
+            ImageScale.THUMB)
+        self.assertTrue(self.service.fs.exists(info.path))
+
+        # a job which always breaks the pool is recorded as failed
+        self.service.saveFile(self.USER, "mem", "image.png",
+            BytesIO(png_bytes(300, 400)))
+        self.pool._executor = BrokenExecutor()
+        self.pool._newExecutor = BrokenExecutor
+        try:
+            self.assertEqual(self.pool.runPending(),
+                self.pool.MAX_ATTEMPTS + 1)
+        finally:
+            self.pool._executor = None
+
+        self.assertIsNone(self.service.previewFile(self.USER, "mem",
+            "image.png", ImageScale.THUMB))
+        self.assertFalse(self.service.fs.exists(info.path))
+
+def main():
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(PreviewWorkerPoolTestCase)
+    unittest.TextTestRunner().run(suite)
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,7 @@ import os, sys
 from ..dao.library import Song
 from ..dao.image import ImageScale, scale_image_file
 from ..dao.filesys.filesys import FileSystem
+from ..dao.filesys.transfer import iter_chunks
 from ..dao.transcode import FFmpeg, _TranscodeFile
 from .exception import TranscodeServiceException
 import logging
@@ -108,8 +109,7 @@ class TranscodeService(object):
     def _transcodeSongGenImpl(self, path, cmd):
         with self.fs.open(path, "rb") as rb:
             with _TranscodeFile(cmd, rb) as tb:
-                for buf in iter(lambda: tb.read(2048), b""):
-                    yield buf
+                yield from iter_chunks(tb)
 
     def audioName(self, song, format, quality, nchannels=2):
 
@@ -109,7 +109,7 @@ from yueserver.dao.search import (
     LessThanSearchRule, GreaterThanSearchRule,
     LessThanEqualSearchRule, GreaterThanEqualSearchRule,
     PartialStringSearchRule, InvertedPartialStringSearchRule,
-    Column, case_
+    Column, case_, compile_rule
 )
 
 # -----------------------------------------------------------------------------
@@ -1670,6 +1670,7 @@ class FileContentSortProxyModel(SortProxyModel):
         super(FileContentSortProxyModel, self).__init__(*args)
 
         self._rule = None
+        self._match = None
         self._dir = False
 
         self._show_hidden = False
@@ -1707,10 +1708,12 @@ class FileContentSortProxyModel(SortProxyModel):
 
         try:
             self._rule = self.grammar.ruleFromString(pattern)
+            self._match = compile_rule(self._rule)
             self._dir = 'dir' in self.grammar.meta_options
             trace("compiled rule:", self._rule, "match dirname:", self._dir)
         except Exception as e:
             self._rule = None
+            self._match = None
             self._dir = False
             trace("error compiling rule", type(e), e)
 
@@ -1746,7 +1749,7 @@ class FileContentSortProxyModel(SortProxyModel):
         if not self._dir and isinstance(ent, sync.DirEnt):
             return True
 
-        return self._rule.check(item)
+        return self._match(item)
 
 class FileContextMenu(QMenu):
 
@@ -0,0 +1,720 @@
+"""
+Micro benchmarks for performance sensitive code paths
+
+each benchmark compares the current implementation with the
+implementation it replaced, using the same inputs.
+
+    python -m yueserver.tools.benchmark search
+    python -m yueserver.tools.benchmark -n 1000000 shuffle
+    python -m yueserver.tools.benchmark fifo
+    python -m yueserver.tools.benchmark -n 20000 headers
+    python -m yueserver.tools.benchmark -n 10000 response
+"""
+import io
+import time
+import random
+import socket
+import argparse
+from threading import Thread, Condition, Lock
+
+from sqlalchemy import column
+
+from yueserver.dao.library import Song
+from yueserver.dao.shuffle import binshuffle, fisher_yates
+from yueserver.dao.filesys.util import BytesFIFO, BytesFIFOReader, \
+    BytesFIFOWriter
+from yueserver.dao.search import \
+        PartialStringSearchRule, \
+        InvertedPartialStringSearchRule, \
+        ExactSearchRule, \
+        InvertedExactSearchRule, \
+        LessThanSearchRule, \
+        LessThanEqualSearchRule, \
+        GreaterThanSearchRule, \
+        GreaterThanEqualSearchRule, \
+        RegExpSearchRule, \
+        RangeSearchRule, \
+        NotRangeSearchRule, \
+        NotSearchRule, \
+        AndSearchRule, \
+        OrSearchRule, \
+        compile_rule
+from yueserver.framework2.server import Protocol
+from yueserver.framework2.server_core import SocketFile, SocketReader, \
+    CaseInsensitiveDict, Namespace, Response, copy_payload
+from http.client import responses
+
+# the implementations replaced by the current code, kept for comparison
+
+class ShuffleElement(object):
+
+    def __init__(self, key, ref, index):
+        self.key = key
+        self.ref = ref
+        self.index = index
+        self.score = 0
+
+def binshuffle_reference(data, group_mapping=lambda x: x):
+    """ the original binshuffle, which allocates an object per element """
+    grpcounts = {}
+    grpoffset = {}
+    temp = []
+
+    N = len(data)
+
+    if N < 2:
+        return data
+
+    # pre shuffle the data to randomize the output
+    # Otherwise items within a group would always be output
+    # in the same order found in the input array
+    fisher_yates(data)
+
+    # count the number of elements in each group
+    # assign a value from 0 to G to each element in a group
+    for elem in data:
+        k = group_mapping(elem)
+        if k not in grpcounts:
+            grpcounts[k] = 1
+        else:
+            grpcounts[k] += 1
+        temp.append(ShuffleElement(k, elem, grpcounts[k] - 1))
+
+    # generate an initial offset for each group
+    # the offset is random, and the range is chosen to
+    # solve the degenerate problem where some groups contain a few
+    # elements, and others contain many elements.
+    for grp, count in grpcounts.items():
+        grpoffset[grp] = random.random() * (N / count)
+
+    # calculate a score for each element
+    # the score ranges from 0-h/2 to N+h/2.
+    # elements within a group are spaced
+    # evenly within this range.
+    for i, elem in enumerate(temp):
+        count = grpcounts[elem.key]
+        h = (N / count) / 2
+        offset = random.random() * h - h / 2 + grpoffset[elem.key]
+        elem.score = N * elem.index / count + offset
+
+    # finally sort by the score, randomizing the elements
+    # while separating items that belong to the same group
+    temp = sorted(temp, key=lambda x: x.score)
+
+    return [x.ref for x in temp]
+
+class BytesFIFOReference(object):
+    """
+    The original, unbounded, FIFO, which BytesFIFO replaced
+    """
+    def __init__(self, init_size=2048, incr_size=2048, lock=None, max_size=None):
+        """ Create a FIFO of ``init_size`` bytes.
+
+        max_size: optional, if set will attempt to keep the size of the
+            internal buffer below this size. internal size still depends
+            on the size of individual writes and reads
+            TODO: disabled by default, still seems to cause deadlock
+        """
+        self._buffer = io.BytesIO(b"\x00" * init_size)
+        self._size = init_size
+        self._filled = 0
+        self._read_ptr = 0
+        self._write_ptr = 0
+        self._writer_closed = False
+        self._reader_closed = False
+        self._max_size = max_size
+
+        self._capacity_increase = incr_size
+
+        self._lock = lock or Lock()
+        self._cond = Condition(self._lock)
+
+    def read(self, request_size=-1):
+        """
+        Read at most ``size`` bytes from the FIFO.
+
+        If less than ``size`` bytes are available, or ``size`` is negative,
+        return all remaining bytes.
+        """
+
+        # TODO: reads should block if the writer is not closed and the
+        #       filled size is empty
+
+        with self._lock:
+            try:
+                data = self._read(request_size)
+            finally:
+                self._cond.notify()
+            return data
+
+    def _read_size_impl(self, request_size):
+
+        if request_size < 0:
+            size = self._filled
+        else:
+            size = min(request_size, self._filled)
+        contig = self._size - self._read_ptr
+        contig_read = min(contig, size)
+
+        return contig_read, size
+
+    def _read_size(self, request_size, blocking):
+        contig_read, size = self._read_size_impl(request_size)
+
+        # block until some bytes are avilable
+        # do not block if some bytes are available
+        if blocking:
+            if (request_size == -1):
+                while not self._writer_closed:
+                    self._cond.wait()
+                    contig_read, size = self._read_size_impl(request_size)
+            else:
+                while not self._writer_closed and contig_read == 0:
+                    self._cond.wait()
+                    contig_read, size = self._read_size_impl(request_size)
+
+        return contig_read, size
+
+    def _read(self, request_size, blocking=True):
+
+        #TODO: refactor this duplicate logic which waits for data
+        # to be available
+        # Figure out how many bytes we can really read
+
+        # sys.stderr.write("[%s] read 1\n" % current_thread())
+
+        contig_read, size = self._read_size(request_size, blocking)
+
+        # Go to read pointer
+        self._buffer.seek(self._read_ptr)
+
+        ret = self._buffer.read(contig_read)
+        self._read_ptr += contig_read
+        if contig_read < size:
+            leftover_size = size - contig_read
+            self._buffer.seek(0)
+            ret += self._buffer.read(leftover_size)
+            self._read_ptr = leftover_size
+
+        self._filled -= size
+        return ret
+
+    def write(self, data):
+        """
+        Write as many bytes of ``data`` as are free in the FIFO.
+
+        If less than ``len(data)`` bytes are free, write as many as can be written.
+        Returns the number of bytes written.
+        """
+
+        with self._lock:
+
+            try:
+                write_size = self._write(data)
+            finally:
+                self._cond.notify()
+
+            return write_size
+
+    def _write(self, data):
+
+        write_size = len(data)
+
+        while self._max_size and self._filled > self._max_size and \
+          (self._size - self._read_ptr) > 0:
+            self._cond.wait()
+            self._cond.notify()
+
+        if self._size < self._filled + write_size:
+            new_size = self._filled + write_size + self._capacity_increase
+            self._resize(new_size)
+
+        if write_size:
+            contig = self._size - self._write_ptr
+            contig_write = min(contig, write_size)
+            # TODO: avoid 0 write
+            # TODO: avoid copy
+            # TODO: test performance of above
+            self._buffer.seek(self._write_ptr)
+            self._buffer.write(data[:contig_write])
+            self._write_ptr += contig_write
+
+            if contig < write_size:
+                self._buffer.seek(0)
+                self._buffer.write(data[contig_write:write_size])
+                #self._buffer.write(buffer(data, contig_write, write_size - contig_write))
+                self._write_ptr = write_size - contig_write
+
+        self._filled += write_size
+
+        return write_size
+
+    def close_writer(self):
+        with self._lock:
+            self._writer_closed = True
+            self._cond.notify()
+
+    def close_reader(self):
+        with self._lock:
+            self._reader_closed = True
+            self._cond.notify()
+
+    def close(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def empty(self):
+        with self._lock:
+            return self._filled == 0
+
+    def full(self):
+        with self._lock:
+            return self._filled == self._size
+
+    def capacity(self):
+        with self._lock:
+            return self._size
+
+    def __len__(self):
+        with self._lock:
+            return self._filled
+
+    def __nonzero__(self):
+        with self._lock:
+            return self._filled > 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    #def resize(self, new_size):
+    #    with self._lock:
+    #        return self._resize(new_size)
+
+    def _resize(self, new_size):
+        """
+        Resize FIFO to contain ``new_size`` bytes. If FIFO currently has
+        more than ``new_size`` bytes filled, :exc:`ValueError` is raised.
+        If ``new_size`` is less than 1, :exc:`ValueError` is raised.
+        If ``new_size`` is smaller than the current size, the internal
+        buffer is not contracted (yet).
+        """
+
+        if new_size < 1:
+            raise ValueError("Cannot resize to zero or less bytes.")
+
+        if new_size < self._filled:
+            raise ValueError("Cannot contract FIFO to less than {} bytes, "
+                             "or data will be lost.".format(self._filled))
+        # original data is non-contiguous. we need to copy old data,
+        # re-write to the beginning of the buffer, and re-sync
+        # the read and write pointers.
+        if self._read_ptr >= self._write_ptr:
+            old_data = self._read(self._filled, False)
+            self._buffer.seek(0)
+            self._buffer.write(old_data)
+            self._filled = len(old_data)
+            self._read_ptr = 0
+            self._write_ptr = self._filled
+        self._size = new_size
+
+class SocketWriteFileReference(object):
+    """
+    The original SocketWriteFile, which sends each chunk with three calls
+    """
+    def __init__(self, sock, chunked):
+        super(SocketWriteFileReference, self).__init__()
+
+        self.sock = sock
+        self.chunked = chunked
+        self.closed = False
+
+        self.bytes_written = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def read(self, n=None):
+        raise NotImplementedError()
+
+    def write(self, data):
+        if self.closed:
+            return
+
+        if self.chunked:
+            self.sock.sendall(b"%X\r\n" % len(data))
+            self.sock.sendall(data)
+            self.sock.sendall(b"\r\n")
+        else:
+            self.sock.sendall(data)
+
+        n = len(data)
+        self.bytes_written += n
+        return n
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+
+        if self.chunked:
+            self.sock.sendall(b"0\r\n\r\n")
+        self.closed = True
+
+def timed(func, *args, repeat=3):
+    """ return the best run time, in seconds, of calling func(*args) """
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        t1 = time.perf_counter()
+        if best is None or (t1 - t0) < best:
+            best = t1 - t0
+    return best
+
+def report(headers, rows):
+    widths = [max(len(str(x)) for x in col) for col in zip(headers, *rows)]
+    fmt = "  ".join("%%%ds" % w for w in widths)
+    print(fmt % tuple(headers))
+    for row in rows:
+        print(fmt % tuple(row))
+
+class SearchBenchmark(object):
+    """
+    compare Rule.check with compile_rule, in rows per second
+
+    uses the song fixtures and rules from dao/search_test.py
+    """
+
+    def songs(self, count):
+        return [{Song.id: str(i),
+                 Song.artist: "art%d" % i,
+                 Song.album: "alb%d" % i,
+                 Song.title: "ttl%d" % i,
+                 Song.path: "/path/%d" % i,
+                 Song.play_count: i % 4000,
+                 Song.year: i % 21 + 1990} for i in range(count)]
+
+    def rules(self):
+        rng1 = RangeSearchRule(column('play_count'), 1995, 2005, type_=int)
+        rng2 = NotRangeSearchRule(column('play_count'), 1995, 2005, type_=int)
+        gt1 = GreaterThanEqualSearchRule(column('play_count'), 1995, type_=int)
+        lt1 = LessThanEqualSearchRule(column('play_count'), 2005, type_=int)
+        lt2 = LessThanSearchRule(column('play_count'), 1995, type_=int)
+        gt2 = GreaterThanSearchRule(column('play_count'), 2005, type_=int)
+        pl1 = PartialStringSearchRule(column('artist'), 'art1')
+        pl2 = InvertedPartialStringSearchRule(column('artist'), 'art1')
+        rex1 = RegExpSearchRule(column('artist'), "^art1.*$")
+
+        return [
+            ("partial", pl1),
+            ("inverted partial", pl2),
+            ("exact", ExactSearchRule(column('artist'), 'art1')),
+            ("exact int", ExactSearchRule(column('play_count'), 2000, type_=int)),
+            ("not exact", InvertedExactSearchRule(column('artist'), 'art1')),
+            ("range", rng1),
+            ("not range", rng2),
+            ("and", AndSearchRule([gt1, lt1])),
+            ("or", OrSearchRule([lt2, gt2])),
+            ("not", NotSearchRule([rng1, ])),
+            ("regexp", rex1),
+            ("nested", AndSearchRule([OrSearchRule([pl1, rex1]),
+                NotSearchRule([rng1]), lt1])),
+        ]
+
+    def run(self, count):
+
+        songs = self.songs(count)
+
+        def check(rule):
+            return [s for s in songs if rule.check(s)]
+
+        def compiled(rule):
+            f = compile_rule(rule)
+            return [s for s in songs if f(s)]
+
+        rows = []
+        for name, rule in self.rules():
+            assert check(rule) == compiled(rule)
+            t1 = timed(check, rule)
+            t2 = timed(compiled, rule)
+            rows.append((name,
+                "%.0f" % (count / t1),
+                "%.0f" % (count / t2),
+                "%.2fx" % (t1 / t2)))
+
+        print("search: %d rows" % count)
+        report(("rule", "check rows/s", "compiled rows/s", "speedup"), rows)
+
+class ShuffleBenchmark(object):
+    """
+    compare the original binshuffle with the vectorized binshuffle
+
+    runs at 1k, 100k and 1M elements, up to the requested count
+    """
+
+    def run(self, count):
+
+        sizes = [n for n in (1000, 100000, 1000000) if n <= count] or [count]
+
+        rows = []
+        for n in sizes:
+            # roughly 12 songs per artist
+            data = [(i, "art%d" % (i % max(1, n // 12))) for i in range(n)]
+
+            def group(x):
+                return x[1]
+
+            t1 = timed(binshuffle_reference, list(data), group)
+            t2 = timed(binshuffle, list(data), group)
+            rows.append((n,
+                "%.3f" % t1,
+                "%.3f" % t2,
+                "%.2fx" % (t1 / t2)))
+
+        print("shuffle:")
+        report(("elements", "reference (s)", "vectorized (s)", "speedup"), rows)
+
+class FifoBenchmark(object):
+    """
+    compare the producer/consumer throughput of BytesFIFOReference and BytesFIFO
+
+    streams count kilobytes through each fifo, for several chunk sizes
+    """
+
+    def transfer(self, fifo, total, chunk_size, readinto=False):
+
+        chunk = b"0" * chunk_size
+
+        def produce():
+            with BytesFIFOWriter(fifo) as writer:
+                for i in range(total // chunk_size):
+                    writer.write(chunk)
+
+        thread = Thread(target=produce)
+        thread.start()
+
+        count = 0
+        with BytesFIFOReader(fifo) as reader:
+            if readinto:
+                buf = bytearray(chunk_size)
+                n = reader.readinto(buf)
+                while n:
+                    count += n
+                    n = reader.readinto(buf)
+            else:
+                buf = reader.read(chunk_size)
+                while buf:
+                    count += len(buf)
+                    buf = reader.read(chunk_size)
+
+        thread.join()
+        assert count == (total // chunk_size) * chunk_size
+
+    def run(self, count):
+
+        total = count * 1024
+        mb = total / 1024 / 1024
+
+        rows = []
+        for chunk_size in (4096, 64 * 1024, 256 * 1024):
+
+            t1 = timed(lambda: self.transfer(
+                BytesFIFOReference(), total, chunk_size))
+            t2 = timed(lambda: self.transfer(
+                BytesFIFO(), total, chunk_size))
+            t3 = timed(lambda: self.transfer(
+                BytesFIFO(), total, chunk_size, True))
+            rows.append((chunk_size,
+                "%.1f" % (mb / t1),
+                "%.1f" % (mb / t2),
+                "%.1f" % (mb / t3),
+                "%.2fx" % (t1 / t3)))
+
+        print("fifo: %.1f MB" % mb)
+        report(("chunk size", "reference MB/s", "read MB/s",
+            "readinto MB/s", "speedup"), rows)
+
+class HeadersBenchmark(object):
+    """
+    compare Protocol.parse_headers reading from SocketFile and SocketReader,
+    in requests per second
+
+    count pipelined requests are sent over a local socket pair
+    """
+
+    REQUEST = (b"GET /api/fs/default/path/music/folder/song.mp3?dl=0 HTTP/1.1\r\n"
+        b"Host: localhost:4200\r\n"
+        b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:68.0) Firefox/68.0\r\n"
+        b"Accept: */*\r\n"
+        b"Accept-Language: en-US,en;q=0.5\r\n"
+        b"Accept-Encoding: gzip, deflate\r\n"
+        b"Authorization: Basic YWRtaW46YWRtaW4=\r\n"
+        b"Connection: keep-alive\r\n"
+        b"\r\n")
+
+    def parse(self, factory, count):
+
+        a, b = socket.socketpair()
+
+        def produce():
+            a.sendall(self.REQUEST * count)
+
+        thread = Thread(target=produce)
+        thread.start()
+
+        protocol = Protocol()
+        request = Namespace(rfile=factory(b))
+        try:
+            for i in range(count):
+                request.headers = CaseInsensitiveDict()
+                protocol.parse_headers(request)
+                assert request.headers[b'Connection'] == b'keep-alive'
+        finally:
+            thread.join()
+            a.close()
+            b.close()
+
+    def run(self, count):
+
+        t1 = timed(self.parse, SocketFile, count)
+        t2 = timed(self.parse, SocketReader, count)
+
+        print("headers: %d requests, %d bytes each" % (count, len(self.REQUEST)))
+        report(("reference req/s", "buffered req/s", "speedup"),
+            [("%.0f" % (count / t1), "%.0f" % (count / t2), "%.2fx" % (t1 / t2))])
+
+class CountingSocket(object):
+    """ a socket which counts the calls made to send a response
+
+    a TLS socket does not support sendmsg, and each call to sendall
+    produces at least one record of at most 16k
+    """
+    def __init__(self, tls):
+        super(CountingSocket, self).__init__()
+        self.calls = 0
+        self.records = 0
+        if not tls:
+            self.sendmsg = self._sendmsg
+
+    def sendall(self, data):
+        self.calls += 1
+        self.records += max(1, (len(data) + 16383) // 16384)
+
+    def _sendmsg(self, buffers):
+        self.calls += 1
+        return sum(len(b) for b in buffers)
+
+class ResponseBenchmark(object):
+    """
+    compare the number of send calls and TLS records per response for
+    the original and coalesced Protocol.send_response
+
+    the streamed body is count kilobytes, sent in 64k and 4k chunks
+    """
+
+    def send_reference(self, request, response):
+        """ the original send_response, one call per header line """
+
+        wsock = request.request
+        chunked = 'Transfer-Encoding' in response.headers
+
+        status_str = responses[response.status].encode("utf-8")
+        wsock.sendall(b"%s %d %s\r\n" % (request.transport_protocol,
+            response.status, status_str))
+        for hdr, val in response.headers.items():
+            wsock.sendall(b"%s: %s\r\n" % (hdr.encode("utf-8"), str(val).encode("utf-8")))
+        wsock.sendall(b"\r\n")
+
+        wfile = SocketWriteFileReference(wsock, chunked)
+        copy_payload(response.payload, wfile)
+        wfile.close()
+
+    def cases(self, count):
+
+        song = {"id": "0" * 36, "artist": "artist", "album": "album",
+            "title": "title", "year": 2000, "play_count": 10}
+
+        def stream(chunk_size):
+            chunk = b"0" * chunk_size
+            for i in range(count * 1024 // chunk_size):
+                yield chunk
+
+        return [
+            ("small json", lambda: Response(200, {}, {"result": [song]})),
+            ("stream 64k", lambda: Response(200,
+                {'Transfer-Encoding': 'chunked'}, stream(64 * 1024))),
+            ("stream 4k", lambda: Response(200,
+                {'Transfer-Encoding': 'chunked'}, stream(4 * 1024))),
+        ]
+
+    def run(self, count):
+
+        protocol = Protocol()
+
+        rows = []
+        for name, factory in self.cases(count):
+            for tls in (False, True):
+                result = []
+                for send in (self.send_reference, protocol.send_response):
+                    sock = CountingSocket(tls)
+                    request = Namespace(request=sock, t0=time.perf_counter(),
+                        transport_protocol=b"HTTP/1.1", method=b"GET",
+                        path_safe="/", client_address=("localhost", 0))
+                    send(request, factory())
+                    result.append(sock)
+                ref, new = result
+                rows.append((name, "tls" if tls else "tcp",
+                    ref.calls, new.calls,
+                    ref.records if tls else "-",
+                    new.records if tls else "-"))
+
+        print("response: %d KB streamed" % count)
+        report(("body", "socket", "reference calls", "calls",
+            "reference records", "records"), rows)
+
+def main():
+    """run benchmarks"""
+
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--count', type=int, default=100000,
+                        help='number of elements to use')
+
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+    subparsers.add_parser('search', help=SearchBenchmark.__doc__)
+    subparsers.add_parser('shuffle', help=ShuffleBenchmark.__doc__)
+    subparsers.add_parser('fifo', help=FifoBenchmark.__doc__)
+    subparsers.add_parser('headers', help=HeadersBenchmark.__doc__)
+    subparsers.add_parser('response', help=ResponseBenchmark.__doc__)
+
+    args = parser.parse_args()
+
+    benchmarks = {
+        "search": SearchBenchmark,
+        "shuffle": ShuffleBenchmark,
+        "fifo": FifoBenchmark,
+        "headers": HeadersBenchmark,
+        "response": ResponseBenchmark,
+    }
+
+    benchmarks[args.benchmark]().run(args.count)
+
+if __name__ == '__main__':
+    main()
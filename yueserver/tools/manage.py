@@ -24,9 +24,10 @@ from ..dao.db import db_remove, db_connect, db_init, \
     connection_string
 from ..dao.user import UserDao
 from ..dao.storage import StorageDao
-from ..dao.migrate import migrate_main
+from ..dao.migrate import migrate_main, explain_queries
 from ..dao.filesys.filesys import FileSystem
 from ..dao.filesys.s3fs import BotoFileSystemImpl
+from ..dao.filesys.transfer import copyfileobj
 from ..dao.settings import SettingsDao, Settings
 #from ..app import YueApp, generate_client
 from ..config import Config
@@ -96,6 +97,25 @@ def migrate(args):
     migrate_main(db)
     # db_update(db, db.tables, args.env_cfg_path)
 
+def explain(args):
+    """report common queries which scan an entire table"""
+
+    db = db_connect(args.database_url)
+
+    count = 0
+    for name, plan, scans in explain_queries(db):
+        status = "FULL SCAN" if scans else "ok"
+        print("%s: %s" % (name, status))
+        for line in plan:
+            print("    %s" % line)
+        if scans:
+            count += 1
+
+    if count:
+        sys.stderr.write("%d queries scan an entire table. "
+            "run migrate to create missing indexes\n" % count)
+        sys.exit(1)
+
 def routes(args):
     """List application endpoints"""
 
@@ -194,7 +214,10 @@ def filesystem_list(args):
             cfg.aws.endpoint,
             cfg.aws.region,
             cfg.aws.access_key,
-            cfg.aws.secret_key)
+            cfg.aws.secret_key,
+            part_size=cfg.aws.part_size,
+            multipart_threshold=cfg.aws.multipart_threshold,
+            max_concurrency=cfg.aws.max_concurrency)
         FileSystem.register(BotoFileSystemImpl.scheme, s3fs)
 
     fs = FileSystem()
@@ -221,7 +244,10 @@ def filesystem_copy(args):
             cfg.aws.endpoint,
             cfg.aws.region,
             cfg.aws.access_key,
-            cfg.aws.secret_key)
+            cfg.aws.secret_key,
+            part_size=cfg.aws.part_size,
+            multipart_threshold=cfg.aws.multipart_threshold,
+            max_concurrency=cfg.aws.max_concurrency)
         FileSystem.register(BotoFileSystemImpl.scheme, s3fs)
 
     fs = FileSystem()
@@ -243,8 +269,7 @@ def filesystem_copy(args):
         print(dst)
         with fs.open(src, "rb") as rb:
             with fs.open(dst, "wb") as wb:
-                for chunk in iter(lambda: rb.read(2048), b""):
-                    wb.write(chunk)
+                copyfileobj(rb, wb)
 
 def filesystem_remove(args):
 
@@ -255,7 +280,10 @@ def filesystem_remove(args):
             cfg.aws.endpoint,
             cfg.aws.region,
             cfg.aws.access_key,
-            cfg.aws.secret_key)
+            cfg.aws.secret_key,
+            part_size=cfg.aws.part_size,
+            multipart_threshold=cfg.aws.multipart_threshold,
+            max_concurrency=cfg.aws.max_concurrency)
         FileSystem.register(BotoFileSystemImpl.scheme, s3fs)
 
     fs = FileSystem()
@@ -480,9 +508,16 @@ def main():
     # MIGRATE - migrate a database
 
     parser_migrate = subparsers.add_parser('migrate',
-        help='migrate a database')
+        help='migrate a database and create missing indexes')
     parser_migrate.set_defaults(func=migrate)
 
+    ###########################################################################
+    # EXPLAIN - check that common queries use an index
+
+    parser_explain = subparsers.add_parser('explain',
+        help='report common queries which scan an entire table')
+    parser_explain.set_defaults(func=explain)
+
     ###########################################################################
     # ROUTES - list known endpoints of the rest service
 
@@ -8,6 +8,7 @@ import logging
 
 from ..dao.db import main_test
 from ..dao.filesys.filesys import FileSystem, MemoryFileSystemImpl
+from ..dao.storage_usage import UsageLedger
 
 from ..app import TestApp
 from ..framework.client import FlaskAppClient
@@ -72,6 +73,9 @@ class SyncTestCaseX(object):
         self.client = FlaskAppClient(self.rest_client, self.app._registered_endpoints)
 
         self.app.db.delete(self.app.db.tables.FileSystemStorageTable)
+        self.app.db.delete(self.app.db.tables.FileSystemDirectoryTable)
+        self.app.db.delete(self.app.db.tables.FileSystemUserUsageTable)
+        UsageLedger.instance(self.app.db, self.app.db.tables).clear()
 
         MemoryFileSystemImpl.clear()
 
@@ -306,6 +310,9 @@ class SyncCLITestCaseX(object):
                 os.remove(path)
 
         self.app.db.delete(self.app.db.tables.FileSystemStorageTable)
+        self.app.db.delete(self.app.db.tables.FileSystemDirectoryTable)
+        self.app.db.delete(self.app.db.tables.FileSystemUserUsageTable)
+        UsageLedger.instance(self.app.db, self.app.db.tables).clear()
         MemoryFileSystemImpl.clear()
 
     def tearDown(self):